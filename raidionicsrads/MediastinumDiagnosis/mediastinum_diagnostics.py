@@ -8,6 +8,8 @@ from ..Processing.mediastinum_processing import *
 from .mediastinum_parameters import MediastinumDiagnosisParameters
 from ..Utils.ants_registration import *
 from ..Utils.configuration_parser import ResourcesConfiguration
+from ..Utils.volume_cache import load_cached_volume
+from ..Utils.io import load_mask, load_intensities, mask_array, save_mask
 from ..Utils.segmentation_parser import collect_segmentation_model_parameters, update_segmentation_runtime_parameters
 
 
@@ -114,14 +116,11 @@ class MediastinumDiagnostics:
             predictions_file = os.path.join(os.path.dirname(output_predictions_prefix), pred_name)
             thr = class_thresholds[c]
 
-            pred_ni = load_nifti_volume(predictions_file)
-            pred = pred_ni.get_fdata()[:]
+            pred_ni, pred = load_intensities(predictions_file)
 
-            final_mask = np.zeros(pred.shape)
-            final_mask[pred >= thr] = 1
-            final_mask = final_mask.astype('uint8')
+            final_mask = (pred >= thr).astype('uint8')
             final_mask_filename = os.path.join(self.output_path, 'input_' + os.path.basename(predictions_file).split('.')[0].split('_')[-1] + '_mask.nii.gz')
-            nib.save(nib.Nifti1Image(final_mask, affine=pred_ni.affine), final_mask_filename)
+            save_mask(final_mask, pred_ni.affine, final_mask_filename)
             generated_masks.append(final_mask_filename)
 
         self.processed_class_names.extend(class_names[1:])
@@ -131,8 +130,7 @@ class MediastinumDiagnostics:
         self.__compute_lymphnodes_statistics()
 
     def __compute_lateralisation(self, volume):
-        brain_lateralisation_mask_ni = load_nifti_volume(ResourcesConfiguration.getInstance().neuro_mni_atlas_lateralisation_mask_filepath)
-        brain_lateralisation_mask = brain_lateralisation_mask_ni.get_fdata()[:]
+        brain_lateralisation_mask_ni, brain_lateralisation_mask = load_mask(ResourcesConfiguration.getInstance().neuro_mni_atlas_lateralisation_mask_filepath)
         pfile = open(self.output_report_filepath, 'a')
 
         # Computing the lateralisation for the center of mass
@@ -178,8 +176,8 @@ class MediastinumDiagnostics:
         lobe_inclusion_min_lim = 0.05
         pfile = open(self.output_report_filepath, 'a')
 
-        lobes_maks_ni = nib.load(ResourcesConfiguration.getInstance().neuro_mni_atlas_lobes_mask_filepath)
-        lobes_mask = lobes_maks_ni.get_fdata()
+        lobes_maks_ni = load_cached_volume(ResourcesConfiguration.getInstance().neuro_mni_atlas_lobes_mask_filepath)
+        lobes_mask = mask_array(lobes_maks_ni)
         lobes_description = pd.read_csv(ResourcesConfiguration.getInstance().neuro_mni_atlas_lobes_description_filepath)
 
         # Computing the lobe location for the center of mass
@@ -236,9 +234,8 @@ class MediastinumDiagnostics:
         pfile.close()
 
     def __compute_lymphnodes_statistics(self):
-        lymphnodes_ni = load_nifti_volume(self.lymphnodes_mask_filepath)
+        lymphnodes_ni, lymphnodes = load_mask(self.lymphnodes_mask_filepath)
         spacings = lymphnodes_ni.header.get_zooms()
-        lymphnodes = lymphnodes_ni.get_fdata()[:]
 
         cc_labels = measurements.label(lymphnodes)[0]
         candidates = measurements.find_objects(cc_labels)
@@ -268,8 +265,7 @@ class MediastinumDiagnostics:
         output_filename = os.path.join(self.output_path, 'mediastinum_diagnosis_lymphnodes_report.csv')
         candidates_metrics_df.to_csv(output_filename)
 
-        cc_labels_ni = nib.Nifti1Image(cc_labels, affine=lymphnodes_ni.affine)
-        nib.save(cc_labels_ni, self.lymphnodes_mask_filepath)
+        save_mask(cc_labels, lymphnodes_ni.affine, self.lymphnodes_mask_filepath)
         self.lymph_nodes_metrics = candidates_metrics_df
 
     def __generate_final_report(self):
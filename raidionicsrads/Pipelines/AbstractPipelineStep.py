@@ -1,5 +1,8 @@
 import json
 from abc import ABC, abstractmethod
+from typing import Tuple
+from ..Utils.run_context import RunContext
+from ..Utils.memory_budget import get_volume_voxels, estimate_peak_memory
 
 
 class AbstractPipelineStep(ABC):
@@ -7,10 +10,13 @@ class AbstractPipelineStep(ABC):
     _step_description = None
     _skip = False
     _inclusion = "required"
+    _cancellation_token = None  # CancellationToken to check regularly during long-running processes
+    _context = None  # RunContext carrying the configuration of the run
 
-    def __init__(self, step_json: dict) -> None:
+    def __init__(self, step_json: dict, context: RunContext = None) -> None:
         self.__reset()
         self._step_json = step_json
+        self._context = RunContext.resolve(context)
         self._step_description = step_json["description"]
         self._inclusion = step_json["inclusion"] if "inclusion" in step_json.keys() else "required"
 
@@ -22,6 +28,12 @@ class AbstractPipelineStep(ABC):
         self._step_json = {}
         self._step_description = None
         self._skip = False
+        self._cancellation_token = None
+        self._context = None
+
+    @property
+    def context(self) -> RunContext:
+        return self._context
 
     @property
     def step_json(self) -> dict:
@@ -52,6 +64,14 @@ class AbstractPipelineStep(ABC):
         if value in ["required", "optional"]:
             self._inclusion = value
 
+    @property
+    def cancellation_token(self):
+        return self._cancellation_token
+
+    @cancellation_token.setter
+    def cancellation_token(self, token) -> None:
+        self._cancellation_token = token
+
     @abstractmethod
     def setup(self, patient_parameters):
         pass
@@ -66,5 +86,80 @@ class AbstractPipelineStep(ABC):
 
     def get_task(self) -> str:
         return self._step_json["task"] if "task" in self._step_json.keys() else None
-    # @TODO. Should there be a step assess method, before executing the pipeline, ensuring all inputs are available
-    # for all steps.
+
+    def get_timeout(self):
+        """
+        Maximum runtime allowed for the step in seconds, or None if unbounded. A timeout value specified inside the
+        step json takes precedence over the value specified for the task type in the main configuration file.
+        """
+        if "timeout" in self._step_json.keys() and self._step_json["timeout"] is not None:
+            timeout = float(self._step_json["timeout"])
+            return timeout if timeout > 0 else None
+        return self._context.config.get_step_timeout(self.get_task())
+
+    def get_input_voxels(self, patient_parameters) -> int:
+        """
+        Total number of voxels of the radiological volumes used by the step, read from the image headers. If the step
+        json does not point to specific volumes, the largest volume of the patient is considered.
+        """
+        entries = list(self._step_json["inputs"].values()) if "inputs" in self._step_json.keys() else []
+        entries.extend([self._step_json[k] for k in ["moving", "fixed"] if k in self._step_json.keys()])
+        voxels = 0
+        for entry in entries:
+            filepath = None
+            if str(entry["timestamp"]) == "-1" or str(entry["sequence"]) == "MNI":
+                filepath = self._context.config.mni_atlas_filepath_T1
+            else:
+                volume_uid = patient_parameters.get_radiological_volume_uid(timestamp=entry["timestamp"],
+                                                                            sequence=entry["sequence"])
+                if volume_uid != "-1":
+                    filepath = patient_parameters.get_radiological_volume(volume_uid=volume_uid).usable_input_filepath
+            if filepath is not None:
+                voxels = voxels + get_volume_voxels(filepath)
+        if len(entries) == 0:
+            for volume_uid in patient_parameters.get_all_radiological_volume_uids():
+                voxels = max(voxels, get_volume_voxels(
+                    patient_parameters.get_radiological_volume(volume_uid=volume_uid).usable_input_filepath))
+        return voxels
+
+    def estimate_memory(self, patient_parameters) -> int:
+        """
+        Estimated peak memory of the step, in bytes, from the declared (or learned) profile of its task type and the
+        size of its inputs. To override for steps with a specific memory footprint.
+        """
+        return estimate_peak_memory(self.get_task(), self.get_input_voxels(patient_parameters))
+
+    def check_cancellation(self) -> None:
+        """
+        Interrupts the step, by raising, if the processing was cancelled or the step ran out of time.
+        """
+        if self._cancellation_token is not None:
+            self._cancellation_token.check()
+
+    def run_blocking(self, function, *args, **kwargs):
+        """
+        Runs a blocking call which cannot check the cancellation by itself (e.g., a model inference), inside a child
+        process stopped as soon as the step is cancelled or runs out of time (see CancellationToken.run_process).
+        """
+        if self._cancellation_token is None:
+            return function(*args, **kwargs)
+        return self._cancellation_token.run_process(function, *args, **kwargs)
+
+    def assess(self, planner) -> Tuple[str, str]:
+        """
+        Pre-flight assessment, before executing the pipeline, that all inputs are or will be available for the step.
+        No heavy processing should happen here. The outputs the step will produce must be declared to the planner,
+        for the assessment of the following steps.
+
+        Parameters
+        ----------
+        planner: PipelinePlanner
+            Tracks what is available for the patient, from disk and from the previous steps.
+        Returns
+        -------
+        str, str
+            Expected outcome of the step, from [ready, skip, fail], and the reason behind it.
+        """
+        if self.skip:
+            return "skip", "Step flagged to be skipped."
+        return "ready", ""
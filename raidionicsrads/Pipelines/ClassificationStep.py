@@ -6,8 +6,8 @@ import pandas as pd
 import logging
 import configparser
 import traceback
-from ..Utils.configuration_parser import ResourcesConfiguration
-from ..Utils.io import load_nifti_volume
+from ..Utils.run_context import RunContext
+from ..Utils.io import load_nifti_volume, stage_file
 from .AbstractPipelineStep import AbstractPipelineStep
 
 
@@ -22,8 +22,8 @@ class ClassificationStep(AbstractPipelineStep):
     _input_volume_uid = None
     _input_volume_filepath = None
 
-    def __init__(self, step_json: dict):
-        super(ClassificationStep, self).__init__(step_json=step_json)
+    def __init__(self, step_json: dict, context: RunContext = None):
+        super(ClassificationStep, self).__init__(step_json=step_json, context=context)
         self.__reset()
         self._model_name = self._step_json["model"]
 
@@ -48,7 +48,7 @@ class ClassificationStep(AbstractPipelineStep):
         if self.skip:
             return
 
-        self.working_folder = os.path.join(ResourcesConfiguration.getInstance().output_folder, "classification_tmp")
+        self.working_folder = os.path.join(self._context.config.output_folder, "classification_tmp")
         os.makedirs(self.working_folder, exist_ok=True)
         os.makedirs(os.path.join(self.working_folder, 'inputs'), exist_ok=True)
         os.makedirs(os.path.join(self.working_folder, 'outputs'), exist_ok=True)
@@ -60,11 +60,17 @@ class ClassificationStep(AbstractPipelineStep):
                 return self._patient_parameters
 
             if len(self._step_json["inputs"].keys()) == 0:
-                for volume_uid in self._patient_parameters.get_all_radiological_volume_uids():
+                volume_uids = self._patient_parameters.get_all_radiological_volume_uids()
+                batched = self._step_json["batched"] if "batched" in self._step_json.keys() else True
+                if batched and len(volume_uids) > 1:
+                    self.__perform_batched_classification(volume_uids=volume_uids)
+                    volume_uids = []
+                for volume_uid in volume_uids:
+                    self.check_cancellation()
                     self._input_volume_uid = volume_uid
                     self._input_volume_filepath = self._patient_parameters.get_radiological_volume(volume_uid=volume_uid).usable_input_filepath
                     new_fp = os.path.join(self.working_folder, 'inputs', 'input0.nii.gz')
-                    shutil.copyfile(self._input_volume_filepath, new_fp)
+                    stage_file(self._input_volume_filepath, new_fp)
                     self.__perform_classification()
             elif len(self._step_json["inputs"].keys()) == 1:
                 # Brain tumor type classification use-case
@@ -72,7 +78,7 @@ class ClassificationStep(AbstractPipelineStep):
 
                 if ((input_json["space"]["timestamp"] == input_json["timestamp"] and
                      input_json["space"]["sequence"] == input_json["sequence"]) or
-                        ResourcesConfiguration.getInstance().predictions_use_registered_data):
+                        self._context.config.predictions_use_registered_data):
                     volume_uid = self._patient_parameters.get_radiological_volume_uid(timestamp=input_json["timestamp"],
                                                                                       sequence=input_json["sequence"])
                     if volume_uid == "-1":
@@ -80,7 +86,7 @@ class ClassificationStep(AbstractPipelineStep):
                     self._input_volume_uid = volume_uid
                     self._input_volume_filepath = self._patient_parameters.get_radiological_volume(volume_uid=volume_uid).usable_input_filepath
                     new_fp = os.path.join(self.working_folder, 'inputs', 'input0.nii.gz')
-                    shutil.copyfile(self._input_volume_filepath, new_fp)
+                    stage_file(self._input_volume_filepath, new_fp)
                     self.__perform_classification()
             else:  # Not a use-case for the moment.
                 pass
@@ -105,24 +111,11 @@ class ClassificationStep(AbstractPipelineStep):
         @TODO. Should hold the sequence class for each input, and dump a report/summary for Raidionics/the user.
         """
         try:
-            tmp_dir = os.path.join(ResourcesConfiguration.getInstance().output_folder, "classification_tmp")
+            tmp_dir = os.path.join(self._context.config.output_folder, "classification_tmp")
             os.makedirs(tmp_dir, exist_ok=True)
-            classification_config = configparser.ConfigParser()
-            classification_config.add_section('System')
-            classification_config.set('System', 'gpu_id', ResourcesConfiguration.getInstance().gpu_id)
-            classification_config.set('System', 'inputs_folder', os.path.join(self.working_folder, 'inputs'))
-            classification_config.set('System', 'output_folder', os.path.join(self.working_folder, 'outputs'))
-            classification_config.set('System', 'model_folder',
-                                      os.path.join(ResourcesConfiguration.getInstance().model_folder, self._model_name))
-            classification_config.add_section('Runtime')
-            classification_config.set('Runtime', 'reconstruction_method', 'probabilities')
-            classification_config.set('Runtime', 'reconstruction_order', 'resample_first')
-            classification_config.add_section('Neuro')
-            classification_config.set('Neuro', 'brain_segmentation_filename', '')
-            classification_config_filename = os.path.join(os.path.join(self.working_folder, 'inputs'),
-                                                          'classification_config.ini')
-            with open(classification_config_filename, 'w') as outfile:
-                classification_config.write(outfile)
+            classification_config_filename = self.__write_classification_config(
+                inputs_folder=os.path.join(self.working_folder, 'inputs'),
+                output_folder=os.path.join(self.working_folder, 'outputs'))
 
             log_level = logging.getLogger().level
             log_str = 'warning'
@@ -134,20 +127,71 @@ class ClassificationStep(AbstractPipelineStep):
                 log_str = 'error'
 
             from raidionicsseg.fit import run_model
-            run_model(classification_config_filename)
+            self.run_blocking(run_model, classification_config_filename)
         except Exception as e:
             raise ValueError(f"[ClassificationStep] Automatic classification failed with: {e}.")
 
+        self.__parse_classification_results(
+            results_filename=os.path.join(os.path.join(self.working_folder, 'outputs'), 'classification-results.csv'),
+            volume_uid=self._input_volume_uid)
+
+    def __perform_batched_classification(self, volume_uids: list) -> None:
+        """
+        Classifies all the given radiological volumes within a single call, instead of going through the whole
+        classification (i.e., child process start and raidionicsseg import when the step runtime is bounded) anew for
+        each volume. Each volume is staged inside its own sub-folder, with its own configuration file, and classified
+        through the public raidionicsseg entry point.
+        @TODO. The model itself is still loaded for each volume, until raidionicsseg accepts a preloaded session.
+        """
+        config_filenames = []
+        for i, volume_uid in enumerate(volume_uids):
+            self.check_cancellation()
+            inputs_folder = os.path.join(self.working_folder, 'inputs', str(i))
+            outputs_folder = os.path.join(self.working_folder, 'outputs', str(i))
+            os.makedirs(inputs_folder, exist_ok=True)
+            os.makedirs(outputs_folder, exist_ok=True)
+            stage_file(self._patient_parameters.get_radiological_volume(volume_uid=volume_uid).usable_input_filepath,
+                       os.path.join(inputs_folder, 'input0.nii.gz'))
+            config_filenames.append(self.__write_classification_config(inputs_folder=inputs_folder,
+                                                                       output_folder=outputs_folder))
+
+        try:
+            self.run_blocking(_run_models, config_filenames)
+        except Exception as e:
+            raise ValueError(f"[ClassificationStep] Automatic classification failed with: {e}.")
+
+        for i, volume_uid in enumerate(volume_uids):
+            self.__parse_classification_results(
+                results_filename=os.path.join(self.working_folder, 'outputs', str(i), 'classification-results.csv'),
+                volume_uid=volume_uid)
+
+    def __write_classification_config(self, inputs_folder: str, output_folder: str) -> str:
+        classification_config = configparser.ConfigParser()
+        classification_config.add_section('System')
+        classification_config.set('System', 'gpu_id', self._context.config.gpu_id)
+        classification_config.set('System', 'inputs_folder', inputs_folder)
+        classification_config.set('System', 'output_folder', output_folder)
+        classification_config.set('System', 'model_folder',
+                                  os.path.join(self._context.config.model_folder, self._model_name))
+        classification_config.add_section('Runtime')
+        classification_config.set('Runtime', 'reconstruction_method', 'probabilities')
+        classification_config.set('Runtime', 'reconstruction_order', 'resample_first')
+        classification_config.add_section('Neuro')
+        classification_config.set('Neuro', 'brain_segmentation_filename', '')
+        classification_config_filename = os.path.join(inputs_folder, 'classification_config.ini')
+        with open(classification_config_filename, 'w') as outfile:
+            classification_config.write(outfile)
+        return classification_config_filename
+
+    def __parse_classification_results(self, results_filename: str, volume_uid: str) -> None:
         try:
-            classification_results_filename = os.path.join(os.path.join(self.working_folder, 'outputs'),
-                                                           'classification-results.csv')
-            shutil.copyfile(classification_results_filename,
-                            os.path.join(ResourcesConfiguration.getInstance().output_folder,
+            shutil.copyfile(results_filename,
+                            os.path.join(self._context.config.output_folder,
                                          self._step_json["target"][0] + '_classification_results_raw.csv'))
-            classification_results_df = pd.read_csv(classification_results_filename)
+            classification_results_df = pd.read_csv(results_filename)
             final_class = classification_results_df.values[classification_results_df[classification_results_df.columns[1]].idxmax(), 0]
             if self._step_json["target"][0] == "MRSequence":
-                self._patient_parameters.get_radiological_volume(volume_uid=self._input_volume_uid).set_sequence_type(final_class)
+                self._patient_parameters.get_radiological_volume(volume_uid=volume_uid).set_sequence_type(final_class)
             elif self._step_json["target"][0] == "BrainTumorType":
                 # Can only store the brain tumor type info inside the patient report, later on
                 pass
@@ -168,7 +212,7 @@ class ClassificationStep(AbstractPipelineStep):
         -------
 
         """
-        classification_results_filename = os.path.join(ResourcesConfiguration.getInstance().output_folder,
+        classification_results_filename = os.path.join(self._context.config.output_folder,
                                                        self._step_json["target"][0] + "_classification_results.csv")
         classes = []
         if self._step_json["target"][0] == "MRSequence":
@@ -184,4 +228,13 @@ class ClassificationStep(AbstractPipelineStep):
         else:
             raise ValueError(f"[ClassificationStep] Use-cases other than MRI sequence classification and brain "
                              f" tumor type have not been implemented yet!")
-        logging.info(f"Classification results written to {classification_results_filename}")
\ No newline at end of file
+        logging.info(f"Classification results written to {classification_results_filename}")
+
+
+def _run_models(config_filenames: list) -> None:
+    """
+    Runs the raidionicsseg inference for each configuration file in turn, as a single (possibly child process) call.
+    """
+    from raidionicsseg.fit import run_model
+    for config_filename in config_filenames:
+        run_model(config_filename)
@@ -4,8 +4,10 @@ import traceback
 import logging
 import numpy as np
 import nibabel as nib
+from typing import Tuple
 from .AbstractPipelineStep import AbstractPipelineStep
-from ..Utils.configuration_parser import ResourcesConfiguration
+from ..Utils.run_context import RunContext
+from ..Utils.volume_cache import load_cached_volume
 from ..Utils.ReportingStructures.NeuroReportingStructure import NeuroReportingStructure
 from ..Processing.neuro_report_computing import *
 from ..Utils.DataStructures.AnnotationStructure import AnnotationClassType, BrainTumorType
@@ -22,8 +24,8 @@ class FeaturesComputationStep(AbstractPipelineStep):
     _report = None
     _targets = None
 
-    def __init__(self, step_json: dict) -> None:
-        super(FeaturesComputationStep, self).__init__(step_json=step_json)
+    def __init__(self, step_json: dict, context: RunContext = None) -> None:
+        super(FeaturesComputationStep, self).__init__(step_json=step_json, context=context)
         self.__reset()
         self._report_space = self._step_json["space"]
         self._targets = self._step_json["target"]
@@ -69,16 +71,35 @@ class FeaturesComputationStep(AbstractPipelineStep):
 
         """
         try:
-            if ResourcesConfiguration.getInstance().diagnosis_task == 'neuro_diagnosis':
+            if self._context.config.diagnosis_task == 'neuro_diagnosis':
                 self.__run_neuro_reporting()
             else:
                 logging.warning("[FeaturesComputationStep] No execution implemented yet for the task {}".format(
-                    ResourcesConfiguration.getInstance().diagnosis_task))
+                    self._context.config.diagnosis_task))
                 pass
         except Exception as e:
             raise ValueError("[FeaturesComputationStep] Step execution failed with: {}.".format(e))
         return self._patient_parameters
 
+    def assess(self, planner) -> Tuple[str, str]:
+        """
+        Pre-flight check that the base radiological volume exists for the timestamp, and that the structures to
+        characterize are, or will be, available in the reporting space.
+        """
+        if self.report_space != "MNI":
+            return "fail", "Features computation only implemented for MNI space."
+        base_volume = {"timestamp": self.step_json["timestamp"],
+                       "sequence": str(MRISequenceType.T1c) if self.step_json["tumor_type"] == "contrast-enhancing"
+                       else str(MRISequenceType.FLAIR)}
+        if not planner.has_volume(base_volume):
+            return "fail", "No radiological volume for {}.".format(base_volume)
+        space = {"timestamp": -1, "sequence": "MNI"}
+        missing = [t for t in self.targets if not planner.has_registered_volume(base_volume, space, t)]
+        if len(self.targets) != 0 and len(missing) == len(self.targets):
+            # Nothing to characterize, the report would be empty.
+            return "fail", "No structure available in {} space for: {}.".format(self.report_space, missing)
+        return "ready", ""
+
     def cleanup(self):
         pass
 
@@ -88,14 +109,10 @@ class FeaturesComputationStep(AbstractPipelineStep):
         # The FLAIR image might not be the base image for non-ce either... need to find a smarter way to handle this...
 
         """
-        non_available_uid = True
-        report_uid = None
-        while non_available_uid:
-            report_uid = 'RADS' + str(np.random.randint(0, 10000))
-            if report_uid not in self._patient_parameters.get_all_reportings_uids():
-                non_available_uid = False
+        report_uid = self._patient_parameters.generate_uid('RADS', timestamp_uid="T" + str(self.step_json["timestamp"]),
+                                                           role='report', content_digest=self.step_json["tumor_type"])
         report = NeuroReportingStructure(id=report_uid,
-                                         output_folder=ResourcesConfiguration.getInstance().output_folder,
+                                         output_folder=self._context.config.output_folder,
                                          timestamp=self.step_json["timestamp"])
         base_radiological_volume = self._patient_parameters.get_radiological_volume_for_timestamp_and_sequence(timestamp=self.step_json["timestamp"], sequence=str(MRISequenceType.T1c)) if self.step_json["tumor_type"] == "contrast-enhancing" else self._patient_parameters.get_radiological_volume_for_timestamp_and_sequence(timestamp=self.step_json["timestamp"], sequence=str(MRISequenceType.FLAIR))
         brain_annotation = self._patient_parameters.get_all_annotations_uids_class_radiological_volume(volume_uid=base_radiological_volume[0].unique_id, annotation_class=AnnotationClassType.Brain, return_objects=True)
@@ -107,13 +124,14 @@ class FeaturesComputationStep(AbstractPipelineStep):
                 if self.report_space not in brain_annotation[0].registered_volumes.keys() :
                     raise ValueError(f"The {self.report_space} key was not found for {brain_annotation[0].radiological_volume_uid}")
                 brain_filepath = brain_annotation[0].registered_volumes[self.report_space]["filepath"]
-            brain_nib = nib.load(brain_filepath)
+            brain_nib = load_cached_volume(brain_filepath)
 
         for t in self.targets:
+            self.check_cancellation()
             # Filling in the tumor type (@TODO. not ideal here, but the report is not yet created at the time the
             # classification is performed... Should be made cleaner in the future.
             if t == "Tumor":
-                tumortype_classif_results_fn = os.path.join(ResourcesConfiguration.getInstance().output_folder,
+                tumortype_classif_results_fn = os.path.join(self._context.config.output_folder,
                                                             "BrainTumorType_classification_results_raw.csv")
                 if os.path.exists(tumortype_classif_results_fn):
                     tumortype_classif_results_df = pd.read_csv(tumortype_classif_results_fn)
@@ -137,7 +155,7 @@ class FeaturesComputationStep(AbstractPipelineStep):
                 if annotation_filepath is None:
                     logging.error("No structure filepath found on disk.")
                 else:
-                    structure_nib = nib.load(annotation_filepath)
+                    structure_nib = load_cached_volume(annotation_filepath)
             else:
                 # @TODO. Have to manually assemble the combined structure
                 pass
@@ -146,15 +164,16 @@ class FeaturesComputationStep(AbstractPipelineStep):
                 logging.error(f"No segmentation file found nor assembled for structure: {t}")
                 continue
             else:
-                res = compute_structure_statistics(input_mask=structure_nib, brain_mask=brain_nib)
+                res = compute_structure_statistics(input_mask=structure_nib, brain_mask=brain_nib,
+                                                   context=self._context)
                 report.include_statistics(structure=t, statistics=res, space=self.report_space)
                 if self.report_space != 'Patient':
                     # Including the tumor volume in original patient space, quick fix for now as the only
                     # supported report_space is MNI
                     pat_space_result = NeuroStructureStatistics()
-                    patient_anno = nib.load(annotation_filepath).get_fdata()[:]
-                    volume = np.count_nonzero(patient_anno) * np.prod(
-                        nib.load(annotation_filepath).header.get_zooms()[0:3]) * 1e-3
+                    patient_anno_nib = load_cached_volume(annotation_filepath)
+                    volume = np.count_nonzero(patient_anno_nib.dataobj) * np.prod(
+                        patient_anno_nib.header.get_zooms()[0:3]) * 1e-3
                     pat_space_result.volume = NeuroVolumeStatistics(volume=volume, brain_percentage=-1.)
                     report.include_statistics(structure=t, statistics=pat_space_result, space="Patient")
         # Include the acquisition infos here (for now?)
@@ -187,21 +206,16 @@ class FeaturesComputationStep(AbstractPipelineStep):
                 reg_data = self._patient_parameters.get_annotation(annotation_uid=anno_uid).get_registered_volume_info(destination_space_uid=self.report_space)
                 report_filename_input = reg_data["filepath"]
 
-            non_available_uid = True
-            report_uid = None
-            while non_available_uid:
-                report_uid = 'RADS' + str(np.random.randint(0, 10000))
-                if report_uid not in self._patient_parameters.get_all_reportings_uids():
-                    non_available_uid = False
+            report_uid = self._patient_parameters.generate_uid('RADS', filepath=report_filename_input, role='report')
             report = NeuroReportingStructure(id=report_uid, parent_uid=self._radiological_volume_uid,
-                                             output_folder=ResourcesConfiguration.getInstance().output_folder)
+                                             output_folder=self._context.config.output_folder)
             report._tumor_type = self._patient_parameters.get_annotation(annotation_uid=anno_uid).get_annotation_subtype_str()
-            updated_report = compute_neuro_report(report_filename_input, report)
+            updated_report = compute_neuro_report(report_filename_input, report, context=self._context)
             if self.report_space != 'Patient':
                 # Including the tumor volume in original patient space, quick fix for now
                 patient_anno_fn = self._patient_parameters.get_annotation(annotation_uid=anno_uid).usable_input_filepath
-                patient_anno = nib.load(patient_anno_fn).get_fdata()[:]
-                volume = np.count_nonzero(patient_anno) * np.prod(nib.load(patient_anno_fn).header.get_zooms()[0:3]) * 1e-3
+                patient_anno_nib = load_cached_volume(patient_anno_fn)
+                volume = np.count_nonzero(patient_anno_nib.dataobj) * np.prod(patient_anno_nib.header.get_zooms()[0:3]) * 1e-3
                 updated_report._statistics['Main']['Overall'].original_space_volume = np.round(volume, 2)
             self._patient_parameters.include_reporting(report_uid, updated_report)
             updated_report.to_txt()
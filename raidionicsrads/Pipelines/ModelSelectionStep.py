@@ -10,7 +10,7 @@ import traceback
 import json
 
 from ..Utils.utilities import get_type_from_string, get_type_from_enum_name
-from ..Utils.configuration_parser import ResourcesConfiguration
+from ..Utils.run_context import RunContext
 from ..Utils.io import load_nifti_volume
 from .AbstractPipelineStep import AbstractPipelineStep
 from ..Utils.DataStructures.PatientStructure import PatientParameters
@@ -32,8 +32,8 @@ class ModelSelectionStep(AbstractPipelineStep):
     _target_timestamp = None # Timestamp for the inputs to run the model on (if on-the-fly adaptation is needed)
     _predictions_format = None
 
-    def __init__(self, step_json: dict):
-        super(ModelSelectionStep, self).__init__(step_json=step_json)
+    def __init__(self, step_json: dict, context: RunContext = None):
+        super(ModelSelectionStep, self).__init__(step_json=step_json, context=context)
         self.__reset()
         step_keys = list(self._step_json.keys())
         self._base_model_name = self._step_json["model"] if "model" in step_keys else None
@@ -68,10 +68,10 @@ class ModelSelectionStep(AbstractPipelineStep):
         """
         self._patient_parameters = patient_parameters
 
-        self._working_folder = os.path.join(ResourcesConfiguration.getInstance().output_folder, "modelselection_tmp")
+        self._working_folder = os.path.join(self._context.config.output_folder, "modelselection_tmp")
         os.makedirs(self._working_folder, exist_ok=True)
         try:
-            base_model_path = os.path.join(ResourcesConfiguration.getInstance().model_folder, self._base_model_name)
+            base_model_path = os.path.join(self._context.config.model_folder, self._base_model_name)
             if self._base_model_name is None or not os.path.exists(base_model_path) or not os.path.isdir(base_model_path):
                 raise ValueError(f"Provided input model directory does not exist on disk with value {base_model_path}")
         except Exception as e:
@@ -96,8 +96,8 @@ class ModelSelectionStep(AbstractPipelineStep):
             return
 
         try:
-            base_model_path = os.path.join(ResourcesConfiguration.getInstance().model_folder, self._base_model_name)
-            if ResourcesConfiguration.getInstance().diagnosis_task == 'neuro_diagnosis':
+            base_model_path = os.path.join(self._context.config.model_folder, self._base_model_name)
+            if self._context.config.diagnosis_task == 'neuro_diagnosis':
                 model_name = self.__identify_model_from_mri_inputs(base_model_path=base_model_path)
             else:
                 model_name = self.__identify_model_from_ct_inputs(base_model_path=base_model_path)
@@ -108,7 +108,7 @@ class ModelSelectionStep(AbstractPipelineStep):
 
         if model_name is None:
             raise ValueError(f"[ModelSelectionStep] failed, no model could be selected.")
-        model_pipeline_fn = os.path.join(ResourcesConfiguration.getInstance().model_folder, model_name, "pipeline.json")
+        model_pipeline_fn = os.path.join(self._context.config.model_folder, model_name, "pipeline.json")
         model_pipeline = None
         with open(model_pipeline_fn, 'r') as infile:
             model_pipeline = json.load(infile)
@@ -0,0 +1,162 @@
+import json
+import logging
+import os
+import pickle
+import shutil
+import threading
+import traceback
+from contextlib import nullcontext
+from typing import List
+
+
+class PipelineCheckpoint:
+    """
+    Persistence of the pipeline progress for a patient, allowing to resume an interrupted run.
+    After the pipeline setup and after each completed step, the whole PatientParameters state (volumes, annotations,
+    registrations, and reportings) is pickled on disk, next to a json file listing the final pipeline and the steps
+    already completed. Both files are written atomically, such that a run killed at any point leaves a usable
+    checkpoint behind. The checkpoint is removed once the run completes without interruption.
+    When steps are executed in parallel, the state is only written once no other step is running, such that the
+    partial changes of an unfinished step are never stored alongside the completed ones. The steps completed meanwhile
+    are marked as such at that point, or run again when resuming if the run is interrupted before.
+    """
+    _checkpoint_folder = None  # Folder on disk where the checkpoint files are stored
+    _pipeline_json = {}  # Final pipeline being executed, as written in executed_pipeline.json
+    _completed_steps = []  # Keys of the pipeline steps already completed
+    _running_steps = set()  # Keys of the pipeline steps currently running
+    _pending_steps = []  # Keys of the pipeline steps completed while other steps were still running
+    _consistent = True  # False once a step was interrupted, its partial changes being left in the patient state
+    _lock = None  # Lock preventing concurrent writes when steps are executed in parallel
+
+    def __init__(self, output_folder: str) -> None:
+        self.__reset()
+        self._checkpoint_folder = os.path.join(output_folder, 'checkpoint')
+
+    def __reset(self):
+        """
+        All objects share class or static variables.
+        An instance or non-static variables are different for different objects (every object has a copy).
+        """
+        self._checkpoint_folder = None
+        self._pipeline_json = {}
+        self._completed_steps = []
+        self._running_steps = set()
+        self._pending_steps = []
+        self._consistent = True
+        self._lock = threading.Lock()
+
+    @property
+    def checkpoint_folder(self) -> str:
+        return self._checkpoint_folder
+
+    @property
+    def pipeline_json(self) -> dict:
+        return self._pipeline_json
+
+    @pipeline_json.setter
+    def pipeline_json(self, pipeline: dict) -> None:
+        self._pipeline_json = pipeline
+
+    @property
+    def completed_steps(self) -> List[str]:
+        return self._completed_steps
+
+    def is_completed(self, step_key: str) -> bool:
+        return step_key in self._completed_steps
+
+    def exists(self) -> bool:
+        return os.path.exists(os.path.join(self._checkpoint_folder, 'patient_state.pkl')) and \
+            os.path.exists(os.path.join(self._checkpoint_folder, 'pipeline_progress.json'))
+
+    def clear(self) -> None:
+        """
+        Removes any checkpoint left over by a previous run, when starting a run from scratch, or the checkpoint of the
+        current run once completed.
+        """
+        with self._lock:
+            self._completed_steps = []
+            self._pending_steps = []
+            if os.path.exists(self._checkpoint_folder):
+                shutil.rmtree(self._checkpoint_folder)
+
+    def start(self, step_key: str) -> None:
+        """
+        Marks the given step as running, its changes to the patient state being incomplete until save() or abort().
+        """
+        with self._lock:
+            self._running_steps.add(step_key)
+
+    def abort(self, step_key: str) -> None:
+        """
+        Marks the given step as interrupted. The patient state may hold its partial changes, and is therefore not
+        stored anymore for the rest of the run.
+        """
+        with self._lock:
+            self._running_steps.discard(step_key)
+            self._consistent = False
+
+    def save(self, patient_parameters, step_key: str = None) -> None:
+        """
+        Stores the current patient state, and marks the given step as completed, as soon as no other step is running.
+
+        Parameters
+        ----------
+        patient_parameters: PatientParameters
+            Patient state after the completion of the step.
+        step_key: str
+            Key of the completed step inside the final pipeline, or None when saving the state after the setup.
+        """
+        with self._lock:
+            if step_key is not None:
+                self._running_steps.discard(step_key)
+                if step_key not in self._pending_steps and step_key not in self._completed_steps:
+                    self._pending_steps.append(step_key)
+            if len(self._running_steps) != 0 or not self._consistent:
+                return
+            self._completed_steps.extend(self._pending_steps)
+            self._pending_steps = []
+            try:
+                os.makedirs(self._checkpoint_folder, exist_ok=True)
+                state_fn = os.path.join(self._checkpoint_folder, 'patient_state.pkl')
+                # Pickled under the patient lock, such that steps running concurrently cannot change the state meanwhile
+                with getattr(patient_parameters, 'lock', None) or nullcontext():
+                    content = pickle.dumps(patient_parameters, protocol=pickle.HIGHEST_PROTOCOL)
+                with open(state_fn + '.tmp', 'wb') as outfile:
+                    outfile.write(content)
+                os.replace(state_fn + '.tmp', state_fn)
+
+                progress = {"pipeline": self._pipeline_json, "completed_steps": self._completed_steps}
+                progress_fn = os.path.join(self._checkpoint_folder, 'pipeline_progress.json')
+                with open(progress_fn + '.tmp', 'w', newline='\n') as outfile:
+                    json.dump(progress, outfile, indent=4)
+                os.replace(progress_fn + '.tmp', progress_fn)
+            except Exception as e:
+                # A failed checkpoint should never interrupt the pipeline, the next completed step will try again.
+                logging.warning("[PipelineCheckpoint] Saving the checkpoint after step {} failed with: {}".format(
+                    step_key, e))
+                logging.debug("Traceback: {}.".format(traceback.format_exc()))
+
+    def load(self):
+        """
+        Reloads the patient state and the pipeline progress from the last checkpoint on disk.
+
+        Returns
+        -------
+        PatientParameters
+            Patient state at the time of the last completed step, or None if no valid checkpoint exists.
+        """
+        if not self.exists():
+            return None
+        try:
+            with open(os.path.join(self._checkpoint_folder, 'pipeline_progress.json'), 'r') as infile:
+                progress = json.load(infile)
+            with open(os.path.join(self._checkpoint_folder, 'patient_state.pkl'), 'rb') as infile:
+                patient_parameters = pickle.load(infile)
+            self._pipeline_json = progress["pipeline"]
+            self._completed_steps = progress["completed_steps"]
+        except Exception as e:
+            logging.warning("[PipelineCheckpoint] Loading the checkpoint from {} failed with: {}".format(
+                self._checkpoint_folder, e))
+            logging.debug("Traceback: {}.".format(traceback.format_exc()))
+            return None
+        return patient_parameters
@@ -0,0 +1,126 @@
+from ..Utils.utilities import get_type_from_enum_name
+from ..Utils.DataStructures.AnnotationStructure import AnnotationClassType
+
+
+class PipelinePlanner:
+    """
+    Dry-run of a final pipeline over the patient data, without any heavy processing.
+    The planner tracks what is available for each radiological volume (identified by its timestamp and sequence),
+    both from the patient data loaded from disk and from the outputs the previous steps are expected to produce.
+    Each step assesses its own inputs against the planner (see AbstractPipelineStep.assess), and declares its
+    outputs, leading to a report indicating which steps will run, be skipped, or fail.
+    """
+    _patient_parameters = None  # Patient data as loaded from disk
+    _planned_outputs = set()  # Outputs expected to be produced by the steps assessed so far
+
+    def __init__(self, patient_parameters) -> None:
+        self.__reset()
+        self._patient_parameters = patient_parameters
+
+    def __reset(self):
+        """
+        All objects share class or static variables.
+        An instance or non-static variables are different for different objects (every object has a copy).
+        """
+        self._patient_parameters = None
+        self._planned_outputs = set()
+
+    @property
+    def patient_parameters(self):
+        return self._patient_parameters
+
+    def produce(self, output: tuple) -> None:
+        """
+        Declares an output which will be available for the following steps, as a tuple starting with its kind
+        (e.g., ('annotation', timestamp, sequence, label)).
+        """
+        self._planned_outputs.add(tuple([str(x) for x in output]))
+
+    def get_volume_uid(self, entry: dict) -> str:
+        return self._patient_parameters.get_radiological_volume_uid(timestamp=entry["timestamp"],
+                                                                    sequence=entry["sequence"])
+
+    def has_volume(self, entry: dict) -> bool:
+        if is_atlas(entry):
+            return True
+        return self.get_volume_uid(entry) != "-1"
+
+    def has_annotation(self, entry: dict, label: str) -> bool:
+        if not self.has_volume(entry):
+            return False
+        if ('annotation', str(entry["timestamp"]), str(entry["sequence"]), str(label)) in self._planned_outputs:
+            return True
+        annotation_type = get_type_from_enum_name(AnnotationClassType, label)
+        if annotation_type == -1 or is_atlas(entry):
+            return False
+        return len(self._patient_parameters.get_all_annotations_uids_class_radiological_volume(
+            volume_uid=self.get_volume_uid(entry), annotation_class=annotation_type)) != 0
+
+    def get_annotation_labels(self, entry: dict) -> list:
+        """
+        All annotation classes existing, or expected, for the given radiological volume.
+        """
+        labels = [x[3] for x in self._planned_outputs if x[0] == 'annotation' and x[1] == str(entry["timestamp"])
+                  and x[2] == str(entry["sequence"])]
+        if self.get_volume_uid(entry) != "-1":
+            for a in self._patient_parameters.get_all_annotations_radiological_volume(volume_uid=self.get_volume_uid(entry)):
+                labels.append(a.get_annotation_type_name())
+        return list(set(labels))
+
+    def has_registration(self, moving: dict, fixed: dict) -> bool:
+        if ('registration', str(moving["timestamp"]), str(moving["sequence"]), str(fixed["timestamp"]),
+                str(fixed["sequence"])) in self._planned_outputs:
+            return True
+        return self._patient_parameters.get_registration_by_json(fixed=fixed, moving=moving) is not None
+
+    def has_registered_volume(self, entry: dict, space: dict, label: str = None) -> bool:
+        """
+        Checks if the radiological volume (or one of its annotations if a label is provided) is, or will be,
+        available in the reference space of another volume.
+        """
+        planned = ('registered', str(entry["timestamp"]), str(entry["sequence"]), str(label), str(space["timestamp"]),
+                   str(space["sequence"]))
+        if planned in self._planned_outputs:
+            return True
+        volume_uid = self.get_volume_uid(entry)
+        space_uid = 'MNI' if is_atlas(space) else self.get_volume_uid(space)
+        if volume_uid == "-1" or space_uid == "-1":
+            return False
+        if label is None:
+            return self._patient_parameters.get_radiological_volume(volume_uid=volume_uid).is_registered_volume_included(
+                destination_space_uid=space_uid)
+        annotation_type = get_type_from_enum_name(AnnotationClassType, label)
+        for a in self._patient_parameters.get_all_annotations_uids_class_radiological_volume(
+                volume_uid=volume_uid, annotation_class=annotation_type):
+            if self._patient_parameters.get_annotation(annotation_uid=a).is_registered_volume_included(
+                    destination_space_uid=space_uid):
+                return True
+        return False
+
+    def assess_input(self, input_json: dict) -> str:
+        """
+        Generic assessment of an input entry from the step json (as used by the segmentation steps).
+
+        Returns
+        -------
+        str
+            Reason why the input is not available, or None if it is.
+        """
+        if not self.has_volume(input_json):
+            return "No radiological volume for {}.".format(input_json)
+        space = input_json["space"] if "space" in input_json.keys() else input_json
+        same_space = (str(space["timestamp"]) == str(input_json["timestamp"]) and
+                      str(space["sequence"]) == str(input_json["sequence"]))
+        if same_space or self._patient_parameters.context.config.predictions_use_registered_data:
+            if input_json["labels"] and not self.has_annotation(input_json, input_json["labels"]):
+                return "No annotation for {}.".format(input_json)
+        else:
+            if not self.has_volume(space):
+                return "No radiological volume for {}.".format(space)
+            if not self.has_registered_volume(input_json, space, input_json["labels"] if input_json["labels"] else None):
+                return "No registered volume in the requested space for {}.".format(input_json)
+        return None
+
+
+def is_atlas(entry: dict) -> bool:
+    return str(entry["timestamp"]) == "-1" or str(entry["sequence"]) == "MNI"
@@ -0,0 +1,216 @@
+import logging
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Set, Tuple
+
+
+class PipelineScheduler:
+    """
+    Dependency-aware runner for the steps of a final pipeline.
+    The pipeline json does not list explicit dependencies between steps, they are therefore derived from the
+    patient data each step reads and writes (as described by its inputs/moving/fixed/timestamp fields). A step can
+    only start once all the previous steps it conflicts with are over, while independent steps (e.g., segmentations
+    of different sequences, or registrations of different pairs) run concurrently on a bounded pool of workers.
+    Steps with no clear footprint (e.g., classification or selection tasks) act as barriers.
+    When a memory budget is provided, a ready step is only started if its estimated peak memory fits within what is
+    left of the budget, the steps being admitted in pipeline order.
+    """
+    _steps = {}  # Pipeline steps, indexed by their string position in the pipeline
+    _max_workers = 1  # Upper bound on the number of steps running at the same time
+    _dependencies = {}  # For each step key, set of previous step keys which must be completed beforehand
+    _memory_budget = None  # MemoryBudget shared by the running steps, or None if unlimited
+    _memory_estimates = {}  # For each step key, estimated peak memory in bytes
+
+    def __init__(self, steps: dict, max_workers: int = 1, memory_budget=None, memory_estimates: dict = None) -> None:
+        self.__reset()
+        self._steps = steps
+        self._max_workers = max(1, max_workers)
+        self._memory_budget = memory_budget
+        self._memory_estimates = memory_estimates if memory_estimates is not None else {}
+        self.__compute_dependencies()
+
+    def __reset(self):
+        """
+        All objects share class or static variables.
+        An instance or non-static variables are different for different objects (every object has a copy).
+        """
+        self._steps = {}
+        self._max_workers = 1
+        self._dependencies = {}
+        self._memory_budget = None
+        self._memory_estimates = {}
+
+    @property
+    def dependencies(self) -> dict:
+        return self._dependencies
+
+    def run(self, run_step: Callable[[str], bool]) -> bool:
+        """
+        Executes all steps in dependency order, with at most max_workers steps in flight.
+
+        Parameters
+        ----------
+        run_step: Callable
+            Method processing a single step from its key, returning False if the pipeline must be interrupted
+            (i.e., failure of a required step).
+        Returns
+        -------
+        bool
+            True if all steps were processed, False if the execution was interrupted.
+        """
+        pending = list(self._steps.keys())
+        completed = set()
+        running = {}
+        interrupted = False
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            while (pending and not interrupted) or running:
+                if not interrupted:
+                    for s in list(pending):
+                        if len(running) >= self._max_workers:
+                            break
+                        if self._dependencies[s].issubset(completed):
+                            if not self.__admit(s):
+                                break
+                            pending.remove(s)
+                            running[executor.submit(run_step, s)] = s
+                if not running:
+                    # Should not happen as the dependencies always point to previous steps.
+                    logging.error("[PipelineScheduler] No step can be scheduled, remaining steps: {}.".format(pending))
+                    return False
+                done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for f in done:
+                    s = running.pop(f)
+                    completed.add(s)
+                    if self._memory_budget is not None:
+                        self._memory_budget.release(self.__get_memory_estimate(s))
+                    try:
+                        if not f.result():
+                            interrupted = True
+                    except Exception as e:
+                        logging.error("[PipelineScheduler] Processing of step {} failed with:\n{}".format(s, e))
+                        logging.debug("Traceback: {}.".format(traceback.format_exc()))
+                        interrupted = True
+        return not interrupted
+
+    def __admit(self, s: str) -> bool:
+        if self._memory_budget is None:
+            return True
+        if not self._memory_budget.try_acquire(self.__get_memory_estimate(s)):
+            logging.debug("[PipelineScheduler] Step {} waiting for memory ({:.2f} GB estimated, {:.2f} GB in "
+                          "use).".format(s, self.__get_memory_estimate(s) / 1e9, self._memory_budget.used / 1e9))
+            return False
+        return True
+
+    def __get_memory_estimate(self, s: str) -> int:
+        return self._memory_estimates[s] if s in self._memory_estimates.keys() else 0
+
+    def __compute_dependencies(self) -> None:
+        footprints = {}
+        for s in self._steps.keys():
+            footprints[s] = get_step_footprint(self._steps[s].step_json)
+
+        keys = list(self._steps.keys())
+        for i, s in enumerate(keys):
+            self._dependencies[s] = set()
+            reads, writes = footprints[s]
+            for p in keys[:i]:
+                prev_reads, prev_writes = footprints[p]
+                if (_intersects(prev_writes, reads.union(writes)) or _intersects(prev_reads, writes)):
+                    self._dependencies[s].add(p)
+            logging.debug("[PipelineScheduler] Step {} depends on steps {}.".format(s, sorted(self._dependencies[s],
+                                                                                         key=int)))
+
+
+def get_step_footprint(step_json: dict) -> Tuple[Set[str], Set[str]]:
+    """
+    Lists the patient resources read and written by a pipeline step, from its json description.
+    Radiological volumes (and all the data attached to them, e.g., annotations or registered files) are identified
+    as 'T<timestamp>:<sequence>', where the sequence can be '*' to cover all volumes of a timestamp, and the
+    timestamp can be '*' to cover the volumes of all timestamps. Registrations are identified as
+    'Reg:<moving>-><fixed>', and the generated reports as 'Reports'. The '*' resource covers everything, making the
+    step a barrier.
+    The footprints are conservative: when the volume the results are attached to is only known at runtime, all the
+    candidate volumes are considered written.
+
+    Parameters
+    ----------
+    step_json: dict
+        Step description, as stored in the pipeline json file.
+    Returns
+    -------
+    Set[str], Set[str]
+        Resources read by the step, and resources written by the step.
+    """
+    task = step_json["task"] if "task" in step_json.keys() else None
+    reads = set()
+    writes = set()
+    try:
+        if task in ["Segmentation", "Segmentation refinement"]:
+            input_keys = sorted(list(step_json["inputs"].keys()), key=lambda x: str(x))
+            for k in input_keys:
+                reads.add(_volume_resource(step_json["inputs"][k]))
+                if "space" in step_json["inputs"][k].keys():
+                    reads.add(_volume_resource(step_json["inputs"][k]["space"]))
+            # The annotations are attached to the first input used in its own space, only known at runtime, hence any
+            # input volume might be written. All the (refined) segmentations share the same working folder.
+            for k in input_keys:
+                writes.add(_volume_resource(step_json["inputs"][k], all_sequences=task != "Segmentation"))
+            writes.add("Scratch:segmentation" if task == "Segmentation" else "Scratch:segmentation_refinement")
+        elif task == "Registration":
+            reads.add(_volume_resource(step_json["moving"]))
+            reads.add(_volume_resource(step_json["fixed"]))
+            writes.add(_registration_resource(step_json))
+        elif task == "Apply registration":
+            reads.add(_registration_resource(step_json))
+            reads.add(_volume_resource(step_json["fixed"]))
+            if str(step_json["fixed"]["sequence"]) == "MNI" and step_json["direction"] == "forward":
+                # Annotations registered towards the moving volume are also propagated to the atlas space, these
+                # annotations being attached to volumes of any timestamp (e.g., a T1 annotation registered to T0).
+                reads.add(_ALL_VOLUMES)
+                writes.add(_ALL_VOLUMES)
+            else:
+                reads.add(_volume_resource(step_json["moving"]))
+                writes.add(_volume_resource(step_json["moving"]))
+        elif task == "Features computation":
+            reads.add(_volume_resource(step_json, all_sequences=True))
+            writes.add("Reports")
+        elif task == "Surgical reporting":
+            reads.add("*")
+            writes.add("Reports")
+        else:
+            # Classification, model selection, reporting selection, and unknown tasks act as barriers.
+            reads.add("*")
+            writes.add("*")
+    except Exception as e:
+        logging.debug("[PipelineScheduler] Footprint of step {} could not be identified with: {}. Treated as a "
+                      "barrier.".format(step_json, e))
+        reads = {"*"}
+        writes = {"*"}
+    return reads, writes
+
+
+# Resource covering the volumes of all timestamps, with all the data attached to them
+_ALL_VOLUMES = "T*:*"
+
+
+def _volume_resource(entry: dict, all_sequences: bool = False) -> str:
+    return "T{}:{}".format(str(entry["timestamp"]), "*" if all_sequences else str(entry["sequence"]))
+
+
+def _registration_resource(step_json: dict) -> str:
+    return "Reg:{}->{}".format(_volume_resource(step_json["moving"]), _volume_resource(step_json["fixed"]))
+
+
+def _overlaps(first: str, second: str) -> bool:
+    if first == "*" or second == "*" or first == second:
+        return True
+    if first.startswith("T") and second.startswith("T"):
+        first_ts, first_seq = first.split(":", 1)
+        second_ts, second_seq = second.split(":", 1)
+        return (first_ts == second_ts or first_ts == "T*" or second_ts == "T*") and \
+            (first_seq == "*" or second_seq == "*")
+    return False
+
+
+def _intersects(first: Set[str], second: Set[str]) -> bool:
+    return any([_overlaps(f, s) for f in first for s in second])
@@ -9,7 +9,10 @@ from aenum import Enum, unique
 from raidionicsseg.Utils.configuration_parser import ConfigResources
 
 from ..Utils.utilities import get_type_from_string
-from ..Utils.configuration_parser import ResourcesConfiguration
+from ..Utils.run_context import RunContext, with_run_context
+from ..Utils.performance_metrics import PerformanceMonitor, bind_current_record
+from ..Utils.cancellation import CancellationToken
+from ..Utils.memory_budget import MemoryBudget, record_peak_memory, estimate_patient_peak_memory
 from .ClassificationStep import ClassificationStep
 from .SegmentationStep import SegmentationStep
 from .SegmentationRefinementStep import SegmentationRefinementStep
@@ -19,6 +22,9 @@ from .FeaturesComputationStep import FeaturesComputationStep
 from .SurgicalReportingStep import SurgicalReportingStep
 from .ModelSelectionStep import ModelSelectionStep
 from .ReportingSelectionStep import ReportingSelectionStep
+from .PipelineScheduler import PipelineScheduler
+from .PipelineCheckpoint import PipelineCheckpoint
+from .PipelinePlanner import PipelinePlanner
 
 
 @unique
@@ -49,10 +55,17 @@ class Pipeline:
     _input_filepath = ""  # Full filepath to the current pipeline, stored in a json file
     _pipeline_json = {}  # Loaded pipeline from the aforementioned json file, stored as a dictionary
     _steps = {}  # Internal pipeline steps, inherited from AbstractPipelineStep, matching the steps inside the json dict.
+    _patient_parameters = None  # Patient data shared by all steps during the pipeline execution.
+    _checkpoint = None  # On-disk persistence of the patient state after each completed step, for resuming a run.
+    _monitor = None  # Performance metrics collected for each step, dumped next to the executed pipeline.
+    _cancellation_token = None  # Patient-level cancellation, parent of the token given to each step.
+    _interrupted = False  # Whether the last execution was interrupted before completing all steps.
+    _context = None  # RunContext carrying the configuration of the run, handed down to all steps.
 
-    def __init__(self, input_filename: str) -> None:
+    def __init__(self, input_filename: str, context: RunContext = None) -> None:
         self.__reset()
         self._input_filepath = input_filename
+        self._context = RunContext.resolve(context)
         self.__init_from_scratch()
 
     def __reset(self):
@@ -63,6 +76,12 @@ class Pipeline:
         self._input_filepath = ""
         self._pipeline_json = {}
         self._steps = {}
+        self._patient_parameters = None
+        self._checkpoint = None
+        self._monitor = None
+        self._cancellation_token = None
+        self._interrupted = False
+        self._context = None
 
     def __init_from_scratch(self):
         """
@@ -82,30 +101,39 @@ class Pipeline:
             task = get_type_from_string(TaskType, pipeline[s]["task"])
             step = None
             if task == TaskType.Class:
-                step = ClassificationStep(pipeline[s])
+                step = ClassificationStep(pipeline[s], context=self._context)
                 if pipeline[s]["target"][0] == "MRSequence" and not initial:
                     step.skip = True
             elif task == TaskType.Seg:
-                step = SegmentationStep(pipeline[s])
+                step = SegmentationStep(pipeline[s], context=self._context)
             elif task == TaskType.SegRef:
-                step = SegmentationRefinementStep(pipeline[s])
+                step = SegmentationRefinementStep(pipeline[s], context=self._context)
             elif task == TaskType.Reg:
-                step = RegistrationStep(pipeline[s])
+                step = RegistrationStep(pipeline[s], context=self._context)
             elif task == TaskType.AReg:
-                step = RegistrationDeployerStep(pipeline[s])
+                step = RegistrationDeployerStep(pipeline[s], context=self._context)
             elif task == TaskType.FComp:
-                step = FeaturesComputationStep(pipeline[s])
+                step = FeaturesComputationStep(pipeline[s], context=self._context)
             elif task == TaskType.SRep:
-                step = SurgicalReportingStep(pipeline[s])
+                step = SurgicalReportingStep(pipeline[s], context=self._context)
             elif task == TaskType.ModSelec:
-                step = ModelSelectionStep(pipeline[s])
+                step = ModelSelectionStep(pipeline[s], context=self._context)
             elif task == TaskType.ReportSelec:
-                step = ReportingSelectionStep(pipeline[s])
+                step = ReportingSelectionStep(pipeline[s], context=self._context)
             if step:
                 self._steps[str(i)] = step
             else:
                 logging.warning(f"Step dismissed because task could not be matched.")
 
+    @property
+    def interrupted(self) -> bool:
+        return self._interrupted
+
+    @property
+    def context(self) -> RunContext:
+        return self._context
+
+    @with_run_context
     def setup(self, patient_parameters) -> None:
         """
         @TODO. Should not consider all classification tasks the same, the initial exception is only for the sequence
@@ -122,51 +150,62 @@ class Pipeline:
 
         """
         logging.info('LOG: Pipeline setup - {} steps.'.format(len(self._steps)))
+        self._checkpoint = PipelineCheckpoint(output_folder=self._context.config.output_folder)
+        self._checkpoint.clear()
+        self._monitor = PerformanceMonitor()
+        if self._cancellation_token is None:
+            self._cancellation_token = CancellationToken()
         final_pipeline = {}
         final_count = 0
         for s in list(self._steps.keys()):
             try:
                 if self._steps[s].get_task() in [str(TaskType.Class), str(TaskType.ModSelec), str(TaskType.ReportSelec)]:
-                    start = time.time()
-                    logging.info("LOG: Pipeline - {desc} - Begin ({curr}/{tot})".format(
-                        desc=self._steps[s].step_description,
-                        curr=str(int(s) + 1),
-                        tot=len(self._steps)))
-                    try:
-                        self._steps[s].setup(patient_parameters)
-                    except Exception as e:
-                        logging.warning("""[PipelineStructure] Setup phase of {} failed with:\n{}""".format(
-                            self._steps[s].step_json, e))
-                        logging.debug("Traceback: {}.".format(traceback.format_exc()))
-                        continue
-                    pipeline_backup = deepcopy(final_pipeline)
-                    try:
-                        if self._steps[s].get_task() == str(TaskType.Class):
-                            patient_parameters = self._steps[s].execute()
-                            final_count = final_count + 1
-                            final_count_str = str(final_count)
-                            final_pipeline[final_count_str] = {}
-                            final_pipeline[final_count_str] = deepcopy(self._steps[s].step_json)
-                        else:
-                            task_optimal_pipeline = self._steps[s].execute()
-                            for top in task_optimal_pipeline.keys():
+                    with self._monitor.measure("setup", str(int(s) + 1), self._steps[s]) as metrics:
+                        start = time.time()
+                        logging.info("LOG: Pipeline - {desc} - Begin ({curr}/{tot})".format(
+                            desc=self._steps[s].step_description,
+                            curr=str(int(s) + 1),
+                            tot=len(self._steps)))
+                        token = CancellationToken(timeout=self._steps[s].get_timeout(),
+                                                  parent=self._cancellation_token)
+                        self._steps[s].cancellation_token = token
+                        try:
+                            token.run(bind_current_record(self._steps[s].setup), patient_parameters)
+                        except Exception as e:
+                            logging.warning("""[PipelineStructure] Setup phase of {} failed with:\n{}""".format(
+                                self._steps[s].step_json, e))
+                            logging.debug("Traceback: {}.".format(traceback.format_exc()))
+                            metrics["status"] = "timed_out" if token.is_timed_out() else "failed"
+                            continue
+                        pipeline_backup = deepcopy(final_pipeline)
+                        try:
+                            if self._steps[s].get_task() == str(TaskType.Class):
+                                patient_parameters = token.run(bind_current_record(self._steps[s].execute))
                                 final_count = final_count + 1
                                 final_count_str = str(final_count)
                                 final_pipeline[final_count_str] = {}
-                                final_pipeline[final_count_str] = task_optimal_pipeline[top]
-                    except Exception as e:
-                        logging.warning("""[PipelineStructure] Execution phase of {} failed with:\n{}""".format(
-                            self._steps[s].step_json, e))
-                        logging.debug(f"Traceback: {traceback.format_exc()}.")
-                        final_pipeline = deepcopy(pipeline_backup)
-                        continue
-                    logging.info('LOG: Pipeline - {desc} - Runtime: {time} seconds.'.format(
-                        desc=self._steps[s].step_description,
-                        time=time.time() - start))
-                    logging.info("LOG: Pipeline - {desc} - End ({curr}/{tot})".format(
-                        desc=self._steps[s].step_description,
-                        curr=str(int(s) + 1),
-                        tot=len(self._steps)))
+                                final_pipeline[final_count_str] = deepcopy(self._steps[s].step_json)
+                            else:
+                                task_optimal_pipeline = token.run(bind_current_record(self._steps[s].execute))
+                                for top in task_optimal_pipeline.keys():
+                                    final_count = final_count + 1
+                                    final_count_str = str(final_count)
+                                    final_pipeline[final_count_str] = {}
+                                    final_pipeline[final_count_str] = task_optimal_pipeline[top]
+                        except Exception as e:
+                            logging.warning("""[PipelineStructure] Execution phase of {} failed with:\n{}""".format(
+                                self._steps[s].step_json, e))
+                            logging.debug(f"Traceback: {traceback.format_exc()}.")
+                            final_pipeline = deepcopy(pipeline_backup)
+                            metrics["status"] = "timed_out" if token.is_timed_out() else "failed"
+                            continue
+                        logging.info('LOG: Pipeline - {desc} - Runtime: {time} seconds.'.format(
+                            desc=self._steps[s].step_description,
+                            time=time.time() - start))
+                        logging.info("LOG: Pipeline - {desc} - End ({curr}/{tot})".format(
+                            desc=self._steps[s].step_description,
+                            curr=str(int(s) + 1),
+                            tot=len(self._steps)))
                 else:
                     final_count = final_count + 1
                     final_count_str = str(final_count)
@@ -185,49 +224,272 @@ class Pipeline:
         self.__parse_pipeline_steps(pipeline=final_pipeline, initial=False)
 
         # Writing on disk the actual/final pipeline (for info and reuse in Raidionics)
-        executed_pipeline_fn = os.path.join(ResourcesConfiguration.getInstance().output_folder, "executed_pipeline.json")
+        executed_pipeline_fn = os.path.join(self._context.config.output_folder, "executed_pipeline.json")
         with open(executed_pipeline_fn, 'w', newline='\n') as outfile:
             json.dump(final_pipeline, outfile, indent=4)
+        self._checkpoint.pipeline_json = final_pipeline
+        self._checkpoint.save(patient_parameters=patient_parameters)
+        self.__dump_metrics(patient_parameters)
         return patient_parameters
 
-    def execute(self, patient_parameters):
-        logging.info('LOG: Pipeline - {} steps.'.format(len(self._steps)))
+    @with_run_context
+    def resume(self):
+        """
+        Reloads the final pipeline and the patient state from the checkpoint of a previous (interrupted) run, instead
+        of going through the setup phase. The steps already completed will be skipped during the execution.
+
+        Returns
+        -------
+        PatientParameters
+            Patient state after the last completed step, or None if no checkpoint could be found.
+        """
+        self._checkpoint = PipelineCheckpoint(output_folder=self._context.config.output_folder)
+        self._monitor = PerformanceMonitor()
+        patient_parameters = self._checkpoint.load()
+        if patient_parameters is None:
+            return None
+        patient_parameters.context = self._context
+        self.__parse_pipeline_steps(pipeline=self._checkpoint.pipeline_json, initial=False)
+        logging.info("[PipelineStructure] Resuming the pipeline with {} out of {} steps already completed.".format(
+            len(self._checkpoint.completed_steps), len(self._steps)))
+        return patient_parameters
+
+    @with_run_context
+    def plan(self, patient_parameters) -> dict:
+        """
+        Pre-flight assessment of the final pipeline, resolving the inputs of each step against the patient data and
+        the outputs the previous steps will produce, without running any heavy processing. The report is also
+        written on disk next to the executed pipeline.
+        The assessment is advisory only: it relies on the declared inputs and outputs of each step, and the pipeline
+        is executed whatever its outcome.
+
+        Parameters
+        ----------
+        patient_parameters: PatientParameters
+            Patient data, as available after the pipeline setup.
+        Returns
+        -------
+        dict
+            Plan report, with the expected status of each step (from [ready, skip, fail]) and whether the pipeline is
+            expected to run as a whole (i.e., no required step is expected to fail).
+        """
+        planner = PipelinePlanner(patient_parameters=patient_parameters)
+        report = {"feasible": True, "steps": {}}
         for s in list(self._steps.keys()):
-            start = time.time()
-            logging.info("LOG: Pipeline - {desc} - Begin ({curr}/{tot})".format(desc=self._steps[s].step_description,
-                                                                                curr=str(int(s) + 1),
-                                                                                tot=len(self._steps)))
+            step = self._steps[s]
+            entry = {"task": step.get_task(), "description": step.step_description, "inclusion": step.inclusion}
             try:
-                self._steps[s].setup(patient_parameters)
+                status, reason = step.assess(planner)
             except Exception as e:
-                if self._steps[s].inclusion == "required":
-                    logging.error("""[Backend error] Setup phase of {} failed with:\n{}""".format(
-                        self._steps[s].step_json, e))
-                    logging.debug("Traceback: {}.".format(traceback.format_exc()))
+                logging.debug("Traceback: {}.".format(traceback.format_exc()))
+                status, reason = "fail", "Assessment failed with: {}".format(e)
+            if status == "fail" and step.inclusion != "required":
+                status = "skip"
+            elif status == "fail":
+                report["feasible"] = False
+            entry["status"] = status
+            entry["reason"] = reason
+            report["steps"][str(int(s) + 1)] = entry
+            if status != "ready":
+                logging.info("[PipelineStructure] Plan - Step {} ({}) expected to {}: {}".format(
+                    str(int(s) + 1), step.step_description, status, reason))
+
+        plan_fn = os.path.join(self._context.config.output_folder, "executed_pipeline_plan.json")
+        with open(plan_fn, 'w', newline='\n') as outfile:
+            json.dump(report, outfile, indent=4)
+        return report
+
+    def cancel(self, reason: str = "Patient processing cancelled.") -> None:
+        """
+        Requests the interruption of the pipeline execution. No further step is started, and the running steps stop
+        at their next cancellation check.
+        """
+        if self._cancellation_token is None:
+            self._cancellation_token = CancellationToken()
+        self._cancellation_token.cancel(reason=reason)
+
+    @with_run_context
+    def execute(self, patient_parameters):
+        """
+        Runs all steps of the final pipeline. With more than one pipeline worker specified in the configuration,
+        independent steps are run concurrently following the dependencies identified by the PipelineScheduler.
+        Each step runs with a cancellation token bounded by the timeout of its task type, a timed-out optional step
+        is skipped while a timed-out required step aborts the processing of the patient.
+        """
+        logging.info('LOG: Pipeline - {} steps.'.format(len(self._steps)))
+        self._patient_parameters = patient_parameters
+        if self._monitor is None:
+            self._monitor = PerformanceMonitor()
+        if self._cancellation_token is None:
+            self._cancellation_token = CancellationToken()
+        self._interrupted = False
+        if self._context.config.pipeline_workers <= 1:
+            for s in list(self._steps.keys()):
+                if not self.__run_step(s):
+                    self._interrupted = True
                     break
-                else:
-                    logging.warning("""[Backend warning] Setup phase of {} failed with:\n{}""".format(
-                        self._steps[s].step_json, e))
-                    logging.debug("Traceback: {}.".format(traceback.format_exc()))
+        else:
+            memory_budget = None
+            if self._context.config.memory_budget is not None:
+                memory_budget = MemoryBudget(total=self._context.config.memory_budget * 1e9)
+            scheduler = PipelineScheduler(steps=self._steps,
+                                          max_workers=self._context.config.pipeline_workers,
+                                          memory_budget=memory_budget,
+                                          memory_estimates=self.__estimate_steps_memory(self._patient_parameters))
+            self._interrupted = not scheduler.run(run_step=self._context.bind(self.__run_step))
+        self.__dump_metrics(self._patient_parameters)
+        if self._context.config.patient_snapshot and not self._interrupted:
+            self._patient_parameters.save_snapshot()
+        if self._checkpoint is not None and not self._interrupted:
+            # Only needed to resume an interrupted run, and not part of the deliverables.
+            self._checkpoint.clear()
+        return self._patient_parameters
+
+    def __run_step(self, s: str) -> bool:
+        """
+        Setup and execution of a single pipeline step, with performance metrics and checkpointing.
+
+        Parameters
+        ----------
+        s: str
+            Key of the step to run inside the pipeline.
+        Returns
+        -------
+        bool
+            False if the pipeline execution should be interrupted (i.e., failure of a required step), True otherwise.
+        """
+        if self._checkpoint is not None and self._checkpoint.is_completed(s):
+            logging.info("[PipelineStructure] Step {} ({}) already completed in a previous run -- skipping.".format(
+                str(int(s) + 1), self._steps[s].step_description))
+            return True
+        if self._cancellation_token.is_cancelled():
+            logging.error("[Backend error] Step {} ({}) not started: {}".format(
+                str(int(s) + 1), self._steps[s].step_description, self._cancellation_token.reason))
+            return False
+        if self._checkpoint is not None:
+            self._checkpoint.start(s)
+        status = False
+        try:
+            with self._monitor.measure("execute", str(int(s) + 1), self._steps[s]) as metrics:
+                status = self.__process_step(s, metrics)
+            self.__learn_step_memory(s, metrics)
+        finally:
+            if self._checkpoint is not None and status:
+                self._checkpoint.save(patient_parameters=self._patient_parameters, step_key=s)
+            elif self._checkpoint is not None:
+                self._checkpoint.abort(s)
+        return status
+
+    def __process_step(self, s: str, metrics: dict) -> bool:
+        start = time.time()
+        logging.info("LOG: Pipeline - {desc} - Begin ({curr}/{tot})".format(desc=self._steps[s].step_description,
+                                                                            curr=str(int(s) + 1),
+                                                                            tot=len(self._steps)))
+        token = CancellationToken(timeout=self._steps[s].get_timeout(), parent=self._cancellation_token)
+        self._steps[s].cancellation_token = token
+        try:
+            token.run(bind_current_record(self._steps[s].setup), self._patient_parameters)
+        except Exception as e:
+            if token.is_cancelled():
+                return self.__handle_cancelled_step(s, token, metrics)
+            if self._steps[s].inclusion == "required":
+                logging.error("""[Backend error] Setup phase of {} failed with:\n{}""".format(
+                    self._steps[s].step_json, e))
+                logging.debug("Traceback: {}.".format(traceback.format_exc()))
+                metrics["status"] = "failed"
+                return False
+            else:
+                metrics["status"] = "failed"
+                logging.warning("""[Backend warning] Setup phase of {} failed with:\n{}""".format(
+                    self._steps[s].step_json, e))
+                logging.debug("Traceback: {}.".format(traceback.format_exc()))
+        try:
+            patient_parameters = token.run(bind_current_record(self._steps[s].execute))
+            if patient_parameters is not None and patient_parameters is not self._patient_parameters:
+                # The steps update the shared patient state in place, never expected to return a new one when
+                # running concurrently.
+                with self._patient_parameters.lock:
+                    self._patient_parameters = patient_parameters
+        except Exception as e:
+            if token.is_cancelled():
+                return self.__handle_cancelled_step(s, token, metrics)
+            if self._steps[s].inclusion == "required":
+                logging.error("""[Backend error] Execution phase of {} failed with:\n{}""".format(
+                    self._steps[s].step_json, e))
+                logging.debug("Traceback: {}.".format(traceback.format_exc()))
+                metrics["status"] = "failed"
+                return False
+            else:
+                metrics["status"] = "failed"
+                logging.warning("""[Backend warning] Execution phase of {} failed with:\n{}""".format(
+                    self._steps[s].step_json, e))
+                logging.debug("Traceback: {}.".format(traceback.format_exc()))
+        logging.info('LOG: Pipeline - {desc} - Runtime: {time} seconds.'.format(desc=self._steps[s].step_description,
+                                                                                time=time.time() - start))
+        logging.info("LOG: Pipeline - {desc} - End ({curr}/{tot})".format(desc=self._steps[s].step_description,
+                                                                          curr=str(int(s) + 1),
+                                                                          tot=len(self._steps)))
+        return True
+
+    def estimate_peak_memory(self, patient_parameters) -> int:
+        """
+        Estimated peak memory in bytes for executing the whole pipeline on the patient, given the maximum number of
+        steps running concurrently.
+        """
+        estimates = self.__estimate_steps_memory(patient_parameters)
+        return estimate_patient_peak_memory(list(estimates.values()),
+                                            workers=self._context.config.pipeline_workers)
+
+    def __estimate_steps_memory(self, patient_parameters) -> dict:
+        estimates = {}
+        for s in list(self._steps.keys()):
             try:
-                patient_parameters = self._steps[s].execute()
+                estimates[s] = self._steps[s].estimate_memory(patient_parameters)
             except Exception as e:
-                if self._steps[s].inclusion == "required":
-                    logging.error("""[Backend error] Execution phase of {} failed with:\n{}""".format(
-                        self._steps[s].step_json, e))
-                    logging.debug("Traceback: {}.".format(traceback.format_exc()))
-                    break
-                else:
-                    logging.warning("""[Backend warning] Execution phase of {} failed with:\n{}""".format(
-                        self._steps[s].step_json, e))
-                    logging.debug("Traceback: {}.".format(traceback.format_exc()))
-            logging.info('LOG: Pipeline - {desc} - Runtime: {time} seconds.'.format(desc=self._steps[s].step_description,
-                                                                                    time=time.time() - start))
-            logging.info("LOG: Pipeline - {desc} - End ({curr}/{tot})".format(desc=self._steps[s].step_description,
-                                                                              curr=str(int(s) + 1),
-                                                                              tot=len(self._steps)))
-        return patient_parameters
+                logging.debug("[PipelineStructure] Memory estimation for step {} failed with: {}".format(s, e))
+                estimates[s] = 0
+        return estimates
+
+    def __learn_step_memory(self, s: str, metrics: dict) -> None:
+        """
+        Refines the memory profile of the task type with the memory increase (process and children) measured for the
+        step, only reliable when the step ran alone. The learned profiles therefore come from sequential pipelines, and
+        are used for the admission of concurrent patients (batch mode) or of later concurrent pipelines in the process.
+        """
+        if self._context.config.pipeline_workers > 1 or metrics["status"] != "completed":
+            return
+        try:
+            record_peak_memory(task=self._steps[s].get_task(),
+                               voxels=self._steps[s].get_input_voxels(self._patient_parameters),
+                               peak_increase=metrics["peak_rss_increase"])
+        except Exception as e:
+            logging.debug("[PipelineStructure] Memory profiling for step {} failed with: {}".format(s, e))
+
+    def __handle_cancelled_step(self, s: str, token: CancellationToken, metrics: dict) -> bool:
+        """
+        Outcome of a step interrupted because of a timeout or a cancellation request. An optional step is skipped, and
+        the pipeline continues, whereas a required step aborts the processing of the patient.
+        """
+        metrics["status"] = "timed_out" if token.is_timed_out() else "cancelled"
+        if self._steps[s].inclusion == "required" or not token.is_timed_out():
+            logging.error("[Backend error] Step {} ({}) interrupted: {}".format(str(int(s) + 1),
+                                                                               self._steps[s].step_description,
+                                                                               token.reason))
+            self._cancellation_token.cancel(reason="Required step {} interrupted.".format(str(int(s) + 1)))
+            return False
+        logging.warning("[Backend warning] Optional step {} ({}) interrupted and skipped: {}".format(
+            str(int(s) + 1), self._steps[s].step_description, token.reason))
+        return True
+
+    def __dump_metrics(self, patient_parameters) -> None:
+        """
+        Writes on disk the performance metrics collected so far, next to the executed pipeline.
+        """
+        metrics_fn = os.path.join(self._context.config.output_folder, "executed_pipeline_metrics.json")
+        self._monitor.dump(filename=metrics_fn,
+                           patient_id=patient_parameters.unique_id if patient_parameters is not None else None)
 
+    @with_run_context
     def cleanup(self):
         for s in list(self._steps.keys()):
             self._steps[s].cleanup()
\ No newline at end of file
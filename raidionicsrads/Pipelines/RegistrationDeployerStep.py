@@ -5,9 +5,10 @@ import nibabel as nib
 import logging
 import configparser
 import traceback
+from typing import Tuple
 from tqdm import tqdm
-from ..Utils.configuration_parser import ResourcesConfiguration
-from ..Utils.io import load_nifti_volume
+from ..Utils.run_context import RunContext
+from ..Utils.io import load_nifti_volume, load_intensities, publish_volume, save_mask
 from ..Utils.ants_registration import *
 from ..Processing.brain_processing import *
 from .AbstractPipelineStep import AbstractPipelineStep
@@ -26,8 +27,8 @@ class RegistrationDeployerStep(AbstractPipelineStep):
     _registration_instance = None
     _direction = None
 
-    def __init__(self, step_json: dict):
-        super(RegistrationDeployerStep, self).__init__(step_json=step_json)
+    def __init__(self, step_json: dict, context: RunContext = None):
+        super(RegistrationDeployerStep, self).__init__(step_json=step_json, context=context)
         self.__reset()
         self._registration_runner = ANTsRegistration()
         self._direction = self._step_json["direction"]
@@ -70,8 +71,9 @@ class RegistrationDeployerStep(AbstractPipelineStep):
         """
         try:
             self._patient_parameters = patient_parameters
+            self._registration_runner.cancellation_token = self.cancellation_token
 
-            if (ResourcesConfiguration.getInstance().predictions_use_registered_data
+            if (self._context.config.predictions_use_registered_data
                     and self._step_json["fixed"]["sequence"] != "MNI"):
                 self.skip = True
                 return
@@ -113,7 +115,7 @@ class RegistrationDeployerStep(AbstractPipelineStep):
         """
         try:
             if self.skip:
-                if (ResourcesConfiguration.getInstance().predictions_use_registered_data
+                if (self._context.config.predictions_use_registered_data
                         and self._step_json["fixed"]["sequence"] != "MNI"):
                     logging.debug("[RegistrationDeployerStep] Step skipped because pre-registered inputs are used.")
                     return self._patient_parameters
@@ -136,6 +138,30 @@ class RegistrationDeployerStep(AbstractPipelineStep):
         except Exception as e:
             raise ValueError(f"[RegistrationDeployerStep] Registration deployment failed with: {e}.")
 
+    def assess(self, planner) -> Tuple[str, str]:
+        """
+        Pre-flight check that the registration to apply is, or will be, available.
+        """
+        moving = self._step_json["moving"]
+        fixed = self._step_json["fixed"]
+        if self._context.config.predictions_use_registered_data and fixed["sequence"] != "MNI":
+            return "skip", "Registration not necessary since using co-registered inputs."
+        if not planner.has_volume(moving):
+            if self._inclusion == "optional":
+                return "skip", "No radiological volume for {}.".format(moving)
+            return "fail", "No radiological volume for {}.".format(moving)
+        if not planner.has_registration(moving=moving, fixed=fixed):
+            if planner.has_registered_volume(moving, fixed):
+                return "skip", "Registered volume manually provided."
+            return "fail", "No registration instance for {} to {}.".format(moving, fixed)
+        if self._direction == 'forward':
+            planner.produce(('registered', moving["timestamp"], moving["sequence"], None, fixed["timestamp"],
+                             fixed["sequence"]))
+            for label in planner.get_annotation_labels(moving):
+                planner.produce(('registered', moving["timestamp"], moving["sequence"], label, fixed["timestamp"],
+                                 fixed["sequence"]))
+        return "ready", ""
+
     def cleanup(self):
         self._registration_runner.clear_output_folder()
 
@@ -147,13 +173,13 @@ class RegistrationDeployerStep(AbstractPipelineStep):
 
             fixed_filepath = None
             if self.fixed_volume_uid == 'MNI':
-                fixed_filepath = ResourcesConfiguration.getInstance().mni_atlas_filepath_T1
+                fixed_filepath = self._context.config.mni_atlas_filepath_T1
             else:
                 fixed_filepath = self._patient_parameters.get_radiological_volume(volume_uid=self.fixed_volume_uid).usable_input_filepath
 
             moving_filepath = None
             if self.moving_volume_uid == 'MNI':
-                moving_filepath = ResourcesConfiguration.getInstance().mni_atlas_filepath_T1
+                moving_filepath = self._context.config.mni_atlas_filepath_T1
             else:
                 moving_filepath = self._patient_parameters.get_radiological_volume(volume_uid=self.moving_volume_uid).usable_input_filepath
 
@@ -171,7 +197,7 @@ class RegistrationDeployerStep(AbstractPipelineStep):
                                   self._patient_parameters.get_radiological_volume(volume_uid=self.moving_volume_uid)._sequence_type.name +
                                   '_registered_to_' + self._fixed_volume_uid + '.nii.gz')
             os.makedirs(os.path.dirname(new_fp), exist_ok=True)
-            shutil.copyfile(fp, new_fp)
+            publish_volume(fp, new_fp)
             self._patient_parameters.get_radiological_volume(volume_uid=self.moving_volume_uid).include_registered_volume(filepath=new_fp,
                                                                                                                            registration_uid=self.registration_instance.unique_id,
                                                                                                                            destination_space_uid=self._fixed_volume_uid)
@@ -183,7 +209,7 @@ class RegistrationDeployerStep(AbstractPipelineStep):
             fixed_filepath = None
             dest_base_folder = None
             if self.fixed_volume_uid == 'MNI':
-                fixed_filepath = ResourcesConfiguration.getInstance().mni_atlas_filepath_T1
+                fixed_filepath = self._context.config.mni_atlas_filepath_T1
                 dest_base_folder = self.fixed_volume_uid + '_space'
             else:
                 fixed_filepath = self._patient_parameters.get_radiological_volume(volume_uid=self.fixed_volume_uid).usable_input_filepath
@@ -192,6 +218,7 @@ class RegistrationDeployerStep(AbstractPipelineStep):
                                       + '_space')
 
             for anno in self._patient_parameters.get_all_annotations_uids_radiological_volume(volume_uid=self.moving_volume_uid):
+                self.check_cancellation()
                 annotation = self._patient_parameters.get_annotation(annotation_uid=anno)
                 if annotation.is_registered_volume_included(destination_space_uid=self.fixed_volume_uid):
                     logging.info(f"Registered annotation ({annotation.get_annotation_type_str()}) already existing -- skipping the step")
@@ -205,7 +232,7 @@ class RegistrationDeployerStep(AbstractPipelineStep):
                                       self.moving_volume_uid + '_label_' + annotation.get_annotation_type_name() +
                                       '_registered_to_' + self.fixed_volume_uid + '.nii.gz')
                 os.makedirs(os.path.dirname(new_fp), exist_ok=True)
-                shutil.copyfile(fp, new_fp)
+                publish_volume(fp, new_fp)
                 annotation.include_registered_volume(filepath=new_fp,
                                                      registration_uid=self.registration_instance.unique_id,
                                                      destination_space_uid=self.fixed_volume_uid)
@@ -213,6 +240,7 @@ class RegistrationDeployerStep(AbstractPipelineStep):
                 # In addition, the other registered annotations towards the moving volume uid are parsed for an atlas
                 # registration case. Only the extra annotations, not featured natively for the volume uid, are registered.
                 for reganno in self._patient_parameters.get_all_registered_annotations_uids_radiological_volume(volume_uid=self.moving_volume_uid):
+                    self.check_cancellation()
                     reg_annotation = self._patient_parameters.get_annotation(annotation_uid=reganno)
                     if len(self._patient_parameters.get_all_annotations_uids_class_radiological_volume(volume_uid=self.moving_volume_uid, annotation_class=reg_annotation.get_annotation_type_enum())) == 0:
                         if reg_annotation.is_registered_volume_included(destination_space_uid=self.fixed_volume_uid):
@@ -230,7 +258,7 @@ class RegistrationDeployerStep(AbstractPipelineStep):
                                               self.moving_volume_uid + '_label_' + reg_annotation.get_annotation_type_name() +
                                               '_registered_to_' + self.fixed_volume_uid + '.nii.gz')
                         os.makedirs(os.path.dirname(new_fp), exist_ok=True)
-                        shutil.copyfile(fp, new_fp)
+                        publish_volume(fp, new_fp)
                         reg_annotation.include_registered_volume(filepath=new_fp,
                                                              registration_uid=self.registration_instance.unique_id,
                                                              destination_space_uid=self.fixed_volume_uid)
@@ -249,13 +277,14 @@ class RegistrationDeployerStep(AbstractPipelineStep):
             os.makedirs(dump_folder, exist_ok=True)
 
             try:
-                for s in ResourcesConfiguration.getInstance().neuro_features_cortical_structures:
+                for s in self._context.config.neuro_features_cortical_structures:
+                    self.check_cancellation()
                     fp = self._registration_runner.apply_registration_inverse_transform(
-                        moving=ResourcesConfiguration.getInstance().cortical_structures['MNI'][s]['Mask'],
+                        moving=self._context.config.cortical_structures['MNI'][s]['Mask'],
                         fixed=fixed_filepath, interpolation='nearestNeighbor', label='Cortical-structures/' + s)
 
                     new_fp = os.path.join(dump_folder, self.fixed_volume_uid + '_' + s + '_atlas.nii.gz')
-                    shutil.copyfile(fp, new_fp)
+                    publish_volume(fp, new_fp)
             except:
                 raise ValueError("Applying the registration on the a cortical structures atlas failed.")
 
@@ -265,17 +294,17 @@ class RegistrationDeployerStep(AbstractPipelineStep):
             os.makedirs(dump_folder, exist_ok=True)
 
             try:
-                for s in ResourcesConfiguration.getInstance().neuro_features_subcortical_structures:
-                    for i, elem in enumerate(tqdm(ResourcesConfiguration.getInstance().subcortical_structures['MNI'][s]['Singular'].keys())):
-                        raw_filename = ResourcesConfiguration.getInstance().subcortical_structures['MNI'][s]['Singular'][elem]
-                        raw_tract_ni = nib.load(raw_filename)
-                        raw_tract = raw_tract_ni.get_fdata()[:]
-                        raw_tract[raw_tract < bcb_tracts_cutoff] = 0
-                        raw_tract[raw_tract >= bcb_tracts_cutoff] = 1
-                        raw_tract = raw_tract.astype('uint8')
-                        dump_filename = os.path.join(self._registration_runner.registration_folder, os.path.basename(raw_filename))
+                for s in self._context.config.neuro_features_subcortical_structures:
+                    for i, elem in enumerate(tqdm(self._context.config.subcortical_structures['MNI'][s]['Singular'].keys())):
+                        self.check_cancellation()
+                        raw_filename = self._context.config.subcortical_structures['MNI'][s]['Singular'][elem]
+                        raw_tract_ni, raw_tract = load_intensities(raw_filename)
+                        raw_tract = (raw_tract >= bcb_tracts_cutoff).astype('uint8')
+                        dump_filename = os.path.join(self._registration_runner.registration_folder,
+                                                     os.path.basename(raw_filename).split('.')[0] +
+                                                     self._context.config.get_intermediate_extension())
                         os.makedirs(os.path.dirname(dump_filename), exist_ok=True)
-                        nib.save(nib.Nifti1Image(raw_tract, affine=raw_tract_ni.affine), dump_filename)
+                        save_mask(raw_tract, raw_tract_ni.affine, dump_filename)
 
                         fp = self._registration_runner.apply_registration_inverse_transform(
                             moving=dump_filename,
@@ -283,9 +312,9 @@ class RegistrationDeployerStep(AbstractPipelineStep):
                             interpolation='nearestNeighbor',
                             label='Subcortical-structures/' + os.path.basename(raw_filename).split('.')[0].replace('_mni', ''))
                         new_fp = os.path.join(dump_folder, self.fixed_volume_uid + '_' + s + '_atlas_' + elem + '.nii.gz')
-                        shutil.copyfile(fp, new_fp)
+                        publish_volume(fp, new_fp)
 
-                    overall_mask_filename = ResourcesConfiguration.getInstance().subcortical_structures['MNI'][s]['Mask']
+                    overall_mask_filename = self._context.config.subcortical_structures['MNI'][s]['Mask']
                     fp = self._registration_runner.apply_registration_inverse_transform(
                         moving=overall_mask_filename,
                         fixed=fixed_filepath,
@@ -293,7 +322,7 @@ class RegistrationDeployerStep(AbstractPipelineStep):
                         label='Subcortical-structures/' + s)
 
                     new_fp = os.path.join(dump_folder, self.fixed_volume_uid + '_' + s + '_atlas_overall_mask.nii.gz')
-                    shutil.copyfile(fp, new_fp)
+                    publish_volume(fp, new_fp)
             except:
                 raise ValueError("Applying the registration on the a subcortical structures atlas failed.")
 
@@ -302,8 +331,9 @@ class RegistrationDeployerStep(AbstractPipelineStep):
             os.makedirs(dump_folder, exist_ok=True)
 
             try:
-                for s in ResourcesConfiguration.getInstance().neuro_features_braingrid:
-                    overall_mask_filename = ResourcesConfiguration.getInstance().braingrid_structures['MNI'][s]['Mask']
+                for s in self._context.config.neuro_features_braingrid:
+                    self.check_cancellation()
+                    overall_mask_filename = self._context.config.braingrid_structures['MNI'][s]['Mask']
                     fp = self._registration_runner.apply_registration_inverse_transform(
                         moving=overall_mask_filename,
                         fixed=fixed_filepath,
@@ -311,7 +341,7 @@ class RegistrationDeployerStep(AbstractPipelineStep):
                         label='Braingrid-structures/' + s)
 
                     new_fp = os.path.join(dump_folder, self.fixed_volume_uid + '_' + s + '_atlas.nii.gz')
-                    shutil.copyfile(fp, new_fp)
+                    publish_volume(fp, new_fp)
             except:
                 raise ValueError("Applying the registration on the a BrainGrid structures atlas failed.")
         except Exception as e:
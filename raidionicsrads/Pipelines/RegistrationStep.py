@@ -1,12 +1,13 @@
 import os
 import shutil
-import numpy as np
 import nibabel as nib
 import logging
 import configparser
 import traceback
-from ..Utils.configuration_parser import ResourcesConfiguration
+from typing import Tuple
+from ..Utils.run_context import RunContext
 from ..Utils.io import load_nifti_volume
+from ..Utils.result_cache import ResultCache
 from ..Utils.ants_registration import *
 from ..Processing.brain_processing import *
 from .AbstractPipelineStep import AbstractPipelineStep
@@ -27,10 +28,11 @@ class RegistrationStep(AbstractPipelineStep):
     _fixed_volume_filepath = None
     _moving_mask_filepath = None
     _fixed_mask_filepath = None
+    _mask_annotation_uids = None  # Unique ids of the brain mask annotations used for the registration, if any
     _registration_runner = None
 
-    def __init__(self, step_json: dict):
-        super(RegistrationStep, self).__init__(step_json=step_json)
+    def __init__(self, step_json: dict, context: RunContext = None):
+        super(RegistrationStep, self).__init__(step_json=step_json, context=context)
         self.__reset()
         self._registration_runner = ANTsRegistration()
 
@@ -44,6 +46,7 @@ class RegistrationStep(AbstractPipelineStep):
         self._registration_runner = None
         self._moving_mask_filepath = None
         self._fixed_mask_filepath = None
+        self._mask_annotation_uids = []
 
     @property
     def moving_volume_uid(self) -> str:
@@ -66,8 +69,9 @@ class RegistrationStep(AbstractPipelineStep):
 
         """
         self._patient_parameters = patient_parameters
+        self._registration_runner.cancellation_token = self.cancellation_token
         try:
-            if ResourcesConfiguration.getInstance().predictions_use_registered_data and self._step_json["fixed"]["sequence"] != 'MNI':
+            if self._context.config.predictions_use_registered_data and self._step_json["fixed"]["sequence"] != 'MNI':
                 self.skip = True
                 return
             # Check if a registration instance exists for this combination
@@ -81,7 +85,7 @@ class RegistrationStep(AbstractPipelineStep):
                 self.moving_volume_uid = moving_volume_uid
                 self._moving_volume_filepath = self._patient_parameters.get_radiological_volume(volume_uid=self.moving_volume_uid).usable_input_filepath
             elif self._step_json["moving"]["timestamp"] == -1:  # Atlas file
-                self._moving_volume_filepath = ResourcesConfiguration.getInstance().mni_atlas_filepath_T1
+                self._moving_volume_filepath = self._context.config.mni_atlas_filepath_T1
             elif self._inclusion == "optional":
                 self.skip = True
                 return
@@ -96,7 +100,7 @@ class RegistrationStep(AbstractPipelineStep):
                 self._fixed_volume_uid = fixed_volume_uid
                 self._fixed_volume_filepath = self._patient_parameters.get_radiological_volume(volume_uid=self._fixed_volume_uid).usable_input_filepath
             elif self._step_json["fixed"]["timestamp"] == -1:  # Atlas file
-                self._fixed_volume_filepath = ResourcesConfiguration.getInstance().mni_atlas_filepath_T1
+                self._fixed_volume_filepath = self._context.config.mni_atlas_filepath_T1
             else:
                 raise ValueError("[RegistrationStep] Requested registration fixed input cannot be found for: {}".format(self._step_json["fixed"]))
             if not os.path.exists(self._fixed_volume_filepath):
@@ -118,7 +122,7 @@ class RegistrationStep(AbstractPipelineStep):
 
         """
         if self.skip:
-            if ResourcesConfiguration.getInstance().predictions_use_registered_data and self._step_json["fixed"][
+            if self._context.config.predictions_use_registered_data and self._step_json["fixed"][
                 "sequence"] != 'MNI':
                 logging.info("Skipping registration - not necessary since using co-registered inputs")
                 return self._patient_parameters
@@ -142,6 +146,28 @@ class RegistrationStep(AbstractPipelineStep):
 
         return self._patient_parameters
 
+    def assess(self, planner) -> Tuple[str, str]:
+        """
+        Pre-flight check that both moving and fixed volumes are available, and that the registration is needed.
+        """
+        moving = self._step_json["moving"]
+        fixed = self._step_json["fixed"]
+        if self._context.config.predictions_use_registered_data and fixed["sequence"] != 'MNI':
+            return "skip", "Registration not necessary since using co-registered inputs."
+        if planner.has_registration(moving=moving, fixed=fixed):
+            return "skip", "Registration already existing."
+        if not planner.has_volume(moving):
+            if self._inclusion == "optional":
+                return "skip", "No radiological volume for {}.".format(moving)
+            return "fail", "No radiological volume for {}.".format(moving)
+        if not planner.has_volume(fixed):
+            return "fail", "No radiological volume for {}.".format(fixed)
+        if planner.has_registered_volume(moving, fixed):
+            return "skip", "Registered volume manually provided."
+        planner.produce(('registration', moving["timestamp"], moving["sequence"], fixed["timestamp"],
+                         fixed["sequence"]))
+        return "ready", ""
+
     def cleanup(self):
         self._registration_runner.clear_cache()
 
@@ -152,60 +178,107 @@ class RegistrationStep(AbstractPipelineStep):
         """
         fixed_masked_filepath = None
         moving_masked_filepath = None
+        self._mask_annotation_uids = []
         try:
-            if ResourcesConfiguration.getInstance().diagnosis_task == 'neuro_diagnosis':
+            if self._context.config.diagnosis_task == 'neuro_diagnosis':
                 if self.fixed_volume_uid:
                     brain_anno = self._patient_parameters.get_all_annotations_uids_class_radiological_volume(self.fixed_volume_uid, AnnotationClassType.Brain)
                     if len(brain_anno) != 0:
                         self._fixed_mask_filepath = self._patient_parameters.get_annotation(annotation_uid=brain_anno[0]).usable_input_filepath
+                        self._mask_annotation_uids.append(brain_anno[0])
                 else:
-                    self._fixed_mask_filepath = ResourcesConfiguration.getInstance().mni_atlas_brain_mask_filepath
+                    self._fixed_mask_filepath = self._context.config.mni_atlas_brain_mask_filepath
 
                 if self.moving_volume_uid:
                     brain_anno = self._patient_parameters.get_all_annotations_uids_class_radiological_volume(self.moving_volume_uid, AnnotationClassType.Brain)
                     if len(brain_anno) != 0:
                         self._moving_mask_filepath = self._patient_parameters.get_annotation(annotation_uid=brain_anno[0]).usable_input_filepath
+                        self._mask_annotation_uids.append(brain_anno[0])
                 else:
-                    self._moving_mask_filepath = ResourcesConfiguration.getInstance().mni_atlas_brain_mask_filepath
+                    self._moving_mask_filepath = self._context.config.mni_atlas_brain_mask_filepath
 
                 moving_masked_filepath = perform_brain_masking(image_filepath=self._moving_volume_filepath,
                                                                mask_filepath=self._moving_mask_filepath,
-                                                               output_folder=self._registration_runner.registration_folder)
+                                                               output_folder=self._registration_runner.registration_folder,
+                                                               context=self._context)
                 fixed_masked_filepath = perform_brain_masking(image_filepath=self._fixed_volume_filepath,
                                                               mask_filepath=self._fixed_mask_filepath,
-                                                              output_folder=self._registration_runner.registration_folder)
+                                                              output_folder=self._registration_runner.registration_folder,
+                                                              context=self._context)
                 return fixed_masked_filepath, moving_masked_filepath
         except Exception as e:
             raise ValueError(f"Preprocessing step failed to proceed with: {e}.")
 
+    def __compute_registration(self, fixed_filepath, moving_filepath, registration_method):
+        """
+        Computes the registration transforms, unless the same registration was already computed on the same inputs,
+        in which case the transforms are restored from the results cache (if enabled).
+        """
+        cache = ResultCache.from_configuration(config=self._context.config)
+        cache_key = None
+        if cache is not None:
+            input_fps = [x for x in [self._moving_volume_filepath, self._moving_mask_filepath,
+                                     self._fixed_volume_filepath, self._fixed_mask_filepath] if x is not None]
+            try:
+                runtime_parameters = {"task": self._context.config.diagnosis_task,
+                                      "registration": self._registration_runner.registration_parameters(
+                                          registration_method)}
+                cache_key = ResultCache.compute_key(step_json=self._step_json, input_filepaths=input_fps,
+                                                    runtime_parameters=runtime_parameters)
+            except Exception as e:
+                logging.warning("[RegistrationStep] Computing the results cache key failed with: {}. Running without"
+                                " the results cache.".format(e))
+                logging.debug("Traceback: {}.".format(traceback.format_exc()))
+                cache = None
+        if cache is not None:
+            manifest = cache.restore(key=cache_key, destination_folder=self._registration_runner.registration_folder)
+            if manifest is not None:
+                logging.info("[RegistrationStep] Registration transforms restored from cache (key: {}).".format(cache_key))
+                self._registration_runner.reg_transform['fwdtransforms'] = [manifest["restored"][x] for x in
+                                                                            manifest["metadata"]["fwdtransforms"]]
+                self._registration_runner.reg_transform['invtransforms'] = [manifest["restored"][x] for x in
+                                                                            manifest["metadata"]["invtransforms"]]
+                return
+
+        self._registration_runner.compute_registration(fixed=fixed_filepath, moving=moving_filepath,
+                                                       registration_method=registration_method)
+
+        if cache is not None:
+            # Transform filenames can be shared between directions (e.g., the affine matrix), and their order matters.
+            files = {}
+            metadata = {"fwdtransforms": [], "invtransforms": []}
+            for direction in ["fwdtransforms", "invtransforms"]:
+                for i, fp in enumerate(self._registration_runner.reg_transform[direction]):
+                    name = os.path.join(direction, str(i), os.path.basename(fp))
+                    files[name] = fp
+                    metadata[direction].append(name)
+            cache.store(key=cache_key, files=files, metadata=metadata)
+
     def __registration(self, fixed_filepath, moving_filepath):
         try:
             registration_method = 'SyN'
-            logging.info("[RegistrationStep] Using {} ANTs backend.".format(ResourcesConfiguration.getInstance().system_ants_backend))
-            if ResourcesConfiguration.getInstance().system_ants_backend == "cpp":
-                logging.info("[RegistrationStep] ANTs root located in {}.".format(ResourcesConfiguration.getInstance().ants_root))
+            logging.info("[RegistrationStep] Using {} ANTs backend.".format(self._context.config.system_ants_backend))
+            if self._context.config.system_ants_backend == "cpp":
+                logging.info("[RegistrationStep] ANTs root located in {}.".format(self._context.config.ants_root))
             try:
-                self._registration_runner.compute_registration(fixed=fixed_filepath, moving=moving_filepath,
-                                                               registration_method=registration_method)
+                self.__compute_registration(fixed_filepath=fixed_filepath, moving_filepath=moving_filepath,
+                                            registration_method=registration_method)
             except Exception as e:
                 raise RuntimeError(f"ANTs execution code failed with: {e}")
 
-            non_available_uid = True
-            reg_uid = None
-            while non_available_uid:
-                reg_uid = 'R' + str(np.random.randint(0, 10000))
-                if reg_uid not in self._patient_parameters.get_all_annotations_uids():
-                    non_available_uid = False
-
             if self.fixed_volume_uid is None:
                 self.fixed_volume_uid = 'MNI'
             if self.moving_volume_uid is None:
                 self.moving_volume_uid = 'MNI'
+            # The registration is identified by the (content-derived) uids of the registered volumes
+            reg_uid = self._patient_parameters.generate_uid('R', role='registration',
+                                                            content_digest=self.moving_volume_uid + '-to-' + self.fixed_volume_uid)
 
             registration = Registration(uid=reg_uid, fixed_uid=self.fixed_volume_uid, moving_uid=self.moving_volume_uid,
                                         fwd_paths=self._registration_runner.reg_transform['fwdtransforms'],
                                         inv_paths=self._registration_runner.reg_transform['invtransforms'],
-                                        output_folder=ResourcesConfiguration.getInstance().output_folder)
+                                        output_folder=self._context.config.output_folder,
+                                        source_uids=self._mask_annotation_uids)
             self._patient_parameters.include_registration(reg_uid, registration)
             self._registration_runner.clear_cache()
         except Exception as e:
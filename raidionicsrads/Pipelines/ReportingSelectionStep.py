@@ -11,7 +11,7 @@ import json
 from typing import List
 
 from ..Utils.utilities import get_type_from_string, get_type_from_enum_name
-from ..Utils.configuration_parser import ResourcesConfiguration
+from ..Utils.run_context import RunContext
 from ..Utils.io import load_nifti_volume
 from .AbstractPipelineStep import AbstractPipelineStep
 from ..Utils.DataStructures.PatientStructure import PatientParameters
@@ -28,8 +28,8 @@ class ReportingSelectionStep(AbstractPipelineStep):
     _timestamps = None
     _tumor_type = None  # Type of tumor generally, i.e., contrast-enhancing or non contrast-enhancing
 
-    def __init__(self, step_json: dict):
-        super(ReportingSelectionStep, self).__init__(step_json=step_json)
+    def __init__(self, step_json: dict, context: RunContext = None):
+        super(ReportingSelectionStep, self).__init__(step_json=step_json, context=context)
         self.__reset()
         step_keys = list(self._step_json.keys())
         self._scope_reporting = self._step_json["scope"] if "scope" in step_keys else None
@@ -99,7 +99,7 @@ class ReportingSelectionStep(AbstractPipelineStep):
             existing pipeline.
         """
         try:
-            if ResourcesConfiguration.getInstance().diagnosis_task == 'neuro_diagnosis':
+            if self._context.config.diagnosis_task == 'neuro_diagnosis':
                 reporting_pipeline = self.__generate_neuro_reporting_pipeline()
             else:
                 reporting_pipeline = self.__generate_mediastinum_reporting_pipeline()
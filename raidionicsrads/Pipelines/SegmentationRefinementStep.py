@@ -5,10 +5,11 @@ import nibabel as nib
 import logging
 import configparser
 import traceback
+from typing import Tuple
 from ..Utils.utilities import get_type_from_string, get_type_from_enum_name
-from ..Utils.configuration_parser import ResourcesConfiguration
+from ..Utils.run_context import RunContext
 from ..Utils.volume_utilities import prediction_binary_dilation
-from ..Utils.io import load_nifti_volume
+from ..Utils.io import load_nifti_volume, load_mask, save_mask
 from .AbstractPipelineStep import AbstractPipelineStep
 from ..Utils.DataStructures.PatientStructure import PatientParameters
 from ..Utils.DataStructures.AnnotationStructure import Annotation, AnnotationClassType, BrainTumorType
@@ -27,8 +28,8 @@ class SegmentationRefinementStep(AbstractPipelineStep):
     _refinement_operation = None  # Type of refinement to operate
     _refinement_args = None  # Generic arguments needed for the specified refinement operation
 
-    def __init__(self, step_json: dict):
-        super(SegmentationRefinementStep, self).__init__(step_json=step_json)
+    def __init__(self, step_json: dict, context: RunContext = None):
+        super(SegmentationRefinementStep, self).__init__(step_json=step_json, context=context)
         self.__reset()
         self._refinement_operation = self._step_json["operation"]
         self._refinement_args = self._step_json["args"]
@@ -62,7 +63,7 @@ class SegmentationRefinementStep(AbstractPipelineStep):
         """
         self._patient_parameters = patient_parameters
 
-        self._working_folder = os.path.join(ResourcesConfiguration.getInstance().output_folder, "seg_refinement_tmp")
+        self._working_folder = os.path.join(self._context.config.output_folder, "seg_refinement_tmp")
         os.makedirs(self._working_folder, exist_ok=True)
         os.makedirs(os.path.join(self._working_folder, 'inputs'), exist_ok=True)
         os.makedirs(os.path.join(self._working_folder, 'outputs'), exist_ok=True)
@@ -82,7 +83,7 @@ class SegmentationRefinementStep(AbstractPipelineStep):
                     # for specifying the volume the annotation is linked to, if multiple inputs.
                     if not self._input_volume_uid:
                         self._input_volume_uid = volume_uid
-                    if self.refinement_operation != "brain_overlap" and ResourcesConfiguration.getInstance().predictions_use_stripped_data:
+                    if self.refinement_operation != "brain_overlap" and self._context.config.predictions_use_stripped_data:
                         self.skip = True
                         return
                     if self.refinement_operation != "global_context":
@@ -122,12 +123,12 @@ class SegmentationRefinementStep(AbstractPipelineStep):
             Updated placeholder with the results of the current step.
         """
         if self.skip:
-            if self.refinement_operation != "brain_overlap" and ResourcesConfiguration.getInstance().predictions_use_stripped_data:
+            if self.refinement_operation != "brain_overlap" and self._context.config.predictions_use_stripped_data:
                 logging.info("Skipping brain overlap segmentation refinement, the input scans are skull-stripped")
             return self._patient_parameters
 
         try:
-            if ResourcesConfiguration.getInstance().diagnosis_task == 'neuro_diagnosis':
+            if self._context.config.diagnosis_task == 'neuro_diagnosis':
                 self.__perform_neuro_postprocessing()
             else:
                 self.__perform_mediastinum_postprocessing()
@@ -135,6 +136,20 @@ class SegmentationRefinementStep(AbstractPipelineStep):
             raise ValueError("[SegmentationRefinementStep] Step execution failed with: {}.".format(e))
         return self._patient_parameters
 
+    def assess(self, planner) -> Tuple[str, str]:
+        """
+        Pre-flight check that the volume and annotation to refine are, or will be, available.
+        """
+        input_json = self._step_json["inputs"][list(self._step_json["inputs"].keys())[0]]
+        if not planner.has_volume(input_json):
+            return "fail", "No radiological volume for {}.".format(input_json)
+        if self.refinement_operation != "brain_overlap" and self._context.config.predictions_use_stripped_data:
+            return "skip", "Refinement not necessary since using skull-stripped inputs."
+        if self.refinement_operation != "global_context":
+            if not input_json["labels"] or not planner.has_annotation(input_json, input_json["labels"]):
+                return "fail", "No annotation to refine for {}.".format(input_json)
+        return "ready", ""
+
     def cleanup(self):
         if self._working_folder is not None and os.path.exists(self._working_folder):
             shutil.rmtree(self._working_folder)
@@ -158,6 +173,8 @@ class SegmentationRefinementStep(AbstractPipelineStep):
                 brain_mask_filepath = self._patient_parameters.get_annotation(
                     annotation_uid=brain_annotation_uid).usable_input_filepath
                 perform_brain_overlap_refinement(predictions_filepath=predictions_filepath, brain_mask_filepath=brain_mask_filepath)
+                self._patient_parameters.get_annotation(annotation_uid=self._input_annotation_uid).add_source_uids(
+                    [brain_annotation_uid])
             elif self.refinement_operation == "brain_overlap":
                 predictions_filepath = self._patient_parameters.get_annotation(annotation_uid=self._input_annotation_uid).usable_input_filepath
                 brain_annotation_uids = self._patient_parameters.get_all_annotations_uids_class_radiological_volume(volume_uid=self._input_volume_uid, annotation_class=AnnotationClassType.Brain)
@@ -167,20 +184,25 @@ class SegmentationRefinementStep(AbstractPipelineStep):
                 brain_mask_filepath = self._patient_parameters.get_annotation(
                     annotation_uid=brain_annotation_uid).usable_input_filepath
                 perform_brain_overlap_refinement(predictions_filepath=predictions_filepath, brain_mask_filepath=brain_mask_filepath)
+                self._patient_parameters.get_annotation(annotation_uid=self._input_annotation_uid).add_source_uids(
+                    [brain_annotation_uid])
             elif self.refinement_operation == "global_context":
                 annotation_files = {}
+                source_uids = []  # Annotations used for the refinement, besides the ones of the input volume
                 for a in self._patient_parameters.get_all_annotations_radiological_volume(volume_uid=self._input_volume_uid):
                     annotation_files[a.get_annotation_type_str()] = a.usable_input_filepath
                 for v in self._patient_parameters.get_all_radiological_volumes_for_timestamp(timestamp=self._step_json["inputs"]["0"]["timestamp"]):
                     if v.unique_id != self._input_volume_uid:
                         linked_annos = self._patient_parameters.get_all_annotations_radiological_volume(v.unique_id)
                         for anno in linked_annos:
-                            if not ResourcesConfiguration.getInstance().predictions_use_registered_data:
+                            if not self._context.config.predictions_use_registered_data:
                                 if self._input_volume_uid in list(anno.registered_volumes.keys()):
                                     if anno.get_annotation_type_str() not in list(annotation_files.keys()):
                                         annotation_files[anno.get_annotation_type_str()] = anno.registered_volumes[self._input_volume_uid]["filepath"]
+                                        source_uids.append(anno.unique_id)
                             else:
                                 annotation_files[anno.get_annotation_type_str()] = anno.usable_input_filepath
+                                source_uids.append(anno.unique_id)
 
                 tumor_general_type = "contrast-enhancing"
                 if self.step_json["inputs"]["0"]["labels"] == "FLAIRChanges":
@@ -189,20 +211,20 @@ class SegmentationRefinementStep(AbstractPipelineStep):
                                                                    timestamp=self._step_json["inputs"]["0"]["timestamp"],
                                                                                    tumor_general_type=tumor_general_type)
                 for ranno in list(refined_annos.keys()):
-                    if not self._patient_parameters.get_all_annotations_uids_class_radiological_volume(volume_uid=self._input_volume_uid,
-                                                                                                       annotation_class=ranno):
+                    existing_uids = self._patient_parameters.get_all_annotations_uids_class_radiological_volume(
+                        volume_uid=self._input_volume_uid, annotation_class=ranno)
+                    for uid in existing_uids:
+                        self._patient_parameters.get_annotation(annotation_uid=uid).add_source_uids(source_uids)
+                    if not existing_uids:
                         # A new annotation has been created and should be included.
-                        non_available_uid = True
-                        anno_uid = None
-                        while non_available_uid:
-                            anno_uid = 'A' + str(np.random.randint(0, 10000))
-                            if anno_uid not in self._patient_parameters.get_all_annotations_uids():
-                                non_available_uid = False
+                        anno_uid = self._patient_parameters.generate_uid(
+                            'A', filepath=refined_annos[ranno], role='refinement',
+                            timestamp_uid=self._patient_parameters.get_radiological_volume(volume_uid=self._input_volume_uid).timestamp_uid)
                         annotation = Annotation(uid=anno_uid, input_filename=refined_annos[ranno],
                                                 output_folder=self._patient_parameters.get_radiological_volume(
                                                     volume_uid=self._input_volume_uid).output_folder,
                                                 radiological_volume_uid=self._input_volume_uid,
-                                                annotation_class=ranno)
+                                                annotation_class=ranno, source_uids=source_uids)
                         self._patient_parameters.include_annotation(anno_uid, annotation)
             else:
                 raise ValueError("The selected refinement operation is not available, with value {}".format(self.refinement_operation))
@@ -229,12 +251,11 @@ class SegmentationRefinementStep(AbstractPipelineStep):
 
             for fn in segmentation_files:
                 seg_fn = os.path.join(segmentation_folder, fn)
-                seg_ni = nib.load(seg_fn)
-                seg = seg_ni.get_fdata()[:]
+                seg_ni, seg = load_mask(seg_fn)
 
                 res = None
                 if self.refinement_operation == "dilation":
-                    res = prediction_binary_dilation(seg.astype('uint8'),
+                    res = prediction_binary_dilation(seg,
                                                      voxel_volume=np.prod(seg_ni.header.get_zooms()) * 1e-3,
                                                      arg=int(self._refinement_args))
                 elif self.refinement_operation == "brain_overlap":
@@ -242,9 +263,8 @@ class SegmentationRefinementStep(AbstractPipelineStep):
                 else:
                     raise ValueError("The selected refinement operation is not available, with value {}".format(self.refinement_operation))
 
-                res_ni = nib.Nifti1Image(res, affine=seg_ni.affine)
                 output_fn = os.path.join(self._working_folder, 'outputs', fn)
-                nib.save(res_ni, output_fn)
+                save_mask(res, seg_ni.affine, output_fn)
 
         except Exception as e:
             if os.path.exists(self._working_folder):
@@ -1,13 +1,14 @@
 import os
 import shutil
-import numpy as np
 import nibabel as nib
 import logging
 import configparser
 import traceback
+from typing import Tuple
 from ..Utils.utilities import get_type_from_string, get_type_from_enum_name
-from ..Utils.configuration_parser import ResourcesConfiguration
-from ..Utils.io import load_nifti_volume
+from ..Utils.run_context import RunContext
+from ..Utils.segmentation_backend import run_segmentation_model
+from ..Utils.result_cache import ResultCache
 from .AbstractPipelineStep import AbstractPipelineStep
 from ..Utils.DataStructures.PatientStructure import PatientParameters
 from ..Utils.DataStructures.AnnotationStructure import Annotation, AnnotationClassType, BrainTumorType
@@ -23,9 +24,11 @@ class SegmentationStep(AbstractPipelineStep):
     _model_name = None  # Basename of the folder containing the model to execute
     _patient_parameters = None  # Overall patient parameters, updated on-the-fly
     _working_folder = None  # Temporary directory on disk to store inputs/outputs for the segmentation
+    _input_filepaths = None  # Filepaths of the model inputs, indexed by their rank for the model
+    _source_uids = None  # Unique ids of the radiological volumes and annotations used as model inputs
 
-    def __init__(self, step_json: dict):
-        super(SegmentationStep, self).__init__(step_json=step_json)
+    def __init__(self, step_json: dict, context: RunContext = None):
+        super(SegmentationStep, self).__init__(step_json=step_json, context=context)
         self.__reset()
         # @TODO. Extend the model_name if multiple are available based on the number of inputs (postop seg) with e.g. _1c, _2c, etc...
         self._model_name = self._step_json["model"]
@@ -41,6 +44,8 @@ class SegmentationStep(AbstractPipelineStep):
         self._model_name = None
         self._patient_parameters = None
         self._working_folder = None
+        self._input_filepaths = {}
+        self._source_uids = []
 
     def setup(self, patient_parameters: PatientParameters) -> None:
         """
@@ -52,8 +57,10 @@ class SegmentationStep(AbstractPipelineStep):
             Placeholder for the current patient data, which will be updated with the results of this step.
         """
         self._patient_parameters = patient_parameters
+        self._input_filepaths = {}
+        self._source_uids = []
 
-        self._working_folder = os.path.join(ResourcesConfiguration.getInstance().output_folder, "segmentation_tmp")
+        self._working_folder = os.path.join(self._context.config.output_folder, "segmentation_tmp")
         os.makedirs(self._working_folder, exist_ok=True)
         os.makedirs(os.path.join(self._working_folder, 'inputs'), exist_ok=True)
         os.makedirs(os.path.join(self._working_folder, 'outputs'), exist_ok=True)
@@ -64,11 +71,12 @@ class SegmentationStep(AbstractPipelineStep):
                 # Use-case where the radiological volume should be used in its original reference space
                 if ((input_json["space"]["timestamp"] == input_json["timestamp"] and
                     input_json["space"]["sequence"] == input_json["sequence"]) or
-                        ResourcesConfiguration.getInstance().predictions_use_registered_data):
+                        self._context.config.predictions_use_registered_data):
                     volume_uid = self._patient_parameters.get_radiological_volume_uid(timestamp=input_json["timestamp"],
                                                                                       sequence=input_json["sequence"])
                     if volume_uid == "-1":
                         raise ValueError("No radiological volume for {}.".format(input_json))
+                    self._source_uids.append(volume_uid)
 
                     # Assuming the first input is actually the final target. Might need to add another parameter
                     # for specifying the volume the annotation is linked to, if multiple inputs.
@@ -82,18 +90,17 @@ class SegmentationStep(AbstractPipelineStep):
                         if len(anno_uids) == 0:
                             raise ValueError("No annotation for {}.".format(input_json))
                         anno_uid = anno_uids[0]
+                        self._source_uids.append(anno_uid)
                         input_fp = self._patient_parameters.get_annotation(annotation_uid=anno_uid).usable_input_filepath
                         if not os.path.exists(input_fp):
                             raise ValueError("No annotation file on disk for {}.".format(input_fp))
-                        new_fp = os.path.join(self._working_folder, 'inputs', 'input' + str(k) + '.nii.gz')
-                        shutil.copyfile(input_fp, new_fp)
+                        self._input_filepaths[int(k)] = input_fp
                     else:
                         if volume_uid != "-1":
                             input_fp = self._patient_parameters.get_radiological_volume(volume_uid=volume_uid).usable_input_filepath
                             if not os.path.exists(input_fp):
                                 raise ValueError("No radiological volume file on disk for {}.".format(input_fp))
-                            new_fp = os.path.join(self._working_folder, 'inputs', 'input' + str(k) + '.nii.gz')
-                            shutil.copyfile(input_fp, new_fp)
+                            self._input_filepaths[int(k)] = input_fp
                         else:
                             raise ValueError("No radiological volume for {}.".format(input_json))
 
@@ -103,6 +110,7 @@ class SegmentationStep(AbstractPipelineStep):
                                                                                       sequence=input_json["sequence"])
                     if volume_uid == "-1":
                         raise ValueError("No radiological volume for {}.".format(input_json))
+                    self._source_uids.append(volume_uid)
 
                     ref_space_uid = self._patient_parameters.get_radiological_volume_uid(timestamp=input_json["space"]["timestamp"],
                                                                                          sequence=input_json["space"]["sequence"])
@@ -110,6 +118,8 @@ class SegmentationStep(AbstractPipelineStep):
                         raise ValueError("No radiological volume for {}.".format(input_json["space"]))
                     else:  # @TODO. The reference space is an atlas, have to make an extra-pass for this.
                         pass
+                    if ref_space_uid != "-1":
+                        self._source_uids.append(ref_space_uid)
 
                     # Use-case where the input is actually an annotation and not a radiological volume
                     if input_json["labels"]:
@@ -122,24 +132,22 @@ class SegmentationStep(AbstractPipelineStep):
                         if len(anno_uids) == 0:
                             raise ValueError("No annotation for {}.".format(input_json))
                         anno_uid = anno_uids[0]
+                        self._source_uids.append(anno_uid)
                         input_fp = self._patient_parameters.get_annotation(annotation_uid=anno_uid).get_registered_volume_info(ref_space_uid)["filepath"]
                         if not os.path.exists(input_fp):
                             raise ValueError("No registered annotation file on disk for {}.".format(input_fp))
-                        new_fp = os.path.join(self._working_folder, 'inputs', 'input' + str(k) + '.nii.gz')
-                        shutil.copyfile(input_fp, new_fp)
+                        self._input_filepaths[int(k)] = input_fp
                     # Use-case where the provided inputs are already co-registered
-                    elif ResourcesConfiguration.getInstance().predictions_use_registered_data:
+                    elif self._context.config.predictions_use_registered_data:
                         input_fp = self._patient_parameters.get_radiological_volume(volume_uid=volume_uid).usable_input_filepath
                         if not os.path.exists(input_fp):
                             raise ValueError("No radiological volume file on disk for {}.".format(input_fp))
-                        new_fp = os.path.join(self._working_folder, 'inputs', 'input' + str(k) + '.nii.gz')
-                        shutil.copyfile(input_fp, new_fp)
+                        self._input_filepaths[int(k)] = input_fp
                     else:
                         reg_fp = self._patient_parameters.get_radiological_volume(volume_uid=volume_uid).get_registered_volume_info(ref_space_uid)["filepath"]
                         if not os.path.exists(reg_fp):
                             raise ValueError("No registered radiological file on disk for {}.".format(reg_fp))
-                        new_fp = os.path.join(self._working_folder, 'inputs', 'input' + str(k) + '.nii.gz')
-                        shutil.copyfile(reg_fp, new_fp)
+                        self._input_filepaths[int(k)] = reg_fp
         except Exception as e:
             if os.path.exists(self._working_folder):
                 shutil.rmtree(self._working_folder)
@@ -155,12 +163,29 @@ class SegmentationStep(AbstractPipelineStep):
             Updated placeholder with the results of the current step.
         """
         if self._input_volume_uid:
-            if ResourcesConfiguration.getInstance().diagnosis_task == 'neuro_diagnosis':
+            if self._context.config.diagnosis_task == 'neuro_diagnosis':
                 self.__perform_neuro_segmentation()
             else:
                 self.__perform_mediastinum_segmentation()
         return self._patient_parameters
 
+    def assess(self, planner) -> Tuple[str, str]:
+        """
+        Pre-flight check that all inputs are, or will be, available. The annotations the model will generate are
+        attached to the radiological volume of the first input.
+        """
+        input_keys = list(self._step_json["inputs"].keys())
+        for k in input_keys:
+            reason = planner.assess_input(self._step_json["inputs"][k])
+            if reason is not None:
+                return "fail", reason
+        target_volume = self._step_json["inputs"][input_keys[0]]
+        if planner.has_annotation(target_volume, self._segmentation_targets[0]):
+            return "skip", "Segmentation results already existing for {}.".format(self._segmentation_targets[0])
+        for t in self._segmentation_targets:
+            planner.produce(('annotation', target_volume["timestamp"], target_volume["sequence"], t))
+        return "ready", ""
+
     def cleanup(self):
         if self._working_folder is not None and os.path.exists(self._working_folder):
             shutil.rmtree(self._working_folder)
@@ -181,28 +206,28 @@ class SegmentationStep(AbstractPipelineStep):
 
             seg_config = configparser.ConfigParser()
             seg_config.add_section('System')
-            seg_config.set('System', 'gpu_id', ResourcesConfiguration.getInstance().gpu_id)
+            seg_config.set('System', 'gpu_id', self._context.config.gpu_id)
             seg_config.set('System', 'inputs_folder', os.path.join(self._working_folder, 'inputs'))
             seg_config.set('System', 'output_folder', os.path.join(self._working_folder, 'outputs'))
             seg_config.set('System', 'model_folder',
-                           os.path.join(ResourcesConfiguration.getInstance().model_folder, self._model_name))
+                           os.path.join(self._context.config.model_folder, self._model_name))
             seg_config.add_section('Runtime')
             seg_config.set('Runtime', 'reconstruction_method',
-                           ResourcesConfiguration.getInstance().predictions_reconstruction_method)
+                           self._context.config.predictions_reconstruction_method)
             if self._segmentation_output_type:
                 seg_config.set('Runtime', 'reconstruction_method', self._segmentation_output_type)
             seg_config.set('Runtime', 'reconstruction_order',
-                           ResourcesConfiguration.getInstance().predictions_reconstruction_order)
+                           self._context.config.predictions_reconstruction_order)
             seg_config.set('Runtime', 'use_preprocessed_data',
-                           str(ResourcesConfiguration.getInstance().predictions_use_stripped_data))
+                           str(self._context.config.predictions_use_stripped_data))
             seg_config.set('Runtime', 'folds_ensembling',
-                           str(ResourcesConfiguration.getInstance().predictions_folds_ensembling))
+                           str(self._context.config.predictions_folds_ensembling))
             seg_config.set('Runtime', 'ensembling_strategy',
-                           ResourcesConfiguration.getInstance().predictions_ensembling_strategy)
+                           self._context.config.predictions_ensembling_strategy)
             seg_config.set('Runtime', 'test_time_augmentation_iteration',
-                           str(ResourcesConfiguration.getInstance().predictions_test_time_augmentation_iterations))
+                           str(self._context.config.predictions_test_time_augmentation_iterations))
             seg_config.set('Runtime', 'test_time_augmentation_fusion_mode',
-                           ResourcesConfiguration.getInstance().predictions_test_time_augmentation_fusion_mode)
+                           self._context.config.predictions_test_time_augmentation_fusion_mode)
 
             # @TODO. Have to be slightly improved, but should be working for our use-cases for now.
             existing_brain_annotations = self._patient_parameters.get_all_annotations_uids_class_radiological_volume(volume_uid=self._input_volume_uid,
@@ -211,6 +236,7 @@ class SegmentationStep(AbstractPipelineStep):
                 seg_config.add_section('Neuro')
                 seg_config.set('Neuro', 'brain_segmentation_filename',
                                self._patient_parameters.get_annotation(annotation_uid=existing_brain_annotations[0]).usable_input_filepath)
+                self._source_uids.append(existing_brain_annotations[0])
             seg_config_filename = os.path.join(os.path.join(self._working_folder, 'inputs'), 'seg_config.ini')
             with open(seg_config_filename, 'w') as outfile:
                 seg_config.write(outfile)
@@ -224,8 +250,8 @@ class SegmentationStep(AbstractPipelineStep):
             elif log_level == 40:
                 log_str = 'error'
 
-            from raidionicsseg.fit import run_model
-            run_model(seg_config_filename)
+            predictions = self.__run_segmentation_model(seg_config=seg_config,
+                                                        seg_config_filename=seg_config_filename)
         except Exception as e:
             if os.path.exists(self._working_folder):
                 shutil.rmtree(self._working_folder)
@@ -233,34 +259,22 @@ class SegmentationStep(AbstractPipelineStep):
 
         try:
             # Collecting the results and associating them with the parent radiological volume.
-            generated_segmentations = []
-            for _, _, files in os.walk(os.path.join(self._working_folder, 'outputs')):
-                for f in files:
-                    if 'nii.gz' in f:
-                        generated_segmentations.append(f)
-                break
-
-            for s in generated_segmentations:
+            for s in sorted(predictions.keys()):
                 label_name = s.split('_')[1].split('.')[0]
                 if label_name in self._segmentation_targets:
                     # @TODO. If multiple models generate the same output class, how to deal with it internally?
                     # E.g., the issue with the cavity/necrosis disambiguation, how to hold multiple tumor segmentations
                     # before performing some kind of refinement?
-                    seg_filename = os.path.join(os.path.join(self._working_folder, 'outputs'), s)
                     final_seg_filename = os.path.join(self._patient_parameters.get_radiological_volume(volume_uid=self._input_volume_uid).output_folder,
                                                       os.path.basename(self._patient_parameters.get_radiological_volume(volume_uid=self._input_volume_uid).raw_input_filepath).split('.')[0] + '_annotation-' + label_name  + '_' + self._step_json["model"].split('/')[0] + '.nii.gz')
-                    if not os.path.exists(seg_filename):
-                        raise ValueError("Segmentation results file could not be found on disk at {}".format(seg_filename))
-                    shutil.move(seg_filename, final_seg_filename)
-                    non_available_uid = True
-                    anno_uid = None
-                    while non_available_uid:
-                        anno_uid = 'A' + str(np.random.randint(0, 10000))
-                        if anno_uid not in self._patient_parameters.get_all_annotations_uids():
-                            non_available_uid = False
+                    self.__save_prediction(prediction=predictions[s], filename=final_seg_filename)
+                    anno_uid = self._patient_parameters.generate_uid(
+                        'A', filepath=final_seg_filename, role='segmentation',
+                        timestamp_uid=self._patient_parameters.get_radiological_volume(volume_uid=self._input_volume_uid).timestamp_uid)
                     annotation = Annotation(uid=anno_uid, input_filename=final_seg_filename,
                                             output_folder=self._patient_parameters.get_radiological_volume(volume_uid=self._input_volume_uid).output_folder,
-                                            radiological_volume_uid=self._input_volume_uid, annotation_class=label_name)
+                                            radiological_volume_uid=self._input_volume_uid, annotation_class=label_name,
+                                            source_uids=self._source_uids)
                     if 'Tumor' in label_name:
                         subtype = "Glioblastoma"
                         if 'Meningioma' in self._model_name:
@@ -296,19 +310,19 @@ class SegmentationStep(AbstractPipelineStep):
 
             seg_config = configparser.ConfigParser()
             seg_config.add_section('System')
-            seg_config.set('System', 'gpu_id', ResourcesConfiguration.getInstance().gpu_id)
+            seg_config.set('System', 'gpu_id', self._context.config.gpu_id)
             # seg_config.set('System', 'input_filename', self._input_volume_filepath)
             seg_config.set('System', 'inputs_folder', os.path.join(self._working_folder, 'inputs'))
             seg_config.set('System', 'output_folder', os.path.join(self._working_folder, 'outputs'))
             seg_config.set('System', 'model_folder',
-                           os.path.join(ResourcesConfiguration.getInstance().model_folder, self._model_name))
+                           os.path.join(self._context.config.model_folder, self._model_name))
             seg_config.add_section('Runtime')
             seg_config.set('Runtime', 'reconstruction_method',
-                           ResourcesConfiguration.getInstance().predictions_reconstruction_method)
+                           self._context.config.predictions_reconstruction_method)
             if self._segmentation_output_type:
                 seg_config.set('Runtime', 'reconstruction_method', self._segmentation_output_type)
-            seg_config.set('Runtime', 'reconstruction_order', ResourcesConfiguration.getInstance().predictions_reconstruction_order)
-            seg_config.set('Runtime', 'use_preprocessed_data', "True" if ResourcesConfiguration.getInstance().predictions_use_stripped_data else "False")
+            seg_config.set('Runtime', 'reconstruction_order', self._context.config.predictions_reconstruction_order)
+            seg_config.set('Runtime', 'use_preprocessed_data', "True" if self._context.config.predictions_use_stripped_data else "False")
 
             # @TODO. Have to be slightly improved, but should be working for our use-cases for now.
             existing_lungs_annotations = self._patient_parameters.get_all_annotations_uids_class_radiological_volume(
@@ -332,8 +346,8 @@ class SegmentationStep(AbstractPipelineStep):
             elif log_level == 40:
                 log_str = 'error'
 
-            from raidionicsseg.fit import run_model
-            run_model(seg_config_filename)
+            predictions = self.__run_segmentation_model(seg_config=seg_config,
+                                                        seg_config_filename=seg_config_filename)
         except Exception as e:
             if os.path.exists(self._working_folder):
                 shutil.rmtree(self._working_folder)
@@ -341,36 +355,23 @@ class SegmentationStep(AbstractPipelineStep):
 
         try:
             # Collecting the results and associating them with the parent radiological volume.
-            generated_segmentations = []
-            for _, _, files in os.walk(os.path.join(self._working_folder, 'outputs')):
-                for f in files:
-                    if 'nii.gz' in f:
-                        generated_segmentations.append(f)
-                break
-
-            for s in generated_segmentations:
+            for s in sorted(predictions.keys()):
                 label_name = s.split('_')[1].split('.')[0]
                 if label_name in self._segmentation_targets:
-                    seg_filename = os.path.join(os.path.join(self._working_folder, 'outputs'), s)
                     final_seg_filename = os.path.join(self._patient_parameters.get_radiological_volume(
                         volume_uid=self._input_volume_uid).output_folder,
                                                       os.path.basename(self._patient_parameters.get_radiological_volume(
                                                           volume_uid=self._input_volume_uid).raw_input_filepath).split(
                                                           '.')[0] + '_annotation-' + label_name + '.nii.gz')
-                    if not os.path.exists(seg_filename):
-                        raise ValueError(
-                            "Segmentation results file could not be found on disk at {}".format(seg_filename))
-                    shutil.move(seg_filename, final_seg_filename)
-                    non_available_uid = True
-                    anno_uid = None
-                    while non_available_uid:
-                        anno_uid = 'A' + str(np.random.randint(0, 10000))
-                        if anno_uid not in self._patient_parameters.get_all_annotations_uids():
-                            non_available_uid = False
+                    self.__save_prediction(prediction=predictions[s], filename=final_seg_filename)
+                    anno_uid = self._patient_parameters.generate_uid(
+                        'A', filepath=final_seg_filename, role='segmentation',
+                        timestamp_uid=self._patient_parameters.get_radiological_volume(volume_uid=self._input_volume_uid).timestamp_uid)
                     annotation = Annotation(uid=anno_uid, input_filename=final_seg_filename,
                                             output_folder=self._patient_parameters.get_radiological_volume(
                                                 volume_uid=self._input_volume_uid).output_folder,
-                                            radiological_volume_uid=self._input_volume_uid, annotation_class=label_name)
+                                            radiological_volume_uid=self._input_volume_uid, annotation_class=label_name,
+                                            source_uids=self._source_uids)
                     self._patient_parameters.include_annotation(anno_uid, annotation)
                     logging.info("Saved segmentation results in {}".format(final_seg_filename))
         except Exception as e:
@@ -381,6 +382,60 @@ class SegmentationStep(AbstractPipelineStep):
         if os.path.exists(self._working_folder):
             shutil.rmtree(self._working_folder)
 
+    def __run_segmentation_model(self, seg_config: configparser.ConfigParser, seg_config_filename: str) -> dict:
+        """
+        Runs the segmentation backend, unless the same model was already run on the same inputs with the same runtime
+        parameters, in which case the predictions are restored from the results cache (if enabled).
+
+        Returns
+        -------
+        dict
+            Filepaths of the predictions inside the working folder, indexed by their backend filename (e.g.,
+            labels_Tumor.nii.gz).
+        """
+        cache = ResultCache.from_configuration(config=self._context.config)
+        cache_key = None
+        outputs_folder = os.path.join(self._working_folder, 'outputs')
+        input_fps = [self._input_filepaths[k] for k in sorted(self._input_filepaths.keys())]
+        if cache is not None:
+            key_fps = list(input_fps)
+            for section in ['Neuro', 'Mediastinum']:
+                if seg_config.has_section(section):
+                    key_fps.extend([seg_config[section][k] for k in sorted(seg_config[section].keys())])
+            runtime_parameters = {"task": self._context.config.diagnosis_task,
+                                  "runtime": dict(seg_config['Runtime'])}
+            try:
+                cache_key = ResultCache.compute_key(step_json=self._step_json, input_filepaths=key_fps,
+                                                    model_folder=seg_config['System']['model_folder'],
+                                                    runtime_parameters=runtime_parameters)
+            except Exception as e:
+                logging.warning("[SegmentationStep] Computing the results cache key failed with: {}. Running without"
+                                " the results cache.".format(e))
+                logging.debug("Traceback: {}.".format(traceback.format_exc()))
+                cache = None
+        if cache is not None:
+            manifest = cache.restore(key=cache_key, destination_folder=outputs_folder)
+            if manifest is not None:
+                logging.info("[SegmentationStep] Segmentation results restored from cache (key: {}).".format(cache_key))
+                return {f: manifest["restored"][f] for f in manifest["restored"].keys() if 'nii.gz' in f}
+
+        self.check_cancellation()
+        predictions = run_segmentation_model(config_filename=seg_config_filename, input_filepaths=input_fps,
+                                             working_folder=self._working_folder,
+                                             cancellation_token=self.cancellation_token)
+
+        if cache is not None:
+            cache.store(key=cache_key, files=predictions)
+        return predictions
+
+    def __save_prediction(self, prediction: str, filename: str) -> None:
+        """
+        Moves a prediction produced inside the working folder to its final destination.
+        """
+        if not os.path.exists(prediction):
+            raise ValueError("Segmentation results file could not be found on disk at {}".format(prediction))
+        shutil.move(prediction, filename)
+
     def __identify_model_from_inputs(self, base_model_path: str) -> str:
         """
         For each model, a subset of models has been trained based on the provided inputs.
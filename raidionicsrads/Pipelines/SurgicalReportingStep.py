@@ -1,9 +1,9 @@
 import json
 import traceback
 import logging
-import numpy as np
+from typing import Tuple
 from .AbstractPipelineStep import AbstractPipelineStep
-from ..Utils.configuration_parser import ResourcesConfiguration
+from ..Utils.run_context import RunContext
 from ..Utils.ReportingStructures.NeuroSurgicalReportingStructure import NeuroSurgicalReportingStructure
 from ..Processing.neuro_report_computing import compute_surgical_report
 from ..Utils.DataStructures.AnnotationStructure import AnnotationClassType
@@ -17,8 +17,8 @@ class SurgicalReportingStep(AbstractPipelineStep):
     _report = None
     _tumor_type = None
 
-    def __init__(self, step_json: dict) -> None:
-        super(SurgicalReportingStep, self).__init__(step_json=step_json)
+    def __init__(self, step_json: dict, context: RunContext = None) -> None:
+        super(SurgicalReportingStep, self).__init__(step_json=step_json, context=context)
         self.__reset()
         step_keys = list(self._step_json.keys())
         self._tumor_type = self._step_json["tumor_type"] if "tumor_type" in step_keys else None
@@ -45,16 +45,36 @@ class SurgicalReportingStep(AbstractPipelineStep):
 
     def execute(self):
         try:
-            if ResourcesConfiguration.getInstance().diagnosis_task == 'neuro_diagnosis':
+            if self._context.config.diagnosis_task == 'neuro_diagnosis':
                 self.__run_neuro_surgical_reporting()
             else:
                 logging.warning("[SurgicalReportingStep] No execution implemented yet for the task {}".format(
-                    ResourcesConfiguration.getInstance().diagnosis_task))
+                    self._context.config.diagnosis_task))
                 pass
         except Exception as e:
             raise ValueError(f"[SurgicalReportingStep] Step execution failed with: {e}.")
         return self._patient_parameters
 
+    def assess(self, planner) -> Tuple[str, str]:
+        """
+        Pre-flight check that the preoperative and postoperative radiological volumes exist, and that their tumor
+        segmentations are, or will be, available. The volumes and structures are the ones looked up in
+        __run_neuro_surgical_reporting (i.e., timestamps 0 and 1, based on the tumor type).
+        """
+        if self._context.config.diagnosis_task != 'neuro_diagnosis':
+            return "ready", ""
+        if self.tumor_type is None or self.tumor_type.lower() not in ["contrast-enhancing", "non contrast-enhancing"]:
+            return "fail", "Unknown tumor type {}.".format(self.tumor_type)
+        contrast_enhancing = self.tumor_type.lower() == "contrast-enhancing"
+        sequence = "T1-CE" if contrast_enhancing else "FLAIR"
+        for entry, label in [({"timestamp": 0, "sequence": sequence}, "Tumor" if contrast_enhancing else "FLAIRChanges"),
+                             ({"timestamp": 1, "sequence": sequence}, "TumorCE" if contrast_enhancing else "FLAIRChanges")]:
+            if not planner.has_volume(entry):
+                return "fail", "No radiological volume for {}.".format(entry)
+            if not planner.has_annotation(entry, label):
+                return "fail", "Missing the {} segmentation for {}.".format(label, entry)
+        return "ready", ""
+
     def cleanup(self):
         pass
 
@@ -63,14 +83,10 @@ class SurgicalReportingStep(AbstractPipelineStep):
         @TODO. Should it be possible to compute some volume/change values for each timestamp also?
         """
         try:
-            non_available_uid = True
-            report_uid = None
-            while non_available_uid:
-                report_uid = 'SurRep' + str(np.random.randint(0, 10000))
-                if report_uid not in self._patient_parameters.get_all_reportings_uids():
-                    non_available_uid = False
+            report_uid = self._patient_parameters.generate_uid('SurRep', role='surgical-report',
+                                                               content_digest=self.tumor_type)
             report = NeuroSurgicalReportingStructure(id=report_uid,
-                                                     output_folder=ResourcesConfiguration.getInstance().output_folder)
+                                                     output_folder=self._context.config.output_folder)
             if self.tumor_type.lower() == "contrast-enhancing":
                 preop_t1ce_uid = self._patient_parameters.get_radiological_volume_uid(timestamp=0, sequence="T1-CE")
                 postop_t1ce_uid = self._patient_parameters.get_radiological_volume_uid(timestamp=1, sequence="T1-CE")
@@ -15,12 +15,12 @@ from skimage.measure import regionprops
 from scipy.ndimage.measurements import center_of_mass
 
 from ..Utils.DataStructures.AnnotationStructure import AnnotationClassType
-from ..Utils.io import load_nifti_volume
-from ..Utils.configuration_parser import ResourcesConfiguration
+from ..Utils.io import load_nifti_volume, load_mask, load_intensities, save_mask, save_intensities
+from ..Utils.run_context import RunContext
 from ..Utils.segmentation_parser import collect_segmentation_model_parameters
 
 
-def perform_brain_extraction(image_filepath: str, method: str = 'deep_learning') -> str:
+def perform_brain_extraction(image_filepath: str, method: str = 'deep_learning', context: RunContext = None) -> str:
     """
     @DEPRECATED? The brain segmentation is performed as a stand-alone pipeline step
     The brain extraction process.
@@ -33,25 +33,28 @@ def perform_brain_extraction(image_filepath: str, method: str = 'deep_learning')
         Skull stripping method to use to choose from [ants, deep_learning]. In ants mode the ANTs library is used
         to perform the task, and in deep_learning mode a custom brain segmentation model is used.
         AT THE TIME, ONLY THE deep_learning MODE IS IMPLEMENTED AND AVAILABLE!
+    context : RunContext
+        Run context holding the configuration, the active one if None.
     Returns
     -------
     str
         Full filepath of the newly created brain mask.
     """
+    config = RunContext.resolve(context).config
     # Creating temporary folder to delete when all is done
-    tmp_folder = os.path.join(ResourcesConfiguration.getInstance().output_folder, 'tmp')
+    tmp_folder = os.path.join(config.output_folder, 'tmp')
     os.makedirs(tmp_folder, exist_ok=True)
 
     brain_predictions_file = None
     if method == 'deep_learning':
-        brain_predictions_file = perform_custom_brain_extraction(image_filepath, tmp_folder)
+        brain_predictions_file = perform_custom_brain_extraction(image_filepath, tmp_folder, context=context)
     else:
         pass
 
     return brain_predictions_file
 
 
-def perform_custom_brain_extraction(image_filepath: str, folder: str) -> str:
+def perform_custom_brain_extraction(image_filepath: str, folder: str, context: RunContext = None) -> str:
     """
     @DEPRECATED?
     The custom brain segmentation is performed by using the pre-trained model followed by skull-stripping.
@@ -62,24 +65,27 @@ def perform_custom_brain_extraction(image_filepath: str, folder: str) -> str:
         Filepath of the patient input MRI volume.
     folder : str
         Destination folder in which the brain mask will be saved.
+    context : RunContext
+        Run context holding the configuration, the active one if None.
     Returns
     -------
     str
         Full filepath of the newly created brain mask.
     """
+    config = RunContext.resolve(context).config
     brain_config_filename = ''
     dump_brain_mask_filepath = ''
     try:
         brain_config = configparser.ConfigParser()
         brain_config.add_section('System')
-        brain_config.set('System', 'gpu_id', ResourcesConfiguration.getInstance().gpu_id)
+        brain_config.set('System', 'gpu_id', config.gpu_id)
         brain_config.set('System', 'input_filename', image_filepath)
-        brain_config.set('System', 'output_folder', ResourcesConfiguration.getInstance().output_folder)
-        brain_config.set('System', 'model_folder', os.path.join(os.path.dirname(ResourcesConfiguration.getInstance().model_folder), 'MRI_Brain'))
+        brain_config.set('System', 'output_folder', config.output_folder)
+        brain_config.set('System', 'model_folder', os.path.join(os.path.dirname(config.model_folder), 'MRI_Brain'))
         brain_config.add_section('Runtime')
         brain_config.set('Runtime', 'reconstruction_method', 'thresholding')
         brain_config.set('Runtime', 'reconstruction_order', 'resample_first')
-        brain_config_filename = os.path.join(os.path.dirname(ResourcesConfiguration.getInstance().config_filename), 'brain_config.ini')
+        brain_config_filename = os.path.join(os.path.dirname(config.config_filename), 'brain_config.ini')
         with open(brain_config_filename, 'w') as outfile:
             brain_config.write(outfile)
 
@@ -112,9 +118,8 @@ def perform_custom_brain_extraction(image_filepath: str, folder: str) -> str:
         raise ValueError("Impossible to perform automatic brain segmentation.\n")
 
     try:
-        brain_mask_filename = os.path.join(ResourcesConfiguration.getInstance().output_folder, 'labels_Brain.nii.gz')
-        brain_mask_ni = load_nifti_volume(brain_mask_filename)
-        brain_mask = brain_mask_ni.get_fdata()[:].astype('uint8')
+        brain_mask_filename = os.path.join(config.output_folder, 'labels_Brain.nii.gz')
+        brain_mask_ni, brain_mask = load_mask(brain_mask_filename)
 
         # The automatic segmentation should be clean, but just in case, only the largest component is retained.
         labels, nb_components = label(brain_mask)
@@ -126,7 +131,6 @@ def perform_custom_brain_extraction(image_filepath: str, folder: str) -> str:
         brain_object.bbox[2]:brain_object.bbox[5]] = 1
 
         dump_brain_mask = brain_mask & brain_component
-        dump_brain_mask_ni = nib.Nifti1Image(dump_brain_mask, affine=brain_mask_ni.affine)
         if os.name == 'nt':
             path_parts = list(PurePath(os.path.realpath(folder)).parts[:-1] + ('input_brain_mask.nii.gz',))
             dump_brain_mask_filepath = PurePath()
@@ -135,7 +139,7 @@ def perform_custom_brain_extraction(image_filepath: str, folder: str) -> str:
             dump_brain_mask_filepath = str(dump_brain_mask_filepath)
         else:
             dump_brain_mask_filepath = os.path.join('/'.join(folder.split('/')[:-1]), 'input_brain_mask.nii.gz')
-        nib.save(dump_brain_mask_ni, dump_brain_mask_filepath)
+        save_mask(dump_brain_mask, brain_mask_ni.affine, dump_brain_mask_filepath)
         os.remove(brain_config_filename)
     except Exception as e:
         logging.error("Skull stripping operation failed with: {}.\n".format(traceback.format_exc()))
@@ -146,23 +150,25 @@ def perform_custom_brain_extraction(image_filepath: str, folder: str) -> str:
     return dump_brain_mask_filepath
 
 
-def perform_brain_masking(image_filepath, mask_filepath, output_folder):
+def perform_brain_masking(image_filepath, mask_filepath, output_folder, context: RunContext = None):
     """
     Set to 0 any voxel that does not belong to the brain mask.
+    The masked image is an intermediate file, saved in the intermediate format.
     :param image_filepath:
     :param mask_filepath:
     :return: masked_image_filepath
     """
     os.makedirs(output_folder, exist_ok=True)
     image_ni = load_nifti_volume(image_filepath)
-    brain_mask_ni = load_nifti_volume(mask_filepath)
+    _, brain_mask = load_mask(mask_filepath)
 
-    image = image_ni.get_fdata()[:]
-    brain_mask = brain_mask_ni.get_fdata()[:]
+    # Masking in the original data type (e.g., int16 for MRI), which is also the data type kept on disk.
+    image = np.array(np.asanyarray(image_ni.dataobj))
     image[brain_mask == 0] = 0
 
-    masked_input_filepath = os.path.join(output_folder, os.path.basename(image_filepath).split('.')[0] + '_masked.nii.gz')
-    nib.save(nib.Nifti1Image(image, affine=image_ni.affine), masked_input_filepath)
+    masked_input_filepath = os.path.join(output_folder, os.path.basename(image_filepath).split('.')[0] + '_masked' +
+                                         RunContext.resolve(context).config.get_intermediate_extension())
+    save_intensities(image, image_ni.affine, masked_input_filepath, header=image_ni.header)
     return masked_input_filepath
 
 
@@ -190,10 +196,8 @@ def perform_brain_overlap_refinement(predictions_filepath: str, brain_mask_filep
 
     """
     try:
-        pred_nib = nib.load(predictions_filepath)
-        brain_mask_nib = nib.load(brain_mask_filepath)
-        pred = pred_nib.get_fdata()[:]
-        brain_mask = brain_mask_nib.get_fdata()[:].astype('uint8')
+        pred_nib, pred = load_intensities(predictions_filepath)
+        _, brain_mask = load_mask(brain_mask_filepath)
 
         pred_binary = np.zeros(pred.shape, dtype='uint8')
         pred_binary[pred > 1e-3] = 1
@@ -207,8 +211,7 @@ def perform_brain_overlap_refinement(predictions_filepath: str, brain_mask_filep
             if overlap:
                 label_pred = np.where(cc_pred_bin == (l + 1), pred, 0).astype("float32")
                 final_pred = final_pred + label_pred
-        final_pred_nib = nib.Nifti1Image(final_pred, affine=pred_nib.affine, header=pred_nib.header)
-        nib.save(final_pred_nib, predictions_filepath)
+        save_intensities(final_pred, pred_nib.affine, predictions_filepath, header=pred_nib.header)
     except Exception as e:
         raise ValueError("Brain overlap refinement failed with: {}.".format(e))
 
@@ -238,24 +241,19 @@ def perform_segmentation_global_consistency_refinement(annotation_files: dict, t
     for a in list(annotation_files.keys()):
         if a == str(AnnotationClassType.Tumor):
             tumorcore_anno_fn = annotation_files[a]
-            tumorcore_anno_nib = nib.load(tumorcore_anno_fn)
-            tumorcore_anno = tumorcore_anno_nib.get_fdata()[:]
+            tumorcore_anno_nib, tumorcore_anno = load_mask(tumorcore_anno_fn)
         elif a == str(AnnotationClassType.Cavity):
             cavity_anno_fn = annotation_files[a]
-            cavity_anno_nib = nib.load(cavity_anno_fn)
-            cavity_anno = cavity_anno_nib.get_fdata()[:]
+            cavity_anno_nib, cavity_anno = load_mask(cavity_anno_fn)
         elif a == str(AnnotationClassType.TumorCE):
             tumor_ce_anno_fn = annotation_files[a]
-            tumor_ce_anno_nib = nib.load(tumor_ce_anno_fn)
-            tumor_ce_anno = tumor_ce_anno_nib.get_fdata()[:]
+            tumor_ce_anno_nib, tumor_ce_anno = load_mask(tumor_ce_anno_fn)
         elif a == str(AnnotationClassType.FLAIRChanges):
             flair_changes_anno_fn = annotation_files[a]
-            flair_changes_anno_nib = nib.load(flair_changes_anno_fn)
-            flair_changes_anno = flair_changes_anno_nib.get_fdata()[:]
+            flair_changes_anno_nib, flair_changes_anno = load_mask(flair_changes_anno_fn)
         elif a == str(AnnotationClassType.Necrosis):
             necrosis_anno_fn = annotation_files[a]
-            necrosis_anno_nib = nib.load(necrosis_anno_fn)
-            necrosis_anno = necrosis_anno_nib.get_fdata()[:]
+            necrosis_anno_nib, necrosis_anno = load_mask(necrosis_anno_fn)
 
     if timestamp == 1:
         if tumor_general_type == "contrast-enhancing":
@@ -267,16 +265,14 @@ def perform_segmentation_global_consistency_refinement(annotation_files: dict, t
             if cavity_anno is not None and flair_changes_anno is not None:
                 refined_tumorce = np.zeros(tumor_ce_anno.shape).astype("uint8")
                 refined_tumorce[(tumor_ce_anno != 0) & (cavity_anno == 0)] = 1
-                nib.save(nib.Nifti1Image(refined_tumorce, affine=tumor_ce_anno_nib.affine, header=tumor_ce_anno_nib.header),
-                         tumor_ce_anno_fn)
+                save_mask(refined_tumorce, tumor_ce_anno_nib.affine, tumor_ce_anno_fn, header=tumor_ce_anno_nib.header)
 
                 output_annotation_files[AnnotationClassType.TumorCE] = tumor_ce_anno_fn
                 new_flair_changes = np.zeros(flair_changes_anno.shape).astype('uint8')
                 new_flair_changes[flair_changes_anno == 1] = 1
                 new_flair_changes[tumor_ce_anno == 1] = 1
                 new_flair_changes[cavity_anno == 1] = 0
-                nib.save(nib.Nifti1Image(new_flair_changes, flair_changes_anno_nib.affine, flair_changes_anno_nib.header),
-                         flair_changes_anno_fn)
+                save_mask(new_flair_changes, flair_changes_anno_nib.affine, flair_changes_anno_fn, header=flair_changes_anno_nib.header)
                 output_annotation_files[AnnotationClassType.FLAIRChanges] = flair_changes_anno_fn
 
                 new_cavity = np.zeros(cavity_anno.shape).astype('uint8')
@@ -291,9 +287,7 @@ def perform_segmentation_global_consistency_refinement(annotation_files: dict, t
                 refined_flairchanges = np.zeros(flair_changes_anno.shape).astype("uint8")
                 refined_flairchanges[flair_changes_anno == 1] = 1
                 refined_flairchanges[cavity_anno == 1] = 0
-                nib.save(
-                    nib.Nifti1Image(refined_flairchanges, affine=flair_changes_anno_nib.affine,
-                                    header=flair_changes_anno_nib.header), flair_changes_anno_fn)
+                save_mask(refined_flairchanges, flair_changes_anno_nib.affine, flair_changes_anno_fn, header=flair_changes_anno_nib.header)
     elif timestamp == 0:
         if tumor_general_type == "contrast-enhancing":
             if cavity_anno is None and flair_changes_anno is None and tumor_ce_anno is None and necrosis_anno is None:
@@ -308,39 +302,33 @@ def perform_segmentation_global_consistency_refinement(annotation_files: dict, t
                 new_flair_changes = np.zeros(flair_changes_anno.shape).astype('uint8')
                 new_flair_changes[flair_changes_anno == 1] = 1
                 new_flair_changes[tumorcore_anno == 1] = 0
-                nib.save(nib.Nifti1Image(new_flair_changes, flair_changes_anno_nib.affine, flair_changes_anno_nib.header),
-                         flair_changes_anno_fn)
+                save_mask(new_flair_changes, flair_changes_anno_nib.affine, flair_changes_anno_fn, header=flair_changes_anno_nib.header)
                 output_annotation_files[AnnotationClassType.Tumor] = tumorcore_anno_fn
                 output_annotation_files[AnnotationClassType.FLAIRChanges] = flair_changes_anno_fn
             elif flair_changes_anno is None and cavity_anno is None and tumor_ce_anno is None and necrosis_anno is not None:
                 new_necrosis = np.zeros(necrosis_anno.shape).astype('uint8')
                 new_necrosis[(tumorcore_anno == 1) & (necrosis_anno == 1)] = 1
-                nib.save(nib.Nifti1Image(new_necrosis, necrosis_anno_nib.affine, necrosis_anno_nib.header),
-                         necrosis_anno_fn)
+                save_mask(new_necrosis, necrosis_anno_nib.affine, necrosis_anno_fn, header=necrosis_anno_nib.header)
                 new_et = np.zeros(necrosis_anno.shape).astype('uint8')
                 new_et[(tumorcore_anno == 1) & (necrosis_anno == 0)] = 1
                 new_et_fn = os.path.join(os.path.dirname(necrosis_anno_fn), os.path.basename(necrosis_anno_fn.split('_annotation')[0]) + '_annotation-TumorCE.nii.gz')
-                nib.save(nib.Nifti1Image(new_et, necrosis_anno_nib.affine, necrosis_anno_nib.header),
-                         new_et_fn)
+                save_mask(new_et, necrosis_anno_nib.affine, new_et_fn, header=necrosis_anno_nib.header)
                 output_annotation_files[AnnotationClassType.Tumor] = tumorcore_anno_fn
                 output_annotation_files[AnnotationClassType.Necrosis] = necrosis_anno_fn
                 output_annotation_files[AnnotationClassType.TumorCE] = new_et_fn
             elif flair_changes_anno is not None and cavity_anno is None and tumor_ce_anno is None and necrosis_anno is not None:
                 new_necrosis = np.zeros(necrosis_anno.shape).astype('uint8')
                 new_necrosis[(tumorcore_anno == 1) & (necrosis_anno == 1)] = 1
-                nib.save(nib.Nifti1Image(new_necrosis, necrosis_anno_nib.affine, necrosis_anno_nib.header),
-                         necrosis_anno_fn)
+                save_mask(new_necrosis, necrosis_anno_nib.affine, necrosis_anno_fn, header=necrosis_anno_nib.header)
                 new_flair_changes = np.zeros(flair_changes_anno.shape).astype('uint8')
                 new_flair_changes[flair_changes_anno == 1] = 1
                 new_flair_changes[tumorcore_anno == 1] = 1
-                nib.save(nib.Nifti1Image(new_flair_changes, flair_changes_anno_nib.affine, flair_changes_anno_nib.header),
-                         flair_changes_anno_fn)
+                save_mask(new_flair_changes, flair_changes_anno_nib.affine, flair_changes_anno_fn, header=flair_changes_anno_nib.header)
                 new_edema = np.zeros(necrosis_anno.shape).astype('uint8')
                 new_edema[flair_changes_anno == 1] = 1
                 new_edema[tumorcore_anno == 1] = 0
                 new_edema_fn = os.path.join(os.path.dirname(necrosis_anno_fn), os.path.basename(necrosis_anno_fn.split('_annotation')[0]) + '_annotation-Edema.nii.gz')
-                nib.save(nib.Nifti1Image(new_edema, necrosis_anno_nib.affine, necrosis_anno_nib.header),
-                         new_edema_fn)
+                save_mask(new_edema, necrosis_anno_nib.affine, new_edema_fn, header=necrosis_anno_nib.header)
                 output_annotation_files[AnnotationClassType.Tumor] = tumorcore_anno_fn
                 output_annotation_files[AnnotationClassType.Necrosis] = necrosis_anno_fn
                 output_annotation_files[AnnotationClassType.FLAIRChanges] = flair_changes_anno_fn
@@ -4,6 +4,7 @@ import scipy.ndimage.morphology as smo
 from copy import deepcopy
 import nibabel as nib
 from skimage import measure
+from ..Utils.io import intensity_array, mask_array, save_mask
 
 
 def mediastinum_clipping(volume, parameters):
@@ -69,14 +70,13 @@ def perform_lungs_overlap_refinement(predictions_filepath: str, mask_filepath: s
         return
         pred_nib = nib.load(predictions_filepath)
         mask_nib = nib.load(mask_filepath)
-        pred = pred_nib.get_fdata()[:]
-        lungs_mask = mask_nib.get_fdata()[:].astype('uint8')
+        pred = intensity_array(pred_nib)
+        lungs_mask = mask_array(mask_nib)
 
         pred_binary = np.zeros(pred.shape, dtype='uint8')
         pred_binary[pred > 1e-3] = 1
         final_pred = np.zeros(pred.shape, dtype='uint8')
         final_pred[(lungs_mask == 1) & (pred_binary == 1)] = 1
-        final_pred_nib = nib.Nifti1Image(final_pred, affine=pred_nib.affine, header=pred_nib.header)
-        nib.save(final_pred_nib, predictions_filepath)
+        save_mask(final_pred, pred_nib.affine, predictions_filepath, header=pred_nib.header)
     except Exception as e:
         raise ValueError("Lungs overlap refinement failed with: {}.".format(e))
\ No newline at end of file
@@ -9,13 +9,16 @@ from skimage.morphology import ball
 from scipy.ndimage import binary_closing
 from ..Processing.tumor_features_computation import *
 from ..Utils.DataStructures.RadiologicalVolumeStructure import MRISequenceType
-from ..Utils.io import load_nifti_volume
-from ..Utils.configuration_parser import ResourcesConfiguration
+from ..Utils.io import load_mask, mask_array
+from ..Utils.volume_cache import load_cached_volume
+from ..Utils.atlas_store import load_atlas_mask, load_atlas_intensities, load_tract_bundle
+from ..Utils.run_context import RunContext
 from ..Utils.ReportingStructures.NeuroReportingStructure import *
 from ..Utils.ReportingStructures.NeuroSurgicalReportingStructure import *
 
 
-def compute_neuro_report(input_filename: str, report: NeuroReportingStructure) -> NeuroReportingStructure:
+def compute_neuro_report(input_filename: str, report: NeuroReportingStructure,
+                         context: RunContext = None) -> NeuroReportingStructure:
     """
     Main method computing all elements of the clinical report for a brain use-case.
 
@@ -25,13 +28,15 @@ def compute_neuro_report(input_filename: str, report: NeuroReportingStructure) -
 
     report: NeuroReportingStructure
         Prefilled version of the report which will be further completed inside the method
+    context: RunContext
+        Run context holding the configuration, the active one if None.
     Return
     -------
     Full and final version of the report, filled in with all requested parameters.
     """
+    config = RunContext.resolve(context).config
     try:
-        registered_tumor_ni = load_nifti_volume(input_filename)
-        registered_tumor = registered_tumor_ni.get_fdata()[:]
+        registered_tumor_ni, registered_tumor = load_mask(input_filename)
 
         tumor_type = report._tumor_type
         if np.count_nonzero(registered_tumor) == 0:
@@ -54,8 +59,8 @@ def compute_neuro_report(input_filename: str, report: NeuroReportingStructure) -
             return report
 
         # Computing the tumor volume in original patient space
-        # segmentation_ni = nib.load(ResourcesConfiguration.getInstance().runtime_tumor_mask_filepath)
-        # segmentation_mask = segmentation_ni.get_fdata()[:]
+        # segmentation_ni = load_cached_volume(config.runtime_tumor_mask_filepath)
+        # segmentation_mask = mask_array(segmentation_ni)
         # volume = compute_volume(volume=segmentation_mask, spacing=segmentation_ni.header.get_zooms())
         # self.diagnosis_parameters.statistics['Main']['Overall'].original_space_tumor_volume = volume
 
@@ -73,9 +78,8 @@ def compute_neuro_report(input_filename: str, report: NeuroReportingStructure) -
         report._tumor_multifocal_distance = dist
 
         # Computing localisation and lateralisation for the whole tumor extent
-        brain_lateralisation_mask_ni = load_nifti_volume(
-            ResourcesConfiguration.getInstance().mni_atlas_lateralisation_mask_filepath)
-        brain_lateralisation_mask = brain_lateralisation_mask_ni.get_fdata()[:]
+        brain_lateralisation_mask_ni, brain_lateralisation_mask = load_atlas_mask(
+            config.mni_atlas_lateralisation_mask_filepath, config)
         left, right, mid = compute_lateralisation(volume=refined_image, brain_mask=brain_lateralisation_mask)
         report._statistics['Main']['Overall'].left_laterality_percentage = left
         report._statistics['Main']['Overall'].right_laterality_percentage = right
@@ -83,26 +87,25 @@ def compute_neuro_report(input_filename: str, report: NeuroReportingStructure) -
 
         if report._tumor_type == 'Glioblastoma':
             if report._statistics['Main']['Overall'].left_laterality_percentage >= 50.0:
-                map_filepath = ResourcesConfiguration.getInstance().mni_resection_maps['Probability']['Left']
+                map_filepath = config.mni_resection_maps['Probability']['Left']
             else:
-                map_filepath = ResourcesConfiguration.getInstance().mni_resection_maps['Probability']['Right']
+                map_filepath = config.mni_resection_maps['Probability']['Right']
 
-            resection_probability_map_ni = nib.load(map_filepath)
-            resection_probability_map = resection_probability_map_ni.get_fdata()[:]
+            resection_probability_map_ni, resection_probability_map = load_atlas_intensities(map_filepath, config)
             residual, resectable, average = compute_resectability_index(volume=refined_image,
                                                                         resectability_map=resection_probability_map)
             report._statistics['Main']['Overall'].mni_space_expected_residual_tumor_volume = residual
             report._statistics['Main']['Overall'].mni_space_expected_resectable_tumor_volume = resectable
             report._statistics['Main']['Overall'].mni_space_resectability_index = average
 
-        for s in ResourcesConfiguration.getInstance().neuro_features_cortical_structures:
-            overlap = compute_cortical_structures_location(volume=refined_image, reference=s)
+        for s in config.neuro_features_cortical_structures:
+            overlap = compute_cortical_structures_location(volume=refined_image, reference=s, context=context)
             report._statistics['Main']['Overall'].mni_space_cortical_structures_overlap[s] = overlap
             # if self.from_slicer:
             #     ordered_l = collections.OrderedDict(sorted(report._statistics['Main']['Overall'].mni_space_cortical_structures_overlap[s].items(), key=operator.itemgetter(1), reverse=True))
             #     report._statistics['Main']['Overall'].mni_space_cortical_structures_overlap[s] = ordered_l
-        for s in ResourcesConfiguration.getInstance().neuro_features_subcortical_structures:
-            overlaps, distances = compute_subcortical_structures_location(volume=refined_image, category='Main', reference=s)
+        for s in config.neuro_features_subcortical_structures:
+            overlaps, distances = compute_subcortical_structures_location(volume=refined_image, category='Main', reference=s, context=context)
             if False: #self.from_slicer:
                 sorted_d = collections.OrderedDict(sorted(distances.items(), key=operator.itemgetter(1), reverse=False))
                 sorted_o = collections.OrderedDict(sorted(overlaps.items(), key=operator.itemgetter(1), reverse=True))
@@ -111,10 +114,10 @@ def compute_neuro_report(input_filename: str, report: NeuroReportingStructure) -
             else:
                 report._statistics['Main']['Overall'].mni_space_subcortical_structures_overlap[s] = overlaps
                 report._statistics['Main']['Overall'].mni_space_subcortical_structures_distance[s] = distances
-        for s in ResourcesConfiguration.getInstance().neuro_features_braingrid:
+        for s in config.neuro_features_braingrid:
             overlap_per_voxel, infiltrated_voxels = compute_braingrid_voxels_infiltration(volume=refined_image,
                                                                                            category='Main',
-                                                                                           reference=s)
+                                                                                           reference=s, context=context)
             report._statistics['Main']['Overall'].mni_space_braingrid_infiltration_overlap[s] = overlap_per_voxel
             report._statistics['Main']['Overall'].mni_space_braingrid_infiltration_count = infiltrated_voxels
         return report
@@ -123,16 +126,18 @@ def compute_neuro_report(input_filename: str, report: NeuroReportingStructure) -
 
 
 def compute_structure_statistics(input_mask: nib.Nifti1Image,
-                                 brain_mask: nib.Nifti1Image = None) -> NeuroStructureStatistics:
+                                 brain_mask: nib.Nifti1Image = None,
+                                 context: RunContext = None) -> NeuroStructureStatistics:
     """
 
     Return
     -------
 
     """
+    config = RunContext.resolve(context).config
     try:
         result = NeuroStructureStatistics()
-        input_array = input_mask.get_fdata()[:]
+        input_array = mask_array(input_mask)
 
         # Cleaning the segmentation mask just in case, removing potential small and noisy areas
         cluster_size_cutoff_in_pixels = 100
@@ -147,7 +152,7 @@ def compute_structure_statistics(input_mask: nib.Nifti1Image,
 
         brain_array = None
         if brain_mask:
-            brain_array = brain_mask.get_fdata()[:]
+            brain_array = mask_array(brain_mask)
         volume, brain_perc = compute_volume(volume=refined_image, spacing=input_mask.header.get_zooms(),
                                             brain_mask=brain_array)
         result.volume = NeuroVolumeStatistics(volume=volume, brain_percentage=brain_perc)
@@ -161,36 +166,34 @@ def compute_structure_statistics(input_mask: nib.Nifti1Image,
         result.multifocality = NeuroMultifocalityStatistics(status=status, parts=nb, distance=dist)
 
         # Computing localisation features
-        brain_lateralisation_mask_ni = load_nifti_volume(
-            ResourcesConfiguration.getInstance().mni_atlas_lateralisation_mask_filepath)
-        brain_lateralisation_mask = brain_lateralisation_mask_ni.get_fdata()[:]
+        brain_lateralisation_mask_ni, brain_lateralisation_mask = load_atlas_mask(
+            config.mni_atlas_lateralisation_mask_filepath, config)
         left, right, crossing = compute_lateralisation(volume=refined_image, brain_mask=brain_lateralisation_mask)
         result.location = NeuroLocationStatistics(left=left, right=right, crossing=crossing)
 
         # Compute resectability parameters -- @TODO. Should add a check on tumor type (should be only available for GBM)
         if left >= 50.0:
-                map_filepath = ResourcesConfiguration.getInstance().mni_resection_maps['Probability']['Left']
+                map_filepath = config.mni_resection_maps['Probability']['Left']
         else:
-            map_filepath = ResourcesConfiguration.getInstance().mni_resection_maps['Probability']['Right']
-        resection_probability_map_ni = nib.load(map_filepath)
-        resection_probability_map = resection_probability_map_ni.get_fdata()[:]
+            map_filepath = config.mni_resection_maps['Probability']['Right']
+        resection_probability_map_ni, resection_probability_map = load_atlas_intensities(map_filepath, config)
 
         residual, resectable, average = compute_resectability_index(volume=refined_image,
                                                                     resectability_map=resection_probability_map)
         result.resectability = NeuroResectabilityStatistics(resectable=resectable, residual=residual, index=average)
         
         # Computing cortical, subcortical, and infiltration profiles
-        for s in ResourcesConfiguration.getInstance().neuro_features_cortical_structures:
-            overlaps = compute_cortical_structures_location(volume=refined_image, reference=s)
+        for s in config.neuro_features_cortical_structures:
+            overlaps = compute_cortical_structures_location(volume=refined_image, reference=s, context=context)
             result.cortical[s] = NeuroCorticalStatistics(overlap=overlaps, distance=None)
-        for s in ResourcesConfiguration.getInstance().neuro_features_subcortical_structures:
+        for s in config.neuro_features_subcortical_structures:
             overlaps, distances = compute_subcortical_structures_location(volume=refined_image,
-                                                                          category='Main', reference=s)
+                                                                          category='Main', reference=s, context=context)
             result.subcortical[s] = NeuroSubCorticalStatistics(overlap=overlaps, distance=distances)
-        for s in ResourcesConfiguration.getInstance().neuro_features_braingrid:
+        for s in config.neuro_features_braingrid:
             overlap_per_voxel, infiltrated_voxels = compute_braingrid_voxels_infiltration(volume=refined_image,
                                                                                            category='Main',
-                                                                                           reference=s)
+                                                                                           reference=s, context=context)
             result.infiltration[s] = NeuroInfiltrationStatistics(overlap=overlap_per_voxel, count=infiltrated_voxels)
 
         return result
@@ -198,11 +201,11 @@ def compute_structure_statistics(input_mask: nib.Nifti1Image,
         raise ValueError(f"Structure features computation failed with: {e}")
 
 
-def compute_cortical_structures_location(volume, reference='MNI'):
+def compute_cortical_structures_location(volume, reference='MNI', context: RunContext = None):
+    config = RunContext.resolve(context).config
     logging.debug("Computing cortical structures location with {}.".format(reference))
-    regions_data = ResourcesConfiguration.getInstance().cortical_structures['MNI'][reference]
-    region_mask_ni = nib.load(regions_data['Mask'])
-    region_mask = region_mask_ni.get_fdata()
+    regions_data = config.cortical_structures['MNI'][reference]
+    region_mask_ni, region_mask = load_atlas_mask(regions_data['Mask'], config)
     lobes_description = pd.read_csv(regions_data['Description'])
 
     # Computing the lobe location for the center of mass
@@ -238,7 +241,8 @@ def compute_cortical_structures_location(volume, reference='MNI'):
     return overlap_per_lobe
 
 
-def compute_subcortical_structures_location(volume, category=None, reference='BCB'):
+def compute_subcortical_structures_location(volume, category=None, reference='BCB', context: RunContext = None):
+    config = RunContext.resolve(context).config
     logging.debug("Computing subcortical structures location with {}.".format(reference))
     distances = {}
     overlaps = {}
@@ -248,14 +252,11 @@ def compute_subcortical_structures_location(volume, category=None, reference='BC
     if reference == 'BrainLab':
         tract_cutoff = 0.25
 
-    tracts_dict = ResourcesConfiguration.getInstance().subcortical_structures['MNI'][reference]['Singular']
-    for i, tfn in enumerate(tracts_dict.keys()):
+    tracts_bundle = load_tract_bundle(config.subcortical_structures['MNI'][reference], config)
+    for i, tfn in enumerate(tracts_bundle.names):
         dist = -1.
         try:
-            reg_tract_ni = nib.load(tracts_dict[tfn])
-            reg_tract = reg_tract_ni.get_fdata()[:]
-            reg_tract[reg_tract < tract_cutoff] = 0
-            reg_tract[reg_tract >= tract_cutoff] = 1
+            reg_tract, reg_tract_spacing = tracts_bundle.mask(tfn, cutoff=tract_cutoff)
             overlap_volume = np.logical_and(reg_tract, volume).astype('uint8')
             if reference == "BCB":
                 distances_columns.append('distance_' + tfn.split('.')[0][:-4] + '_' + category)
@@ -268,7 +269,7 @@ def compute_subcortical_structures_location(volume, category=None, reference='BC
                 overlaps[tfn] = float((np.count_nonzero(overlap_volume) / np.count_nonzero(volume)) * 100.)
             else:
                 if np.count_nonzero(reg_tract) > 0:
-                    dist = compute_hd95(volume, reg_tract, voxelspacing=reg_tract_ni.header.get_zooms(), connectivity=1)
+                    dist = compute_hd95(volume, reg_tract, voxelspacing=reg_tract_spacing, connectivity=1)
                 distances[tfn] = dist
                 overlaps[tfn] = 0.
         except Exception:
@@ -278,11 +279,11 @@ def compute_subcortical_structures_location(volume, category=None, reference='BC
     return overlaps, distances
 
 
-def compute_braingrid_voxels_infiltration(volume, category=None, reference='Voxels'):
+def compute_braingrid_voxels_infiltration(volume, category=None, reference='Voxels', context: RunContext = None):
+    config = RunContext.resolve(context).config
     logging.debug("Computing BrainGrid infiltration with {}.".format(reference))
-    regions_data = ResourcesConfiguration.getInstance().braingrid_structures['MNI'][reference]
-    region_mask_ni = nib.load(regions_data['Mask'])
-    region_mask = region_mask_ni.get_fdata()
+    regions_data = config.braingrid_structures['MNI'][reference]
+    region_mask_ni, region_mask = load_atlas_mask(regions_data['Mask'], config)
     lobes_description = pd.read_csv(regions_data['Description'])
 
     total_voxels_labels = np.unique(region_mask)[1:]  # Removing the background label with value 0.
@@ -312,41 +313,41 @@ def compute_surgical_report(brain_preop_fn: str, brain_postop_fn: str, tumor_pre
     Is it correct to compare the tumorcore preop and tumorCE postop?
     """
     try:
-        preop_brain_annotation_ni = nib.load(brain_preop_fn)
-        postop_brain_annotation_ni = nib.load(brain_postop_fn)
-        preop_brain_volume, _ = compute_volume(preop_brain_annotation_ni.get_fdata()[:], preop_brain_annotation_ni.header.get_zooms())
-        postop_brain_volume, _ = compute_volume(postop_brain_annotation_ni.get_fdata()[:], postop_brain_annotation_ni.header.get_zooms())
+        preop_brain_annotation_ni = load_cached_volume(brain_preop_fn)
+        postop_brain_annotation_ni = load_cached_volume(brain_postop_fn)
+        preop_brain_volume, _ = compute_volume(mask_array(preop_brain_annotation_ni), preop_brain_annotation_ni.header.get_zooms())
+        postop_brain_volume, _ = compute_volume(mask_array(postop_brain_annotation_ni), postop_brain_annotation_ni.header.get_zooms())
 
-        preop_annotation_ni = nib.load(tumor_preop_fn)
-        postop_annotation_ni = nib.load(tumor_postop_fn)
-        preop_volume, _ = compute_volume(preop_annotation_ni.get_fdata()[:], preop_annotation_ni.header.get_zooms())
-        postop_volume, _ = compute_volume(postop_annotation_ni.get_fdata()[:], postop_annotation_ni.header.get_zooms())
+        preop_annotation_ni = load_cached_volume(tumor_preop_fn)
+        postop_annotation_ni = load_cached_volume(tumor_postop_fn)
+        preop_volume, _ = compute_volume(mask_array(preop_annotation_ni), preop_annotation_ni.header.get_zooms())
+        postop_volume, _ = compute_volume(mask_array(postop_annotation_ni), postop_annotation_ni.header.get_zooms())
 
         flairchanges_preop_volume = None
         if flairchanges_preop_fn is not None:
-            flairchanges_preop_ni = nib.load(flairchanges_preop_fn)
-            flairchanges_preop_volume, _ = compute_volume(flairchanges_preop_ni.get_fdata()[:],
+            flairchanges_preop_ni = load_cached_volume(flairchanges_preop_fn)
+            flairchanges_preop_volume, _ = compute_volume(mask_array(flairchanges_preop_ni),
                                                        flairchanges_preop_ni.header.get_zooms())
 
         flairchanges_postop_volume = None
         if flairchanges_postop_fn is not None:
-            flairchanges_postop_ni = nib.load(flairchanges_postop_fn)
-            flairchanges_postop_volume, _ = compute_volume(flairchanges_postop_ni.get_fdata()[:],
+            flairchanges_postop_ni = load_cached_volume(flairchanges_postop_fn)
+            flairchanges_postop_volume, _ = compute_volume(mask_array(flairchanges_postop_ni),
                                                         flairchanges_postop_ni.header.get_zooms())
         necrosis_preop_volume = None
         if necrosis_preop_fn is not None:
-            necrosis_preop_ni = nib.load(necrosis_preop_fn)
-            necrosis_preop_volume, _ = compute_volume(necrosis_preop_ni.get_fdata()[:],
+            necrosis_preop_ni = load_cached_volume(necrosis_preop_fn)
+            necrosis_preop_volume, _ = compute_volume(mask_array(necrosis_preop_ni),
                                                        necrosis_preop_ni.header.get_zooms())
         necrosis_postop_volume = None
         if necrosis_postop_fn is not None:
-            necrosis_postop_ni = nib.load(necrosis_postop_fn)
-            necrosis_postop_volume, _ = compute_volume(necrosis_postop_ni.get_fdata()[:],
+            necrosis_postop_ni = load_cached_volume(necrosis_postop_fn)
+            necrosis_postop_volume, _ = compute_volume(mask_array(necrosis_postop_ni),
                                                        necrosis_postop_ni.header.get_zooms())
         cavity_postop_volume = None
         if cavity_postop_fn is not None:
-            cavity_postop_ni = nib.load(cavity_postop_fn)
-            cavity_postop_volume, _ = compute_volume(cavity_postop_ni.get_fdata()[:], cavity_postop_ni.header.get_zooms())
+            cavity_postop_ni = load_cached_volume(cavity_postop_fn)
+            cavity_postop_volume, _ = compute_volume(mask_array(cavity_postop_ni), cavity_postop_ni.header.get_zooms())
 
         eor = ((preop_volume - postop_volume) / preop_volume) * 100.
         report.statistics.tumor_volume_preop = preop_volume
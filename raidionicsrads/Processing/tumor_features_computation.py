@@ -115,11 +115,11 @@ def compute_multifocality(volume: np.ndarray, spacing: Tuple,
             max_radius_index = parts_labels[radiuses.index(max_radius)]
 
             # Computing the minimum distances between each focus
-            main_tumor_label = np.zeros(volume.shape)
+            main_tumor_label = np.zeros(volume.shape, dtype=np.uint8)
             main_tumor_label[tumor_clusters == (max_radius_index + 1)] = 1
             for l, lab in enumerate(parts_labels):
                 if lab != max_radius_index:
-                    satellite_label = np.zeros(volume.shape)
+                    satellite_label = np.zeros(volume.shape, dtype=np.uint8)
                     satellite_label[tumor_clusters == (lab + 1)] = 1
                     dist = compute_hd95(satellite_label, main_tumor_label, voxelspacing=spacing, connectivity=1)
                     if multifocal_largest_minimum_distance is None:
@@ -225,9 +225,9 @@ def compute_resectability_index(volume: np.ndarray, resectability_map: np.ndarra
 
     try:
         logging.debug("Computing tumor resectability index.")
-        resectability_map = np.nan_to_num(resectability_map)
+        # Only the tumor voxels are read, the map possibly being memory-mapped from the atlas store.
         tumor_voxels_count = np.count_nonzero(volume)
-        total_resectability = np.sum(resectability_map[volume != 0])
+        total_resectability = np.sum(np.nan_to_num(resectability_map[volume != 0]))
         resectable_volume = total_resectability * 1e-3
         residual_tumor_volume = (tumor_voxels_count * 1e-3) - resectable_volume
         avg_resectability = total_resectability / tumor_voxels_count
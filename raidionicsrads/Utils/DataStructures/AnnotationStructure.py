@@ -1,4 +1,5 @@
 import os
+from contextlib import nullcontext
 from typing import List
 from aenum import Enum, unique
 from ..utilities import get_type_from_string, get_type_from_enum_name, input_file_type_conversion
@@ -68,12 +69,15 @@ class Annotation:
     _annotation_type = None
     _annotation_subtype = None
     _registered_volumes = {}
+    _source_uids = []  # Unique ids of the other elements (volumes, annotations) the annotation was generated from
+    _owner = None  # IndexedCollection holding the instance, notified when an indexed attribute changes
     # @TODO. Should we save also if the annotation is manual or automatic?
 
     def __init__(self, uid: str, input_filename: str, output_folder: str, radiological_volume_uid: str,
-                 annotation_class: str) -> None:
+                 annotation_class: str, source_uids: List[str] = None) -> None:
         self.__reset()
         self._unique_id = uid
+        self._source_uids = [x for x in source_uids if x != radiological_volume_uid] if source_uids else []
         self._raw_input_filepath = input_filename
         self._output_folder = output_folder
         self._radiological_volume_uid = radiological_volume_uid
@@ -93,6 +97,8 @@ class Annotation:
         self._annotation_type = None
         self._annotation_subtype = None
         self._registered_volumes = {}
+        self._source_uids = []
+        self._owner = None
 
     @property
     def unique_id(self) -> str:
@@ -120,6 +126,19 @@ class Annotation:
     def radiological_volume_uid(self) -> str:
         return self._radiological_volume_uid
 
+    @property
+    def source_uids(self) -> List[str]:
+        return self._source_uids
+
+    def add_source_uids(self, uids: List[str]) -> None:
+        """
+        Records other elements the annotation content depends on (e.g., the brain mask used for refining it), such that
+        the annotation is invalidated when one of them changes (see PatientParameters.rescan).
+        """
+        with self.__state_lock():
+            self._source_uids = self._source_uids + [x for x in uids if x not in self._source_uids and
+                                                     x != self._radiological_volume_uid]
+
     def get_annotation_type_enum(self) -> Enum:
         return self._annotation_type
 
@@ -139,12 +158,14 @@ class Annotation:
         type: str
             New annotation type to associate with the current instance.
         """
-        if isinstance(type, str):
-            ctype = get_type_from_string(AnnotationClassType, type)
-            if ctype != -1:
-                self._annotation_type = ctype
-        elif isinstance(type, AnnotationClassType):
-            self._annotation_type = type
+        with self.__state_lock():
+            if isinstance(type, str):
+                ctype = get_type_from_string(AnnotationClassType, type)
+                if ctype != -1:
+                    self._annotation_type = ctype
+            elif isinstance(type, AnnotationClassType):
+                self._annotation_type = type
+            self.__notify_owner()
 
     def get_annotation_subtype_enum(self) -> Enum:
         return self._annotation_subtype
@@ -185,10 +206,23 @@ class Annotation:
         return destination_space_uid in list(self._registered_volumes.keys())
 
     def include_registered_volume(self, filepath: str, registration_uid: str, destination_space_uid: str) -> None:
-        if destination_space_uid in list(self._registered_volumes.keys()):
-            raise ValueError("[AnnotationStructure] Trying to insert a registered volume with an already existing "
-                             "destination space key: {}.".format(destination_space_uid))
-        self._registered_volumes[destination_space_uid] = {"filepath": filepath, "registration_uid": registration_uid}
+        with self.__state_lock():
+            if destination_space_uid in list(self._registered_volumes.keys()):
+                raise ValueError("[AnnotationStructure] Trying to insert a registered volume with an already existing "
+                                 "destination space key: {}.".format(destination_space_uid))
+            self._registered_volumes[destination_space_uid] = {"filepath": filepath,
+                                                               "registration_uid": registration_uid}
+            self.__notify_owner()
+
+    def remove_registered_volume(self, destination_space_uid: str) -> dict:
+        """
+        Forgets the registered volume for the given destination space (e.g., after its registration was invalidated),
+        returning its info, None if not included.
+        """
+        with self.__state_lock():
+            info = self._registered_volumes.pop(destination_space_uid, None)
+            self.__notify_owner()
+            return info
 
     def get_registered_volume_info(self, destination_space_uid: str):
         return self._registered_volumes[destination_space_uid]
@@ -196,6 +230,20 @@ class Annotation:
     def get_registered_volume_destination_uids(self) -> List[str]:
         return list(self._registered_volumes.keys())
 
+    def __getstate__(self) -> dict:
+        # The owning collection is set again when the instance is inserted into it.
+        state = self.__dict__.copy()
+        state.pop('_owner', None)
+        return state
+
+    def __notify_owner(self) -> None:
+        if self._owner is not None:
+            self._owner.reindex(self)
+
+    def __state_lock(self):
+        # Lock of the owning collection, serializing the changes with the other accesses to the patient state.
+        return self._owner.lock if self._owner is not None else nullcontext()
+
     def __init_from_scratch(self):
         """
         Mostly in case the annotation was provided by the user in a non-nifti format.
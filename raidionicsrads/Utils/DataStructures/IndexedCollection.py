@@ -0,0 +1,167 @@
+import threading
+from typing import Callable, Dict, List
+
+
+class IndexedCollection(dict):
+    """
+    Dictionary of structure instances (e.g., radiological volumes or annotations) indexed by unique id, maintaining
+    secondary indexes over attributes of the instances (e.g., timestamp and sequence), such that the lookups on these
+    attributes do not scan the whole collection.
+    The indexes are updated on each insertion and removal. The instances notify the collection when an indexed
+    attribute changes afterwards (e.g., a sequence type set by the classification), by calling reindex through their
+    _owner attribute, which is not part of their pickled state.
+    All the insertions, removals, and lookups are serialized by a reentrant lock, which the patient state shares
+    between its collections (see PatientParameters.lock), the steps of a pipeline running concurrently.
+    """
+    _key_functions = {}  # Function returning the list of keys of an instance, for each index name
+    _indexes = {}  # Unique ids of the instances for each key, for each index name
+    _keys = {}  # Keys under which each instance is currently indexed, for each index name
+    _order = {}  # Insertion rank of each unique id, to return the lookups in insertion order
+    _uids = {}  # Unique id of each instance, indexed by object identity, for the notifications
+    _counter = 0
+    _lock = None  # Reentrant lock serializing the accesses, possibly shared with other collections
+
+    def __init__(self, key_functions: Dict[str, Callable] = None, *args, **kwargs) -> None:
+        super(IndexedCollection, self).__init__()
+        self.__reset(key_functions if key_functions is not None else {})
+        self.update(*args, **kwargs)
+
+    def __reset(self, key_functions: Dict[str, Callable]):
+        """
+        All objects share class or static variables.
+        An instance or non-static variables are different for different objects (every object has a copy).
+        """
+        self._key_functions = dict(key_functions)
+        self._indexes = {name: {} for name in self._key_functions.keys()}
+        self._keys = {name: {} for name in self._key_functions.keys()}
+        self._order = {}
+        self._uids = {}
+        self._counter = 0
+        self._lock = threading.RLock()
+
+    @property
+    def lock(self):
+        return self._lock
+
+    @lock.setter
+    def lock(self, lock) -> None:
+        self._lock = lock
+
+    def __reduce__(self):
+        # The items are only inserted once the indexes exist, when unpickling.
+        with self._lock:
+            return self.__class__, (self._key_functions,), None, None, iter(list(self.items()))
+
+    def __setitem__(self, uid, instance) -> None:
+        with self._lock:
+            if uid in self:
+                self.__unindex(uid)
+            else:
+                self._order[uid] = self._counter
+                self._counter = self._counter + 1
+            super(IndexedCollection, self).__setitem__(uid, instance)
+            self._uids[id(instance)] = uid
+            if hasattr(instance, '_owner'):
+                instance._owner = self
+            self.__index(uid)
+
+    def __delitem__(self, uid) -> None:
+        with self._lock:
+            self.__unindex(uid)
+            instance = self[uid]
+            super(IndexedCollection, self).__delitem__(uid)
+            del self._order[uid]
+            self._uids.pop(id(instance), None)
+            if getattr(instance, '_owner', None) is self:
+                instance._owner = None
+
+    def pop(self, uid, *default):
+        with self._lock:
+            if uid not in self:
+                if default:
+                    return default[0]
+                raise KeyError(uid)
+            instance = self[uid]
+            del self[uid]
+            return instance
+
+    def popitem(self):
+        with self._lock:
+            if len(self) == 0:
+                raise KeyError('popitem(): collection is empty')
+            uid = next(reversed(list(self.keys())))
+            return uid, self.pop(uid)
+
+    def setdefault(self, uid, default=None):
+        with self._lock:
+            if uid not in self:
+                self[uid] = default
+            return self[uid]
+
+    def update(self, *args, **kwargs) -> None:
+        with self._lock:
+            for uid, instance in dict(*args, **kwargs).items():
+                self[uid] = instance
+
+    def clear(self) -> None:
+        with self._lock:
+            for uid in list(self.keys()):
+                del self[uid]
+
+    def copy(self):
+        with self._lock:
+            return self.__class__(self._key_functions, dict(self))
+
+    def lookup(self, index: str, key) -> List[str]:
+        """
+        Unique ids of the instances indexed under key in the given index, in insertion order.
+        """
+        with self._lock:
+            uids = self._indexes[index].get(key, None)
+            if not uids:
+                return []
+            return sorted(uids, key=self._order.__getitem__)
+
+    def lookup_first(self, index: str, key):
+        """
+        Unique id of the first inserted instance indexed under key in the given index, None if none.
+        """
+        with self._lock:
+            uids = self._indexes[index].get(key, None)
+            if not uids:
+                return None
+            return min(uids, key=self._order.__getitem__)
+
+    def ordered(self, uids: List[str]) -> List[str]:
+        """
+        Sorts unique ids of the collection in insertion order (i.e., the iteration order of the collection).
+        """
+        with self._lock:
+            return sorted(uids, key=self._order.__getitem__)
+
+    def reindex(self, instance) -> None:
+        """
+        Updates the indexes of an instance, after a change of any of its indexed attributes.
+        """
+        with self._lock:
+            uid = self._uids.get(id(instance), None)
+            if uid is not None and self.get(uid, None) is instance:
+                self.__unindex(uid)
+                self.__index(uid)
+
+    def __index(self, uid) -> None:
+        instance = self[uid]
+        for name, key_function in self._key_functions.items():
+            keys = list(key_function(instance))
+            self._keys[name][uid] = keys
+            for k in keys:
+                self._indexes[name].setdefault(k, set()).add(uid)
+
+    def __unindex(self, uid) -> None:
+        for name in self._key_functions.keys():
+            for k in self._keys[name].pop(uid, []):
+                uids = self._indexes[name].get(k, None)
+                if uids is not None:
+                    uids.discard(uid)
+                    if not uids:
+                        del self._indexes[name][k]
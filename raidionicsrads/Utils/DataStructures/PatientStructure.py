@@ -1,16 +1,163 @@
 import os
+import hashlib
+import json
+import pickle
+import threading
+import traceback
 import numpy as np
 import re
 import glob
 import pandas as pd
 import logging
-import nibabel as nib
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
-from ..configuration_parser import ResourcesConfiguration
+from ..run_context import RunContext
+from ..configuration_parser import share_threads
+from ..volume_cache import load_cached_volume
+from ..io import save_mask
 from ..utilities import input_file_category_disambiguation, get_type_from_enum_name
+from ..dicom_series import is_dicom_series_folder, read_series_metadata, dicom_series_name
+from ..result_cache import compute_file_digest
 from .RadiologicalVolumeStructure import RadiologicalVolume
 from .AnnotationStructure import Annotation, AnnotationClassType
 from .RegistrationStructure import Registration
+from .IndexedCollection import IndexedCollection
+
+
+def _volume_timestamp_key(volume: RadiologicalVolume) -> list:
+    return [volume._timestamp_id]
+
+
+def _volume_timestamp_sequence_key(volume: RadiologicalVolume) -> list:
+    return [(volume._timestamp_id, str(volume._sequence_type))]
+
+
+def _volume_base_filename_key(volume: RadiologicalVolume) -> list:
+    if volume.usable_input_filepath is None:
+        return []
+    return [os.path.basename(volume.usable_input_filepath).split('.')[0]]
+
+
+def _annotation_volume_key(annotation: Annotation) -> list:
+    return [annotation._radiological_volume_uid]
+
+
+def _annotation_volume_class_key(annotation: Annotation) -> list:
+    return [(annotation._radiological_volume_uid, annotation._annotation_type)]
+
+
+def _annotation_registered_key(annotation: Annotation) -> list:
+    return list(annotation.registered_volumes.keys())
+
+
+def _annotation_registered_class_key(annotation: Annotation) -> list:
+    return [(r, annotation._annotation_type) for r in annotation.registered_volumes.keys()]
+
+
+def _registration_fixed_moving_key(registration: Registration) -> list:
+    return [(registration.fixed_uid, registration.moving_uid)]
+
+
+# Version of the patient snapshot layout, to increase whenever the pickled structures change
+SNAPSHOT_VERSION = 3
+# Number of hexadecimal characters of the content-derived hash inside the unique ids
+UID_HASH_LENGTH = 8
+
+
+def generate_uid(prefix: str, relative_path: str, timestamp_uid: str, role: str, content_digest: str,
+                 suffix: str = None, taken=()) -> str:
+    """
+    Deterministic unique id for a patient element (e.g., radiological volume, annotation, registration), derived
+    from a hash of its relative path, timestamp, role, and content digest, such that processing the same data again
+    yields the same identifiers.
+
+    Parameters
+    ----------
+    prefix: str
+        Type of element, e.g., V for a radiological volume or A for an annotation.
+    relative_path: str
+        Path of the element file relative to the patient input folder (or to the output folder for the generated
+        elements).
+    timestamp_uid: str
+        Identifier of the timestamp the element belongs to (e.g., T0).
+    role: str
+        Role of the element, e.g., input or segmentation.
+    content_digest: str
+        Digest of the element content (e.g., sha256 of the file, or DICOM SeriesInstanceUID).
+    suffix: str
+        Human-readable part appended to the id, e.g., the base filename.
+    taken: collection
+        Identifiers already in use, a collision being resolved by deterministically salting the hash.
+    Returns
+    -------
+    str
+        The unique id, as prefix + hash (+ _suffix).
+    """
+    salt = 0
+    while True:
+        fields = [relative_path.replace(os.sep, '/'), timestamp_uid, role, content_digest]
+        if salt > 0:
+            fields.append(str(salt))
+        hash_value = hashlib.sha256('\x1f'.join([str(f) for f in fields]).encode('utf-8')).hexdigest()
+        uid = prefix + hash_value[:UID_HASH_LENGTH] + ('_' + suffix if suffix else '')
+        if uid not in taken:
+            return uid
+        salt = salt + 1
+
+
+def _file_signature(filepath: str):
+    """
+    Size and modification time of a file or folder, None if not existing.
+    """
+    try:
+        stats = os.stat(filepath)
+        return [stats.st_size, stats.st_mtime_ns]
+    except OSError:
+        return None
+
+
+def _input_digest(filepath: str, is_dicom_series: bool, metadata: dict = None) -> str:
+    """
+    Content digest of an input file, or of a DICOM series folder (identified by its SeriesInstanceUID).
+    """
+    if is_dicom_series:
+        metadata = metadata if metadata is not None else read_series_metadata(filepath)
+        digest = metadata["SeriesInstanceUID"]
+        if digest == '':
+            digest = hashlib.sha256('\n'.join([os.path.basename(f) for f in metadata["Files"]]).encode('utf-8')).hexdigest()
+        return digest
+    return compute_file_digest(filepath)
+
+
+def _identify_input_file(filepath: str, is_dicom_series: bool):
+    """
+    Content category, from [Volume, Annotation], base name, and content digest of an input file or DICOM series
+    folder.
+    """
+    if is_dicom_series:
+        metadata = read_series_metadata(filepath)
+        return "Volume", dicom_series_name(filepath, metadata=metadata), _input_digest(filepath, True, metadata)
+    return input_file_category_disambiguation(filepath), os.path.basename(filepath).strip().split('.')[0], \
+        _input_digest(filepath, False)
+
+
+def _create_stripped_mask(volume_filepath: str, mask_filepath: str) -> str:
+    """
+    Saves the mask of the non-zero voxels of a stripped input (e.g., skull-stripped).
+    """
+    volume_nib = load_cached_volume(volume_filepath)
+    mask = (np.asanyarray(volume_nib.dataobj) != 0).astype('uint8')
+    return save_mask(mask, volume_nib.affine, mask_filepath)
+
+
+# Secondary indexes maintained over the radiological volumes, annotations, and registrations of a patient
+_RADIOLOGICAL_VOLUME_INDEXES = {'timestamp': _volume_timestamp_key,
+                                'timestamp_sequence': _volume_timestamp_sequence_key,
+                                'base_filename': _volume_base_filename_key}
+_ANNOTATION_INDEXES = {'volume': _annotation_volume_key, 'volume_class': _annotation_volume_class_key,
+                       'registered': _annotation_registered_key,
+                       'registered_class': _annotation_registered_class_key}
+_REGISTRATION_INDEXES = {'fixed_moving': _registration_fixed_moving_key}
 
 
 class PatientParameters:
@@ -22,19 +169,29 @@ class PatientParameters:
     _atlas_volumes = {}  # All Atlas instances loaded for the current patient.
     _registrations = {}  # All registration transforms.
     _reportings = {}  # All clinical reports (if applicable).
+    _input_digests = {}  # Content digest of each ingested input file (or DICOM series folder), indexed by filepath.
+    _input_signatures = {}  # Size and modification time of each ingested input file when ingested, indexed by filepath.
+    _context = None  # RunContext of the run processing the patient.
+    _lock = None  # Reentrant lock serializing the changes to the patient state, shared with its collections.
 
-    def __init__(self, id: str, patient_filepath: str):
+    def __init__(self, id: str, patient_filepath: str, context: RunContext = None):
         """
         """
         self.__reset()
         self._unique_id = id
         self._input_filepath = patient_filepath
+        self._context = RunContext.resolve(context)
 
         if not patient_filepath or not os.path.exists(patient_filepath):
             # Error case
             return
 
+        if self._context.config.patient_snapshot:
+            if self.__load_snapshot():
+                return
         self.__init_from_scratch()
+        if self._context.config.patient_snapshot:
+            self.save_snapshot()
 
     def __reset(self):
         """
@@ -44,11 +201,53 @@ class PatientParameters:
         self._unique_id = None
         self._input_filepath = None
         self._timestamps = {}
-        self._radiological_volumes = {}
-        self._annotation_volumes = {}
+        self._radiological_volumes = IndexedCollection(_RADIOLOGICAL_VOLUME_INDEXES)
+        self._annotation_volumes = IndexedCollection(_ANNOTATION_INDEXES)
         self._atlas_volumes = {}
-        self._registrations = {}
+        self._registrations = IndexedCollection(_REGISTRATION_INDEXES)
         self._reportings = {}
+        self._input_digests = {}
+        self._input_signatures = {}
+        self._context = None
+        self._lock = threading.RLock()
+        self.__share_lock()
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state.pop('_lock', None)
+        # The run context belongs to the run, the run reloading the state attaching its own (see context).
+        state.pop('_context', None)
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._context = None
+        self._lock = threading.RLock()
+        self.__share_lock()
+
+    def __share_lock(self) -> None:
+        # The collections (and the instances they hold, through them) serialize their changes with the patient lock.
+        for collection in [self._radiological_volumes, self._annotation_volumes, self._registrations]:
+            collection.lock = self._lock
+
+    @property
+    def lock(self):
+        """
+        Reentrant lock to hold while changing (or pickling) the patient state, when pipeline steps run concurrently.
+        The insertions into the collections and the changes made through the instances methods acquire it already.
+        """
+        return self._lock
+
+    @property
+    def context(self) -> RunContext:
+        return self._context
+
+    @context.setter
+    def context(self, context: RunContext) -> None:
+        """
+        Attaches the patient state to the given run context, e.g. after being reloaded from a checkpoint.
+        """
+        self._context = context
 
     @property
     def unique_id(self) -> str:
@@ -58,6 +257,18 @@ class PatientParameters:
     def input_filepath(self) -> str:
         return self._input_filepath
 
+    @property
+    def input_digests(self) -> dict:
+        return self._input_digests
+
+    @property
+    def snapshot_filepath(self) -> str:
+        return os.path.join(self._context.config.output_folder, 'patient_snapshot.pkl')
+
+    @property
+    def rescan_filepath(self) -> str:
+        return os.path.join(self._context.config.output_folder, 'patient_rescan.json')
+
     @property
     def radiological_volumes(self) -> dict:
         return self._radiological_volumes
@@ -80,132 +291,595 @@ class PatientParameters:
 
         In case of stripped inputs (i.e., skull-stripped or lung-stripped), the corresponding mask should be created
         for each input
+
+        The files of all timestamps are identified, converted, and read concurrently by a pool of threads (see
+        ingestion_threads), while the unique ids are drawn and the results merged into the patient state in the
+        folder order, such that the patient state does not depend on the threads scheduling.
         """
         try:
-            timestamp_folders = []
-            for _, dirs, _ in os.walk(self._input_filepath):
-                for d in dirs:
-                    timestamp_folders.append(d)
+            timestamp_files = self.__list_timestamp_inputs()
+            for timestamp_uid, (ts_folder, _, _) in timestamp_files.items():
+                self._timestamps[timestamp_uid] = TimestampParameters(id=timestamp_uid, timestamp_filepath=ts_folder)
+
+            threads = self._context.config.get_threads(self._context.config.ingestion_threads)
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                volume_uids, _ = self.__ingest_input_files(timestamp_files, executor, threads)
+                self.__include_registration_folders(timestamp_files, volume_uids)
+                self.__include_sequences_file(volume_uids)
+                self.__create_stripped_masks(volume_uids, executor, threads)
+        except Exception as e:
+            raise ValueError("Patient structure setup from disk folder failed with: {}".format(e))
+
+    def __list_timestamp_inputs(self) -> dict:
+        """
+        Lists the input files of each timestamp folder, the timestamp uids following the integer inside the folder
+        names.
+
+        Returns
+        -------
+        dict
+            Folder, input files (and DICOM series sub-folders), and DICOM series sub-folders for each timestamp uid,
+            in timestamp order.
+        """
+        timestamp_folders = []
+        for _, dirs, _ in os.walk(self._input_filepath):
+            for d in dirs:
+                timestamp_folders.append(d)
+            break
+
+        ts_folders_dict = {}
+        for i in timestamp_folders:
+            if re.search(r'\d+', i):  # Skipping folders without an integer inside, otherwise assuming timestamps from 0 onwards
+                ts_folders_dict[int(re.search(r'\d+', i).group())] = i
+
+        ordered_ts_folders = dict(sorted(ts_folders_dict.items(), key=lambda item: item[0], reverse=False))
+
+        timestamp_files = {}
+        for i, ts in enumerate(list(ordered_ts_folders.keys())):
+            ts_folder = os.path.join(self._input_filepath, ordered_ts_folders[ts])
+            if self._context.config.caller == 'raidionics':  # Specifics to cater to Raidionics
+                ts_folder = os.path.join(ts_folder, 'raw')
+            patient_files = []
+
+            for _, _, files in os.walk(ts_folder):
+                for f in files:
+                    if '.'.join(f.split('.')[1:]) in self._context.config.get_accepted_image_formats():
+                        patient_files.append(f)
                 break
+            # DICOM series, each stored in its own sub-folder, are converted as radiological volumes
+            dicom_series = [d for d in sorted(os.listdir(ts_folder)) if is_dicom_series_folder(os.path.join(ts_folder, d))]
+            patient_files.extend(dicom_series)
+            timestamp_files["T" + str(i)] = (ts_folder, patient_files, dicom_series)
+        return timestamp_files
+
+    def __ingest_input_files(self, timestamp_files: dict, executor: ThreadPoolExecutor, threads: int):
+        """
+        Identifies and includes the given input files as radiological volumes or annotations, the latter being
+        attached to the radiological volume (already included or not) of their timestamp with the exact same base
+        filename.
 
-            ts_folders_dict = {}
-            for i in timestamp_folders:
-                if re.search(r'\d+', i):  # Skipping folders without an integer inside, otherwise assuming timestamps from 0 onwards
-                    ts_folders_dict[int(re.search(r'\d+', i).group())] = i
+        Parameters
+        ----------
+        timestamp_files: dict
+            Folder, input files, and DICOM series sub-folders for each timestamp uid, in timestamp order.
+        executor: ThreadPoolExecutor
+            Pool of threads identifying and converting the files.
+        threads: int
+            Number of threads in the pool, sharing the cores with the thread pools created from within it.
+        Returns
+        -------
+        Tuple[List[str], List[str]]
+            Unique ids of the included radiological volumes and annotations.
+        """
+        identify = share_threads(self._context.bind(_identify_input_file), threads)
+        create_volume = share_threads(self._context.bind(lambda **kwargs: RadiologicalVolume(**kwargs)), threads)
+        create_annotation = share_threads(self._context.bind(lambda **kwargs: Annotation(**kwargs)), threads)
 
-            ordered_ts_folders = dict(sorted(ts_folders_dict.items(), key=lambda item: item[0], reverse=False))
+        # Identifying the content of all the files at once, across timestamps
+        file_contents = {}
+        for timestamp_uid, (ts_folder, patient_files, dicom_series) in timestamp_files.items():
+            for f in patient_files:
+                # Signature taken beforehand, such that a file modified during its ingestion is found by a rescan
+                self._input_signatures[os.path.join(ts_folder, f)] = _file_signature(os.path.join(ts_folder, f))
+                file_contents[(timestamp_uid, f)] = executor.submit(identify, os.path.join(ts_folder, f),
+                                                                    f in dicom_series)
 
-            for i, ts in enumerate(list(ordered_ts_folders.keys())):
-                ts_folder = os.path.join(self._input_filepath, ordered_ts_folders[ts])
-                if ResourcesConfiguration.getInstance().caller == 'raidionics':  # Specifics to cater to Raidionics
-                    ts_folder = os.path.join(ts_folder, 'raw')
-                patient_files = []
+        # Creating the radiological volumes (i.e., converting the inputs if needed) concurrently, with the
+        # unique ids drawn beforehand in the folder order
+        volume_futures = []
+        volume_uids_taken = set(self._radiological_volumes.keys())
+        annotation_files = {}
+        for timestamp_uid, (ts_folder, patient_files, _) in timestamp_files.items():
+            annotation_files[timestamp_uid] = []
+            for f in patient_files:
+                file_content_type, base_data_uid, digest = file_contents[(timestamp_uid, f)].result()
+                self._input_digests[os.path.join(ts_folder, f)] = digest
+                # Generating a unique id for the radiological volume
+                if file_content_type == "Volume":
+                    data_uid = generate_uid('V', os.path.relpath(os.path.join(ts_folder, f), self._input_filepath),
+                                            timestamp_uid=timestamp_uid, role='input', content_digest=digest,
+                                            suffix=base_data_uid, taken=volume_uids_taken)
+                    volume_uids_taken.add(data_uid)
+                    volume_futures.append((data_uid, timestamp_uid,
+                                           executor.submit(create_volume, uid=data_uid,
+                                                           input_filename=os.path.join(ts_folder, f),
+                                                           timestamp_uid=timestamp_uid)))
+                elif file_content_type == "Annotation":
+                    annotation_files[timestamp_uid].append(f)
+        for data_uid, _, future in volume_futures:
+            self._radiological_volumes[data_uid] = future.result()
 
-                timestamp_uid = "T" + str(i)
-                timestamp_instance = TimestampParameters(id=timestamp_uid, timestamp_filepath=ts_folder)
-                self._timestamps[timestamp_uid] = timestamp_instance
+        # Iterating over the annotation files in a second time, when all the parent objects have been created.
+        # An annotation is attached to the radiological volume of its timestamp with the exact same base filename.
+        annotation_futures = []
+        annotation_uids_taken = set(self._annotation_volumes.keys())
+        for timestamp_uid in self._timestamps.keys():
+            if timestamp_uid not in timestamp_files:
+                continue
+            ts_folder = timestamp_files[timestamp_uid][0]
+            for f in annotation_files[timestamp_uid]:
+                # Collecting the base name of the radiological volume, often before a label or annotation tag
+                base_name = os.path.basename(f).strip().split('.')[0].split('label')[0][:-1]
+                if self._context.config.caller == 'raidionics':
+                    base_name = os.path.basename(f).strip().split('.')[0].split('annotation')[0][:-1]
+                parents = [uid for uid in self._radiological_volumes.lookup('base_filename', base_name)
+                           if self._radiological_volumes[uid].timestamp_uid == timestamp_uid]
+                if parents:
+                    parent_uid = parents[0]
+                    data_uid = generate_uid('A', os.path.relpath(os.path.join(ts_folder, f), self._input_filepath),
+                                            timestamp_uid=timestamp_uid, role='input',
+                                            content_digest=file_contents[(timestamp_uid, f)].result()[2],
+                                            suffix=base_name, taken=annotation_uids_taken)
+                    annotation_uids_taken.add(data_uid)
+                    if self._context.config.caller == 'raidionics':
+                        class_name = os.path.basename(f).strip().split('.')[0].split('annotation')[1][1:]
+                    else:
+                        class_name = os.path.basename(f).strip().split('.')[0].split('label')[1][1:]
+                    annotation_futures.append((data_uid, executor.submit(
+                        create_annotation, uid=data_uid, input_filename=os.path.join(ts_folder, f),
+                        output_folder=self._radiological_volumes[parent_uid].output_folder,
+                        radiological_volume_uid=parent_uid, annotation_class=class_name)))
+                else:
+                    # Case where the annotation does not match any radiological volume, has to be left aside
+                    pass
+        for data_uid, future in annotation_futures:
+            self.annotation_volumes[data_uid] = future.result()
+        return [v[0] for v in volume_futures], [a[0] for a in annotation_futures]
 
-                for _, _, files in os.walk(ts_folder):
+    def __include_registration_folders(self, timestamp_files: dict, volume_uids: List[str]) -> None:
+        """
+        Includes the registered volumes found in the registration sub-folders of each timestamp (i.e., [name]_space),
+        when either the registered or the fixed radiological volume is part of volume_uids.
+        """
+        for timestamp_uid, (ts_folder, _, dicom_series) in timestamp_files.items():
+            registration_folders = [os.path.join(ts_folder, d) for d in os.listdir(ts_folder) if os.path.isdir(os.path.join(ts_folder, d)) and d not in dicom_series]
+            for rf in registration_folders:
+                registered_radiological_volumes = []
+                registered_labels = []
+                for _, _, files in os.walk(rf):
                     for f in files:
-                        if '.'.join(f.split('.')[1:]) in ResourcesConfiguration.getInstance().get_accepted_image_formats():
-                            patient_files.append(f)
-                    break
-
-                annotation_files = []
-                for f in patient_files:
-                    file_content_type = input_file_category_disambiguation(os.path.join(ts_folder, f))
-                    # Generating a unique id for the radiological volume
-                    if file_content_type == "Volume":
-                        base_data_uid = os.path.basename(f).strip().split('.')[0]
-                        non_available_uid = True
-                        while non_available_uid:
-                            data_uid = 'V' + str(np.random.randint(0, 10000)) + '_' + base_data_uid
-                            if data_uid not in list(self._radiological_volumes.keys()):
-                                non_available_uid = False
-                        self._radiological_volumes[data_uid] = RadiologicalVolume(uid=data_uid,
-                                                                                  input_filename=os.path.join(ts_folder, f),
-                                                                                  timestamp_uid=timestamp_uid)
-                    elif file_content_type == "Annotation":
-                        annotation_files.append(f)
-
-                # Iterating over the annotation files in a second time, when all the parent objects have been created
-                for f in annotation_files:
-                    # Collecting the base name of the radiological volume, often before a label or annotation tag
-                    base_name = os.path.basename(f).strip().split('.')[0].split('label')[0][:-1]
-                    if ResourcesConfiguration.getInstance().caller == 'raidionics':
-                        base_name = os.path.basename(f).strip().split('.')[0].split('annotation')[0][:-1]
-                    parent_link = [base_name in x for x in list(self._radiological_volumes.keys())]
-                    if True in parent_link:
-                        parent_uid = list(self._radiological_volumes.keys())[parent_link.index(True)]
-                        non_available_uid = True
-                        while non_available_uid:
-                            data_uid = 'A' + str(np.random.randint(0, 10000)) + '_' + base_name
-                            if data_uid not in list(self.annotation_volumes.keys()):
-                                non_available_uid = False
-                        if ResourcesConfiguration.getInstance().caller == 'raidionics':
-                            class_name = os.path.basename(f).strip().split('.')[0].split('annotation')[1][1:]
+                        if "label" in f or "annotation" in f:
+                            registered_labels.append(f)
                         else:
-                            class_name = os.path.basename(f).strip().split('.')[0].split('label')[1][1:]
-                        self.annotation_volumes[data_uid] = Annotation(uid=data_uid,
-                                                                        input_filename=os.path.join(ts_folder, f),
-                                                                        output_folder=self._radiological_volumes[parent_uid].output_folder,
-                                                                        radiological_volume_uid=parent_uid,
-                                                                        annotation_class=class_name)
-                    else:
-                        # Case where the annotation does not match any radiological volume, has to be left aside
-                        pass
-                registration_folders = [os.path.join(ts_folder, d) for d in os.listdir(ts_folder) if os.path.isdir(os.path.join(ts_folder, d))]
-                for rf in registration_folders:
-                    registered_radiological_volumes = []
-                    registered_labels = []
-                    for _, _, files in os.walk(rf):
-                        for f in files:
-                            if "label" in f or "annotation" in f:
-                                registered_labels.append(f)
-                            else:
-                                registered_radiological_volumes.append(f)
-                    for rr in registered_radiological_volumes:
-                        fixed_volume = self.get_radiological_volume_by_base_filename(base_fn=os.path.basename(rf[:-1]).replace("_space", ""))
-                        reg_volume = self.get_radiological_volume_by_base_filename(base_fn=rr.split('_reg')[0])
-                        reg_volume.include_registered_volume(filepath=os.path.join(rf, rr), registration_uid=None,
-                                                             destination_space_uid=fixed_volume.unique_id)
-
-            sequences_filename = os.path.join(self._input_filepath, 'mri_sequences.csv')
-            if os.path.exists(sequences_filename):
-                df = pd.read_csv(sequences_filename)
-                volume_basenames = list(df['File'].values)
-                for vn in volume_basenames:
-                    volume_object = self.get_radiological_volume_by_base_filename(vn)
-                    if volume_object:
+                            registered_radiological_volumes.append(f)
+                for rr in registered_radiological_volumes:
+                    fixed_volume = self.get_radiological_volume_by_base_filename(base_fn=os.path.basename(rf[:-1]).replace("_space", ""))
+                    reg_volume = self.get_radiological_volume_by_base_filename(base_fn=rr.split('_reg')[0])
+                    if reg_volume.unique_id not in volume_uids and fixed_volume.unique_id not in volume_uids:
+                        continue
+                    reg_volume.include_registered_volume(filepath=os.path.join(rf, rr), registration_uid=None,
+                                                         destination_space_uid=fixed_volume.unique_id)
+
+    def __include_sequences_file(self, volume_uids: List[str]) -> None:
+        """
+        Sets the sequence type of the radiological volumes from volume_uids listed in the mri_sequences.csv file of
+        the patient folder, if any.
+        """
+        sequences_filename = os.path.join(self._input_filepath, 'mri_sequences.csv')
+        self._input_signatures[sequences_filename] = _file_signature(sequences_filename)
+        if os.path.exists(sequences_filename):
+            df = pd.read_csv(sequences_filename)
+            volume_basenames = list(df['File'].values)
+            for vn in volume_basenames:
+                volume_object = self.get_radiological_volume_by_base_filename(vn)
+                if volume_object:
+                    if volume_object.unique_id in volume_uids:
                         volume_object.set_sequence_type(df.loc[df['File'] == vn]['MRI sequence'].values[0])
+                else:
+                    logging.warning("[PatientStructure] Filename {} not matching any radiological volume volume.".format(vn))
+
+    def __create_stripped_masks(self, volume_uids: List[str], executor: ThreadPoolExecutor, threads: int) -> List[str]:
+        """
+        Setting up masks (i.e., brain or lungs) for the radiological volumes from volume_uids, if stripped inputs are
+        used. Returns the unique ids of the included mask annotations.
+        """
+        if not self._context.config.predictions_use_stripped_data:
+            return []
+        target_type = AnnotationClassType.Brain if self._context.config.diagnosis_task == 'neuro_diagnosis' else AnnotationClassType.Lungs
+        create_mask = share_threads(self._context.bind(_create_stripped_mask), threads)
+        mask_futures = []
+        for uid in volume_uids:
+            volume = self.get_radiological_volume(uid)
+            mask_fn = os.path.join(volume.output_folder,
+                                   os.path.basename(volume.raw_input_filepath).split('.')[0] + '_label_' + str(target_type) + '.nii.gz')
+            mask_futures.append((uid, mask_fn, executor.submit(create_mask, volume.usable_input_filepath, mask_fn)))
+        mask_uids = []
+        for uid, mask_fn, future in mask_futures:
+            future.result()
+            volume = self.get_radiological_volume(uid)
+            anno_uid = self.generate_uid('A', filepath=mask_fn, timestamp_uid=volume.timestamp_uid,
+                                         role='stripped-mask')
+            self.annotation_volumes[anno_uid] = Annotation(uid=anno_uid, input_filename=mask_fn,
+                                                            output_folder=volume.output_folder,
+                                                            radiological_volume_uid=uid,
+                                                            annotation_class=target_type)
+            mask_uids.append(anno_uid)
+        return mask_uids
+
+    def rescan(self) -> dict:
+        """
+        Updates the patient state after changes in the input folder, without ingesting it again as a whole. The input
+        files are compared against their state when last ingested: files with a new size or modification time are
+        digested again, and only the new files and the files with a new content are ingested. The elements derived
+        from the changed or removed files (i.e., their annotations, the annotations and registrations generated from them,
+        the registrations from or to them, the registered volumes in their space, and the reportings of their
+        timestamps) are dropped from the patient state, such that
+        the pipeline steps producing them are run again.
+        If the known timestamps do not keep their unique id (e.g., a timestamp folder inserted before existing ones), or
+        if the mri_sequences.csv file changed, the patient folder is ingested again as a whole.
+
+        Returns
+        -------
+        dict
+            The added, changed, and removed input files, the unique ids of the ingested elements, and the invalidated
+            elements ('registered_volumes' holding the uid, destination space uid, and filepath of each registered
+            volume), also written to rescan_filepath.
+        """
+        report = {"full": False, "added": [], "changed": [], "removed": [],
+                  "ingested": {"radiological_volumes": [], "annotations": []},
+                  "invalidated": {"radiological_volumes": [], "annotations": [], "registrations": [],
+                                  "registered_volumes": [], "reportings": []}}
+        try:
+            timestamp_files = self.__list_timestamp_inputs()
+            current_files = {}  # Timestamp uid and DICOM series flag for each current input file
+            for timestamp_uid, (ts_folder, patient_files, dicom_series) in timestamp_files.items():
+                for f in patient_files:
+                    current_files[os.path.join(ts_folder, f)] = (timestamp_uid, f in dicom_series)
+
+            report["removed"] = [fp for fp in self._input_digests.keys() if fp not in current_files]
+            report["added"] = [fp for fp in current_files.keys() if fp not in self._input_digests]
+            touched = [fp for fp in current_files.keys() if fp in self._input_digests and
+                       _file_signature(fp) != self._input_signatures.get(fp, None)]
+            threads = self._context.config.get_threads(self._context.config.ingestion_threads)
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                signatures = {fp: _file_signature(fp) for fp in touched}
+                digests = list(executor.map(share_threads(self._context.bind(_input_digest), threads), touched,
+                                            [current_files[fp][1] for fp in touched]))
+                for fp, digest in zip(touched, digests):
+                    if digest != self._input_digests[fp]:
+                        report["changed"].append(fp)
                     else:
-                        logging.warning("[PatientStructure] Filename {} not matching any radiological volume volume.".format(vn))
-
-            # Setting up masks (i.e., brain or lungs) if stripped inputs are used.
-            if ResourcesConfiguration.getInstance().predictions_use_stripped_data:
-                target_type = AnnotationClassType.Brain if ResourcesConfiguration.getInstance().diagnosis_task == 'neuro_diagnosis' else AnnotationClassType.Lungs
-                for uid in self.get_all_radiological_volume_uids():
-                    volume = self.get_radiological_volume(uid)
-                    volume_nib = nib.load(volume.raw_input_filepath)
-                    img_data = volume_nib.get_fdata()[:]
-                    mask = np.zeros(img_data.shape)
-                    mask[img_data != 0] = 1
-                    mask_fn = os.path.join(volume.output_folder,
-                                           os.path.basename(volume.raw_input_filepath).split('.')[0] + '_label_' + str(target_type) + '.nii.gz')
-
-                    nib.save(nib.Nifti1Image(mask, affine=volume_nib.affine), mask_fn)
-                    non_available_uid = True
-                    anno_uid = None
-                    while non_available_uid:
-                        anno_uid = 'A' + str(np.random.randint(0, 10000))
-                        if anno_uid not in self.get_all_annotations_uids():
-                            non_available_uid = False
-                    self.annotation_volumes[anno_uid] = Annotation(uid=data_uid, input_filename=mask_fn,
-                                                                    output_folder=volume.output_folder,
-                                                                    radiological_volume_uid=uid,
-                                                                    annotation_class=target_type)
+                        self._input_signatures[fp] = signatures[fp]  # Only touched, the content being the same
+
+                sequences_filename = os.path.join(self._input_filepath, 'mri_sequences.csv')
+                known_folders = {uid: t._input_filepath for uid, t in self._timestamps.items()}
+                if [uid for uid, folder in known_folders.items() if uid not in timestamp_files or
+                        timestamp_files[uid][0] != folder] or \
+                        _file_signature(sequences_filename) != self._input_signatures.get(sequences_filename, None):
+                    logging.info("[PatientStructure] Timestamp folders or sequences file changed, ingesting the patient"
+                                 " folder again.")
+                    return self.__dump_rescan_report(self.__rescan_from_scratch(report))
+                if not report["added"] and not report["changed"] and not report["removed"]:
+                    return self.__dump_rescan_report(report)
+
+                stale_files = set(report["changed"] + report["removed"])
+                volumes = [uid for uid, v in self._radiological_volumes.items() if v.raw_input_filepath in stale_files]
+                annotations, registrations = self.__collect_derived_elements(volumes, stale_files)
+                # Timestamps whose content changed, invalidating their reportings
+                timestamps = set([self._radiological_volumes[uid].timestamp_uid for uid in volumes])
+                timestamps.update([self._radiological_volumes[a.radiological_volume_uid].timestamp_uid
+                                   for uid, a in self._annotation_volumes.items() if uid in annotations and
+                                   a.radiological_volume_uid in self._radiological_volumes])
+                timestamps.update([current_files[fp][0] for fp in report["added"]])
+                reportings = [uid for uid, r in self._reportings.items()
+                              if self.__is_reporting_invalidated(r, volumes, timestamps)]
+
+                report["invalidated"] = {"radiological_volumes": volumes, "annotations": annotations,
+                                         "registrations": registrations, "registered_volumes": [],
+                                         "reportings": reportings}
+                for element in list(self._radiological_volumes.values()) + list(self._annotation_volumes.values()):
+                    if element.unique_id in volumes or element.unique_id in annotations:
+                        continue
+                    for dest in element.get_registered_volume_destination_uids():
+                        if dest in volumes or element.registered_volumes[dest]["registration_uid"] in registrations:
+                            info = element.remove_registered_volume(dest)
+                            report["invalidated"]["registered_volumes"].append(
+                                {"uid": element.unique_id, "destination_space_uid": dest,
+                                 "filepath": info["filepath"]})
+
+                # Unchanged input annotations attached to an invalidated radiological volume are ingested again, to
+                # be attached to its new version.
+                ingested_files = set(report["added"] + report["changed"])
+                ingested_files.update([self._annotation_volumes[uid].raw_input_filepath for uid in annotations
+                                       if self._annotation_volumes[uid].raw_input_filepath in current_files])
+                for uid in registrations:
+                    del self._registrations[uid]
+                for uid in annotations:
+                    del self._annotation_volumes[uid]
+                for uid in volumes:
+                    del self._radiological_volumes[uid]
+                for uid in reportings:
+                    del self._reportings[uid]
+                for fp in stale_files:
+                    self._input_digests.pop(fp, None)
+                    self._input_signatures.pop(fp, None)
+
+                for timestamp_uid, (ts_folder, _, _) in timestamp_files.items():
+                    if timestamp_uid not in self._timestamps:
+                        self._timestamps[timestamp_uid] = TimestampParameters(id=timestamp_uid,
+                                                                              timestamp_filepath=ts_folder)
+                ingested_timestamp_files = {}
+                for timestamp_uid, (ts_folder, patient_files, dicom_series) in timestamp_files.items():
+                    files = [f for f in patient_files if os.path.join(ts_folder, f) in ingested_files]
+                    if files:
+                        ingested_timestamp_files[timestamp_uid] = (ts_folder, files, dicom_series)
+                volume_uids, annotation_uids = self.__ingest_input_files(ingested_timestamp_files, executor, threads)
+                self.__include_registration_folders(timestamp_files, volume_uids)
+                self.__include_sequences_file(volume_uids)
+                annotation_uids = annotation_uids + self.__create_stripped_masks(volume_uids, executor, threads)
+                report["ingested"] = {"radiological_volumes": volume_uids, "annotations": annotation_uids}
         except Exception as e:
-            raise ValueError("Patient structure setup from disk folder failed with: {}".format(e))
+            raise ValueError("Patient structure rescan of the disk folder failed with: {}".format(e))
+        return self.__dump_rescan_report(report)
+
+    def __collect_derived_elements(self, volumes: List[str], stale_files: set):
+        """
+        Annotations and registrations derived from the given radiological volumes or stale input files, directly or
+        through other derived elements: the annotations read from a stale file, attached to an invalidated volume, or
+        generated from invalidated elements (see Annotation.source_uids), and the registrations from or to an
+        invalidated volume, or computed with invalidated elements (e.g., brain masks).
+
+        Returns
+        -------
+        List[str], List[str]
+            Unique ids of the invalidated annotations and registrations.
+        """
+        invalidated = set(volumes)
+        annotations = []
+        registrations = []
+        updated = True
+        while updated:
+            updated = False
+            for uid, a in self._annotation_volumes.items():
+                if uid not in invalidated and (a.raw_input_filepath in stale_files or
+                                               a.radiological_volume_uid in invalidated or
+                                               len(invalidated.intersection(a.source_uids)) != 0):
+                    invalidated.add(uid)
+                    annotations.append(uid)
+                    updated = True
+            for uid, r in self._registrations.items():
+                if uid not in invalidated and (r.fixed_uid in invalidated or r.moving_uid in invalidated or
+                                               len(invalidated.intersection(r.source_uids)) != 0):
+                    invalidated.add(uid)
+                    registrations.append(uid)
+                    updated = True
+        return annotations, registrations
+
+    def __rescan_from_scratch(self, report: dict) -> dict:
+        """
+        Ingests the patient folder again as a whole, every element not created again with the same unique id being
+        reported as invalidated.
+        """
+        previous = {"radiological_volumes": list(self._radiological_volumes.keys()),
+                    "annotations": list(self._annotation_volumes.keys()),
+                    "registrations": list(self._registrations.keys()),
+                    "registered_volumes": self.__registered_volume_entries(),
+                    "reportings": list(self._reportings.keys())}
+        self.__clear()
+        self.__init_from_scratch()
+        current = {"radiological_volumes": list(self._radiological_volumes.keys()),
+                   "annotations": list(self._annotation_volumes.keys()),
+                   "registrations": list(self._registrations.keys()),
+                   "registered_volumes": self.__registered_volume_entries(),
+                   "reportings": list(self._reportings.keys())}
+        report["full"] = True
+        report["ingested"] = {"radiological_volumes": current["radiological_volumes"],
+                              "annotations": current["annotations"]}
+        report["invalidated"] = {k: [e for e in previous[k] if e not in current[k]] for k in previous.keys()}
+        return report
+
+    def __registered_volume_entries(self) -> List[dict]:
+        entries = []
+        for element in list(self._radiological_volumes.values()) + list(self._annotation_volumes.values()):
+            for dest, info in element.registered_volumes.items():
+                entries.append({"uid": element.unique_id, "destination_space_uid": dest,
+                                "filepath": info["filepath"]})
+        return entries
+
+    def __is_reporting_invalidated(self, report, volumes: List[str], timestamps: set) -> bool:
+        # Reportings are attached to a radiological volume, to a timestamp, or otherwise cover all the timestamps
+        # (e.g., surgical reportings).
+        parent_uid = getattr(report, '_radiological_volume_uid', None)
+        if parent_uid is not None:
+            return parent_uid in volumes or (parent_uid in self._radiological_volumes and
+                                             self._radiological_volumes[parent_uid].timestamp_uid in timestamps)
+        timestamp = getattr(report, '_timestamp', None)
+        if timestamp is not None:
+            return "T" + str(timestamp) in timestamps
+        return len(timestamps) != 0
+
+    def __dump_rescan_report(self, report: dict) -> dict:
+        logging.info("[PatientStructure] Patient folder rescan: {} added, {} changed, and {} removed input files, {}"
+                     " radiological volumes, {} annotations, {} registrations, {} registered volumes, and {} reportings"
+                     " invalidated.".format(len(report["added"]), len(report["changed"]), len(report["removed"]),
+                                            *[len(v) for v in report["invalidated"].values()]))
+        try:
+            os.makedirs(os.path.dirname(self.rescan_filepath), exist_ok=True)
+            with open(self.rescan_filepath, 'w') as outfile:
+                json.dump(report, outfile, indent=4)
+        except Exception as e:
+            logging.warning("[PatientStructure] Saving the rescan report in {} failed with: {}".format(
+                self.rescan_filepath, e))
+            logging.debug("Traceback: {}.".format(traceback.format_exc()))
+        return report
+
+    def __clear(self) -> None:
+        """
+        Drops the whole patient state, keeping the patient identification and run context.
+        """
+        unique_id, input_filepath, context = self._unique_id, self._input_filepath, self._context
+        self.__reset()
+        self._unique_id, self._input_filepath, self._context = unique_id, input_filepath, context
+
+    def save_snapshot(self) -> None:
+        """
+        Writes a compact binary snapshot of the whole patient state (radiological volumes, annotations, registrations,
+        reportings, and input digests and signatures), together with the size and modification time of every file and
+        folder it relies on. A later run on the same folders rebuilds the state from it instead of ingesting the input folder
+        again, as long as none of these files changed (see __load_snapshot).
+        """
+        try:
+            with self._lock:
+                snapshot = {"version": SNAPSHOT_VERSION, "fingerprint": self.__snapshot_fingerprint(),
+                            "files": {fp: _file_signature(fp) for fp in self.__snapshot_filepaths()}, "patient": self}
+                content = pickle.dumps(snapshot, protocol=pickle.HIGHEST_PROTOCOL)
+            os.makedirs(os.path.dirname(self.snapshot_filepath), exist_ok=True)
+            with open(self.snapshot_filepath + '.tmp', 'wb') as outfile:
+                outfile.write(content)
+            os.replace(self.snapshot_filepath + '.tmp', self.snapshot_filepath)
+        except Exception as e:
+            logging.warning("[PatientStructure] Saving the patient snapshot in {} failed with: {}".format(
+                self.snapshot_filepath, e))
+            logging.debug("Traceback: {}.".format(traceback.format_exc()))
+
+    def __load_snapshot(self) -> bool:
+        """
+        Rebuilds the patient state from the snapshot left by a previous run, if any, and if still valid. If only input
+        files and folders changed since, the patient folder is rescanned to update the reloaded state (see rescan).
+
+        Returns
+        -------
+        bool
+            True if the state was reloaded, False if the input folder must be ingested.
+        """
+        if not os.path.exists(self.snapshot_filepath):
+            return False
+        try:
+            with open(self.snapshot_filepath, 'rb') as infile:
+                snapshot = pickle.load(infile)
+            if snapshot["version"] != SNAPSHOT_VERSION or snapshot["fingerprint"] != self.__snapshot_fingerprint():
+                logging.info("[PatientStructure] Patient snapshot {} made with other settings, ingesting the patient"
+                             " folder again.".format(self.snapshot_filepath))
+                return False
+            patient = snapshot["patient"]
+            # Files on the input side, whose changes are caught by a rescan
+            input_filepaths = set([self._input_filepath, os.path.join(self._input_filepath, 'mri_sequences.csv')])
+            input_filepaths.update([t._input_filepath for t in patient._timestamps.values()])
+            input_filepaths.update(patient._input_digests.keys())
+            changed_filepaths = []
+            for fp, signature in snapshot["files"].items():
+                if _file_signature(fp) != signature:
+                    if fp not in input_filepaths:
+                        logging.info("[PatientStructure] {} changed since the patient snapshot, ingesting the patient"
+                                     " folder again.".format(fp))
+                        return False
+                    changed_filepaths.append(fp)
+        except Exception as e:
+            logging.warning("[PatientStructure] Loading the patient snapshot {} failed with: {}".format(
+                self.snapshot_filepath, e))
+            logging.debug("Traceback: {}.".format(traceback.format_exc()))
+            return False
+
+        self._timestamps = patient._timestamps
+        self._radiological_volumes = patient._radiological_volumes
+        self._annotation_volumes = patient._annotation_volumes
+        self._atlas_volumes = patient._atlas_volumes
+        self._registrations = patient._registrations
+        self._reportings = patient._reportings
+        self._input_digests = patient._input_digests
+        self._input_signatures = patient._input_signatures
+        self.__share_lock()
+        logging.info("[PatientStructure] Patient state reloaded from {}.".format(self.snapshot_filepath))
+        if changed_filepaths:
+            logging.info("[PatientStructure] {} input files or folders changed since the patient snapshot, rescanning"
+                         " the patient folder.".format(len(changed_filepaths)))
+            try:
+                self.rescan()
+            except Exception as e:
+                logging.warning("[PatientStructure] Rescan of the patient folder failed with: {}".format(e))
+                logging.debug("Traceback: {}.".format(traceback.format_exc()))
+                self.__clear()
+                return False
+            self.save_snapshot()
+        return True
+
+    def __snapshot_fingerprint(self) -> dict:
+        # Settings changing the outcome of the ingestion
+        config = self._context.config
+        return {"input_folder": os.path.realpath(self._input_filepath),
+                "output_folder": os.path.realpath(config.output_folder), "caller": config.caller,
+                "diagnosis_task": config.diagnosis_task,
+                "use_stripped_data": config.predictions_use_stripped_data,
+                "accepted_image_formats": list(config.get_accepted_image_formats())}
+
+    def __snapshot_filepaths(self) -> List[str]:
+        # The folders are included to detect added or removed inputs (e.g., a new timestamp or file)
+        filepaths = [self._input_filepath, os.path.join(self._input_filepath, 'mri_sequences.csv')]
+        filepaths.extend([t._input_filepath for t in self._timestamps.values()])
+        for v in list(self._radiological_volumes.values()) + list(self._annotation_volumes.values()):
+            filepaths.extend([v.raw_input_filepath, v.usable_input_filepath])
+            filepaths.extend([r["filepath"] for r in v.registered_volumes.values()])
+        for r in self._registrations.values():
+            filepaths.extend(list(r.forward_filepaths) + list(r.inverse_filepaths))
+        return sorted(set([fp for fp in filepaths if fp is not None]))
+
+    def generate_uid(self, prefix: str, filepath: str = None, timestamp_uid: str = '', role: str = '',
+                     content_digest: str = None, suffix: str = None) -> str:
+        """
+        Deterministic unique id, not yet in use for the patient, for an element created during the processing (e.g.,
+        a segmentation, a registration, or a report). See generate_uid.
+
+        Parameters
+        ----------
+        prefix: str
+            Type of element, e.g., A for an annotation, R for a registration, or RADS for a report.
+        filepath: str
+            File holding the element, if any, identified by its path relative to the patient input folder (or to the
+            output folder) and by the digest of its content.
+        timestamp_uid: str
+            Identifier of the timestamp the element belongs to.
+        role: str
+            Role of the element, e.g., segmentation or registration.
+        content_digest: str
+            Digest identifying the element content, taken from the ingestion digests or computed from filepath if
+            None.
+        suffix: str
+            Human-readable part appended to the id.
+        Returns
+        -------
+        str
+            The unique id.
+        """
+        relative_path = ''
+        if filepath is not None:
+            relative_path = os.path.abspath(filepath)
+            for root in [self._input_filepath, self._context.config.output_folder]:
+                try:
+                    if root is not None and not os.path.relpath(filepath, root).startswith('..'):
+                        relative_path = os.path.relpath(filepath, root)
+                        break
+                except ValueError:  # Different drives
+                    pass
+            if content_digest is None:
+                # Ingested input files were already hashed, while generated files are hashed once, when created.
+                content_digest = self._input_digests.get(filepath)
+            if content_digest is None and os.path.isfile(filepath):
+                content_digest = compute_file_digest(filepath)
+        taken = set(self.radiological_volumes.keys()) | set(self.annotation_volumes.keys()) | \
+            set(self.registrations.keys()) | set(self.reportings.keys())
+        return generate_uid(prefix, relative_path, timestamp_uid=timestamp_uid, role=role,
+                            content_digest=content_digest if content_digest is not None else '', suffix=suffix,
+                            taken=taken)
 
     def include_annotation(self, anno_uid, annotation):
         self.annotation_volumes[anno_uid] = annotation
@@ -214,7 +888,8 @@ class PatientParameters:
         self.registrations[reg_uid] = registration
 
     def include_reporting(self, report_uid, report):
-        self.reportings[report_uid] = report
+        with self._lock:
+            self.reportings[report_uid] = report
 
     def get_input_from_json(self, input_json: dict):
         """
@@ -266,7 +941,7 @@ class PatientParameters:
                 else:
                     return volume
                 # Use-case where the provided inputs are already co-registered
-            elif ResourcesConfiguration.getInstance().predictions_use_registered_data:
+            elif self._context.config.predictions_use_registered_data:
                 volume = self.get_radiological_volume(volume_uid=volume_uid)
                 input_fp = volume.usable_input_filepath
                 if not os.path.exists(input_fp):
@@ -285,43 +960,26 @@ class PatientParameters:
         return list(self.radiological_volumes.keys())
 
     def get_all_radiological_volumes_for_timestamp(self, timestamp: int) -> List[RadiologicalVolume]:
-        res_list = []
-        for v in self.radiological_volumes.keys():
-            if self.radiological_volumes[v]._timestamp_id == "T" + str(timestamp):
-                res_list.append(self.radiological_volumes[v])
-        return res_list
+        return [self.radiological_volumes[v] for v in self.get_all_radiological_volumes_uids_for_timestamp(timestamp)]
 
     def get_all_radiological_volumes_uids_for_timestamp(self, timestamp: int) -> List[str]:
-        res_list = []
-        for v in self.radiological_volumes.keys():
-            if self.radiological_volumes[v]._timestamp_id == "T" + str(timestamp):
-                res_list.append(v)
-        return res_list
+        return self.radiological_volumes.lookup('timestamp', "T" + str(timestamp))
 
     def get_radiological_volume_uid(self, timestamp: int, sequence: str) -> str:
-        for v in self.radiological_volumes.keys():
-            if self.radiological_volumes[v]._timestamp_id == "T" + str(timestamp) and str(self.radiological_volumes[v]._sequence_type) == sequence:
-                return v
-        return "-1"
+        uid = self.radiological_volumes.lookup_first('timestamp_sequence', ("T" + str(timestamp), sequence))
+        return uid if uid is not None else "-1"
 
     def get_radiological_volume(self, volume_uid: str) -> RadiologicalVolume:
         return self.radiological_volumes[volume_uid] if volume_uid in self.radiological_volumes.keys() else None
 
     def get_radiological_volume_by_base_filename(self, base_fn: str):
-        result = None
-        for im in self.radiological_volumes:
-            if os.path.basename(self.radiological_volumes[im].usable_input_filepath).split('.')[0] == base_fn:
-                return self.radiological_volumes[im]
-        return result
+        uid = self.radiological_volumes.lookup_first('base_filename', base_fn)
+        return self.radiological_volumes[uid] if uid is not None else None
 
     def get_radiological_volume_for_timestamp_and_sequence(self, timestamp: int,
                                                            sequence: str) -> List[RadiologicalVolume]:
-        res_list = []
-        volumes = self.get_all_radiological_volumes_uids_for_timestamp(timestamp=timestamp)
-        for v in volumes:
-            if self.radiological_volumes[v].get_sequence_type_str() == sequence:
-                res_list.append(self.radiological_volumes[v])
-        return res_list
+        uids = self.radiological_volumes.lookup('timestamp_sequence', ("T" + str(timestamp), sequence))
+        return [self.radiological_volumes[v] for v in uids]
 
     def get_all_annotations_uids(self) -> List[str]:
         return list(self.annotation_volumes.keys())
@@ -330,63 +988,36 @@ class PatientParameters:
         return self.annotation_volumes[annotation_uid]
 
     def get_all_annotations_radiological_volume(self, volume_uid: str) -> List[Annotation]:
-        res = []
-        for v in self.annotation_volumes.keys():
-            if self.annotation_volumes[v]._radiological_volume_uid == volume_uid:
-                res.append(self.annotation_volumes[v])
-        return res
+        return [self.annotation_volumes[v] for v in self.annotation_volumes.lookup('volume', volume_uid)]
 
     def get_all_annotations_for_timestamp(self, timestamp: int) -> List[Annotation]:
         res_list = []
-        volumes = self.get_all_radiological_volumes_uids_for_timestamp(timestamp=timestamp)
-        for a in self.annotation_volumes:
-            if a.radiological_volume_uid in volumes:
-                res_list.append(a)
+        for v in self.get_all_radiological_volumes_uids_for_timestamp(timestamp=timestamp):
+            res_list.extend(self.get_all_annotations_radiological_volume(v))
         return res_list
 
     def get_all_annotations_for_timestamp_and_structure(self, timestamp: int,
                                                         structure: str) -> List[Annotation]:
-        res_list = []
-        volumes = self.get_all_radiological_volumes_uids_for_timestamp(timestamp=timestamp)
-        for a in list(self.annotation_volumes.keys()):
-            if self.annotation_volumes[a].radiological_volume_uid in volumes and self.annotation_volumes[a].get_annotation_type_name() == structure:
-                res_list.append(self.annotation_volumes[a])
-        return res_list
+        return [a for a in self.get_all_annotations_for_timestamp(timestamp)
+                if a.get_annotation_type_name() == structure]
 
     def get_all_annotations_uids_radiological_volume(self, volume_uid: str) -> List[str]:
-        res = []
-        for v in self.annotation_volumes.keys():
-            if self.annotation_volumes[v]._radiological_volume_uid == volume_uid:
-                res.append(v)
-        return res
+        return self.annotation_volumes.lookup('volume', volume_uid)
 
     def get_all_registered_annotations_uids_radiological_volume(self, volume_uid: str) -> List[str]:
-        res = []
-        for v in self.annotation_volumes.keys():
-            for r in self.annotation_volumes[v].registered_volumes.keys():
-                if r == volume_uid:
-                    res.append(v)
-        return res
+        return self.annotation_volumes.lookup('registered', volume_uid)
 
     def get_all_annotations_uids_class_radiological_volume(self, volume_uid: str,
                                                            annotation_class: AnnotationClassType,
                                                            include_coregistrations: bool = False,
                                                            return_objects=False) -> List[str]:
-        res = []
-        for v in self.annotation_volumes.keys():
-            if self.annotation_volumes[v]._radiological_volume_uid == volume_uid and \
-                    self.annotation_volumes[v]._annotation_type == annotation_class:
-                if not return_objects:
-                    res.append(v)
-                else:
-                    res.append(self.annotation_volumes[v])
-            if include_coregistrations:
-                if volume_uid in self.annotation_volumes[v].registered_volumes.keys() and \
-                        self.annotation_volumes[v]._annotation_type == annotation_class:
-                    if not return_objects:
-                        res.append(v)
-                    else:
-                        res.append(self.annotation_volumes[v])
+        res = self.annotation_volumes.lookup('volume_class', (volume_uid, annotation_class))
+        if include_coregistrations:
+            # Same order as a scan of all annotations, an annotation being listed twice if matching both ways.
+            res = self.annotation_volumes.ordered(
+                res + self.annotation_volumes.lookup('registered_class', (volume_uid, annotation_class)))
+        if return_objects:
+            return [self.annotation_volumes[v] for v in res]
         return res
 
     def get_all_annotations_fns_class_radiological_volume(self, volume_uid: str,
@@ -396,22 +1027,20 @@ class PatientParameters:
         @TODO. What if the volume_uid is an atlas?
         """
         res = []
-        for v in self.annotation_volumes.keys():
-            if self.annotation_volumes[v]._radiological_volume_uid == volume_uid and \
-                    self.annotation_volumes[v]._annotation_type == annotation_class:
+        direct = self.annotation_volumes.lookup('volume_class', (volume_uid, annotation_class))
+        coregistered = []
+        if include_coregistrations:
+            coregistered = self.annotation_volumes.lookup('registered_class', (volume_uid, annotation_class))
+        for v in self.annotation_volumes.ordered(list(set(direct + coregistered))):
+            if v in direct:
                 res.append(self.annotation_volumes[v].usable_input_filepath)
-            if include_coregistrations:
-                if volume_uid in self.annotation_volumes[v].registered_volumes.keys() and \
-                        self.annotation_volumes[v]._annotation_type == annotation_class:
-                    res.append(self.annotation_volumes[v].registered_volumes[volume_uid]["filepath"])
+            if v in coregistered:
+                res.append(self.annotation_volumes[v].registered_volumes[volume_uid]["filepath"])
         return res
 
     def get_registration_by_uids(self, fixed_uid: str, moving_uid: str) -> Registration:
-        registration = None
-        for r in list(self.registrations.keys()):
-            if self.registrations[r].fixed_uid == fixed_uid and self.registrations[r].moving_uid == moving_uid:
-                return self.registrations[r]
-        return registration
+        uid = self.registrations.lookup_first('fixed_moving', (fixed_uid, moving_uid))
+        return self.registrations[uid] if uid is not None else None
 
     def get_registration_by_json(self, fixed: dict, moving: dict) -> Registration:
         fixed_ts = fixed["timestamp"]
@@ -1,4 +1,5 @@
 import os
+from contextlib import nullcontext
 from typing import List
 from aenum import Enum, unique
 from ..utilities import get_type_from_string, input_file_type_conversion
@@ -59,6 +60,7 @@ class RadiologicalVolume:
     _radiological_type = None  # Disambiguation between CT/MRI, to select from RadiologicalType
     _sequence_type = None  # Specific sequence type within the radiological type
     _timestamp_id = None  # Internal identifier for the corresponding timestamp
+    _owner = None  # IndexedCollection holding the instance, notified when an indexed attribute changes
     _registered_volumes = {}  # Each element is a dict with the 'filepath' of the registered volume and
     # the 'registration_uid' of the registration applied. The keys are the destination space uid ('MNI' if atlas).
     # @TODO. Do we have a similar dict for the registered atlas files?
@@ -83,6 +85,7 @@ class RadiologicalVolume:
         self._sequence_type = None
         self._timestamp_id = None
         self._registered_volumes = {}
+        self._owner = None
 
     @property
     def unique_id(self) -> str:
@@ -92,6 +95,10 @@ class RadiologicalVolume:
     def output_folder(self) -> str:
         return self._output_folder
 
+    @property
+    def timestamp_uid(self) -> str:
+        return self._timestamp_id
+
     @property
     def raw_input_filepath(self) -> str:
         return self._raw_input_filepath
@@ -119,12 +126,14 @@ class RadiologicalVolume:
         if self._radiological_type == RadiologicalType.CT:
             radiological_type = CTSequenceType
 
-        if isinstance(type, str):
-            ctype = get_type_from_string(radiological_type, type)
-            if ctype != -1:
-                self._sequence_type = ctype
-        elif isinstance(type, radiological_type):
-            self._sequence_type = type
+        with self.__state_lock():
+            if isinstance(type, str):
+                ctype = get_type_from_string(radiological_type, type)
+                if ctype != -1:
+                    self._sequence_type = ctype
+            elif isinstance(type, radiological_type):
+                self._sequence_type = type
+            self.__notify_owner()
 
     @property
     def registered_volumes(self) -> dict:
@@ -144,7 +153,17 @@ class RadiologicalVolume:
         return destination_space_uid in list(self._registered_volumes.keys())
 
     def include_registered_volume(self, filepath: str, registration_uid: str, destination_space_uid: str) -> None:
-        self._registered_volumes[destination_space_uid] = {"filepath": filepath, "registration_uid": registration_uid}
+        with self.__state_lock():
+            self._registered_volumes[destination_space_uid] = {"filepath": filepath,
+                                                               "registration_uid": registration_uid}
+
+    def remove_registered_volume(self, destination_space_uid: str) -> dict:
+        """
+        Forgets the registered volume for the given destination space (e.g., after its registration was invalidated),
+        returning its info, None if not included.
+        """
+        with self.__state_lock():
+            return self._registered_volumes.pop(destination_space_uid, None)
 
     def get_registered_volume_info(self, destination_space_uid: str):
         return self._registered_volumes[destination_space_uid]
@@ -152,6 +171,20 @@ class RadiologicalVolume:
     def get_registered_volume_destination_uids(self) -> List[str]:
         return list(self._registered_volumes.keys())
 
+    def __getstate__(self) -> dict:
+        # The owning collection is set again when the instance is inserted into it.
+        state = self.__dict__.copy()
+        state.pop('_owner', None)
+        return state
+
+    def __notify_owner(self) -> None:
+        if self._owner is not None:
+            self._owner.reindex(self)
+
+    def __state_lock(self):
+        # Lock of the owning collection, serializing the changes with the other accesses to the patient state.
+        return self._owner.lock if self._owner is not None else nullcontext()
+
     def __init_from_scratch(self):
         self._output_folder = os.path.join(ResourcesConfiguration.getInstance().output_folder, self._timestamp_id)
         os.makedirs(self._output_folder, exist_ok=True)
@@ -16,13 +16,15 @@ class Registration:
     _output_folder = None  #
     _fixed_uid = None
     _moving_uid = None
+    _source_uids = []  # Unique ids of the other elements (e.g., brain mask annotations) the registration depends on
 
     def __init__(self, uid: str, fixed_uid: str, moving_uid: str, fwd_paths: List[str], inv_paths: List[str],
-                 output_folder: str) -> None:
+                 output_folder: str, source_uids: List[str] = None) -> None:
         self.__reset()
         self._unique_id = uid
         self._fixed_uid = fixed_uid
         self._moving_uid = moving_uid
+        self._source_uids = list(source_uids) if source_uids else []
         self._output_folder = os.path.join(output_folder, 'Transforms', self._moving_uid + "-to-" + self._fixed_uid)
         os.makedirs(self._output_folder)
 
@@ -46,6 +48,7 @@ class Registration:
         self._output_folder = None
         self._fixed_uid = None
         self._moving_uid = None
+        self._source_uids = []
 
     @property
     def unique_id(self) -> str:
@@ -59,6 +62,10 @@ class Registration:
     def moving_uid(self) -> str:
         return self._moving_uid
 
+    @property
+    def source_uids(self) -> List[str]:
+        return self._source_uids
+
     @property
     def output_folder(self) -> str:
         return self._output_folder
@@ -6,6 +6,8 @@ import time
 import datetime
 import calendar
 import traceback
+import uuid
+import importlib.metadata
 
 import numpy as np
 import subprocess
@@ -14,6 +16,23 @@ import zipfile
 import gzip
 # from dipy.align.reslice import reslice
 from ..Processing.brain_processing import *
+from .configuration_parser import ResourcesConfiguration
+from .io import write_image
+from .result_cache import compute_folder_version
+from .cancellation import start_process_group
+
+
+def _python_registration(moving: str, fixed: str, registration_method: str) -> dict:
+    """
+    Python-based ANTs registration of the moving onto the fixed image, returning the filepaths of the forward and
+    inverse transforms. Defined at the module level to run in a child process (see CancellationToken.run_process).
+    """
+    import ants
+    moving_ants = ants.image_read(moving, dimension=3)
+    fixed_ants = ants.image_read(fixed, dimension=3)
+    reg_transform = ants.registration(fixed_ants, moving_ants, registration_method)
+    return {'fwdtransforms': list(reg_transform['fwdtransforms']),
+            'invtransforms': list(reg_transform['invtransforms'])}
 
 
 class ANTsRegistration:
@@ -25,13 +44,16 @@ class ANTsRegistration:
     def __init__(self):
         self.ants_reg_dir = ResourcesConfiguration.getInstance().ants_reg_dir
         self.ants_apply_dir = ResourcesConfiguration.getInstance().ants_apply_dir
-        self.registration_folder = os.path.join(ResourcesConfiguration.getInstance().output_folder, 'registration/')
+        # Each runner works inside its own sub-folder, so that multiple registrations can be processed concurrently.
+        self.registration_root = os.path.join(ResourcesConfiguration.getInstance().output_folder, 'registration')
+        self.registration_folder = os.path.join(self.registration_root, uuid.uuid4().hex[:8] + '/')
         os.makedirs(self.registration_folder, exist_ok=True)
         self.reg_transform = {}
         self.transform_names = []
         self.inverse_transform_names = []
         self.registration_computed = False
         self.backend = ResourcesConfiguration.getInstance().system_ants_backend
+        self.cancellation_token = None  # Optional CancellationToken bounding the runtime of the ANTs binaries
 
     def clear_cache(self):
         # In Python, registration files are stored in the temporary folder and must be removed.
@@ -47,10 +69,32 @@ class ANTsRegistration:
 
         if os.path.exists(self.registration_folder):
             shutil.rmtree(self.registration_folder)
+        self.__clear_registration_root()
 
     def clear_output_folder(self):
         if os.path.exists(self.registration_folder):
             shutil.rmtree(self.registration_folder)
+        self.__clear_registration_root()
+
+    def __clear_registration_root(self):
+        # The shared parent folder is only removed once all concurrent runners are done with it.
+        try:
+            if os.path.exists(self.registration_root) and len(os.listdir(self.registration_root)) == 0:
+                os.rmdir(self.registration_root)
+        except OSError:
+            pass
+
+    def __run_process(self, args, shell: bool = False):
+        """
+        Runs an ANTs binary (or script) in its own process group, the whole group (i.e., including the binaries called
+        by the scripts) being killed if the current step is cancelled or runs out of time.
+        """
+        popen = start_process_group(args, stdout=subprocess.PIPE, shell=shell)
+        if self.cancellation_token is None:
+            output, _ = popen.communicate()
+        else:
+            output, _ = self.cancellation_token.wait_process(popen)
+        return output
 
     def dump_and_clean(self):
         """
@@ -125,9 +169,37 @@ class ANTsRegistration:
         self.registration_computed = True
         return
 
-    def compute_registration_cpp(self, moving, fixed, registration_method):
-        logging.debug("Starting registration for patient.")
+    def registration_parameters(self, registration_method: str) -> dict:
+        """
+        Everything influencing the transforms computed by compute_registration besides the images: the backend, its
+        version, and the parameters it is called with.
 
+        Parameters
+        ----------
+        registration_method : str
+            ANTs tag to specify which registration method to use (e.g., SyN).
+        Returns
+        -------
+        dict
+            Backend, version, and registration parameters.
+        """
+        if self.backend == 'cpp':
+            script_path, transform = self.__cpp_registration_script(registration_method)
+            # The locally compiled ANTs carries no version number, its scripts and binaries identifying it instead.
+            return {"backend": self.backend, "version": compute_folder_version(self.ants_reg_dir),
+                    "script": os.path.basename(script_path), "dimension": 3, "transform": transform, "cores": 8}
+        try:
+            version = importlib.metadata.version('antspyx')
+        except importlib.metadata.PackageNotFoundError:
+            version = None
+        if registration_method == 'antsRegistrationSyNQuick[s]' or registration_method == 'antsRegistrationSyN[s]':
+            registration_method = 'SyN'
+        return {"backend": self.backend, "version": version, "type_of_transform": registration_method}
+
+    def __cpp_registration_script(self, registration_method: str):
+        """
+        ANTs script and transform type used by the c++ backend for the given registration method.
+        """
         if registration_method == 'SyN':
             registration_method = 'sq'
 
@@ -136,10 +208,16 @@ class ANTsRegistration:
             registration_method = 's'
         else:
             script_path = os.path.join(self.ants_reg_dir, 'antsRegistrationSyN.sh')
+        return script_path, registration_method
+
+    def compute_registration_cpp(self, moving, fixed, registration_method):
+        logging.debug("Starting registration for patient.")
+
+        script_path, registration_method = self.__cpp_registration_script(registration_method)
 
         try:
             if platform.system() == 'Windows':
-                subprocess.call(["{script}".format(script=script_path),
+                self.__run_process(["{script}".format(script=script_path),
                                  '-d{dim}'.format(dim=3),
                                  '-f{fixed}'.format(fixed=fixed),
                                  '-m{moving}'.format(moving=moving),
@@ -153,7 +231,7 @@ class ANTsRegistration:
                                  #'-x{mask}'.format(mask=fixed_mask_filepath)
                                  ], shell=True)
             else:
-                subprocess.call(["{script}".format(script=script_path),
+                self.__run_process(["{script}".format(script=script_path),
                                  '-d{dim}'.format(dim=3),
                                  '-f{fixed}'.format(fixed=fixed),
                                  '-m{moving}'.format(moving=moving),
@@ -190,14 +268,20 @@ class ANTsRegistration:
             if registration_method == 'antsRegistrationSyNQuick[s]' or registration_method == 'antsRegistrationSyN[s]':
                 registration_method = 'SyN'
 
-            self.reg_transform = ants.registration(fixed_ants, moving_ants, registration_method)
+            if self.cancellation_token is not None:
+                # Run in a child process, to be stopped if the step runs out of time
+                self.reg_transform = self.cancellation_token.run_process(_python_registration, moving, fixed,
+                                                                         registration_method)
+            else:
+                self.reg_transform = _python_registration(moving, fixed, registration_method)
             warped_input = ants.apply_transforms(fixed=fixed_ants,
                                                   moving=moving_ants,
                                                   transformlist=self.reg_transform['fwdtransforms'],
                                                   interpolator='linear',
                                                   whichtoinvert=[False, False])
-            warped_input_filename = os.path.join(self.registration_folder, 'input_volume_to_MNI.nii.gz')
-            ants.image_write(warped_input, warped_input_filename)
+            warped_input_filename = os.path.join(self.registration_folder, 'input_volume_to_MNI' +
+                                                 ResourcesConfiguration.getInstance().get_intermediate_extension())
+            write_image(ants.image_write, warped_input, warped_input_filename)
         except Exception as e:
             raise RuntimeError('Python-based ANTs registration failed with: {}'.format(e))
 
@@ -222,7 +306,8 @@ class ANTsRegistration:
         # transform_filenames = [os.path.join(self.registration_folder, x) for x in self.transform_names]
         transform_filenames = self.reg_transform['fwdtransforms']
         moving_registered_filename = os.path.join(self.registration_folder,
-                                                  os.path.basename(moving).split('.')[0] + '_reg_atlas.nii.gz')
+                                                  os.path.basename(moving).split('.')[0] + '_reg_atlas' +
+                                                  ResourcesConfiguration.getInstance().get_intermediate_extension())
 
         if len(transform_filenames) == 4:
             args = ("{script}".format(script=script_path),
@@ -258,12 +343,7 @@ class ANTsRegistration:
         # Or just:
         # args = "bin/bar -c somefile.xml -d text.txt -r aString -f anotherString".split()
         try:
-            if platform.system() == 'Windows':
-                popen = subprocess.Popen(args, stdout=subprocess.PIPE, shell=True)
-            else:
-                popen = subprocess.Popen(args, stdout=subprocess.PIPE)
-            popen.wait()
-            output = popen.stdout.read()
+            output = self.__run_process(args, shell=platform.system() == 'Windows')
             return moving_registered_filename
         except Exception as e:
             raise RuntimeError('Cpp-based ANTs apply registration failed with: {}'.format(e))
@@ -278,8 +358,9 @@ class ANTsRegistration:
                                                  transformlist=self.reg_transform['fwdtransforms'],
                                                  interpolator=interpolation,
                                                  whichtoinvert=[False, False])
-            warped_input_filename = os.path.join(self.registration_folder, 'warped_input_to_output_space.nii.gz')
-            ants.image_write(warped_input, warped_input_filename)
+            warped_input_filename = os.path.join(self.registration_folder, 'warped_input_to_output_space' +
+                                                 ResourcesConfiguration.getInstance().get_intermediate_extension())
+            write_image(ants.image_write, warped_input, warped_input_filename)
             return warped_input_filename
         except Exception as e:
             raise RuntimeError('Python-based ANTs apply registration failed with: {}'.format(e))
@@ -304,7 +385,8 @@ class ANTsRegistration:
 
         # transform_filenames = [os.path.join(self.registration_folder, x) for x in self.inverse_transform_names]
         transform_filenames = self.reg_transform['invtransforms']
-        moving_registered_filename = os.path.join(self.registration_folder, label + '_mask_to_input.nii.gz')
+        moving_registered_filename = os.path.join(self.registration_folder, label + '_mask_to_input' +
+                                                  ResourcesConfiguration.getInstance().get_intermediate_extension())
         os.makedirs(os.path.dirname(moving_registered_filename), exist_ok=True)
 
         if len(transform_filenames) == 4:  # Combined case?
@@ -341,12 +423,7 @@ class ANTsRegistration:
         # Or just:
         # args = "bin/bar -c somefile.xml -d text.txt -r aString -f anotherString".split()
         try:
-            if platform.system() == 'Windows':
-                popen = subprocess.Popen(args, stdout=subprocess.PIPE, shell=True)
-            else:
-                popen = subprocess.Popen(args, stdout=subprocess.PIPE)
-            popen.wait()
-            output = popen.stdout.read()
+            output = self.__run_process(args, shell=platform.system() == 'Windows')
             return moving_registered_filename
         except Exception as e:
             raise RuntimeError('Failed to apply inverse transforms on input image with: {}'.format(e))
@@ -361,11 +438,12 @@ class ANTsRegistration:
                                                  transformlist=self.reg_transform['invtransforms'],
                                                  interpolator=interpolation,
                                                  whichtoinvert=[True, False])
-            warped_input_filename = os.path.join(self.registration_folder, label + '_mask.nii.gz')
+            warped_input_filename = os.path.join(self.registration_folder, label + '_mask' +
+                                                 ResourcesConfiguration.getInstance().get_intermediate_extension())
             # warped_input_filename = os.path.join(ResourcesConfiguration.getInstance().output_folder, 'patient',
             #                                           label + '_mask.nii.gz')
             os.makedirs(os.path.dirname(warped_input_filename), exist_ok=True)
-            ants.image_write(warped_input, warped_input_filename)
+            write_image(ants.image_write, warped_input, warped_input_filename)
             return warped_input_filename
         except Exception as e:
             raise RuntimeError('Failed to apply inverse transform with: {}'.format(e))
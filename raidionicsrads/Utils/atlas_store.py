@@ -0,0 +1,349 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import traceback
+import nibabel as nib
+import numpy as np
+from .configuration_parser import ResourcesConfiguration
+from .io import load_nifti_volume, mask_array, intensity_array, save_mask, save_intensities
+
+# Layout version of the stored atlases, to increase whenever the materialisation (e.g., data types) changes
+STORE_VERSION = 1
+# Value of a probability of 1 inside the packed tract bundles, the probabilities being stored as uint8
+BUNDLE_SCALE = 255
+
+
+class AtlasStore:
+    """
+    Decompressed copies of the atlases shipped with the package (e.g., cortical label maps, BrainGrid voxels,
+    subcortical tracts, resectability maps), opened through memory mapping. The compressed atlases are materialised
+    once, on first use, as uncompressed NIfTI files in compact data types (see mask_array and intensity_array) inside
+    a versioned folder. All subsequent reads, from any process, map the same files and share the operating system
+    page cache instead of each decompressing and holding its own copy.
+    Entries are identified by the source path, modification time, size, and kind, such that an updated atlas is
+    materialised again instead of being served from a stale copy.
+    """
+    _root = None  # Folder holding the versioned stores
+    _enabled = True  # Disabled if the store folder cannot be written
+    _writable = False  # Whether the store folder was checked to be writable
+    _lock = None
+
+    def __init__(self, root: str) -> None:
+        self.__reset()
+        self._root = root
+
+    def __reset(self):
+        """
+        All objects share class or static variables.
+        An instance or non-static variables are different for different objects (every object has a copy).
+        """
+        self._root = None
+        self._enabled = True
+        self._writable = False
+        self._lock = threading.Lock()
+
+    @property
+    def root(self) -> str:
+        return self._root
+
+    @property
+    def folder(self) -> str:
+        return os.path.join(self._root, 'v' + str(STORE_VERSION))
+
+    @property
+    def enabled(self) -> bool:
+        return self._enabled
+
+    def load_mask(self, filepath: str):
+        """
+        Opens an atlas label map (or binary mask) from the store, materialising it first if needed.
+
+        Parameters
+        ----------
+        filepath: str
+            Filepath of the atlas, as shipped with the package.
+        Returns
+        -------
+        nib.Nifti1Image, np.ndarray
+            The image (for its affine and header), and its voxel values as a read-only memory-mapped array in the
+            compact integer data type given by mask_dtype.
+        """
+        return self.__load(filepath, kind='mask')
+
+    def load_intensities(self, filepath: str):
+        """
+        Opens an atlas probability map (e.g., tract or resectability map) from the store, materialising it first if
+        needed.
+
+        Parameters
+        ----------
+        filepath: str
+            Filepath of the atlas, as shipped with the package.
+        Returns
+        -------
+        nib.Nifti1Image, np.ndarray
+            The image (for its affine and header), and its voxel values as a read-only memory-mapped float32 array.
+        """
+        return self.__load(filepath, kind='intensities')
+
+    def load_tract_bundle(self, structures: dict):
+        """
+        Opens the packed bundle of a tract atlas: the shipped one if present, otherwise the one built in the store
+        from the singular tract files on first use.
+
+        Parameters
+        ----------
+        structures: dict
+            Atlas entry from ResourcesConfiguration.subcortical_structures['MNI'], with the Singular, Bundle, and
+            BundleIndex keys.
+        Returns
+        -------
+        TractBundle
+            All tracts of the atlas, memory-mapped from a single file.
+        """
+        bundle_filepath = structures.get('Bundle')
+        index_filepath = structures.get('BundleIndex')
+        if bundle_filepath and index_filepath and os.path.exists(bundle_filepath) and os.path.exists(index_filepath):
+            return TractBundle.open(bundle_filepath, index_filepath)
+
+        if self.__check_folder():
+            try:
+                stats = [(os.path.realpath(fp), os.stat(fp).st_size, os.stat(fp).st_mtime_ns)
+                         for fp in structures['Singular'].values()]
+                key = json.dumps([list(structures['Singular'].keys()), stats])
+                name = os.path.basename(bundle_filepath).split('.')[0] if bundle_filepath else 'tracts_bundle'
+                entry = os.path.join(self.folder, hashlib.sha1(key.encode('utf-8')).hexdigest()[:16] + '_' + name)
+                if not os.path.exists(entry + '.nii') or not os.path.exists(entry + '.json'):
+                    with self._lock:
+                        if not os.path.exists(entry + '.nii') or not os.path.exists(entry + '.json'):
+                            logging.info("[AtlasStore] Packing {} tracts into {}.".format(len(stats), entry + '.nii'))
+                            os.makedirs(self.folder, exist_ok=True)
+                            pack_tract_bundle(structures['Singular'], entry + '.nii', entry + '.json')
+                return TractBundle.open(entry + '.nii', entry + '.json')
+            except Exception as e:
+                logging.warning("[AtlasStore] Packing the tracts in {} failed with: {}. The singular tract files will"
+                                " be read instead.".format(self.folder, e))
+                logging.debug("Traceback: {}.".format(traceback.format_exc()))
+        return TractBundle(tracts=structures['Singular'])
+
+    def entry_filepath(self, filepath: str, kind: str) -> str:
+        stats = os.stat(filepath)
+        key = '{}|{}|{}|{}'.format(os.path.realpath(filepath), stats.st_size, stats.st_mtime_ns, kind)
+        name = os.path.basename(filepath).split('.')[0]
+        return os.path.join(self.folder, hashlib.sha1(key.encode('utf-8')).hexdigest()[:16] + '_' + name + '.nii')
+
+    def __load(self, filepath: str, kind: str):
+        if self.__check_folder():
+            try:
+                entry = self.entry_filepath(filepath, kind)
+                if not os.path.exists(entry):
+                    self.__materialise(filepath, entry, kind)
+                nib_volume = nib.load(entry, mmap='r')
+                return nib_volume, np.asanyarray(nib_volume.dataobj)
+            except Exception as e:
+                logging.warning("[AtlasStore] Using the atlas store for {} failed with: {}. The atlas will be"
+                                " decompressed instead.".format(filepath, e))
+                logging.debug("Traceback: {}.".format(traceback.format_exc()))
+
+        nib_volume = load_nifti_volume(filepath)
+        return nib_volume, mask_array(nib_volume) if kind == 'mask' else intensity_array(nib_volume)
+
+    def __check_folder(self) -> bool:
+        # Only a store folder which cannot be written disables the store for the rest of the process, any other
+        # failure only falls back for the atlas at hand.
+        if self._enabled and not self._writable:
+            try:
+                os.makedirs(self.folder, exist_ok=True)
+                fd, probe_filepath = tempfile.mkstemp(dir=self.folder)
+                os.close(fd)
+                os.remove(probe_filepath)
+                self._writable = True
+            except OSError as e:
+                self._enabled = False
+                logging.warning("[AtlasStore] The atlas store folder {} cannot be written: {}. The atlases will be"
+                                " decompressed for each use instead.".format(self.folder, e))
+                logging.debug("Traceback: {}.".format(traceback.format_exc()))
+        return self._enabled
+
+    def __materialise(self, filepath: str, entry: str, kind: str) -> None:
+        # Written under a temporary name then renamed, such that concurrent processes never map a partial file.
+        with self._lock:
+            if os.path.exists(entry):
+                return
+            logging.info("[AtlasStore] Materialising {} into {}.".format(filepath, entry))
+            os.makedirs(self.folder, exist_ok=True)
+            nib_volume = load_nifti_volume(filepath)
+            fd, tmp_filepath = tempfile.mkstemp(suffix='.nii', dir=self.folder)
+            os.close(fd)
+            try:
+                if kind == 'mask':
+                    save_mask(mask_array(nib_volume), nib_volume.affine, tmp_filepath, header=nib_volume.header)
+                else:
+                    save_intensities(intensity_array(nib_volume), nib_volume.affine, tmp_filepath,
+                                     header=nib_volume.header)
+                os.replace(tmp_filepath, entry)
+            finally:
+                if os.path.exists(tmp_filepath):
+                    os.remove(tmp_filepath)
+
+
+class TractBundle:
+    """
+    Tracts of a subcortical structures atlas, either packed in a single 4D uint8 volume (the tract probabilities
+    scaled by BUNDLE_SCALE, one tract per 4th dimension index) with its name index, or as the singular tract files
+    read one by one when no bundle could be built.
+    """
+    _names = []  # Tract names, in the order of the 4th dimension
+    _image = None  # Packed bundle image, None when reading the singular files
+    _data = None  # Read-only memory-mapped voxel values of the packed bundle
+    _tracts = {}  # Filepath of each singular tract file, indexed by name
+
+    def __init__(self, tracts: dict = None) -> None:
+        self.__reset()
+        if tracts is not None:
+            self._tracts = dict(tracts)
+            self._names = list(tracts.keys())
+
+    def __reset(self):
+        """
+        All objects share class or static variables.
+        An instance or non-static variables are different for different objects (every object has a copy).
+        """
+        self._names = []
+        self._image = None
+        self._data = None
+        self._tracts = {}
+
+    @classmethod
+    def open(cls, bundle_filepath: str, index_filepath: str):
+        bundle = cls()
+        with open(index_filepath, 'r') as infile:
+            index = json.load(infile)
+        bundle._names = index["names"]
+        bundle._image = nib.load(bundle_filepath, mmap='r')
+        bundle._data = np.asanyarray(bundle._image.dataobj)
+        if bundle._data.ndim != 4 or bundle._data.shape[-1] != len(bundle._names):
+            raise ValueError("The tract bundle {} does not match its index {}.".format(bundle_filepath,
+                                                                                      index_filepath))
+        return bundle
+
+    @property
+    def names(self) -> list:
+        return self._names
+
+    @property
+    def packed(self) -> bool:
+        return self._data is not None
+
+    def mask(self, name: str, cutoff: float):
+        """
+        Binary mask of a tract, thresholded at the given probability.
+
+        Parameters
+        ----------
+        name: str
+            Tract name, from names.
+        cutoff: float
+            Probability above which a voxel belongs to the tract. Inside a packed bundle, the comparison is made on
+            the uint8 values, which is exact for a cutoff of 0.5 and within 1/BUNDLE_SCALE otherwise.
+        Returns
+        -------
+        np.ndarray, tuple
+            The uint8 mask, and the voxel spacing.
+        """
+        if self._data is not None:
+            index = self._names.index(name)
+            mask = (self._data[..., index] >= int(np.rint(cutoff * BUNDLE_SCALE))).astype('uint8')
+            return mask, self._image.header.get_zooms()[:3]
+        nib_volume = load_nifti_volume(self._tracts[name])
+        return (intensity_array(nib_volume) >= cutoff).astype('uint8'), nib_volume.header.get_zooms()
+
+
+def pack_tract_bundle(tracts: dict, bundle_filepath: str, index_filepath: str) -> str:
+    """
+    Packs the singular tract files of an atlas into a single uncompressed 4D uint8 NIfTI volume, and its name index
+    as json. The tracts are written one after the other (i.e., contiguous on disk), such that only one of them is
+    held in memory while packing, and reading one tract from the bundle is a single sequential read.
+
+    Parameters
+    ----------
+    tracts: dict
+        Filepath of each tract probability map, indexed by name, in the order to pack them.
+    bundle_filepath: str
+        Filepath of the bundle volume to write, ending in .nii.
+    index_filepath: str
+        Filepath of the json name index to write.
+    Returns
+    -------
+    str
+        The bundle filepath.
+    """
+    names = list(tracts.keys())
+    if len(names) == 0:
+        raise ValueError("No tract to pack into {}.".format(bundle_filepath))
+    reference = load_nifti_volume(tracts[names[0]])
+    header = nib.Nifti1Header()
+    header.set_data_shape(reference.shape[:3] + (len(names),))
+    header.set_data_dtype(np.uint8)
+    header.set_qform(reference.affine, code=1)
+    header.set_sform(reference.affine, code=1)
+    header.set_zooms(reference.header.get_zooms()[:3] + (1.,))
+    header.set_xyzt_units('mm')
+
+    # Written under temporary names then renamed, such that concurrent processes never open a partial bundle.
+    folder = os.path.dirname(os.path.abspath(bundle_filepath))
+    fd, tmp_bundle = tempfile.mkstemp(suffix='.nii', dir=folder)
+    os.close(fd)
+    fd, tmp_index = tempfile.mkstemp(suffix='.json', dir=folder)
+    os.close(fd)
+    try:
+        with open(tmp_bundle, 'wb') as outfile:
+            header.write_to(outfile)
+            outfile.write(b'\x00' * (int(header.get_data_offset()) - outfile.tell()))
+            for name in names:
+                nib_volume = load_nifti_volume(tracts[name])
+                if nib_volume.shape[:3] != reference.shape[:3]:
+                    raise ValueError("The tract {} has a shape of {} instead of {}.".format(
+                        name, nib_volume.shape[:3], reference.shape[:3]))
+                probabilities = np.clip(intensity_array(nib_volume), 0., 1.)
+                outfile.write(np.rint(probabilities * BUNDLE_SCALE).astype(np.uint8).tobytes(order='F'))
+        with open(tmp_index, 'w', newline='\n') as outfile:
+            json.dump({"version": STORE_VERSION, "scale": BUNDLE_SCALE, "names": names}, outfile, indent=4)
+        os.replace(tmp_bundle, bundle_filepath)
+        os.replace(tmp_index, index_filepath)
+    finally:
+        for fp in [tmp_bundle, tmp_index]:
+            if os.path.exists(fp):
+                os.remove(fp)
+    return bundle_filepath
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_atlas_store(config: ResourcesConfiguration = None) -> AtlasStore:
+    """
+    Atlas store located in the folder given by the configuration (the active one if None), shared by all runs using
+    that folder.
+    """
+    root = (config if config is not None else ResourcesConfiguration.getInstance()).atlas_store_folder
+    with _stores_lock:
+        if root not in _stores:
+            _stores[root] = AtlasStore(root=root)
+        return _stores[root]
+
+
+def load_atlas_mask(filepath: str, config: ResourcesConfiguration = None):
+    return get_atlas_store(config).load_mask(filepath)
+
+
+def load_atlas_intensities(filepath: str, config: ResourcesConfiguration = None):
+    return get_atlas_store(config).load_intensities(filepath)
+
+
+def load_tract_bundle(structures: dict, config: ResourcesConfiguration = None) -> TractBundle:
+    return get_atlas_store(config).load_tract_bundle(structures)
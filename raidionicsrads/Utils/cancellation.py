@@ -0,0 +1,213 @@
+import multiprocessing
+import os
+import platform
+import signal
+import subprocess
+import threading
+import time
+import traceback
+
+
+class CancellationToken:
+    """
+    Cooperative cancellation flag shared between the pipeline and the step being executed.
+    A token is cancelled either explicitly (e.g., the whole patient processing is aborted) or implicitly when its
+    deadline is exceeded. Long-running loops inside the steps are expected to call check() regularly, which raises
+    as soon as the token is cancelled. A token created with a parent is also cancelled when its parent is.
+    Blocking calls which cannot check the token by themselves are run in a child process (see run_process), and
+    external binaries in their own process group (see wait_process), such that they are actually stopped when the
+    token is cancelled, and never left running behind.
+    """
+    _event = None  # Set when the token is explicitly cancelled
+    _deadline = None  # Monotonic time after which the token is considered cancelled, or None without timeout
+    _timeout = None  # Allowed duration in seconds, as given at creation
+    _parent = None  # Token from the enclosing scope (e.g., patient-level token for a step-level token)
+    _reason = None  # Human-readable reason for the cancellation
+    _timed_out = False  # Whether the cancellation comes from the deadline of the token
+
+    def __init__(self, timeout: float = None, parent=None) -> None:
+        self.__reset()
+        self._parent = parent
+        self._timeout = timeout
+        if timeout is not None and timeout > 0:
+            self._deadline = time.monotonic() + timeout
+
+    def __reset(self):
+        """
+        All objects share class or static variables.
+        An instance or non-static variables are different for different objects (every object has a copy).
+        """
+        self._event = threading.Event()
+        self._deadline = None
+        self._timeout = None
+        self._parent = None
+        self._reason = None
+        self._timed_out = False
+
+    @property
+    def timeout(self) -> float:
+        return self._timeout
+
+    @property
+    def reason(self) -> str:
+        if self._reason is None and self._parent is not None:
+            return self._parent.reason
+        return self._reason
+
+    def cancel(self, reason: str = "Cancelled.") -> None:
+        if not self._event.is_set():
+            self._reason = reason
+            self._event.set()
+
+    def is_cancelled(self) -> bool:
+        if self._event.is_set():
+            return True
+        if self._deadline is not None and time.monotonic() >= self._deadline:
+            if not self._event.is_set():
+                self._timed_out = True
+            self.cancel(reason="Timed out after {} seconds.".format(self._timeout))
+            return True
+        return self._parent is not None and self._parent.is_cancelled()
+
+    def is_timed_out(self) -> bool:
+        """
+        Whether the token, or the parent it was cancelled through, ran out of time (as opposed to an explicit
+        cancellation).
+        """
+        if not self.is_cancelled():
+            return False
+        if self._event.is_set():
+            return self._timed_out
+        return self._parent is not None and self._parent.is_timed_out()
+
+    def has_deadline(self) -> bool:
+        return self._deadline is not None or (self._parent is not None and self._parent.has_deadline())
+
+    def remaining(self) -> float:
+        """
+        Time left before the closest deadline (from the token or its parents), in seconds, or None if unbounded.
+        """
+        remaining = None if self._deadline is None else max(0., self._deadline - time.monotonic())
+        parent_remaining = self._parent.remaining() if self._parent is not None else None
+        if remaining is None or parent_remaining is None:
+            return remaining if parent_remaining is None else parent_remaining
+        return min(remaining, parent_remaining)
+
+    def check(self) -> None:
+        """
+        Raises if the token has been cancelled, to call at safe interruption points.
+        """
+        if self.is_cancelled():
+            raise ValueError("Processing interrupted: {}".format(self.reason))
+
+    def run(self, function, *args, **kwargs):
+        """
+        Runs a call in the calling thread, if the token is not already cancelled. The call is expected to check the
+        token by itself at safe interruption points (see check), and to run its blocking parts through run_process or
+        wait_process, such that nothing keeps running once the token is cancelled.
+        """
+        self.check()
+        return function(*args, **kwargs)
+
+    def run_process(self, function, *args, **kwargs):
+        """
+        Runs a blocking call which cannot check the token by itself (e.g., a model inference or a python ANTs
+        registration) in a child process, terminated as soon as the token is cancelled. The method only returns once
+        the child process has exited. Without any deadline, the call is run in the calling thread instead, to spare
+        the start of a new interpreter.
+        The function must be defined at the module level, and its arguments and result must be picklable. The child
+        process starts from a fresh interpreter, and does not see the state of the caller (e.g., the run context).
+        """
+        self.check()
+        if not self.has_deadline():
+            return function(*args, **kwargs)
+        mp_context = multiprocessing.get_context('spawn')
+        receiver, sender = mp_context.Pipe(duplex=False)
+        process = mp_context.Process(target=_run_in_child_process, args=(sender, function, args, kwargs))
+        process.start()
+        sender.close()
+        try:
+            outcome = None
+            while outcome is None:
+                remaining = self.remaining()
+                if receiver.poll(0.5 if remaining is None else min(0.5, max(0.01, remaining))):
+                    try:
+                        outcome = receiver.recv()
+                    except EOFError:
+                        process.join()
+                        outcome = ("error", "Child process exited with code {}.".format(process.exitcode), "")
+                elif self.is_cancelled():
+                    raise ValueError("Processing interrupted: {}".format(self.reason))
+        finally:
+            _stop_child_process(process)
+            receiver.close()
+        if outcome[0] == "error":
+            raise RuntimeError("{}\nChild process traceback: {}".format(outcome[1], outcome[2]))
+        return outcome[1]
+
+    def wait_process(self, popen: subprocess.Popen):
+        """
+        Waits for an external process started with start_process_group (e.g., an ANTs binary), killing its whole
+        process group as soon as the token is cancelled. The method only returns once the process has exited.
+
+        Returns
+        -------
+        Tuple
+            The stdout and stderr outputs of the process, as given by communicate.
+        """
+        while True:
+            remaining = self.remaining()
+            try:
+                return popen.communicate(timeout=0.5 if remaining is None else min(0.5, max(0.01, remaining)))
+            except subprocess.TimeoutExpired:
+                if self.is_cancelled():
+                    kill_process_group(popen)
+                    popen.communicate()
+                    raise ValueError("Processing interrupted: {}".format(self.reason))
+
+
+def start_process_group(args, **kwargs) -> subprocess.Popen:
+    """
+    Starts an external process inside its own process group (a new session on POSIX systems), such that the process
+    and all the processes it spawns (e.g., the binaries called by an ANTs shell script) can be killed at once.
+    """
+    if platform.system() == 'Windows':
+        kwargs["creationflags"] = kwargs.get("creationflags", 0) | subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs["start_new_session"] = True
+    return subprocess.Popen(args, **kwargs)
+
+
+def kill_process_group(popen: subprocess.Popen) -> None:
+    """
+    Kills a process started with start_process_group, together with all its descendants.
+    """
+    if popen.poll() is not None:
+        return
+    try:
+        if platform.system() == 'Windows':
+            subprocess.call(['taskkill', '/F', '/T', '/PID', str(popen.pid)], stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+        else:
+            os.killpg(popen.pid, signal.SIGKILL)
+    except (OSError, subprocess.SubprocessError):
+        popen.kill()
+
+
+def _run_in_child_process(sender, function, args, kwargs) -> None:
+    try:
+        sender.send(("value", function(*args, **kwargs)))
+    except BaseException as e:
+        sender.send(("error", "{}: {}".format(type(e).__name__, e), traceback.format_exc()))
+    finally:
+        sender.close()
+
+
+def _stop_child_process(process) -> None:
+    # Terminating gracefully first, such that the child can release its resources (e.g., GPU memory).
+    if process.is_alive():
+        process.terminate()
+        process.join(timeout=5)
+    if process.is_alive():
+        process.kill()
+    process.join()
@@ -1,4 +1,5 @@
 import configparser
+import contextvars
 import logging
 import os
 import sys
@@ -7,23 +8,63 @@ import datetime
 import time
 from pathlib import PurePath
 
+# Configuration of the run context active in the current thread (see RunContext), returned by getInstance() in place
+# of the process-wide singleton.
+_active_configuration = contextvars.ContextVar("raidionicsrads_active_configuration", default=None)
+# Number of threads sharing the cores with the calling thread (e.g., the workers of an enclosing thread pool), by which
+# the size of the thread pools created from the calling thread is divided (see ResourcesConfiguration.get_threads).
+_thread_share = contextvars.ContextVar("raidionicsrads_thread_share", default=1)
+# Upper bound of the thread pools sized from the number of cores, beyond which the gains are marginal.
+_MAX_DEFAULT_THREADS = 8
+
+
+def share_threads(function, threads: int):
+    """
+    Wraps a function run by the workers of a thread pool of the given size, such that the thread pools created from
+    within it share the cores with the other workers (see ResourcesConfiguration.get_threads).
+    """
+    def wrapper(*args, **kwargs):
+        token = _thread_share.set(_thread_share.get() * max(1, threads))
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _thread_share.reset(token)
+    return wrapper
+
+
+def get_default_threads(concurrency: int = 1) -> int:
+    """
+    Default size of a thread pool when running concurrency of them at the same time (e.g., one for each pipeline
+    step running concurrently, or for each patient of a batch run): the cores split between them, at most
+    _MAX_DEFAULT_THREADS.
+    """
+    return max(1, min(_MAX_DEFAULT_THREADS, (os.cpu_count() or 1) // max(1, concurrency)))
+
 
 class ResourcesConfiguration:
     """
     Singleton class to have access from anywhere in the code at the various paths and configuration parameters.
+    The singleton is kept for compatibility, the configuration being carried by a RunContext for each run, which
+    allows processing multiple patients concurrently inside the same process. Independent instances are created with
+    ResourcesConfiguration(standalone=True).
     """
     __instance = None
 
     @staticmethod
     def getInstance():
-        """ Static access method. """
+        """ Static access method, returning the configuration of the active run context if any. """
+        active = _active_configuration.get()
+        if active is not None:
+            return active
         if ResourcesConfiguration.__instance == None:
             ResourcesConfiguration()
         return ResourcesConfiguration.__instance
 
-    def __init__(self):
-        """ Virtually private constructor. """
-        if ResourcesConfiguration.__instance != None:
+    def __init__(self, standalone: bool = False):
+        """ Virtually private constructor, unless a standalone configuration (not the singleton) is requested. """
+        if standalone:
+            self.__setup()
+        elif ResourcesConfiguration.__instance != None:
             raise Exception("This class is a singleton!")
         else:
             ResourcesConfiguration.__instance = self
@@ -60,6 +101,17 @@ class ResourcesConfiguration:
         self.output_folder = None
         self.model_folder = None
         self.pipeline_filename = None
+        self.pipeline_workers = 1
+        self.results_cache_folder = None
+        self.results_cache_max_size = 20.
+        self.memory_budget = None
+        self.volume_cache_size = None  # Memory for the decoded volumes shared across steps, in GB, derived if None
+        self.intermediate_format = 'nii'  # File format of the intermediate volumes, not part of the final outputs
+        self.compression_threads = 0  # Threads compressing each .nii.gz file written, derived from the cores if 0
+        self.ingestion_threads = 0  # Threads ingesting the patient files and decoding DICOM slices, derived from the cores if 0
+        self.patient_snapshot = False  # Reloading the patient state saved by the previous run, if still valid
+        self.atlas_store_folder = os.path.join(os.path.expanduser("~"), '.raidionicsrads', 'atlas_store')  # Decompressed atlases
+        self.step_timeouts = {}  # Maximum runtime in seconds for each task type (e.g., 'registration'), or 'default'
 
         # Parameters matching the main_config parameters from the raidionics_seg backend
         self.predictions_overlapping_ratio = 0.
@@ -91,6 +143,7 @@ class ResourcesConfiguration:
         self.__parse_default_parameters()
         self.__parse_system_parameters()
         self.__parse_runtime_parameters()
+        self.__parse_timeouts_parameters()
 
     def __set_neuro_resources(self):
         self.__set_neuro_atlases_parameters()
@@ -292,6 +345,11 @@ class ResourcesConfiguration:
             substruc_fn = os.path.join(substruc_folder, n)
             readable_name = '_'.join(n.split('.')[0].split('_')[:-1])
             self.subcortical_structures['MNI']['BCB']['Singular'][readable_name] = substruc_fn
+        # Packed 4D stack of all the singular tracts with its name index, built in the atlas store if not shipped
+        self.subcortical_structures['MNI']['BCB']['Bundle'] = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                                                                           'Atlases', 'bcb_tracts', 'bcb_subcortical_structures_bundle.nii')
+        self.subcortical_structures['MNI']['BCB']['BundleIndex'] = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                                                                                'Atlases', 'bcb_tracts', 'bcb_subcortical_structures_bundle.json')
 
         if os.name == 'nt':
             script_path_parts = list(PurePath(os.path.realpath(__file__)).parts[:-2] + ('Atlases', 'bcb_tracts',
@@ -342,6 +400,10 @@ class ResourcesConfiguration:
             substruc_fn = os.path.join(substruc_folder, n)
             readable_name = n.split('.')[0]
             self.subcortical_structures['MNI']['BrainGrid']['Singular'][readable_name] = substruc_fn
+        self.subcortical_structures['MNI']['BrainGrid']['Bundle'] = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                                                                                 'Atlases', 'BrainGrid', 'White_matter_atlas', 'braingrid_subcortical_structures_bundle.nii')
+        self.subcortical_structures['MNI']['BrainGrid']['BundleIndex'] = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                                                                                      'Atlases', 'BrainGrid', 'White_matter_atlas', 'braingrid_subcortical_structures_bundle.json')
 
         if os.name == 'nt':
             script_path_parts = list(PurePath(os.path.realpath(__file__)).parts[:-2] + ('Atlases', 'BrainGrid', 'White_matter_atlas',
@@ -469,6 +531,69 @@ class ResourcesConfiguration:
             if self.config['System']['pipeline_filename'].split('#')[0].strip() != '':
                 self.pipeline_filename = self.config['System']['pipeline_filename'].split('#')[0].strip()
 
+        if self.config.has_option('System', 'pipeline_workers'):
+            if self.config['System']['pipeline_workers'].split('#')[0].strip() != '':
+                self.pipeline_workers = max(1, int(self.config['System']['pipeline_workers'].split('#')[0].strip()))
+
+        if self.config.has_option('System', 'results_cache_folder'):
+            if self.config['System']['results_cache_folder'].split('#')[0].strip() != '':
+                self.results_cache_folder = self.config['System']['results_cache_folder'].split('#')[0].strip()
+
+        if self.config.has_option('System', 'results_cache_max_size'):
+            if self.config['System']['results_cache_max_size'].split('#')[0].strip() != '':
+                self.results_cache_max_size = float(self.config['System']['results_cache_max_size'].split('#')[0].strip())
+
+        if self.config.has_option('System', 'memory_budget'):
+            if self.config['System']['memory_budget'].split('#')[0].strip() != '':
+                self.memory_budget = float(self.config['System']['memory_budget'].split('#')[0].strip())
+
+        if self.config.has_option('System', 'volume_cache_size'):
+            if self.config['System']['volume_cache_size'].split('#')[0].strip() != '':
+                self.volume_cache_size = float(self.config['System']['volume_cache_size'].split('#')[0].strip())
+
+        if self.config.has_option('System', 'intermediate_format'):
+            if self.config['System']['intermediate_format'].split('#')[0].strip() != '':
+                intermediate_format = self.config['System']['intermediate_format'].split('#')[0].strip().lower()
+                if intermediate_format not in ['nii', 'nii.gz']:
+                    raise ValueError(f"The intermediate_format value must be one of [nii, nii.gz], got: {intermediate_format}.")
+                self.intermediate_format = intermediate_format
+
+        if self.config.has_option('System', 'compression_threads'):
+            if self.config['System']['compression_threads'].split('#')[0].strip() != '':
+                self.compression_threads = int(self.config['System']['compression_threads'].split('#')[0].strip())
+
+        if self.config.has_option('System', 'ingestion_threads'):
+            if self.config['System']['ingestion_threads'].split('#')[0].strip() != '':
+                self.ingestion_threads = int(self.config['System']['ingestion_threads'].split('#')[0].strip())
+
+        if self.config.has_option('System', 'patient_snapshot'):
+            if self.config['System']['patient_snapshot'].split('#')[0].strip() != '':
+                self.patient_snapshot = True if self.config['System']['patient_snapshot'].split('#')[0].strip().lower() == 'true' else False
+
+        if self.config.has_option('System', 'atlas_store_folder'):
+            if self.config['System']['atlas_store_folder'].split('#')[0].strip() != '':
+                self.atlas_store_folder = self.config['System']['atlas_store_folder'].split('#')[0].strip()
+
+    def __parse_timeouts_parameters(self):
+        """
+        Optional upper bound on the runtime of each pipeline step, per task type (e.g., segmentation, registration,
+        apply_registration), in seconds. The default entry applies to all task types not specified.
+        """
+        if not self.config.has_section('Timeouts'):
+            return
+        for task in self.config.options('Timeouts'):
+            value = self.config['Timeouts'][task].split('#')[0].strip()
+            if value != '':
+                self.step_timeouts[task.strip().lower()] = float(value)
+
+    def get_step_timeout(self, task: str):
+        """
+        Maximum runtime in seconds allowed for a step of the given task type, or None if not bounded.
+        """
+        key = task.strip().lower().replace(' ', '_') if task is not None else 'default'
+        timeout = self.step_timeouts[key] if key in self.step_timeouts.keys() else self.step_timeouts.get('default')
+        return timeout if timeout is not None and timeout > 0 else None
+
     def __parse_runtime_parameters(self):
         if self.config.has_option('Runtime', 'overlapping_ratio'):
             if self.config['Runtime']['overlapping_ratio'].split('#')[0].strip() != '':
@@ -550,3 +675,22 @@ class ResourcesConfiguration:
 
     def get_accepted_image_formats(self) -> list:
         return self.accepted_image_format
+
+    def get_threads(self, threads: int) -> int:
+        """
+        Size of a thread pool created by the calling thread: the configured number of threads if positive, or the
+        cores available to each pipeline step running concurrently (see get_default_threads). The size is divided by
+        the number of threads already sharing the cores with the caller (e.g., when called from the workers of another
+        pool), such that nested pools never add up to more than the outer pool size.
+        """
+        if threads is None or threads <= 0:
+            threads = get_default_threads(concurrency=self.pipeline_workers)
+        return max(1, threads // _thread_share.get())
+
+    def get_intermediate_extension(self) -> str:
+        """
+        File extension for the volumes only used within a run (e.g., masked inputs, warped annotations before being
+        copied to their final destination). Uncompressed NIfTI files avoid the gzip cost and are memory-mapped when
+        read back.
+        """
+        return '.' + self.intermediate_format
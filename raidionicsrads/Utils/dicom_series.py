@@ -0,0 +1,208 @@
+import logging
+import os
+import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import SimpleITK as sitk
+import numpy as np
+from .configuration_parser import ResourcesConfiguration
+from .io import allocate_nifti, write_image
+from .parallel_gzip import compress_file
+
+# DICOM tags read to identify a series, from the header of a single slice (no pixel data decoded)
+_SERIES_TAGS = {"SeriesInstanceUID": "0020|000e", "SeriesDescription": "0008|103e", "ProtocolName": "0018|1030",
+                "SeriesDate": "0008|0021", "SeriesTime": "0008|0031", "Modality": "0008|0060"}
+# Number of files inspected for the DICOM preamble before deciding a folder does not hold a series
+_PROBED_FILES = 5
+
+
+def is_dicom_file(filepath: str) -> bool:
+    """
+    Checks the DICOM preamble (DICM marker after the 128 first bytes), without parsing the file.
+    """
+    try:
+        with open(filepath, 'rb') as infile:
+            infile.seek(128)
+            return infile.read(4) == b'DICM'
+    except OSError:
+        return False
+
+
+def is_dicom_series_folder(folder: str) -> bool:
+    """
+    Checks whether a folder directly holds the slices of a DICOM series.
+    """
+    if not os.path.isdir(folder):
+        return False
+    files = [os.path.join(folder, f) for f in sorted(os.listdir(folder))]
+    files = [f for f in files if os.path.isfile(f)][:_PROBED_FILES]
+    return any([is_dicom_file(f) for f in files])
+
+
+def read_series_metadata(folder: str) -> dict:
+    """
+    Identifies the DICOM series stored in a folder, by only reading the slices headers. If multiple series are
+    mixed in the folder, the one with the most slices is kept.
+
+    Parameters
+    ----------
+    folder: str
+        Folder holding the slices of the series.
+    Returns
+    -------
+    dict
+        The identification tags (see _SERIES_TAGS) read from the first slice, empty if missing, and the slices
+        filepaths sorted along the acquisition direction under 'Files'.
+    """
+    series_ids = sitk.ImageSeriesReader.GetGDCMSeriesIDs(folder)
+    if not series_ids:
+        raise ValueError("No DICOM series found in {}.".format(folder))
+    files = [sitk.ImageSeriesReader.GetGDCMSeriesFileNames(folder, sid) for sid in series_ids]
+    if len(series_ids) > 1:
+        logging.warning("[DicomSeries] {} series found in {}, only the largest one is used.".format(len(series_ids),
+                                                                                                  folder))
+    files = max(files, key=len)
+
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(files[0])
+    reader.ReadImageInformation()
+    metadata = {}
+    for name, tag in _SERIES_TAGS.items():
+        metadata[name] = reader.GetMetaData(tag).strip() if reader.HasMetaDataKey(tag) else ''
+    metadata["Files"] = list(files)
+    return metadata
+
+
+def dicom_series_name(folder: str, metadata: dict = None) -> str:
+    """
+    File-friendly name of a DICOM series, used for the sequence identification (e.g., containing t1, gd, or flair).
+    The series description is used, or the protocol name, or the folder name as last resort.
+    """
+    metadata = metadata if metadata is not None else read_series_metadata(folder)
+    name = metadata["SeriesDescription"] or metadata["ProtocolName"] or os.path.basename(os.path.normpath(folder))
+    return re.sub(r'[^0-9a-zA-Z-]+', '_', name).strip('_')
+
+
+def convert_dicom_series(folder: str, output_filepath: str, threads: int = None) -> str:
+    """
+    Converts a DICOM series into a NIfTI volume. The slices are decoded concurrently by a pool of threads, and
+    written directly into a memory-mapped uncompressed file, such that the volume is never held in memory (and
+    never duplicated) during the conversion. The file is then compressed with multiple threads if needed.
+    The data type and positions of all slices are read from their headers beforehand: the volume is stored as float32
+    if the slices do not share an integer type (e.g., varying rescale), and the conversion fails if the slices are not
+    evenly spaced.
+
+    Parameters
+    ----------
+    folder: str
+        Folder holding the slices of the series.
+    output_filepath: str
+        Filepath of the NIfTI volume to write, compressed if ending with .nii.gz.
+    threads: int
+        Number of decoding threads, ResourcesConfiguration.ingestion_threads if None, derived from the cores if 0.
+    Returns
+    -------
+    str
+        The output filepath.
+    """
+    threads = ResourcesConfiguration.getInstance().get_threads(
+        threads if threads is not None else ResourcesConfiguration.getInstance().ingestion_threads)
+    files = read_series_metadata(folder)["Files"]
+    if len(files) == 1:
+        # Multi-frame (enhanced) DICOM, stored in a single file.
+        return write_image(sitk.WriteImage, sitk.ReadImage(files[0]), output_filepath)
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        headers = list(executor.map(_read_slice_information, files))
+    first_slice = sitk.ReadImage(files[0])
+    first_array = sitk.GetArrayViewFromImage(first_slice)[0]
+    dtype = _series_dtype([h[0] for h in headers])
+
+    # Geometry in the LPS convention of ITK, the slice axis being given by the first and last slice positions.
+    first_origin = np.asarray(first_slice.GetOrigin())
+    span = np.asarray(headers[-1][1]) - first_origin
+    slice_spacing = np.linalg.norm(span) / (len(files) - 1)
+    direction = np.asarray(first_slice.GetDirection()).reshape(3, 3)
+    if slice_spacing > 0:
+        direction[:, 2] = span / np.linalg.norm(span)
+        _check_slice_positions(positions=[h[1] for h in headers], axis=direction[:, 2], spacing=slice_spacing,
+                               folder=folder)
+    else:
+        slice_spacing = first_slice.GetSpacing()[2]
+    affine = np.eye(4)
+    affine[:3, :3] = direction * np.asarray(first_slice.GetSpacing()[:2] + (slice_spacing,))
+    affine[:3, 3] = first_origin
+    affine = np.diag([-1., -1., 1., 1.]) @ affine
+
+    shape = (first_array.shape[1], first_array.shape[0], len(files))
+    fd, tmp_filepath = tempfile.mkstemp(suffix='.nii', dir=os.path.dirname(os.path.abspath(output_filepath)))
+    os.close(fd)
+    try:
+        data = allocate_nifti(tmp_filepath, shape=shape, dtype=dtype, affine=affine)
+
+        def decode_slice(k: int) -> None:
+            # SimpleITK releases the GIL while decoding, the slices being decoded concurrently.
+            slice_array = first_array if k == 0 else sitk.GetArrayViewFromImage(sitk.ReadImage(files[k]))[0]
+            if slice_array.shape != first_array.shape:
+                raise ValueError("The slice {} has a shape of {} instead of {}.".format(files[k], slice_array.shape,
+                                                                                       first_array.shape))
+            if not np.can_cast(slice_array.dtype, dtype, casting='safe') and \
+                    not (slice_array.dtype.kind == 'f' and dtype.kind == 'f'):
+                raise ValueError("The slice {} has a data type of {}, not fitting in {}.".format(
+                    files[k], slice_array.dtype, dtype))
+            data[:, :, k] = slice_array.T
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(decode_slice, range(len(files))))
+        data.flush()
+        del data
+
+        if output_filepath.endswith('.nii.gz'):
+            compress_file(tmp_filepath, output_filepath,
+                          threads=ResourcesConfiguration.getInstance().get_threads(
+                              ResourcesConfiguration.getInstance().compression_threads))
+        else:
+            os.replace(tmp_filepath, output_filepath)
+    finally:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+    return output_filepath
+
+
+def _read_slice_information(filepath: str) -> tuple:
+    """
+    Pixel type identifier (after the rescale of the slice, if any) and origin of a slice, from its header only.
+    """
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(filepath)
+    reader.ReadImageInformation()
+    return reader.GetPixelID(), reader.GetOrigin()
+
+
+def _series_dtype(pixel_ids: list) -> np.dtype:
+    """
+    Data type holding the voxel values of all slices. SimpleITK returns floating-point values for the slices with a
+    non-integer rescale, which can differ from one slice to the next: float32 is used as soon as one slice is not
+    stored as integers, or if the slices integer types differ.
+    """
+    dtypes = set([sitk.GetArrayViewFromImage(sitk.Image([1, 1], pixel_id)).dtype for pixel_id in set(pixel_ids)])
+    if len(dtypes) == 1 and list(dtypes)[0].kind in ['i', 'u', 'b']:
+        return list(dtypes)[0]
+    if all([d.kind in ['i', 'u', 'b'] for d in dtypes]):
+        common = np.result_type(*dtypes)
+        if common.kind in ['i', 'u'] and common.itemsize <= 4:
+            return common
+    return np.dtype('float32')
+
+
+def _check_slice_positions(positions: list, axis: np.ndarray, spacing: float, folder: str) -> None:
+    """
+    Raises if the slices are not evenly spaced along the slice axis (e.g., missing slices or a varying thickness),
+    the volume geometry being derived from a single slice spacing.
+    """
+    offsets = np.asarray([np.dot(np.asarray(p) - np.asarray(positions[0]), axis) for p in positions])
+    gaps = np.diff(offsets)
+    tolerance = max(1e-3, 0.01 * spacing)
+    if np.any(np.abs(gaps - spacing) > tolerance):
+        raise ValueError("The slices of the DICOM series in {} are not evenly spaced (from {:.3f} to {:.3f} mm instead"
+                         " of {:.3f} mm), slices might be missing.".format(folder, np.min(gaps), np.max(gaps), spacing))
@@ -1,22 +1,287 @@
 import os
+import io
+import shutil
+import tempfile
 import nibabel as nib
 import pandas as pd
 import numpy as np
 from nibabel import four_to_three
 from .configuration_parser import ResourcesConfiguration
+from .volume_cache import load_cached_volume
+from .parallel_gzip import write_gzip, compress_file
+from .performance_metrics import count_io
 
 
 def load_nifti_volume(volume_path):
-    nib_volume = nib.load(volume_path)
+    nib_volume = load_cached_volume(volume_path)
     if len(nib_volume.shape) > 3:
         if len(nib_volume.shape) == 4: #Common problem
             nib_volume = four_to_three(nib_volume)[0]
         else: #DWI volumes
-            nib_volume = nib.Nifti1Image(nib_volume.get_fdata()[:, :, :, 0, 0], affine=nib_volume.affine)
+            nib_volume = nib.Nifti1Image(np.asanyarray(nib_volume.dataobj[:, :, :, 0, 0]), affine=nib_volume.affine)
 
     return nib_volume
 
 
+def mask_dtype(mask: np.ndarray) -> np.dtype:
+    """
+    Most compact integer data type holding the labels of a mask: uint8 for binary masks and label maps up to 255
+    classes, uint16 or int32 for larger atlases.
+    """
+    if mask.size == 0 or mask.dtype == np.uint8 or mask.dtype == np.bool_:
+        return np.dtype('uint8')
+    low, high = np.min(mask), np.max(mask)
+    if low >= 0 and high <= 255:
+        return np.dtype('uint8')
+    if low >= 0 and high <= 65535:
+        return np.dtype('uint16')
+    return np.dtype('int32')
+
+
+def mask_array(nib_volume) -> np.ndarray:
+    """
+    Voxel values of a mask (binary or label map) image, read from its dataobj in the compact integer data type given
+    by mask_dtype, instead of the float64 array returned by get_fdata(). Floating-point labels (e.g., from a linear
+    resampling or an older float64 file) are rounded to the nearest integer.
+    The returned array is always a writable copy, never shared with the volume cache.
+    """
+    data = np.asanyarray(nib_volume.dataobj)
+    if np.issubdtype(data.dtype, np.floating):
+        data = np.rint(data)
+    return np.array(data, dtype=mask_dtype(data))
+
+
+def intensity_array(nib_volume) -> np.ndarray:
+    """
+    Voxel values of an intensity image (e.g., MRI, CT, probability map), read from its dataobj as float32 instead of
+    the float64 array returned by get_fdata(). The returned array is always a writable copy.
+    """
+    return np.array(np.asanyarray(nib_volume.dataobj), dtype=np.float32)
+
+
+def load_mask(filepath: str):
+    """
+    Loads a mask (binary or label map) from disk, as the image and its voxel values in a compact integer data type.
+
+    Parameters
+    ----------
+    filepath: str
+        Filepath of the mask.
+    Returns
+    -------
+    nib.Nifti1Image, np.ndarray
+        The image (for its affine and header), and its voxel values (see mask_array).
+    """
+    nib_volume = load_nifti_volume(filepath)
+    return nib_volume, mask_array(nib_volume)
+
+
+def load_intensities(filepath: str):
+    """
+    Loads an intensity image (e.g., MRI, CT, probability map) from disk, as the image and its voxel values in float32.
+
+    Parameters
+    ----------
+    filepath: str
+        Filepath of the image.
+    Returns
+    -------
+    nib.Nifti1Image, np.ndarray
+        The image (for its affine and header), and its voxel values (see intensity_array).
+    """
+    nib_volume = load_nifti_volume(filepath)
+    return nib_volume, intensity_array(nib_volume)
+
+
+def save_mask(mask: np.ndarray, affine: np.ndarray, filepath: str, header=None) -> str:
+    """
+    Saves a mask (binary or label map), stored on disk in the compact integer data type given by mask_dtype.
+    The header, if provided, is copied with its data type and scaling updated accordingly.
+    """
+    data = np.rint(mask) if np.issubdtype(mask.dtype, np.floating) else mask
+    data = data.astype(mask_dtype(data), copy=False)
+    return save_nifti(nib.Nifti1Image(data, affine=affine, header=_header_for(data, header)), filepath)
+
+
+def save_intensities(data: np.ndarray, affine: np.ndarray, filepath: str, header=None) -> str:
+    """
+    Saves an intensity image, stored on disk in its own data type (e.g., int16 for a masked MRI computed in the
+    original data type), float64 values being stored as float32.
+    The header, if provided, is copied with its data type and scaling updated accordingly.
+    """
+    if data.dtype == np.float64:
+        data = data.astype(np.float32)
+    return save_nifti(nib.Nifti1Image(data, affine=affine, header=_header_for(data, header)), filepath)
+
+
+def _header_for(data: np.ndarray, header):
+    if header is None:
+        return None
+    header = header.copy()
+    header.set_data_dtype(data.dtype)
+    header.set_slope_inter(None, None)
+    return header
+
+
+def _compression_threads() -> int:
+    config = ResourcesConfiguration.getInstance()
+    return config.get_threads(config.compression_threads)
+
+
+def save_nifti(image, filepath: str) -> str:
+    """
+    Saves a NIfTI image, in place of nib.save(). The .nii.gz files are compressed with multiple threads, the image
+    being serialized in memory then compressed block-wise (see parallel_gzip.write_gzip).
+
+    Parameters
+    ----------
+    image: nib.Nifti1Image
+        Image to save.
+    filepath: str
+        Destination filepath, compressed if ending with .nii.gz.
+    Returns
+    -------
+    str
+        The destination filepath.
+    """
+    count_io('nifti_saves')
+    if not filepath.endswith('.nii.gz'):
+        nib.save(image, filepath)
+        return filepath
+
+    buffer = io.BytesIO()
+    image.to_file_map(image.make_file_map({'image': buffer, 'header': buffer}))
+    write_gzip(buffer.getbuffer(), filepath, threads=_compression_threads())
+    return filepath
+
+
+def write_image(write_function, image, filepath: str) -> str:
+    """
+    Saves an image with the writer of another library (e.g., ants.image_write or sitk.WriteImage). For .nii.gz files,
+    the library writes an uncompressed temporary file, compressed with multiple threads into the destination.
+
+    Parameters
+    ----------
+    write_function: callable
+        Library function called as write_function(image, filepath).
+    image: object
+        Image to save, in the format expected by write_function.
+    filepath: str
+        Destination filepath, compressed if ending with .nii.gz.
+    Returns
+    -------
+    str
+        The destination filepath.
+    """
+    count_io('nifti_saves')
+    if not filepath.endswith('.nii.gz'):
+        write_function(image, filepath)
+        return filepath
+
+    fd, tmp_filepath = tempfile.mkstemp(suffix='.nii', dir=os.path.dirname(os.path.abspath(filepath)))
+    os.close(fd)
+    try:
+        write_function(image, tmp_filepath)
+        compress_file(tmp_filepath, filepath, threads=_compression_threads())
+    finally:
+        os.remove(tmp_filepath)
+    return filepath
+
+
+def allocate_nifti(filepath: str, shape: tuple, dtype, affine: np.ndarray) -> np.memmap:
+    """
+    Creates an uncompressed NIfTI file of the given geometry, and returns a writable memory-mapped array over its
+    voxel values, such that a volume can be filled in piece by piece (e.g., slice by slice) without ever being held
+    in memory as a whole. The array is in Fortran order, as stored on disk, each [:, :, k] slice being contiguous.
+
+    Parameters
+    ----------
+    filepath: str
+        Filepath of the file to create, ending with .nii.
+    shape: tuple
+        Shape of the volume.
+    dtype: np.dtype
+        Data type of the voxel values.
+    affine: np.ndarray
+        Voxel to world (RAS) transform, also defining the voxel spacing.
+    Returns
+    -------
+    np.memmap
+        The voxel values, initialized to zero, to be flushed once filled in.
+    """
+    header = nib.Nifti1Header()
+    header.set_data_shape(shape)
+    header.set_data_dtype(dtype)
+    header.set_qform(affine, code=1)
+    header.set_sform(affine, code=1)
+    header.set_xyzt_units('mm')
+    with open(filepath, 'wb') as outfile:
+        header.write_to(outfile)
+        outfile.write(b'\x00' * (int(header.get_data_offset()) - outfile.tell()))
+    return np.memmap(filepath, dtype=header.get_data_dtype(), mode='r+', offset=int(header.get_data_offset()),
+                     shape=tuple(shape), order='F')
+
+
+def publish_volume(src: str, dst: str) -> str:
+    """
+    Copies a volume, possibly stored in the intermediate format, to its final destination in the output tree. The
+    deliverables keep their gzip-compressed format, the compression being applied here only if needed.
+
+    Parameters
+    ----------
+    src: str
+        Filepath of the volume, e.g., as produced inside a temporary working folder.
+    dst: str
+        Final filepath of the volume.
+    Returns
+    -------
+    str
+        The destination filepath.
+    """
+    if dst.endswith('.gz') and not src.endswith('.gz'):
+        compress_file(src, dst, threads=_compression_threads())
+    else:
+        shutil.copyfile(src, dst)
+    return dst
+
+
+def stage_file(src: str, dst: str) -> str:
+    """
+    Makes a file available under another filepath for a temporary consumer (e.g., the inputs folder of the
+    raidionicsseg backend), without copying its content whenever the filesystem allows it. A hard link is attempted
+    first, then a symbolic link (e.g., across filesystems), the content being copied only as a last resort. A source
+    in the uncompressed intermediate format staged under a .nii.gz name is compressed instead (see publish_volume).
+    The staged file shares its content with the source and must therefore be treated as read-only.
+
+    Parameters
+    ----------
+    src: str
+        Filepath of the file to stage.
+    dst: str
+        Filepath under which the file is staged, replaced if already existing.
+    Returns
+    -------
+    str
+        The destination filepath.
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if dst.endswith('.gz') and not src.endswith('.gz'):
+        return publish_volume(src, dst)
+    try:
+        os.link(src, dst)
+        return dst
+    except OSError:
+        pass
+    try:
+        os.symlink(os.path.abspath(src), dst)
+        return dst
+    except OSError:
+        pass
+    shutil.copyfile(src, dst)
+    return dst
+
+
 def dump_predictions(predictions, parameters, nib_volume, storage_prefix):
     print("Writing predictions to files...")
     naming_suffix = 'pred' if parameters.predictions_reconstruction_method == 'probabilities' else 'labels'
@@ -28,12 +293,12 @@ def dump_predictions(predictions, parameters, nib_volume, storage_prefix):
             #predictions_output_path = os.path.join(storage_prefix + '-' + naming_suffix + '_class' + str(c) + '.nii.gz')
             predictions_output_path = os.path.join(storage_prefix + '-' + naming_suffix + '_' + class_names[c] + '.nii.gz')
             os.makedirs(os.path.dirname(predictions_output_path), exist_ok=True)
-            nib.save(img, predictions_output_path)
+            save_nifti(img, predictions_output_path)
     else:
         img = nib.Nifti1Image(predictions, affine=nib_volume.affine)
         predictions_output_path = os.path.join(storage_prefix + '-' + naming_suffix + '_' + 'argmax' + '.nii.gz')
         os.makedirs(os.path.dirname(predictions_output_path), exist_ok=True)
-        nib.save(img, predictions_output_path)
+        save_nifti(img, predictions_output_path)
 
 
 def generate_cortical_structures_labels_for_slicer(atlas_name):
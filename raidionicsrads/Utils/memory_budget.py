@@ -0,0 +1,199 @@
+import logging
+import os
+import threading
+from typing import List
+
+# Declared memory profile for each task type, as (fixed overhead in bytes, bytes per input voxel). The per-voxel
+# cost covers the float64 copies from get_fdata(), the resampled/preprocessed intermediate volumes, and the
+# backend-specific buffers (e.g., deformation fields for SyN, prediction maps for the inference).
+_declared_profiles = {"Classification": (1.5e9, 40),
+                      "Segmentation": (2.5e9, 120),
+                      "Segmentation refinement": (0.3e9, 48),
+                      "Registration": (0.5e9, 160),
+                      "Apply registration": (0.3e9, 64),
+                      "Features computation": (1.0e9, 96),
+                      "Surgical reporting": (0.2e9, 32),
+                      "default": (1.0e9, 64)}
+# Profiles learned from the peak memory (process and children) measured during the previous steps run alone, as bytes
+# per input voxel, never below the declared profiles.
+_learned_profiles = {}
+_learned_lock = threading.Lock()
+# Number of voxels of the volumes already inspected, indexed by (filepath, modification time).
+_shapes_cache = {}
+
+
+def get_volume_voxels(filepath: str) -> int:
+    """
+    Number of voxels of an image on disk, read from the NIfTI header only (the data array is not loaded).
+
+    Parameters
+    ----------
+    filepath: str
+        Filepath of the image on disk.
+    Returns
+    -------
+    int
+        Number of voxels, or 0 if the header could not be read.
+    """
+    try:
+        key = (filepath, os.path.getmtime(filepath))
+        if key not in _shapes_cache:
+            import nibabel as nib
+            shape = nib.load(filepath).header.get_data_shape()
+            voxels = 1
+            for dim in shape:
+                voxels = voxels * max(1, int(dim))
+            _shapes_cache[key] = voxels
+        return _shapes_cache[key]
+    except Exception as e:
+        logging.debug("[MemoryBudget] Header of {} could not be read with: {}".format(filepath, e))
+        return 0
+
+
+def estimate_peak_memory(task: str, voxels: int) -> int:
+    """
+    Estimated peak memory, in bytes, of a step of the given task type working on inputs of the given size.
+    A profile learned from previous executions takes precedence over the declared profile, if larger. The profiles are
+    only learned from steps run alone (i.e., sequential pipelines, see record_peak_memory), and only refine the
+    estimates used to admit concurrent steps or patients within the same process.
+    """
+    overhead, per_voxel = _declared_profiles[task] if task in _declared_profiles.keys() \
+        else _declared_profiles["default"]
+    with _learned_lock:
+        if task in _learned_profiles.keys():
+            # A 10% margin is kept as the learned value comes from a limited number of observations.
+            per_voxel = _learned_profiles[task] * 1.1
+    return int(overhead + per_voxel * voxels)
+
+
+def record_peak_memory(task: str, voxels: int, peak_increase: int) -> None:
+    """
+    Updates the learned profile of a task type from the memory increase measured while running a step alone, which
+    must include the memory of its child processes (e.g., the ANTs binaries).
+    The largest ratio observed so far is kept, and never below the declared profile, to remain on the safe side.
+    """
+    if voxels <= 0 or peak_increase <= 0:
+        return
+    overhead, declared_per_voxel = _declared_profiles[task] if task in _declared_profiles.keys() \
+        else _declared_profiles["default"]
+    per_voxel = max(declared_per_voxel, max(0., peak_increase - overhead) / voxels)
+    with _learned_lock:
+        _learned_profiles[task] = max(per_voxel, _learned_profiles[task]) if task in _learned_profiles.keys() \
+            else per_voxel
+
+
+def default_volume_cache_size(memory_budget: float = None, processes: int = 1) -> float:
+    """
+    Size of the volume cache of each process, in GB, when not specified in the configuration: 2 GB, bounded to a
+    tenth of the memory budget (if any), and split between the processes running concurrently (e.g., batch workers).
+    """
+    size = 2.
+    if memory_budget is not None and memory_budget > 0:
+        size = min(size, 0.1 * memory_budget)
+    return size / max(1, processes)
+
+
+def estimate_patient_peak_memory(step_estimates: List[int], workers: int = 1) -> int:
+    """
+    Upper bound of the memory needed to process a patient, with at most workers steps running at the same time.
+    """
+    if len(step_estimates) == 0:
+        return 0
+    return int(sum(sorted(step_estimates, reverse=True)[:max(1, workers)]))
+
+
+class MemoryBudget:
+    """
+    Admission control over a shared memory budget (e.g., the node memory), for the steps running concurrently inside
+    a pipeline or the patients processed concurrently by a batch runner. A reservation is admitted as long as the
+    total of the current reservations remains within the budget. A reservation larger than the whole budget is only
+    admitted when nothing else is running, so that it can never be blocked forever.
+    """
+    _total = None  # Overall budget, in bytes, or None if unlimited
+    _used = 0  # Sum of the current reservations, in bytes
+    _active = 0  # Number of current reservations
+    _condition = None
+
+    def __init__(self, total: float = None) -> None:
+        self.__reset()
+        self._total = total if total is not None and total > 0 else None
+
+    def __reset(self):
+        """
+        All objects share class or static variables.
+        An instance or non-static variables are different for different objects (every object has a copy).
+        """
+        self._total = None
+        self._used = 0
+        self._active = 0
+        self._condition = threading.Condition()
+
+    @property
+    def total(self) -> float:
+        return self._total
+
+    @property
+    def used(self) -> int:
+        return self._used
+
+    def try_acquire(self, amount: int) -> bool:
+        """
+        Reserves the given amount of memory if it fits within the budget, without blocking.
+        """
+        with self._condition:
+            if self._total is not None and self._active > 0 and self._used + amount > self._total:
+                return False
+            if self._total is not None and amount > self._total:
+                logging.warning("[MemoryBudget] Estimated peak memory of {:.2f} GB above the budget of {:.2f} GB, "
+                                "running alone.".format(amount / 1e9, self._total / 1e9))
+            self._used = self._used + amount
+            self._active = self._active + 1
+            return True
+
+    def acquire(self, amount: int, timeout: float = None) -> bool:
+        """
+        Reserves the given amount of memory, waiting until enough of the budget is released by others.
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self.try_acquire(amount), timeout=timeout)
+
+    def release(self, amount: int) -> None:
+        with self._condition:
+            self._used = max(0, self._used - amount)
+            self._active = max(0, self._active - 1)
+            self._condition.notify_all()
+
+
+def estimate_pipeline_peak_memory(pipeline: dict, input_folder: str, workers: int = 1) -> int:
+    """
+    Coarse estimate of the memory needed to process a patient, before any processing (e.g., for the admission of the
+    patients in a batch runner). The input shapes are read from the headers of all images inside the patient folder,
+    each step being assumed to work on the largest of them.
+
+    Parameters
+    ----------
+    pipeline: dict
+        Pipeline to run, as loaded from the pipeline json file.
+    input_folder: str
+        Patient folder on disk.
+    workers: int
+        Maximum number of steps running concurrently for the patient.
+    Returns
+    -------
+    int
+        Estimated peak memory in bytes.
+    """
+    largest = 0
+    for root, _, files in os.walk(input_folder):
+        for f in files:
+            if f.endswith('.nii') or f.endswith('.nii.gz'):
+                largest = max(largest, get_volume_voxels(os.path.join(root, f)))
+    estimates = []
+    for s in pipeline.keys():
+        step_json = pipeline[s]
+        task = step_json["task"] if "task" in step_json.keys() else None
+        inputs = len(step_json["inputs"].keys()) if "inputs" in step_json.keys() else 0
+        if "moving" in step_json.keys() and "fixed" in step_json.keys():
+            inputs = 2
+        estimates.append(estimate_peak_memory(task, largest * max(1, inputs)))
+    return estimate_patient_peak_memory(estimates, workers)
@@ -0,0 +1,88 @@
+import os
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Size of the uncompressed blocks compressed independently, each becoming a gzip member of the output file
+DEFAULT_BLOCK_SIZE = 8 * 1024 * 1024
+# Same compression level as nibabel for its .nii.gz outputs
+DEFAULT_COMPRESSLEVEL = 1
+
+
+def _compress_member(block, compresslevel: int) -> bytes:
+    # wbits=31 produces a complete gzip member (header, deflate stream, CRC32 and size trailer), with a zero mtime
+    # such that identical volumes produce identical files. zlib releases the GIL while compressing the block.
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 31)
+    return compressor.compress(block) + compressor.flush()
+
+
+def _iter_blocks(source, block_size: int):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source).cast('B')
+        for offset in range(0, len(view), block_size):
+            yield view[offset:offset + block_size]
+        empty = len(view) == 0
+    else:
+        empty = True
+        while True:
+            block = source.read(block_size)
+            if not block:
+                break
+            empty = False
+            yield block
+    if empty:
+        # An empty content still needs one (empty) member to be a valid gzip file.
+        yield b''
+
+
+def write_gzip(source, dst: str, compresslevel: int = DEFAULT_COMPRESSLEVEL, threads: int = 0,
+               block_size: int = DEFAULT_BLOCK_SIZE) -> str:
+    """
+    Compresses the content of source into the gzip file dst, using multiple threads. The content is split into blocks
+    compressed concurrently, each block being written as a standard gzip member: the concatenation is a valid gzip
+    file (RFC 1952), decompressed transparently by gzip, zlib, nibabel, ITK, or ANTs.
+
+    Parameters
+    ----------
+    source: bytes-like or binary file object
+        Uncompressed content, either in memory (e.g., a serialized NIfTI image) or as a file opened for reading.
+    dst: str
+        Filepath of the gzip file to write.
+    compresslevel: int
+        Compression level, between 1 (fastest) and 9 (smallest).
+    threads: int
+        Number of compression threads, all the available cores being used if 0.
+    block_size: int
+        Size of the uncompressed blocks, in bytes.
+    Returns
+    -------
+    str
+        The destination filepath.
+    """
+    threads = threads if threads > 0 else (os.cpu_count() or 1)
+    blocks = _iter_blocks(source, block_size)
+    with open(dst, 'wb') as outfile:
+        if threads == 1:
+            for block in blocks:
+                outfile.write(_compress_member(block, compresslevel))
+            return dst
+
+        # Members are written in order while the following blocks are being compressed, the number of blocks in
+        # flight being bounded to keep the memory usage independent of the file size.
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            pending = deque()
+            for block in blocks:
+                pending.append(executor.submit(_compress_member, block, compresslevel))
+                if len(pending) >= 2 * threads:
+                    outfile.write(pending.popleft().result())
+            while pending:
+                outfile.write(pending.popleft().result())
+    return dst
+
+
+def compress_file(src: str, dst: str, compresslevel: int = DEFAULT_COMPRESSLEVEL, threads: int = 0) -> str:
+    """
+    Compresses the file src into the gzip file dst, using multiple threads (see write_gzip).
+    """
+    with open(src, 'rb') as infile:
+        return write_gzip(infile, dst, compresslevel=compresslevel, threads=threads)
@@ -0,0 +1,265 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+
+# Thread-local placeholder for the metrics record of the step currently running in each thread.
+_current = threading.local()
+
+
+class PerformanceMonitor:
+    """
+    Collects performance metrics for each pipeline step: wall time, CPU time (including waited child processes
+    such as the ANTs binaries), peak resident memory of the process and its children, bytes read and written, and
+    number of image loads and saves.
+    The CPU, memory, and I/O measurements are process-wide, therefore overlapping when steps run concurrently, while
+    the image loads and saves are attributed to the thread running the step. Only the loads and saves going through
+    the package's own I/O functions (io.save_nifti, io.write_image, volume_cache.load_cached_volume) are counted.
+    """
+    _records = {}  # Metrics for each measured step, indexed by pipeline phase and step key
+    _start_time = None  # Creation time of the monitor, for the per-patient totals
+    _lock = None
+
+    def __init__(self) -> None:
+        self.__reset()
+        self._start_time = time.time()
+
+    def __reset(self):
+        """
+        All objects share class or static variables.
+        An instance or non-static variables are different for different objects (every object has a copy).
+        """
+        self._records = {"setup": {}, "execute": {}}
+        self._start_time = None
+        self._lock = threading.Lock()
+
+    @property
+    def records(self) -> dict:
+        return self._records
+
+    @contextmanager
+    def measure(self, phase: str, key: str, step):
+        """
+        Context manager recording the metrics of a pipeline step over the enclosed block.
+
+        Parameters
+        ----------
+        phase: str
+            Pipeline phase, from [setup, execute].
+        key: str
+            Step key, as listed in the corresponding pipeline json.
+        step: AbstractPipelineStep
+            Step being measured.
+        """
+        record = {"task": step.get_task(), "description": step.step_description, "status": "completed",
+                  "wall_time": 0., "cpu_time": 0., "peak_rss": 0, "peak_rss_increase": 0, "bytes_read": None,
+                  "bytes_written": None,
+                  "nifti_loads": 0, "nifti_saves": 0}
+        with self._lock:
+            self._records[phase][key] = record
+        previous_record = getattr(_current, 'record', None)
+        _current.record = record
+        sampler = _MemorySampler()
+        start_rss = sampler.peak
+        sampler.start()
+        start_wall = time.time()
+        start_cpu = _read_cpu_time()
+        start_io = _read_io_counters()
+        try:
+            yield record
+        except Exception:
+            record["status"] = "failed"
+            raise
+        finally:
+            sampler.stop()
+            record["wall_time"] = time.time() - start_wall
+            record["cpu_time"] = _read_cpu_time() - start_cpu
+            record["peak_rss"] = sampler.peak
+            record["peak_rss_increase"] = max(0, sampler.peak - start_rss)
+            end_io = _read_io_counters()
+            if start_io is not None and end_io is not None:
+                record["bytes_read"] = end_io[0] - start_io[0]
+                record["bytes_written"] = end_io[1] - start_io[1]
+            _current.record = previous_record
+
+    def compute_totals(self) -> dict:
+        totals = {"wall_time": time.time() - self._start_time, "cpu_time": 0., "peak_rss": 0, "bytes_read": 0,
+                  "bytes_written": 0, "nifti_loads": 0, "nifti_saves": 0}
+        for phase in self._records.keys():
+            for record in self._records[phase].values():
+                totals["cpu_time"] = totals["cpu_time"] + record["cpu_time"]
+                totals["peak_rss"] = max(totals["peak_rss"], record["peak_rss"])
+                totals["bytes_read"] = totals["bytes_read"] + (record["bytes_read"] if record["bytes_read"] else 0)
+                totals["bytes_written"] = totals["bytes_written"] + (record["bytes_written"] if record["bytes_written"] else 0)
+                totals["nifti_loads"] = totals["nifti_loads"] + record["nifti_loads"]
+                totals["nifti_saves"] = totals["nifti_saves"] + record["nifti_saves"]
+        return totals
+
+    def dump(self, filename: str, patient_id: str = None) -> None:
+        """
+        Writes all collected metrics, and the per-patient totals, in a json file.
+        """
+        try:
+            with self._lock:
+                metrics = {"patient": patient_id, "setup": self._records["setup"],
+                           "execute": self._records["execute"], "totals": self.compute_totals()}
+                with open(filename, 'w', newline='\n') as outfile:
+                    json.dump(metrics, outfile, indent=4)
+        except Exception as e:
+            logging.warning("[PerformanceMonitor] Writing the metrics to {} failed with: {}".format(filename, e))
+            logging.debug("Traceback: {}.".format(traceback.format_exc()))
+
+
+def bind_current_record(function):
+    """
+    Wraps a function to be run in another thread, such that its image loads and saves are still attributed to the
+    step measured in the calling thread.
+    """
+    record = getattr(_current, 'record', None)
+
+    def wrapper(*args, **kwargs):
+        previous_record = getattr(_current, 'record', None)
+        _current.record = record
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _current.record = previous_record
+    return wrapper
+
+
+def count_io(counter: str) -> None:
+    """
+    Attributes an image load or save (counter from [nifti_loads, nifti_saves]) to the step measured in the calling
+    thread. Called from the package's I/O functions.
+    """
+    record = getattr(_current, 'record', None)
+    if record is not None:
+        record[counter] = record[counter] + 1
+
+
+class _MemorySampler(threading.Thread):
+    """
+    Background thread polling the resident memory of the process (and children), to capture the peak over a step.
+    """
+    def __init__(self, interval: float = 0.1) -> None:
+        super(_MemorySampler, self).__init__(daemon=True)
+        self.interval = interval
+        self.peak = _read_total_rss()
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            self.peak = max(self.peak, _read_total_rss())
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.join()
+        self.peak = max(self.peak, _read_total_rss())
+
+
+def _read_cpu_time() -> float:
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def _read_total_rss() -> int:
+    """
+    Current resident memory of the process and of all its descendants (e.g., the ANTs binaries or the inference
+    child processes), in bytes.
+    """
+    return _read_rss() + _read_children_rss()
+
+
+def _read_children_rss() -> int:
+    """
+    Current resident memory of all the descendants of the process, in bytes, or 0 if not available.
+    """
+    try:
+        page_size = os.sysconf('SC_PAGE_SIZE')
+        total = 0
+        pending = _list_children_pids(os.getpid())
+        while len(pending) > 0:
+            pid = pending.pop()
+            try:
+                with open('/proc/{}/statm'.format(pid), 'r') as infile:
+                    total = total + int(infile.read().split()[1]) * page_size
+                pending.extend(_list_children_pids(pid))
+            except (OSError, ValueError, IndexError):
+                # The child process exited in the meantime.
+                continue
+        return total
+    except Exception:
+        pass
+    try:
+        import psutil
+        total = 0
+        for child in psutil.Process().children(recursive=True):
+            try:
+                total = total + child.memory_info().rss
+            except psutil.Error:
+                continue
+        return total
+    except Exception:
+        return 0
+
+
+def _list_children_pids(pid: int) -> list:
+    """
+    Identifiers of the direct children of a process, from /proc (Linux only, raising otherwise).
+    """
+    children = []
+    for task in os.listdir('/proc/{}/task'.format(pid)):
+        try:
+            with open('/proc/{}/task/{}/children'.format(pid, task), 'r') as infile:
+                children.extend([int(x) for x in infile.read().split()])
+        except OSError:
+            continue
+    return children
+
+
+def _read_rss() -> int:
+    """
+    Current resident memory of the process, in bytes.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as infile:
+            return int(infile.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except Exception:
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except Exception:
+        pass
+    try:
+        import resource
+        # Lifetime peak only, in kilobytes on Linux and bytes on macOS.
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+    except Exception:
+        return 0
+
+
+def _read_io_counters():
+    """
+    Bytes read and written by the process so far, or None if not available on the current platform.
+    """
+    try:
+        counters = {}
+        with open('/proc/self/io', 'r') as infile:
+            for line in infile.readlines():
+                name, value = line.split(':')
+                counters[name.strip()] = int(value.strip())
+        return counters['rchar'], counters['wchar']
+    except Exception:
+        pass
+    try:
+        import psutil
+        io = psutil.Process().io_counters()
+        return io.read_bytes, io.write_bytes
+    except Exception:
+        return None
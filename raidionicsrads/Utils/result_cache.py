@@ -0,0 +1,240 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import traceback
+import uuid
+from typing import List
+from .configuration_parser import ResourcesConfiguration
+
+
+class ResultCache:
+    """
+    Persistent content-addressed cache, shared across runs, for the results of the most expensive pipeline steps
+    (i.e., segmentation and registration).
+    Each entry is identified by a hash computed over the step description, the content of the step input files, the
+    version of the model in use, and the relevant runtime parameters. An entry is a folder containing the cached files
+    and a manifest, stored under <cache_folder>/<key[:2]>/<key>. The total size of the cache is bounded, the least
+    recently used entries being evicted first (the entry folder modification time is refreshed on every hit).
+    """
+    _cache_folder = None  # Root folder on disk where all cache entries are stored
+    _max_size = None  # Maximum size of the cache on disk, in bytes
+    _lock = threading.Lock()  # Serializing the eviction process within a single process
+
+    def __init__(self, cache_folder: str, max_size: float) -> None:
+        self.__reset()
+        self._cache_folder = cache_folder
+        self._max_size = max_size
+
+    def __reset(self):
+        """
+        All objects share class or static variables.
+        An instance or non-static variables are different for different objects (every object has a copy).
+        """
+        self._cache_folder = None
+        self._max_size = None
+
+    @staticmethod
+    def from_configuration(config: ResourcesConfiguration = None):
+        """
+        Returns the cache specified in the given configuration (the active one if None), or None if caching is
+        disabled.
+        """
+        config = config if config is not None else ResourcesConfiguration.getInstance()
+        if config.results_cache_folder is None:
+            return None
+        return ResultCache(cache_folder=config.results_cache_folder, max_size=config.results_cache_max_size * 1e9)
+
+    @property
+    def cache_folder(self) -> str:
+        return self._cache_folder
+
+    @staticmethod
+    def compute_key(step_json: dict, input_filepaths: List[str], model_folder: str = None,
+                    runtime_parameters: dict = None) -> str:
+        """
+        Generates the unique identifier of a step result.
+
+        Parameters
+        ----------
+        step_json: dict
+            Step description, as stored in the pipeline json file.
+        input_filepaths: List[str]
+            Files on disk used as inputs by the step, in the order they are used. Only their content matters.
+        model_folder: str
+            Folder containing the model used by the step, if any.
+        runtime_parameters: dict
+            Any other parameter influencing the step results.
+        Returns
+        -------
+        str
+            Hexadecimal digest to use as cache key.
+        """
+        hasher = hashlib.sha256()
+        hasher.update(json.dumps(step_json, sort_keys=True, default=str).encode('utf-8'))
+        for fp in input_filepaths:
+            hasher.update(compute_file_digest(fp).encode('utf-8'))
+        if model_folder is not None:
+            hasher.update(compute_folder_version(model_folder).encode('utf-8'))
+        if runtime_parameters is not None:
+            hasher.update(json.dumps(runtime_parameters, sort_keys=True, default=str).encode('utf-8'))
+        return hasher.hexdigest()
+
+    def lookup(self, key: str) -> dict:
+        """
+        Checks for the existence of a cache entry.
+
+        Parameters
+        ----------
+        key: str
+            Cache key, as generated by compute_key.
+        Returns
+        -------
+        dict
+            Entry manifest, holding the list of cached files and the stored metadata, or None in case of cache miss.
+        """
+        entry_folder = self.__get_entry_folder(key)
+        manifest_fn = os.path.join(entry_folder, 'manifest.json')
+        if not os.path.exists(manifest_fn):
+            return None
+        try:
+            with open(manifest_fn, 'r') as infile:
+                manifest = json.load(infile)
+            for f in manifest["files"]:
+                if not os.path.exists(os.path.join(entry_folder, f)):
+                    return None
+            # Refreshing the access time used for the LRU eviction
+            os.utime(entry_folder, None)
+        except Exception as e:
+            logging.debug("[ResultCache] Reading cache entry {} failed with: {}".format(key, e))
+            return None
+        return manifest
+
+    def restore(self, key: str, destination_folder: str) -> dict:
+        """
+        Copies all files from a cache entry into the destination folder.
+
+        Returns
+        -------
+        dict
+            Entry manifest, with the restored filepaths under 'restored', or None in case of cache miss.
+        """
+        manifest = self.lookup(key)
+        if manifest is None:
+            return None
+        try:
+            os.makedirs(destination_folder, exist_ok=True)
+            manifest["restored"] = {}
+            for f in manifest["files"]:
+                dest_fn = os.path.join(destination_folder, f)
+                os.makedirs(os.path.dirname(dest_fn), exist_ok=True)
+                shutil.copyfile(os.path.join(self.__get_entry_folder(key), f), dest_fn)
+                manifest["restored"][f] = dest_fn
+        except Exception as e:
+            # The entry might have been evicted in the meantime by another process.
+            logging.warning("[ResultCache] Restoring cache entry {} failed with: {}".format(key, e))
+            return None
+        return manifest
+
+    def store(self, key: str, files: dict, metadata: dict = None) -> None:
+        """
+        Creates a new cache entry. Failures are only logged, a cache should never interrupt the processing.
+
+        Parameters
+        ----------
+        key: str
+            Cache key, as generated by compute_key.
+        files: dict
+            Files to cache, as pairs of stored filename (relative path inside the entry) and source filepath on disk.
+        metadata: dict
+            Any additional information needed to restore the results.
+        """
+        entry_folder = self.__get_entry_folder(key)
+        tmp_folder = os.path.join(self._cache_folder, 'tmp_' + uuid.uuid4().hex)
+        try:
+            os.makedirs(tmp_folder)
+            for f in files.keys():
+                os.makedirs(os.path.dirname(os.path.join(tmp_folder, f)), exist_ok=True)
+                shutil.copyfile(files[f], os.path.join(tmp_folder, f))
+            manifest = {"files": list(files.keys()), "metadata": metadata if metadata is not None else {},
+                        "creation": time.strftime('%Y-%m-%d %H:%M:%S')}
+            with open(os.path.join(tmp_folder, 'manifest.json'), 'w', newline='\n') as outfile:
+                json.dump(manifest, outfile, indent=4)
+            os.makedirs(os.path.dirname(entry_folder), exist_ok=True)
+            if os.path.exists(entry_folder):
+                shutil.rmtree(entry_folder)
+            os.replace(tmp_folder, entry_folder)
+        except Exception as e:
+            logging.warning("[ResultCache] Storing cache entry {} failed with: {}".format(key, e))
+            logging.debug("Traceback: {}.".format(traceback.format_exc()))
+            if os.path.exists(tmp_folder):
+                shutil.rmtree(tmp_folder, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        Removes the least recently used entries until the cache fits within its maximum size.
+        """
+        with ResultCache._lock:
+            try:
+                entries = []
+                total_size = 0
+                for prefix in os.listdir(self._cache_folder):
+                    prefix_folder = os.path.join(self._cache_folder, prefix)
+                    if not os.path.isdir(prefix_folder) or prefix.startswith('tmp_'):
+                        continue
+                    for e in os.listdir(prefix_folder):
+                        entry_folder = os.path.join(prefix_folder, e)
+                        size = 0
+                        for root, _, entry_files in os.walk(entry_folder):
+                            size = size + sum([os.path.getsize(os.path.join(root, f)) for f in entry_files])
+                        entries.append((os.path.getmtime(entry_folder), size, entry_folder))
+                        total_size = total_size + size
+                for _, size, entry_folder in sorted(entries):
+                    if total_size <= self._max_size:
+                        break
+                    logging.debug("[ResultCache] Evicting cache entry {}.".format(entry_folder))
+                    shutil.rmtree(entry_folder, ignore_errors=True)
+                    total_size = total_size - size
+            except Exception as e:
+                logging.warning("[ResultCache] Cache eviction failed with: {}".format(e))
+
+    def __get_entry_folder(self, key: str) -> str:
+        return os.path.join(self._cache_folder, key[:2], key)
+
+
+def compute_file_digest(filepath: str) -> str:
+    """
+    Content digest of a file. Gzipped files are hashed over their compressed bytes, without paying for the
+    decompression, the modification time held in the gzip header being left out, such that identical volumes saved at
+    different times look the same (the files written by write_gzip carry no modification time at all).
+    """
+    hasher = hashlib.sha256()
+    with open(filepath, 'rb') as infile:
+        chunk = infile.read(1024 * 1024)
+        if filepath.endswith('.gz') and chunk[:2] == b'\x1f\x8b':
+            chunk = chunk[:4] + bytes(4) + chunk[8:]
+        while chunk:
+            hasher.update(chunk)
+            chunk = infile.read(1024 * 1024)
+    return hasher.hexdigest()
+
+
+def compute_folder_version(folder: str) -> str:
+    """
+    Lightweight version identifier of a folder content (e.g., a model), based on the relative path, size, and
+    modification time of all its files, to avoid hashing hundreds of megabytes of weights on every run.
+    """
+    hasher = hashlib.sha256()
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for f in sorted(files):
+            fp = os.path.join(root, f)
+            stats = os.stat(fp)
+            hasher.update("{}:{}:{}".format(os.path.relpath(fp, folder), stats.st_size,
+                                            stats.st_mtime_ns).encode('utf-8'))
+    return hasher.hexdigest()
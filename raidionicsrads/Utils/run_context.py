@@ -0,0 +1,88 @@
+from contextlib import contextmanager
+from functools import wraps
+from .configuration_parser import ResourcesConfiguration, _active_configuration
+
+
+class RunContext:
+    """
+    State of a single run (i.e., the processing of one patient), explicitly handed to the pipeline, its steps, the
+    patient structure and the processing functions, in place of the process-wide ResourcesConfiguration singleton.
+    Each context carries its own configuration, such that multiple patients can be processed concurrently inside the
+    same process (e.g., from different threads of a service).
+    While a context is active in a thread (see activate), ResourcesConfiguration.getInstance() returns its
+    configuration, for the code still relying on the singleton.
+    The context belongs to the run and is never part of the pickled state of the objects holding it (e.g., a
+    checkpointed patient state), the run reloading them attaching its own context explicitly.
+    """
+    _config = None  # ResourcesConfiguration specific to the run
+
+    def __init__(self, config: ResourcesConfiguration = None) -> None:
+        self.__reset()
+        self._config = config if config is not None else ResourcesConfiguration(standalone=True)
+
+    def __reset(self):
+        """
+        All objects share class or static variables.
+        An instance or non-static variables are different for different objects (every object has a copy).
+        """
+        self._config = None
+
+    @staticmethod
+    def from_config_file(config_filename: str):
+        """
+        Creates a new run context from a main configuration file (*.ini), independent from any other run.
+        """
+        config = ResourcesConfiguration(standalone=True)
+        config.set_environment(config_path=config_filename)
+        return RunContext(config=config)
+
+    @staticmethod
+    def current():
+        """
+        Run context active in the current thread, or a context wrapping the process-wide singleton if none is active.
+        """
+        return RunContext(config=ResourcesConfiguration.getInstance())
+
+    @staticmethod
+    def resolve(context=None):
+        """
+        The given run context, or the current one if None, for the functions taking an optional context.
+        """
+        return context if context is not None else RunContext.current()
+
+    @property
+    def config(self) -> ResourcesConfiguration:
+        return self._config
+
+    @contextmanager
+    def activate(self):
+        """
+        Makes the context active in the current thread, for the code relying on ResourcesConfiguration.getInstance().
+        Activations can be nested, the previous context being restored on exit.
+        """
+        token = _active_configuration.set(self._config)
+        try:
+            yield self
+        finally:
+            _active_configuration.reset(token)
+
+    def bind(self, function):
+        """
+        Wraps a function such that the context is active while it runs, e.g. inside a worker thread.
+        """
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with self.activate():
+                return function(*args, **kwargs)
+        return wrapper
+
+
+def with_run_context(method):
+    """
+    Decorator for the methods of objects holding a run context (as self.context), activating it during the call.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.context.activate():
+            return method(self, *args, **kwargs)
+    return wrapper
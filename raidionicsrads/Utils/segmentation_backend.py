@@ -0,0 +1,47 @@
+import os
+from typing import List
+from .io import stage_file
+
+
+def run_segmentation_model(config_filename: str, input_filepaths: List[str], working_folder: str,
+                           cancellation_token=None) -> dict:
+    """
+    Runs a raidionicsseg segmentation model over the given inputs, through its public file-based entry point (i.e.,
+    run_model). The inputs are staged inside working_folder/inputs through links rather than copies whenever possible
+    (see stage_file), and the predictions are left inside working_folder/outputs. When the runtime of the step is
+    bounded, the inference runs in a child process which can be stopped on cancellation (see
+    CancellationToken.run_process).
+    raidionicsseg exposes no public entry point exchanging the images in memory, its internals are not relied upon.
+
+    Parameters
+    ----------
+    config_filename: str
+        Filepath of the raidionicsseg configuration file (*.ini) holding the runtime parameters.
+    input_filepaths: List[str]
+        Filepaths of the model inputs, in the order expected by the model.
+    working_folder: str
+        Temporary folder, with inputs and outputs sub-folders, used by the backend.
+    cancellation_token: CancellationToken
+        Token of the calling step, if any.
+    Returns
+    -------
+    dict
+        Filepaths of the predictions inside working_folder/outputs, indexed by their filename (e.g.,
+        labels_Tumor.nii.gz).
+    """
+    inputs_folder = os.path.join(working_folder, 'inputs')
+    outputs_folder = os.path.join(working_folder, 'outputs')
+    os.makedirs(inputs_folder, exist_ok=True)
+    os.makedirs(outputs_folder, exist_ok=True)
+    for i, fp in enumerate(input_filepaths):
+        stage_file(fp, os.path.join(inputs_folder, 'input' + str(i) + '.nii.gz'))
+    from raidionicsseg.fit import run_model
+    if cancellation_token is not None:
+        cancellation_token.run_process(run_model, config_filename)
+    else:
+        run_model(config_filename)
+    predictions = {}
+    for f in sorted(os.listdir(outputs_folder)):
+        if 'nii.gz' in f and os.path.isfile(os.path.join(outputs_folder, f)):
+            predictions[f] = os.path.join(outputs_folder, f)
+    return predictions
@@ -4,7 +4,10 @@ from aenum import Enum, unique
 from typing import Union
 import os
 import SimpleITK as sitk
+import nibabel as nib
 import numpy as np
+from .io import write_image
+from .dicom_series import convert_dicom_series, dicom_series_name
 
 
 def get_type_from_string(enum_type: Enum, string: str) -> Union[str, int]:
@@ -34,50 +37,81 @@ def get_type_from_enum_name(enum_type: Enum, string: str) -> Union[str, int]:
         return -1
 
 
-def input_file_category_disambiguation(input_filename: str) -> str:
+def input_file_category_disambiguation(input_filename: str, sample_size: int = 1000000) -> str:
     """
     Identifying whether the volume stored on disk under input_filename contains a radiological volume or is an
     integer-like volume with labels.
     The category belongs to [Volume, Annotation].
+    Only the image header is read beforehand, to draw a strided sample of the voxels (for NIfTI files, without decoding
+    the whole image into memory). The category is always decided from the voxel values, whatever the pixel type (e.g.,
+    label maps are often stored as floats). A sample out of the labels range, or with too many distinct values, is
+    enough to identify a radiological volume. All voxels are only considered when the sample looks like an annotation,
+    since the values missed by the sample could still invalidate it.
 
     Parameters
     ----------
     input_filename: str
         Disk location of the volume to disambiguate.
+    sample_size: int
+        Approximate number of voxels considered for the first decision.
 
     Returns
     ----------
     str
         Human-readable category identified for the input.
     """
-    category = None
     reader = sitk.ImageFileReader()
     reader.SetFileName(input_filename)
-    image = reader.Execute()
-    image_type = image.GetPixelIDTypeAsString()
-    array = sitk.GetArrayFromImage(image)
+    reader.ReadImageInformation()
+    size = list(reader.GetSize()) + ([reader.GetNumberOfComponents()] if reader.GetNumberOfComponents() > 1 else [])
+    stride = max(1, int(np.ceil((np.prod(size, dtype=np.float64) / sample_size) ** (1. / len(size)))))
 
-    if len(np.unique(array)) > 255 or np.max(array) > 255 or np.min(array) < -1:
-        category = "Volume"
+    if input_filename.endswith('.nii') or input_filename.endswith('.nii.gz'):
+        # Slicing the data proxy only decodes the sampled voxels, in their on-disk type (no float64 conversion).
+        proxy = nib.load(input_filename).dataobj
+        sample = proxy[tuple([slice(None, None, stride)] * len(proxy.shape))]
+        category = _voxel_values_category(sample)
+        if category == "Volume" or stride == 1:
+            return category
+        return _voxel_values_category(np.asanyarray(proxy))
+
+    # Other formats are decoded at once by SimpleITK, the array views are used to avoid any copy.
+    array = sitk.GetArrayViewFromImage(reader.Execute())
+    category = _voxel_values_category(array[tuple([slice(None, None, stride)] * array.ndim)])
+    if category == "Volume" or stride == 1:
+        return category
+    return _voxel_values_category(array)
+
+
+def _voxel_values_category(values: np.ndarray) -> str:
+    """
+    Category from [Volume, Annotation] matching a set of voxel values.
+    """
+    if values.size == 0:
+        return "Annotation"
+    if np.max(values) > 255 or np.min(values) < -1:
+        return "Volume"
     # If the input radiological volume has values within [0, 255] only. Empirical solution for now, since less than
     # 10 classes are usually handle at any given time.
-    elif len(np.unique(array)) >= 25:
-        category = "Volume"
-    else:
-        category = "Annotation"
-    return category
+    if len(np.unique(values)) >= 25:
+        return "Volume"
+    return "Annotation"
 
 
 def input_file_type_conversion(input_filename: str, output_folder: str) -> str:
     # Always converting the input file to compressed nifti (based on SimpleITK), otherwise will be discarded.
     # @TODO. Do we catch a potential .seg file that would be coming from 3D Slicer for annotations?
+    if os.path.isdir(input_filename):  # DICOM series folder
+        nifti_outfilename = os.path.join(output_folder, dicom_series_name(input_filename) + '.nii.gz')
+        return convert_dicom_series(input_filename, nifti_outfilename)
+
     pre_file_extension = os.path.basename(input_filename).split('.')[0]
     file_extension = '.'.join(os.path.basename(input_filename).split('.')[1:])
     filename = input_filename
     if file_extension != 'nii.gz':
         input_sitk = sitk.ReadImage(input_filename)
         nifti_outfilename = os.path.join(output_folder, pre_file_extension + '.nii.gz')
-        sitk.WriteImage(input_sitk, nifti_outfilename)
+        write_image(sitk.WriteImage, input_sitk, nifti_outfilename)
         filename = nifti_outfilename
 
     return filename
@@ -0,0 +1,171 @@
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+import nibabel as nib
+import numpy as np
+from .performance_metrics import count_io
+
+
+class VolumeCache:
+    """
+    In-memory cache of the decoded NIfTI volumes, shared by all steps (and runs) inside the process, to avoid decoding
+    the same compressed files over and over (e.g., brain masks or atlas masks used by multiple steps).
+    Entries are identified by the file path, modification time and size, such that a file rewritten on disk is never
+    served from a stale entry. The least recently used entries are evicted once the byte budget is exceeded.
+    The decoded arrays are kept in their on-disk data type inside unnamed temporary files (in shared memory when
+    available), and each caller receives its own image object over a copy-on-write mapping of them: the pages are
+    shared between callers until written, such that in-place edits of an image never affect the cache or other callers.
+    """
+    _max_bytes = 0  # Byte budget for the decoded arrays, the cache being disabled when 0
+    _entries = OrderedDict()  # Cached images indexed by (path, mtime, size), from least to most recently used
+    _size = 0  # Total number of bytes of the cached arrays
+    _hits = 0
+    _misses = 0
+    _lock = None
+
+    def __init__(self, max_bytes: float = 0) -> None:
+        self.__reset()
+        self._max_bytes = max(0, int(max_bytes))
+
+    def __reset(self):
+        """
+        All objects share class or static variables.
+        An instance or non-static variables are different for different objects (every object has a copy).
+        """
+        self._max_bytes = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def max_bytes(self) -> int:
+        return self._max_bytes
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def hits(self) -> int:
+        return self._hits
+
+    @property
+    def misses(self) -> int:
+        return self._misses
+
+    def resize(self, max_bytes: float) -> None:
+        with self._lock:
+            self._max_bytes = max(0, int(max_bytes))
+            self.__evict()
+
+    def clear(self) -> None:
+        with self._lock:
+            for entry in self._entries.values():
+                entry[1].close()
+            self._entries.clear()
+            self._size = 0
+
+    def load(self, filepath: str):
+        """
+        Loads the NIfTI image stored under filepath, decoding it only if no valid entry exists in the cache.
+
+        Parameters
+        ----------
+        filepath: str
+            Filepath of the image on disk.
+        Returns
+        -------
+        nib.Nifti1Image
+            Image with its data array in memory, private to the caller (copy-on-write for the cached volumes).
+        """
+        stats = os.stat(filepath)
+        key = (os.path.realpath(filepath), stats.st_mtime_ns, stats.st_size)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._hits = self._hits + 1
+                # Mapped under the lock, such that the entry cannot be evicted meanwhile.
+                return _new_image(*entry)
+
+        image = nib.load(filepath)
+        array = np.asanyarray(image.dataobj)
+        if isinstance(array, np.memmap) or self._max_bytes == 0 or array.nbytes > self._max_bytes or array.nbytes == 0:
+            # Memory-mapped (i.e., uncompressed) files are cheap to reload and should not consume the budget.
+            return image
+        header = image.header.copy()
+        header.set_data_dtype(array.dtype)
+        header.set_slope_inter(None, None)
+        try:
+            buffer = _store_array(array)
+        except Exception as e:
+            logging.debug("[VolumeCache] Caching {} failed with: {}".format(filepath, e))
+            return image.__class__(array, affine=image.affine, header=header.copy())
+        with self._lock:
+            self._misses = self._misses + 1
+            if key not in self._entries:
+                self._entries[key] = (image.__class__, buffer, array.dtype, array.shape, array.nbytes, image.affine,
+                                      header)
+                self._size = self._size + array.nbytes
+                self.__evict()
+            else:
+                buffer.close()
+        # The decoded array is handed over to the caller, the cache holding its own copy.
+        return image.__class__(array, affine=image.affine, header=header.copy())
+
+    def __evict(self) -> None:
+        while self._size > self._max_bytes and len(self._entries) > 0:
+            _, entry = self._entries.popitem(last=False)
+            # The mappings already handed out remain valid after the file is closed.
+            entry[1].close()
+            self._size = self._size - entry[4]
+            logging.debug("[VolumeCache] Evicted {:.1f} MB, {:.1f} MB in use.".format(entry[4] / 1e6,
+                                                                                    self._size / 1e6))
+
+
+def _store_array(array: np.ndarray):
+    """
+    Writes the array bytes, in Fortran order as nibabel arrays, inside an unnamed temporary file removed once closed.
+    The file is created in shared memory if it has enough room left, in the default temporary folder otherwise.
+    """
+    folder = None
+    try:
+        stats = os.statvfs('/dev/shm')
+        if os.access('/dev/shm', os.W_OK) and stats.f_bavail * stats.f_frsize > 2 * array.nbytes:
+            folder = '/dev/shm'
+    except (AttributeError, OSError):
+        pass
+    buffer = tempfile.TemporaryFile(dir=folder)
+    try:
+        np.asfortranarray(array).T.tofile(buffer)
+        buffer.flush()
+    except Exception:
+        buffer.close()
+        raise
+    return buffer
+
+
+def _new_image(image_class, buffer, dtype: np.dtype, shape: tuple, nbytes: int, affine: np.ndarray, header):
+    # Copy-on-write mapping, the writes of the caller only allocating private copies of the modified pages.
+    data = np.memmap(buffer, dtype=dtype, mode='c', shape=shape, order='F')
+    return image_class(data, affine=affine, header=header.copy())
+
+
+# Cache shared by all the steps (and runs) of the process, sized from the main configuration when a run starts.
+_volume_cache = VolumeCache(max_bytes=2e9)
+
+
+def get_volume_cache() -> VolumeCache:
+    return _volume_cache
+
+
+def load_cached_volume(filepath: str):
+    """
+    Loads a NIfTI image through the process-wide volume cache, in place of nib.load().
+    """
+    count_io('nifti_loads')
+    return _volume_cache.load(filepath)
@@ -6,6 +6,7 @@ from scipy.ndimage import binary_fill_holes, measurements
 from skimage.measure import regionprops
 from skimage.morphology import binary_dilation, ball
 from .configuration_parser import *
+from .io import load_mask, save_mask
 
 
 def crop_MR(volume, parameters):
@@ -104,8 +105,7 @@ def prediction_binary_dilation(prediction_filepath: str, arg: int) -> None:
     :param arg: Volume increase percentage to reach for stopping the dilation process.
     :return: Nothing, the dilated volume is saved in place.
     """
-    pred_ni = nib.load(prediction_filepath)
-    pred = pred_ni.get_fdata()[:].astype('uint8')
+    pred_ni, pred = load_mask(prediction_filepath)
     pred_volume_initial = np.count_nonzero(pred) * np.prod(pred_ni.header.get_zooms()[0:3]) * 1e-3
     res = np.zeros(pred.shape, dtype=pred.dtype)
 
@@ -116,7 +116,7 @@ def prediction_binary_dilation(prediction_filepath: str, arg: int) -> None:
     # Identifying the different focus, for potential volume-based dilation
     detection_labels = measurements.label(pred)[0]
     for c in range(1, np.max(detection_labels) + 1):
-        focus_img = np.zeros(detection_labels.shape)
+        focus_img = np.zeros(detection_labels.shape, dtype='uint8')
         focus_img[detection_labels == c] = 1
         initial_focus_volume_ml = np.count_nonzero(focus_img) * pred_volume_initial
         kernel = ball(radius=1)
@@ -131,5 +131,4 @@ def prediction_binary_dilation(prediction_filepath: str, arg: int) -> None:
         seg_dil = focus_img.astype('uint8')
         res[seg_dil == 1] = 1
 
-    res_ni = nib.Nifti1Image(res.astype('uint8'), affine=pred_ni.affine, header=pred_ni.header)
-    nib.save(res_ni, prediction_filepath)
+    save_mask(res, pred_ni.affine, prediction_filepath, header=pred_ni.header)
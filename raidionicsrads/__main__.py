@@ -3,7 +3,7 @@ import os
 import sys
 import traceback
 import logging
-from raidionicsrads.compute import run_rads
+from raidionicsrads.compute import run_rads, run_rads_batch
 
 
 def path(string):
@@ -14,30 +14,67 @@ def path(string):
 
 
 def main():
+    argsin = sys.argv[1:]
+    if len(argsin) > 0 and argsin[0] == 'batch':
+        return main_batch(argsin[1:])
+
     parser = argparse.ArgumentParser()
     parser.add_argument('config', metavar='config', type=path, help='Path to the configuration file (*.ini)')
     parser.add_argument('--verbose', help="To specify the level of verbose, Default: warning", type=str,
                         choices=['debug', 'info', 'warning', 'error'], default='warning')
+    parser.add_argument('--resume', help="Resume an interrupted run from the last checkpoint in the output folder",
+                        action='store_true')
 
-    argsin = sys.argv[1:]
     args = parser.parse_args(argsin)
     config_filename = args.config
+    set_logging_level(args.verbose)
 
+    try:
+        run_rads(config_filename=config_filename, resume=args.resume)
+    except Exception as e:
+        logging.error('{}'.format(traceback.format_exc()))
+
+
+def main_batch(argsin):
+    """
+    Processing of a whole cohort, as: raidionicsrads batch config.ini --cohort <folder> --output <folder> --workers N
+    """
+    parser = argparse.ArgumentParser(prog='raidionicsrads batch')
+    parser.add_argument('config', metavar='config', type=path,
+                        help='Path to the configuration file (*.ini), used as template for all patients')
+    parser.add_argument('--cohort', metavar='cohort', type=path, default=None,
+                        help='Folder containing one sub-folder per patient (input_folder from the configuration by '
+                             'default)')
+    parser.add_argument('--output', metavar='output', default=None,
+                        help='Destination folder, with one sub-folder per patient (output_folder from the '
+                             'configuration by default)')
+    parser.add_argument('--workers', help="Number of patients processed concurrently, Default: 1", type=int,
+                        default=1)
+    parser.add_argument('--verbose', help="To specify the level of verbose, Default: warning", type=str,
+                        choices=['debug', 'info', 'warning', 'error'], default='warning')
+    parser.add_argument('--resume', help="Resume each patient from the last checkpoint in its output folder",
+                        action='store_true')
+    args = parser.parse_args(argsin)
+    set_logging_level(args.verbose)
+
+    try:
+        run_rads_batch(config_filename=args.config, cohort_folder=args.cohort, output_folder=args.output,
+                       workers=args.workers, resume=args.resume, logging_level=logging.getLogger().level)
+    except Exception as e:
+        logging.error('{}'.format(traceback.format_exc()))
+
+
+def set_logging_level(verbose: str) -> None:
     logging.basicConfig()
     logging.getLogger().setLevel(logging.WARNING)
 
-    if args.verbose == 'debug':
+    if verbose == 'debug':
         logging.getLogger().setLevel(logging.DEBUG)
-    elif args.verbose == 'info':
+    elif verbose == 'info':
         logging.getLogger().setLevel(logging.INFO)
-    elif args.verbose == 'error':
+    elif verbose == 'error':
         logging.getLogger().setLevel(logging.ERROR)
 
-    try:
-        run_rads(config_filename=config_filename)
-    except Exception as e:
-        logging.error('{}'.format(traceback.format_exc()))
-
 
 if __name__ == "__main__":
     logging.info("Internal main call.\n")
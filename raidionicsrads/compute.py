@@ -1,4 +1,7 @@
 from .Utils.configuration_parser import ResourcesConfiguration
+from .Utils.run_context import RunContext
+from .Utils.volume_cache import get_volume_cache
+from .Utils.memory_budget import default_volume_cache_size
 import time
 import traceback
 import logging
@@ -7,11 +10,39 @@ from .Pipelines.PipelineStructure import Pipeline
 from .Pipelines.ClassificationStep import ClassificationStep
 
 
-def run_rads(config_filename: str, logging_filename: str = None) -> None:
+def run_rads(config_filename: str, logging_filename: str = None, resume: bool = False,
+             context: RunContext = None) -> bool:
     """
+    Runs the pipeline specified in the configuration file.
 
+    Parameters
+    ----------
+    config_filename: str
+        Filepath to the main configuration file (*.ini).
+    logging_filename: str
+        Optional filepath to a log file where the logging output will be written.
+    resume: bool
+        If True, the patient state and pipeline progress are reloaded from the checkpoint left inside the output
+        folder by a previous interrupted run, and the execution continues from the first unfinished step.
+    context: RunContext
+        Run context to use, or None to configure the process-wide ResourcesConfiguration singleton from the
+        configuration file and run with it. Each run owning its context, multiple patients can be processed
+        concurrently inside the same process. The volume cache being shared by all the runs of the process, it is
+        only sized from the configuration file when no context is given, and left to the caller otherwise (see
+        get_volume_cache).
+    Returns
+    -------
+    bool
+        True if the pipeline was fully executed, False if the processing of the patient failed.
     """
-    ResourcesConfiguration.getInstance().set_environment(config_path=config_filename)
+    if context is None:
+        ResourcesConfiguration.getInstance().set_environment(config_path=config_filename)
+        context = RunContext(config=ResourcesConfiguration.getInstance())
+        # The volume cache is shared by the whole process, only sized by the runs owning the process.
+        cache_size = context.config.volume_cache_size
+        if cache_size is None:
+            cache_size = default_volume_cache_size(memory_budget=context.config.memory_budget)
+        get_volume_cache().resize(max_bytes=cache_size * 1e9)
     if logging_filename:
         # logging.basicConfig(filename=logging_filename, filemode='a',
         #                     format="%(asctime)s ; %(name)s ; %(levelname)s ; %(message)s", datefmt='%d/%m/%Y %H.%M')
@@ -23,22 +54,50 @@ def run_rads(config_filename: str, logging_filename: str = None) -> None:
         logger.setLevel(logging.DEBUG)
         logger.addHandler(handler)
 
-    logging.info("Starting pipeline for file: {}.".format(ResourcesConfiguration.getInstance().pipeline_filename))
+    with context.activate():
+        return _run_pipeline(context=context, resume=resume)
+
+
+def _run_pipeline(context: RunContext, resume: bool) -> bool:
+    logging.info("Starting pipeline for file: {}.".format(context.config.pipeline_filename))
     start = time.time()
-    pip = Pipeline(ResourcesConfiguration.getInstance().pipeline_filename)
+    pip = Pipeline(context.config.pipeline_filename, context=context)
+    patient_parameters = None
+    if resume:
+        try:
+            patient_parameters = pip.resume()
+        except Exception as e:
+            logging.warning("""[Backend warning] Resuming from the last checkpoint failed with:\n{}""".format(e))
+            logging.debug("Traceback: {}.".format(traceback.format_exc()))
+            patient_parameters = None
+        if patient_parameters is None:
+            logging.warning("No valid checkpoint could be found in {}, starting the pipeline from scratch.".format(
+                context.config.output_folder))
+            pip = Pipeline(context.config.pipeline_filename, context=context)
+
+    if patient_parameters is None:
+        try:
+            patient_parameters = PatientParameters(id="Patient", patient_filepath=context.config.input_folder,
+                                                   context=context)
+        except Exception as e:
+            logging.error("""[Backend error] Patient data setup phase of failed with:\n{}""".format(e))
+            logging.debug("Traceback: {}.".format(traceback.format_exc()))
+            return False
+        try:
+            patient_parameters = pip.setup(patient_parameters=patient_parameters)
+        except Exception as e:
+            logging.error("""[Backend error] Patient data setup phase for models in automatic selection failed with:\n{}""".format(e))
+            logging.debug("Traceback: {}.".format(traceback.format_exc()))
+            return False
     try:
-        patient_parameters = PatientParameters(id="Patient",
-                                               patient_filepath=ResourcesConfiguration.getInstance().input_folder)
+        plan = pip.plan(patient_parameters=patient_parameters)
+        if not plan["feasible"]:
+            failed_steps = [plan["steps"][x]["description"] for x in plan["steps"].keys() if plan["steps"][x]["status"] == "fail"]
+            logging.warning("""[Backend warning] Pipeline pre-flight assessment expects the required step(s) to fail: {}""".format(
+                failed_steps))
     except Exception as e:
-        logging.error("""[Backend error] Patient data setup phase of failed with:\n{}""".format(e))
+        logging.warning("""[Backend warning] Pipeline pre-flight assessment could not be performed:\n{}""".format(e))
         logging.debug("Traceback: {}.".format(traceback.format_exc()))
-        return
-    try:
-        patient_parameters = pip.setup(patient_parameters=patient_parameters)
-    except Exception as e:
-        logging.error("""[Backend error] Patient data setup phase for models in automatic selection failed with:\n{}""".format(e))
-        logging.debug("Traceback: {}.".format(traceback.format_exc()))
-        return
     try:
         patient_parameters = pip.execute(patient_parameters=patient_parameters)
         pip.cleanup()
@@ -46,8 +105,9 @@ def run_rads(config_filename: str, logging_filename: str = None) -> None:
         logging.error("""[Backend error] Patient data execution phase of failed with:\n{}""".format(e))
         logging.debug("Traceback: {}.".format(traceback.format_exc()))
         pip.cleanup()
-        return
+        return False
     logging.info('Total elapsed time for executing the pipeline: {} seconds.'.format(time.time() - start))
+    return not pip.interrupted
 
 
 def run_folder_inspection(config_filename: str, logging_filename: str = None) -> None:
@@ -57,14 +117,16 @@ def run_folder_inspection(config_filename: str, logging_filename: str = None) ->
     # @TODO. I think it should not be a stand-alone method, rather a stand-alone pipeline.json or a step inside another
     # But there's need for a way to dump/communicate the info to Raidionics.
     ResourcesConfiguration.getInstance().set_environment(config_path=config_filename)
+    context = RunContext(config=ResourcesConfiguration.getInstance())
     if logging_filename:
         logging.basicConfig(filename=logging_filename, filemode='a',
                             format="%(asctime)s ; %(name)s ; %(levelname)s ; %(message)s", datefmt='%d/%m/%Y %H.%M')
         logging.getLogger().setLevel(logging.DEBUG)
 
     try:
-        patient_parameters = PatientParameters(id="Patient",
-                                               patient_filepath=ResourcesConfiguration.getInstance().input_folder)
+        with context.activate():
+            patient_parameters = PatientParameters(id="Patient", patient_filepath=context.config.input_folder,
+                                                   context=context)
     except Exception as e:
         logging.error("""[Backend error] Patient data setup phase of failed with:\n{}""".format(e))
         logging.debug("Traceback: {}.".format(traceback.format_exc()))
@@ -80,9 +142,10 @@ def run_folder_inspection(config_filename: str, logging_filename: str = None) ->
     start = time.time()
 
     try:
-        classification = ClassificationStep(class_json)
-        classification.setup(patient_parameters)
-        patient_parameters = classification.execute()
+        classification = ClassificationStep(class_json, context=context)
+        with context.activate():
+            classification.setup(patient_parameters)
+            patient_parameters = classification.execute()
     except Exception as e:
         logging.error("""[Backend error] Classification step setup or execution phase failed with: {}""".format(e))
         logging.debug("Traceback: {}.".format(traceback.format_exc()))
@@ -90,3 +153,161 @@ def run_folder_inspection(config_filename: str, logging_filename: str = None) ->
     # @TODO. Should dump it differently, or arrange filenames for re-use in Raidionics, or return the updated
     # patient_parameters if running another real pipeline straight after.
     logging.info('Total elapsed time for executing the pipeline: {} seconds.'.format(time.time() - start))
+
+
+def run_rads_batch(config_filename: str, cohort_folder: str = None, output_folder: str = None, workers: int = 1,
+                   resume: bool = False, logging_level: int = logging.WARNING) -> dict:
+    """
+    Runs the pipeline specified in the configuration file over a cohort of patients, each patient being processed in
+    a separate worker process (with its own run context) and written in its own output sub-folder.
+    The configuration file is used as a template, its input and output folders being replaced for each patient. When
+    a memory budget is specified in the configuration, a patient is only started if its estimated peak memory fits
+    within what is left of the budget. A summary of the run is written as batch_summary.json in the output folder.
+
+    Parameters
+    ----------
+    config_filename: str
+        Filepath to the main configuration file (*.ini), used as template for all patients.
+    cohort_folder: str
+        Folder containing one sub-folder per patient. If None, the input_folder from the configuration is used.
+    output_folder: str
+        Destination folder, where one sub-folder per patient is created. If None, the output_folder from the
+        configuration is used.
+    workers: int
+        Number of patients processed concurrently.
+    resume: bool
+        If True, each patient resumes from the checkpoint left inside its output folder by a previous run.
+    logging_level: int
+        Logging level inside the worker processes.
+    Returns
+    -------
+    dict
+        Summary of the batch run, with the status and runtime of each patient.
+    """
+    import configparser
+    import json
+    import multiprocessing as mp
+    import os
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    from .Utils.memory_budget import MemoryBudget, estimate_pipeline_peak_memory
+    from .Utils.configuration_parser import get_default_threads
+
+    config = RunContext.from_config_file(config_filename).config
+    cohort_folder = cohort_folder if cohort_folder is not None else config.input_folder
+    output_folder = output_folder if output_folder is not None else config.output_folder
+    if cohort_folder is None or not os.path.isdir(cohort_folder):
+        raise ValueError("A valid cohort folder is required for running in batch mode, got: {}.".format(cohort_folder))
+    if output_folder is None:
+        raise ValueError("A destination folder is required for running in batch mode.")
+    os.makedirs(output_folder, exist_ok=True)
+
+    patients = sorted([d for d in os.listdir(cohort_folder) if os.path.isdir(os.path.join(cohort_folder, d))])
+    pipeline = {}
+    try:
+        with open(config.pipeline_filename, 'r') as infile:
+            pipeline = json.load(infile)
+    except Exception as e:
+        logging.warning("[Backend warning] Pipeline could not be loaded for the memory estimates with: {}".format(e))
+    memory_budget = MemoryBudget(total=config.memory_budget * 1e9
+                                 if config.memory_budget is not None else None)
+    estimates = {}
+    for pat in patients:
+        estimates[pat] = estimate_pipeline_peak_memory(pipeline=pipeline,
+                                                       input_folder=os.path.join(cohort_folder, pat),
+                                                       workers=config.pipeline_workers)
+
+    template = configparser.ConfigParser()
+    template.read(config_filename)
+    if not template.has_section('System'):
+        template.add_section('System')
+    # Each worker process holds its own volume cache, which must fit in the memory budget alongside the processing.
+    cache_size = config.volume_cache_size
+    if cache_size is None:
+        cache_size = default_volume_cache_size(memory_budget=config.memory_budget, processes=workers)
+        template.set('System', 'volume_cache_size', str(cache_size))
+    for pat in patients:
+        estimates[pat] = estimates[pat] + int(cache_size * 1e9)
+    # The default thread pools of each worker process share the cores with the other workers.
+    if config.compression_threads <= 0:
+        template.set('System', 'compression_threads',
+                     str(get_default_threads(concurrency=max(1, workers) * config.pipeline_workers)))
+    if config.ingestion_threads <= 0:
+        template.set('System', 'ingestion_threads', str(get_default_threads(concurrency=max(1, workers))))
+    logging.info("Starting batch processing of {} patients with {} workers.".format(len(patients), workers))
+    start = time.time()
+    results = {}
+    pending = list(patients)
+    running = {}
+    # A fresh interpreter for each worker, not inheriting the singleton state or any thread from the parent.
+    with ProcessPoolExecutor(max_workers=max(1, workers), mp_context=mp.get_context('spawn')) as executor:
+        while pending or running:
+            for pat in list(pending):
+                if len(running) >= max(1, workers) or not memory_budget.try_acquire(estimates[pat]):
+                    break
+                pending.remove(pat)
+                template.set('System', 'input_folder', os.path.join(cohort_folder, pat))
+                template.set('System', 'output_folder', os.path.join(output_folder, pat))
+                patient_config = {section: dict(template[section]) for section in template.sections()}
+                running[executor.submit(_run_batch_patient, pat, patient_config, resume, logging_level)] = pat
+            done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for f in done:
+                pat = running.pop(f)
+                memory_budget.release(estimates[pat])
+                try:
+                    results[pat] = f.result()
+                except Exception as e:
+                    # The worker process itself died (e.g., killed by the system when running out of memory).
+                    results[pat] = {"status": "failed", "wall_time": None, "error": str(e),
+                                    "output_folder": os.path.join(output_folder, pat)}
+                logging.info("Patient {} processed with status: {}.".format(pat, results[pat]["status"]))
+
+    summary = {"cohort_folder": cohort_folder, "output_folder": output_folder, "workers": workers,
+               "wall_time": time.time() - start,
+               "succeeded": sorted([p for p in results.keys() if results[p]["status"] == "succeeded"]),
+               "failed": sorted([p for p in results.keys() if results[p]["status"] != "succeeded"]),
+               "patients": {p: results[p] for p in patients if p in results.keys()}}
+    with open(os.path.join(output_folder, 'batch_summary.json'), 'w', newline='\n') as outfile:
+        json.dump(summary, outfile, indent=4)
+    logging.info("Batch processing done in {} seconds, {} succeeded and {} failed.".format(
+        summary["wall_time"], len(summary["succeeded"]), len(summary["failed"])))
+    return summary
+
+
+def _run_batch_patient(patient_id: str, patient_config: dict, resume: bool, logging_level: int) -> dict:
+    """
+    Processes a single patient of a batch run, inside a worker process. The configuration is written inside the
+    patient output folder, next to the patient log file.
+    """
+    import configparser
+    import os
+
+    output_folder = patient_config['System']['output_folder']
+    os.makedirs(output_folder, exist_ok=True)
+    config = configparser.ConfigParser()
+    config.read_dict(patient_config)
+    config_filename = os.path.join(output_folder, 'rads_config.ini')
+    with open(config_filename, 'w') as outfile:
+        config.write(outfile)
+
+    logger = logging.getLogger()
+    logger.setLevel(logging_level)
+    handler = logging.FileHandler(filename=os.path.join(output_folder, 'rads.log'), mode='a', encoding='utf-8')
+    handler.setFormatter(logging.Formatter(fmt="%(asctime)s ; %(name)s ; %(levelname)s ; %(message)s",
+                                           datefmt='%d/%m/%Y %H.%M'))
+    logger.addHandler(handler)
+    start = time.time()
+    result = {"status": "failed", "wall_time": None, "error": None, "output_folder": output_folder}
+    try:
+        if run_rads(config_filename=config_filename, resume=resume):
+            result["status"] = "succeeded"
+        else:
+            result["error"] = "Pipeline interrupted, see the patient log for details."
+    except Exception as e:
+        result["error"] = str(e)
+        logging.error("[Backend error] Processing of patient {} failed with:\n{}".format(patient_id, e))
+        logging.debug("Traceback: {}.".format(traceback.format_exc()))
+    finally:
+        result["wall_time"] = time.time() - start
+        logger.removeHandler(handler)
+        handler.close()
+    return result
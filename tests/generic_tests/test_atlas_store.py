@@ -0,0 +1,53 @@
+import os
+import pytest
+
+np = pytest.importorskip("numpy")
+nib = pytest.importorskip("nibabel")
+pytest.importorskip("pandas")
+
+from raidionicsrads.Utils.atlas_store import AtlasStore
+
+
+def _atlas(tmp_path, name):
+    labels = np.zeros((6, 7, 8), dtype=np.float32)
+    labels[1:4, 2:5, 3:6] = 2.
+    filepath = os.path.join(tmp_path, name + '.nii.gz')
+    nib.save(nib.Nifti1Image(labels, affine=np.eye(4)), filepath)
+    return filepath, labels
+
+
+def test_atlas_store_failure_is_scoped_to_the_call(tmp_path):
+    store = AtlasStore(root=os.path.join(tmp_path, 'store'))
+    tract_fn, _ = _atlas(tmp_path, 'AF_left')
+    structures = {'Singular': {'AF_left': tract_fn, 'CST_right': os.path.join(tmp_path, 'missing.nii.gz')},
+                  'Bundle': None, 'BundleIndex': None}
+    bundle = store.load_tract_bundle(structures)
+    assert not bundle.packed
+    assert store.enabled
+
+    # Later atlases are still served from the store
+    atlas_fn, labels = _atlas(tmp_path, 'cortical')
+    image, mask = store.load_mask(atlas_fn)
+    assert os.path.exists(store.entry_filepath(atlas_fn, 'mask'))
+    assert mask.dtype == np.uint8 and not mask.flags.writeable
+    assert np.array_equal(mask, labels.astype(np.uint8))
+
+    # An unreadable atlas falls back to the decompression, which then reports the error itself
+    broken_fn = os.path.join(tmp_path, 'broken.nii.gz')
+    with open(broken_fn, 'wb') as outfile:
+        outfile.write(b'not a nifti file')
+    with pytest.raises(Exception):
+        store.load_mask(broken_fn)
+    assert store.enabled
+
+
+def test_atlas_store_unwritable_folder(tmp_path):
+    # A file in place of the store folder, such that it cannot be created whatever the permissions
+    root = os.path.join(tmp_path, 'store')
+    with open(root, 'w') as outfile:
+        outfile.write('')
+    store = AtlasStore(root=root)
+    atlas_fn, labels = _atlas(tmp_path, 'cortical')
+    image, mask = store.load_mask(atlas_fn)
+    assert not store.enabled
+    assert np.array_equal(mask, labels.astype(np.uint8))
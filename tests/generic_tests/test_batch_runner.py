@@ -0,0 +1,66 @@
+import configparser
+import json
+import os
+import pytest
+
+np = pytest.importorskip("numpy")
+nib = pytest.importorskip("nibabel")
+pytest.importorskip("pandas")
+pytest.importorskip("SimpleITK")
+pytest.importorskip("aenum")
+
+from raidionicsrads.compute import run_rads_batch
+
+
+def _batch_config(tmp_path, cohort_folder):
+    pipeline_fn = os.path.join(tmp_path, 'pipeline.json')
+    with open(pipeline_fn, 'w') as outfile:
+        json.dump({}, outfile)
+    rads_config = configparser.ConfigParser()
+    rads_config.add_section('Default')
+    rads_config.set('Default', 'task', 'neuro_diagnosis')
+    rads_config.set('Default', 'caller', '')
+    rads_config.add_section('System')
+    rads_config.set('System', 'gpu_id', "-1")
+    rads_config.set('System', 'input_folder', cohort_folder)
+    rads_config.set('System', 'output_folder', os.path.join(tmp_path, 'outputs'))
+    rads_config.set('System', 'model_folder', os.path.join(tmp_path, 'models'))
+    rads_config.set('System', 'pipeline_filename', pipeline_fn)
+    rads_config.set('System', 'memory_budget', '1')
+    config_fn = os.path.join(tmp_path, 'rads_config.ini')
+    with open(config_fn, 'w') as outfile:
+        rads_config.write(outfile)
+    return config_fn
+
+
+def test_batch_runner_cohort(tmp_path):
+    cohort_folder = os.path.join(tmp_path, 'cohort')
+    rng = np.random.default_rng(0)
+    for pat in ['Patient2', 'Patient1']:
+        os.makedirs(os.path.join(cohort_folder, pat, 'T0'))
+        nib.save(nib.Nifti1Image((rng.random((8, 8, 8)) * 1000.).astype(np.float32), affine=np.eye(4)),
+                 os.path.join(cohort_folder, pat, 'T0', 'T1.nii.gz'))
+    config_fn = _batch_config(tmp_path, cohort_folder)
+
+    summary = run_rads_batch(config_filename=config_fn, workers=2)
+    output_folder = os.path.join(tmp_path, 'outputs')
+    assert summary["output_folder"] == output_folder
+    assert list(summary["patients"].keys()) == ['Patient1', 'Patient2']
+    assert sorted(summary["succeeded"] + summary["failed"]) == ['Patient1', 'Patient2']
+    with open(os.path.join(output_folder, 'batch_summary.json'), 'r') as infile:
+        assert json.load(infile)["patients"].keys() == summary["patients"].keys()
+
+    # Each patient runs from its own configuration, writing in its own output folder
+    for pat in ['Patient1', 'Patient2']:
+        patient_config = configparser.ConfigParser()
+        patient_config.read(os.path.join(output_folder, pat, 'rads_config.ini'))
+        assert patient_config.get('System', 'input_folder') == os.path.join(cohort_folder, pat)
+        assert patient_config.get('System', 'output_folder') == os.path.join(output_folder, pat)
+        assert summary["patients"][pat]["output_folder"] == os.path.join(output_folder, pat)
+        assert os.path.exists(os.path.join(output_folder, pat, 'rads.log'))
+
+
+def test_batch_runner_missing_cohort(tmp_path):
+    config_fn = _batch_config(tmp_path, os.path.join(tmp_path, 'missing'))
+    with pytest.raises(ValueError):
+        run_rads_batch(config_filename=config_fn)
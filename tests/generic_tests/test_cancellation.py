@@ -0,0 +1,78 @@
+import math
+import sys
+import time
+import pytest
+from raidionicsrads.Utils.cancellation import CancellationToken, start_process_group
+
+
+def test_token_explicit_cancellation():
+    token = CancellationToken()
+    assert not token.is_cancelled()
+    assert not token.has_deadline()
+    assert token.remaining() is None
+    token.check()
+    token.cancel(reason="Patient aborted.")
+    assert token.is_cancelled()
+    assert not token.is_timed_out()
+    assert token.reason == "Patient aborted."
+    with pytest.raises(ValueError):
+        token.check()
+
+
+def test_token_deadline():
+    token = CancellationToken(timeout=0.05)
+    assert token.has_deadline()
+    assert 0. <= token.remaining() <= 0.05
+    time.sleep(0.1)
+    assert token.is_cancelled()
+    assert token.is_timed_out()
+    assert token.remaining() == 0.
+
+
+def test_token_parent_propagation():
+    parent = CancellationToken(timeout=60)
+    child = CancellationToken(timeout=120, parent=parent)
+    assert child.remaining() <= 60
+    parent.cancel(reason="Parent cancelled.")
+    assert child.is_cancelled()
+    assert not child.is_timed_out()
+    assert child.reason == "Parent cancelled."
+    # Cancelling a child leaves its parent untouched
+    other_parent = CancellationToken()
+    other_child = CancellationToken(parent=other_parent)
+    other_child.cancel()
+    assert not other_parent.is_cancelled()
+
+
+def test_token_run():
+    token = CancellationToken()
+    assert token.run(max, 1, 2) == 2
+    token.cancel()
+    with pytest.raises(ValueError):
+        token.run(max, 1, 2)
+
+
+def test_token_run_process():
+    token = CancellationToken(timeout=60)
+    assert token.run_process(math.sqrt, 16.) == 4.
+    with pytest.raises(RuntimeError):
+        token.run_process(math.sqrt, -1.)
+
+    token = CancellationToken(timeout=1)
+    start = time.monotonic()
+    with pytest.raises(ValueError):
+        token.run_process(time.sleep, 30)
+    assert time.monotonic() - start < 20
+
+
+def test_token_wait_process():
+    token = CancellationToken(timeout=60)
+    popen = start_process_group([sys.executable, '-c', 'print("done")'], stdout=-1)
+    output, _ = token.wait_process(popen)
+    assert output.strip() == b"done"
+
+    token = CancellationToken(timeout=0.5)
+    popen = start_process_group([sys.executable, '-c', 'import time; time.sleep(30)'])
+    with pytest.raises(ValueError):
+        token.wait_process(popen)
+    assert popen.poll() is not None
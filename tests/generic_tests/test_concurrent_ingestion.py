@@ -0,0 +1,68 @@
+import os
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from raidionicsrads.Utils.configuration_parser import ResourcesConfiguration, share_threads
+from raidionicsrads.Utils.run_context import RunContext
+
+
+def test_thread_pools_share_the_cores():
+    config = ResourcesConfiguration(standalone=True)
+    config.pipeline_workers = 1
+    assert config.get_threads(8) == 8
+    assert config.get_threads(0) >= 1
+
+    def nested_threads(_):
+        return config.get_threads(8)
+
+    # Pools created from the workers of another pool are divided by its size
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        assert list(executor.map(share_threads(nested_threads, 4), range(4))) == [2] * 4
+        assert list(executor.map(share_threads(share_threads(nested_threads, 2), 2), range(2))) == [2] * 2
+        assert list(executor.map(share_threads(nested_threads, 16), range(2))) == [1] * 2
+    # The calling thread is left untouched
+    assert config.get_threads(8) == 8
+
+
+def _ingest(tmp_path, threads):
+    config = ResourcesConfiguration(standalone=True)
+    config.diagnosis_task = 'neuro_diagnosis'
+    config.input_folder = os.path.join(tmp_path, 'inputs')
+    config.output_folder = os.path.join(tmp_path, 'outputs{}'.format(threads))
+    config.ingestion_threads = threads
+    os.makedirs(config.output_folder)
+    context = RunContext(config=config)
+    from raidionicsrads.Utils.DataStructures.PatientStructure import PatientParameters
+    with context.activate():
+        return PatientParameters(id="Patient", patient_filepath=config.input_folder, context=context)
+
+
+def test_concurrent_ingestion_matches_sequential(tmp_path):
+    np = pytest.importorskip("numpy")
+    nib = pytest.importorskip("nibabel")
+    pytest.importorskip("pandas")
+    pytest.importorskip("SimpleITK")
+    pytest.importorskip("aenum")
+
+    rng = np.random.default_rng(0)
+    labels = np.zeros((8, 8, 8), dtype=np.uint8)
+    labels[2:5, 2:5, 2:5] = 1
+    for ts in ['T0', 'T1', 'T2']:
+        os.makedirs(os.path.join(tmp_path, 'inputs', ts))
+        for name in ['T1', 'T1ce', 'FLAIR', 'T2']:
+            nib.save(nib.Nifti1Image((rng.random((8, 8, 8)) * 1000.).astype(np.float32), affine=np.eye(4)),
+                     os.path.join(tmp_path, 'inputs', ts, name + '.nii.gz'))
+        nib.save(nib.Nifti1Image(labels, affine=np.eye(4)),
+                 os.path.join(tmp_path, 'inputs', ts, 'T1ce_label_Tumor.nii.gz'))
+
+    sequential = _ingest(tmp_path, threads=1)
+    concurrent = _ingest(tmp_path, threads=8)
+    # Same patient state, in the same order, whatever the threads scheduling
+    assert list(concurrent.radiological_volumes.keys()) == list(sequential.radiological_volumes.keys())
+    assert list(concurrent.annotation_volumes.keys()) == list(sequential.annotation_volumes.keys())
+    for uid, volume in sequential.radiological_volumes.items():
+        other = concurrent.radiological_volumes[uid]
+        assert other.raw_input_filepath == volume.raw_input_filepath
+        assert other.timestamp_uid == volume.timestamp_uid
+        assert other.get_sequence_type_str() == volume.get_sequence_type_str()
+    for uid, annotation in sequential.annotation_volumes.items():
+        assert concurrent.annotation_volumes[uid].radiological_volume_uid == annotation.radiological_volume_uid
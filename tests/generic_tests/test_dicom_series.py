@@ -0,0 +1,70 @@
+import os
+import pytest
+
+np = pytest.importorskip("numpy")
+nib = pytest.importorskip("nibabel")
+sitk = pytest.importorskip("SimpleITK")
+pytest.importorskip("pandas")
+
+from raidionicsrads.Utils.dicom_series import is_dicom_series_folder, read_series_metadata, dicom_series_name, \
+    convert_dicom_series, _series_dtype
+
+
+def _write_series(folder, volume):
+    os.makedirs(folder)
+    writer = sitk.ImageFileWriter()
+    writer.KeepOriginalImageUIDOn()
+    for i in range(volume.GetDepth()):
+        image_slice = volume[:, :, i]
+        image_slice.SetMetaData("0008|0060", "MR")
+        image_slice.SetMetaData("0020|000e", "1.2.826.0.1.3680043.2.1125.1.1")
+        image_slice.SetMetaData("0008|103e", "T1 GD axial")
+        image_slice.SetMetaData("0020|0037", "1\\0\\0\\0\\1\\0")
+        image_slice.SetMetaData("0020|0032", "\\".join([str(x) for x in
+                                                       volume.TransformIndexToPhysicalPoint((0, 0, i))]))
+        image_slice.SetMetaData("0020|0013", str(i + 1))
+        writer.SetFileName(os.path.join(folder, 'slice{:03d}.dcm'.format(i)))
+        writer.Execute(image_slice)
+
+
+def _volume():
+    rng = np.random.default_rng(0)
+    volume = sitk.GetImageFromArray(rng.integers(0, 2000, size=(12, 10, 9)).astype(np.int16))
+    volume.SetSpacing((0.5, 0.5, 2.))
+    volume.SetOrigin((-10., 20., 5.))
+    return volume
+
+
+def test_dicom_series_conversion(tmp_path):
+    volume = _volume()
+    folder = os.path.join(tmp_path, 'series')
+    _write_series(folder, volume)
+    assert is_dicom_series_folder(folder)
+    assert not is_dicom_series_folder(str(tmp_path))
+    metadata = read_series_metadata(folder)
+    assert len(metadata["Files"]) == 12 and metadata["Modality"] == "MR"
+    assert dicom_series_name(folder, metadata=metadata) == "T1_GD_axial"
+
+    for fn, threads in [('series.nii.gz', 4), ('series.nii', 1)]:
+        image = nib.load(convert_dicom_series(folder, os.path.join(tmp_path, fn), threads=threads))
+        data = np.asanyarray(image.dataobj)
+        assert data.dtype == np.int16
+        assert np.array_equal(data, sitk.GetArrayFromImage(volume).T)
+        assert np.allclose(image.header.get_zooms(), (0.5, 0.5, 2.))
+        # From the LPS convention of DICOM to the RAS convention of NIfTI
+        assert np.allclose(image.affine[:3, 3], (10., -20., 5.))
+
+
+def test_dicom_series_missing_slice(tmp_path):
+    folder = os.path.join(tmp_path, 'series')
+    _write_series(folder, _volume())
+    os.remove(os.path.join(folder, 'slice005.dcm'))
+    with pytest.raises(ValueError):
+        convert_dicom_series(folder, os.path.join(tmp_path, 'series.nii.gz'), threads=2)
+
+
+def test_dicom_series_dtype():
+    assert _series_dtype([sitk.sitkInt16, sitk.sitkInt16]) == np.int16
+    assert _series_dtype([sitk.sitkUInt8, sitk.sitkInt16]) == np.int16
+    assert _series_dtype([sitk.sitkInt16, sitk.sitkFloat64]) == np.float32
+    assert _series_dtype([sitk.sitkUInt32, sitk.sitkInt32]) == np.float32
@@ -0,0 +1,90 @@
+import pickle
+from raidionicsrads.Utils.DataStructures.IndexedCollection import IndexedCollection
+
+
+class _Element:
+    _owner = None  # IndexedCollection holding the instance, as for the patient structures
+
+    def __init__(self, timestamp, sequence):
+        self.timestamp = timestamp
+        self.sequence = sequence
+        self._owner = None
+
+    def set_sequence(self, sequence):
+        self.sequence = sequence
+        if self._owner is not None:
+            self._owner.reindex(self)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_owner', None)
+        return state
+
+
+def _timestamp_key(element):
+    return [element.timestamp]
+
+
+def _timestamp_sequence_key(element):
+    return [(element.timestamp, element.sequence)]
+
+
+_INDEXES = {'timestamp': _timestamp_key, 'timestamp_sequence': _timestamp_sequence_key}
+
+
+def _collection():
+    collection = IndexedCollection(_INDEXES)
+    collection['V2'] = _Element('T0', 'FLAIR')
+    collection['V1'] = _Element('T0', 'T1-CE')
+    collection['V3'] = _Element('T1', 'T1-CE')
+    return collection
+
+
+def test_indexed_collection_insert():
+    collection = _collection()
+    assert list(collection.keys()) == ['V2', 'V1', 'V3']
+    # Lookups in insertion order
+    assert collection.lookup('timestamp', 'T0') == ['V2', 'V1']
+    assert collection.lookup_first('timestamp', 'T0') == 'V2'
+    assert collection.lookup('timestamp_sequence', ('T1', 'T1-CE')) == ['V3']
+    assert collection.lookup('timestamp', 'T2') == []
+    assert collection.lookup_first('timestamp', 'T2') is None
+    assert collection['V1']._owner is collection
+
+
+def test_indexed_collection_replace_and_remove():
+    collection = _collection()
+    previous = collection['V1']
+    collection['V1'] = _Element('T1', 'FLAIR')
+    assert collection.lookup('timestamp', 'T0') == ['V2']
+    # A replaced instance keeps its insertion rank
+    assert collection.lookup('timestamp', 'T1') == ['V1', 'V3']
+
+    del collection['V2']
+    assert collection.lookup('timestamp', 'T0') == []
+    removed = collection.pop('V3')
+    assert removed._owner is None
+    assert collection.lookup('timestamp_sequence', ('T1', 'T1-CE')) == []
+    assert collection.pop('V3', None) is None
+    # Changes of a detached instance are not seen by the collection anymore
+    previous.set_sequence('T2')
+    assert collection.lookup('timestamp_sequence', ('T0', 'T2')) == []
+    collection.clear()
+    assert len(collection) == 0 and collection.lookup('timestamp', 'T1') == []
+
+
+def test_indexed_collection_reindex():
+    collection = _collection()
+    collection['V1'].set_sequence('T2')
+    assert collection.lookup('timestamp_sequence', ('T0', 'T1-CE')) == []
+    assert collection.lookup('timestamp_sequence', ('T0', 'T2')) == ['V1']
+    assert collection.lookup('timestamp', 'T0') == ['V2', 'V1']
+
+
+def test_indexed_collection_pickle():
+    collection = pickle.loads(pickle.dumps(_collection()))
+    assert list(collection.keys()) == ['V2', 'V1', 'V3']
+    assert collection.lookup('timestamp', 'T0') == ['V2', 'V1']
+    assert collection['V3']._owner is collection
+    collection['V3'].set_sequence('FLAIR')
+    assert collection.lookup('timestamp_sequence', ('T1', 'FLAIR')) == ['V3']
@@ -0,0 +1,49 @@
+import os
+import pytest
+
+np = pytest.importorskip("numpy")
+nib = pytest.importorskip("nibabel")
+sitk = pytest.importorskip("SimpleITK")
+pytest.importorskip("pandas")
+pytest.importorskip("aenum")
+
+from raidionicsrads.Utils.utilities import input_file_category_disambiguation
+
+
+def _save(data, filepath):
+    nib.save(nib.Nifti1Image(data, affine=np.eye(4)), filepath)
+    return filepath
+
+
+def test_category_from_voxel_values(tmp_path):
+    rng = np.random.default_rng(0)
+    volume = (rng.random((20, 20, 20)) * 1000.).astype(np.float32)
+    assert input_file_category_disambiguation(_save(volume, os.path.join(tmp_path, 'volume.nii.gz'))) == "Volume"
+
+    labels = np.zeros((20, 20, 20), dtype=np.uint8)
+    labels[5:10, 5:10, 5:10] = 1
+    labels[12:15, 12:15, 12:15] = 2
+    assert input_file_category_disambiguation(_save(labels, os.path.join(tmp_path, 'labels.nii.gz'))) == \
+        "Annotation"
+
+
+def test_category_float_mask(tmp_path):
+    # Binary masks written as floats (e.g., by ANTs, FSL, or a resampling) are annotations
+    mask = np.zeros((20, 20, 20), dtype=np.float32)
+    mask[4:12, 4:12, 4:12] = 1.
+    for fn in ['mask.nii.gz', 'mask.nii']:
+        assert input_file_category_disambiguation(_save(mask, os.path.join(tmp_path, fn))) == "Annotation"
+    mha_fn = os.path.join(tmp_path, 'mask.mha')
+    sitk.WriteImage(sitk.GetImageFromArray(mask), mha_fn)
+    assert input_file_category_disambiguation(mha_fn) == "Annotation"
+
+
+def test_category_full_read_fallback(tmp_path):
+    # Values missed by the strided sample still identify a radiological volume
+    data = np.zeros((20, 20, 20), dtype=np.int16)
+    data[1, 1, 1] = 2000
+    fn = _save(data, os.path.join(tmp_path, 'sparse.nii.gz'))
+    assert input_file_category_disambiguation(fn, sample_size=100) == "Volume"
+    mha_fn = os.path.join(tmp_path, 'sparse.mha')
+    sitk.WriteImage(sitk.GetImageFromArray(data), mha_fn)
+    assert input_file_category_disambiguation(mha_fn, sample_size=100) == "Volume"
@@ -0,0 +1,58 @@
+import os
+import pytest
+
+np = pytest.importorskip("numpy")
+nib = pytest.importorskip("nibabel")
+pytest.importorskip("pandas")
+
+from raidionicsrads.Utils.io import mask_dtype, mask_array, intensity_array, save_mask, save_intensities, \
+    load_mask, load_intensities
+
+
+def test_mask_dtype():
+    assert mask_dtype(np.zeros((0,), dtype=np.int64)) == np.uint8
+    assert mask_dtype(np.array([True, False])) == np.uint8
+    assert mask_dtype(np.array([0, 1, 255], dtype=np.int64)) == np.uint8
+    assert mask_dtype(np.array([0., 1., 2.], dtype=np.float64)) == np.uint8
+    assert mask_dtype(np.array([0, 256, 65535], dtype=np.int64)) == np.uint16
+    assert mask_dtype(np.array([0, 65536], dtype=np.int64)) == np.int32
+    assert mask_dtype(np.array([-1, 1], dtype=np.int16)) == np.int32
+
+
+def test_mask_and_intensity_arrays():
+    affine = np.eye(4)
+    labels = np.array([[[0., 0.9], [2.1, 3.]]], dtype=np.float64)
+    mask = mask_array(nib.Nifti1Image(labels, affine=affine))
+    assert mask.dtype == np.uint8
+    assert mask.tolist() == [[[0, 1], [2, 3]]]
+    assert mask.flags.writeable
+
+    values = np.array([[[-1024, 12], [300, 4000]]], dtype=np.int16)
+    intensities = intensity_array(nib.Nifti1Image(values, affine=affine))
+    assert intensities.dtype == np.float32
+    assert np.array_equal(intensities, values.astype(np.float32))
+
+
+def test_save_and_load(tmp_path):
+    affine = np.diag([0.5, 0.5, 2., 1.])
+    labels = np.zeros((4, 5, 6), dtype=np.float64)
+    labels[1:3, 1:4, 2:5] = 1.
+    labels[0, 0, 0] = 300.
+    mask_fn = save_mask(labels, affine, os.path.join(tmp_path, 'labels.nii.gz'))
+    assert nib.load(mask_fn).get_data_dtype() == np.uint16
+    image, mask = load_mask(mask_fn)
+    assert mask.dtype == np.uint16
+    assert np.array_equal(mask, labels.astype(np.uint16))
+    assert np.allclose(image.affine, affine)
+
+    data = np.linspace(-1., 1., 120, dtype=np.float64).reshape((4, 5, 6))
+    intensity_fn = save_intensities(data, affine, os.path.join(tmp_path, 'intensities.nii.gz'))
+    assert nib.load(intensity_fn).get_data_dtype() == np.float32
+    image, intensities = load_intensities(intensity_fn)
+    assert intensities.dtype == np.float32
+    assert np.allclose(intensities, data, atol=1e-6)
+
+    # Integer intensities are stored in their own data type
+    data = np.arange(120, dtype=np.int16).reshape((4, 5, 6))
+    intensity_fn = save_intensities(data, affine, os.path.join(tmp_path, 'intensities_int.nii'))
+    assert nib.load(intensity_fn).get_data_dtype() == np.int16
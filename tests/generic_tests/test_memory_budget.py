@@ -0,0 +1,86 @@
+import threading
+import time
+from types import SimpleNamespace
+from raidionicsrads.Pipelines.PipelineScheduler import PipelineScheduler
+from raidionicsrads.Utils.memory_budget import MemoryBudget, estimate_peak_memory, estimate_patient_peak_memory, \
+    record_peak_memory
+
+
+def test_memory_budget_admission():
+    budget = MemoryBudget(total=10)
+    assert budget.try_acquire(6)
+    assert not budget.try_acquire(5)
+    assert budget.try_acquire(4)
+    assert budget.used == 10
+    budget.release(6)
+    assert budget.try_acquire(5)
+    budget.release(5)
+    budget.release(4)
+    assert budget.used == 0
+
+    # Larger than the whole budget, only admitted alone
+    assert budget.try_acquire(20)
+    assert not budget.try_acquire(1)
+    budget.release(20)
+
+    unlimited = MemoryBudget(total=None)
+    assert unlimited.total is None and unlimited.try_acquire(1e15) and unlimited.try_acquire(1e15)
+
+
+def test_memory_budget_acquire_waits_for_release():
+    budget = MemoryBudget(total=10)
+    assert budget.try_acquire(8)
+    assert not budget.acquire(5, timeout=0.05)
+    releaser = threading.Timer(0.05, budget.release, args=(8,))
+    releaser.start()
+    assert budget.acquire(5, timeout=5.)
+    releaser.join()
+    assert budget.used == 5
+
+
+def test_memory_estimates():
+    assert estimate_peak_memory("Unknown task", 0) == estimate_peak_memory("default", 0)
+    assert estimate_peak_memory("Segmentation", 1000) > estimate_peak_memory("Segmentation", 10)
+    # A learned profile never goes below the declared one
+    declared = estimate_peak_memory("Test task", 1000000)
+    record_peak_memory("Test task", 1000000, 1)
+    assert estimate_peak_memory("Test task", 1000000) >= declared
+    assert estimate_patient_peak_memory([3, 1, 2], workers=2) == 5
+    assert estimate_patient_peak_memory([], workers=2) == 0
+
+
+def test_scheduler_memory_admission():
+    def volume(sequence):
+        return {"timestamp": 0, "sequence": sequence, "labels": None, "space": {"timestamp": 0, "sequence": sequence}}
+
+    steps = {"0": SimpleNamespace(step_json={"task": "Registration", "moving": volume("T1-CE"),
+                                             "fixed": {"timestamp": -1, "sequence": "MNI"}}),
+             "1": SimpleNamespace(step_json={"task": "Registration", "moving": volume("FLAIR"),
+                                             "fixed": {"timestamp": -1, "sequence": "MNI"}}),
+             "2": SimpleNamespace(step_json={"task": "Registration", "moving": volume("T2"),
+                                             "fixed": {"timestamp": -1, "sequence": "MNI"}})}
+    lock = threading.Lock()
+    state = {"running": 0, "peak": 0}
+
+    def run_step(s):
+        with lock:
+            state["running"] = state["running"] + 1
+            state["peak"] = max(state["peak"], state["running"])
+        time.sleep(0.05)
+        with lock:
+            state["running"] = state["running"] - 1
+        return True
+
+    budget = MemoryBudget(total=10)
+    scheduler = PipelineScheduler(steps=steps, max_workers=3, memory_budget=budget,
+                                  memory_estimates={"0": 6, "1": 6, "2": 6})
+    assert all(len(d) == 0 for d in scheduler.dependencies.values())
+    assert scheduler.run(run_step)
+    # Independent steps, but only one fits within the budget at a time
+    assert state["peak"] == 1 and budget.used == 0
+
+    scheduler = PipelineScheduler(steps=steps, max_workers=3, memory_budget=MemoryBudget(total=20),
+                                  memory_estimates={"0": 6, "1": 6, "2": 6})
+    state["peak"] = 0
+    assert scheduler.run(run_step)
+    assert state["peak"] == 3
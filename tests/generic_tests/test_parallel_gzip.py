@@ -0,0 +1,46 @@
+import gzip
+import io
+import os
+from raidionicsrads.Utils.parallel_gzip import write_gzip, compress_file
+
+
+def _content(size):
+    return bytes([(i * 7 + i // 251) % 256 for i in range(size)])
+
+
+def test_parallel_gzip_round_trip(tmp_path):
+    content = _content(300000)
+    for threads in [1, 4]:
+        for block_size in [1000, 65536, 1 << 20]:
+            dst = os.path.join(tmp_path, 'content_{}_{}.gz'.format(threads, block_size))
+            write_gzip(content, dst, threads=threads, block_size=block_size)
+            with gzip.open(dst, 'rb') as infile:
+                assert infile.read() == content
+
+
+def test_parallel_gzip_file_object_and_empty(tmp_path):
+    content = _content(100000)
+    dst = os.path.join(tmp_path, 'stream.gz')
+    write_gzip(io.BytesIO(content), dst, threads=3, block_size=4096)
+    with gzip.open(dst, 'rb') as infile:
+        assert infile.read() == content
+
+    dst = os.path.join(tmp_path, 'empty.gz')
+    write_gzip(b'', dst, threads=2)
+    with gzip.open(dst, 'rb') as infile:
+        assert infile.read() == b''
+
+
+def test_parallel_gzip_deterministic(tmp_path):
+    src = os.path.join(tmp_path, 'content.bin')
+    with open(src, 'wb') as outfile:
+        outfile.write(_content(200000))
+    outputs = []
+    for threads in [1, 2, 8]:
+        dst = os.path.join(tmp_path, 'content_{}.bin.gz'.format(threads))
+        compress_file(src, dst, threads=threads)
+        with open(dst, 'rb') as infile:
+            outputs.append(infile.read())
+    # Identical files whatever the number of threads, with no modification time in the headers
+    assert outputs[0] == outputs[1] == outputs[2]
+    assert outputs[0][4:8] == bytes(4)
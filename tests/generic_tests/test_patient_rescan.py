@@ -0,0 +1,71 @@
+import os
+import pytest
+
+np = pytest.importorskip("numpy")
+nib = pytest.importorskip("nibabel")
+pytest.importorskip("pandas")
+pytest.importorskip("SimpleITK")
+pytest.importorskip("aenum")
+
+from raidionicsrads.Utils.configuration_parser import ResourcesConfiguration
+from raidionicsrads.Utils.run_context import RunContext
+from raidionicsrads.Utils.DataStructures.PatientStructure import PatientParameters
+
+
+def _save_volume(rng, shape, filepath):
+    nib.save(nib.Nifti1Image((rng.random(shape) * 1000.).astype(np.float32), affine=np.eye(4)), filepath)
+
+
+def _patient_context(tmp_path, rng):
+    folder = os.path.join(tmp_path, 'inputs', 'T0')
+    os.makedirs(folder)
+    labels = np.zeros((8, 8, 8), dtype=np.uint8)
+    labels[2:5, 2:5, 2:5] = 1
+    for name in ['T1', 'FLAIR']:
+        _save_volume(rng, (8, 8, 8), os.path.join(folder, name + '.nii.gz'))
+    nib.save(nib.Nifti1Image(labels, affine=np.eye(4)), os.path.join(folder, 'T1_label_Tumor.nii.gz'))
+
+    config = ResourcesConfiguration(standalone=True)
+    config.diagnosis_task = 'neuro_diagnosis'
+    config.input_folder = os.path.join(tmp_path, 'inputs')
+    config.output_folder = os.path.join(tmp_path, 'outputs')
+    config.patient_snapshot = True
+    os.makedirs(config.output_folder)
+    return RunContext(config=config)
+
+
+def _uid_of(patient, filename):
+    return [uid for uid, volume in patient.radiological_volumes.items()
+            if os.path.basename(volume.raw_input_filepath) == filename][0]
+
+
+def test_patient_rescan_invalidation(tmp_path):
+    rng = np.random.default_rng(0)
+    context = _patient_context(tmp_path, rng)
+    with context.activate():
+        patient = PatientParameters(id="Patient", patient_filepath=context.config.input_folder, context=context)
+        report = patient.rescan()
+        assert not report["full"]
+        assert report["changed"] == [] and report["invalidated"]["radiological_volumes"] == []
+
+        t1_uid = _uid_of(patient, 'T1.nii.gz')
+        flair_uid = _uid_of(patient, 'FLAIR.nii.gz')
+        annotation_uid = list(patient.annotation_volumes.keys())[0]
+        t1_filepath = patient.radiological_volumes[t1_uid].raw_input_filepath
+
+        _save_volume(rng, (8, 8, 9), t1_filepath)
+        report = patient.rescan()
+
+    assert not report["full"]
+    assert report["changed"] == [t1_filepath]
+    assert report["invalidated"]["radiological_volumes"] == [t1_uid]
+    assert report["invalidated"]["annotations"] == [annotation_uid]
+    assert os.path.exists(patient.rescan_filepath)
+
+    # The unchanged volume is kept, the changed one ingested again with its annotation
+    assert flair_uid in patient.radiological_volumes
+    new_t1_uid = _uid_of(patient, 'T1.nii.gz')
+    assert new_t1_uid != t1_uid and new_t1_uid in report["ingested"]["radiological_volumes"]
+    assert len(patient.annotation_volumes) == 1
+    annotation = list(patient.annotation_volumes.values())[0]
+    assert annotation.radiological_volume_uid == new_t1_uid
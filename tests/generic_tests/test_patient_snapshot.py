@@ -0,0 +1,49 @@
+import logging
+import os
+import pytest
+
+np = pytest.importorskip("numpy")
+nib = pytest.importorskip("nibabel")
+pytest.importorskip("pandas")
+pytest.importorskip("SimpleITK")
+pytest.importorskip("aenum")
+
+from raidionicsrads.Utils.configuration_parser import ResourcesConfiguration
+from raidionicsrads.Utils.run_context import RunContext
+from raidionicsrads.Utils.DataStructures.PatientStructure import PatientParameters
+
+
+def _patient_context(tmp_path):
+    rng = np.random.default_rng(0)
+    folder = os.path.join(tmp_path, 'inputs', 'T0')
+    os.makedirs(folder)
+    labels = np.zeros((8, 8, 8), dtype=np.uint8)
+    labels[2:5, 2:5, 2:5] = 1
+    for name in ['T1', 'FLAIR']:
+        nib.save(nib.Nifti1Image((rng.random((8, 8, 8)) * 1000.).astype(np.float32), affine=np.eye(4)),
+                 os.path.join(folder, name + '.nii.gz'))
+    nib.save(nib.Nifti1Image(labels, affine=np.eye(4)), os.path.join(folder, 'T1_label_Tumor.nii.gz'))
+
+    config = ResourcesConfiguration(standalone=True)
+    config.diagnosis_task = 'neuro_diagnosis'
+    config.input_folder = os.path.join(tmp_path, 'inputs')
+    config.output_folder = os.path.join(tmp_path, 'outputs')
+    config.patient_snapshot = True
+    os.makedirs(config.output_folder)
+    return RunContext(config=config)
+
+
+def test_patient_snapshot_reload(tmp_path, caplog):
+    context = _patient_context(tmp_path)
+    with context.activate():
+        patient = PatientParameters(id="Patient", patient_filepath=context.config.input_folder, context=context)
+    assert os.path.exists(patient.snapshot_filepath)
+
+    with caplog.at_level(logging.INFO):
+        with context.activate():
+            reloaded = PatientParameters(id="Patient", patient_filepath=context.config.input_folder,
+                                         context=context)
+    assert "Patient state reloaded" in caplog.text
+    assert reloaded.context is context
+    assert list(reloaded.radiological_volumes.keys()) == list(patient.radiological_volumes.keys())
+    assert list(reloaded.annotation_volumes.keys()) == list(patient.annotation_volumes.keys())
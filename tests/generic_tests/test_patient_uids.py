@@ -0,0 +1,78 @@
+import os
+import pytest
+
+np = pytest.importorskip("numpy")
+nib = pytest.importorskip("nibabel")
+pytest.importorskip("pandas")
+pytest.importorskip("SimpleITK")
+pytest.importorskip("aenum")
+
+from raidionicsrads.Utils.configuration_parser import ResourcesConfiguration
+from raidionicsrads.Utils.run_context import RunContext
+from raidionicsrads.Utils.DataStructures.PatientStructure import PatientParameters, generate_uid
+
+
+def test_generate_uid_determinism():
+    uid = generate_uid('V', os.path.join('T0', 'T1.nii.gz'), timestamp_uid='T0', role='input', content_digest='abc',
+                       suffix='T1')
+    assert uid.startswith('V') and uid.endswith('_T1')
+    assert uid == generate_uid('V', os.path.join('T0', 'T1.nii.gz'), timestamp_uid='T0', role='input',
+                               content_digest='abc', suffix='T1')
+    # The relative paths are identical across platforms
+    assert uid == generate_uid('V', 'T0/T1.nii.gz', timestamp_uid='T0', role='input', content_digest='abc',
+                               suffix='T1')
+    assert uid != generate_uid('V', 'T0/T1.nii.gz', timestamp_uid='T0', role='input', content_digest='abd',
+                               suffix='T1')
+    assert uid != generate_uid('V', 'T0/T1.nii.gz', timestamp_uid='T1', role='input', content_digest='abc',
+                               suffix='T1')
+    # A collision is resolved by salting the hash, the same way every time
+    salted = generate_uid('V', 'T0/T1.nii.gz', timestamp_uid='T0', role='input', content_digest='abc',
+                          suffix='T1', taken={uid})
+    assert salted != uid
+    assert salted == generate_uid('V', 'T0/T1.nii.gz', timestamp_uid='T0', role='input', content_digest='abc',
+                                  suffix='T1', taken={uid})
+
+
+def _save(data, filepath):
+    nib.save(nib.Nifti1Image(data, affine=np.eye(4)), filepath)
+
+
+def _context(tmp_path, output_name):
+    config = ResourcesConfiguration(standalone=True)
+    config.diagnosis_task = 'neuro_diagnosis'
+    config.input_folder = os.path.join(tmp_path, 'inputs')
+    config.output_folder = os.path.join(tmp_path, output_name)
+    os.makedirs(config.output_folder)
+    return RunContext(config=config)
+
+
+def test_patient_uids_and_parents(tmp_path):
+    rng = np.random.default_rng(0)
+    labels = np.zeros((8, 8, 8), dtype=np.uint8)
+    labels[2:5, 2:5, 2:5] = 1
+    for ts in ['T0', 'T1']:
+        os.makedirs(os.path.join(tmp_path, 'inputs', ts))
+        for name in ['T1', 'T1ce', 'a1']:
+            _save((rng.random((8, 8, 8)) * 1000.).astype(np.float32),
+                  os.path.join(tmp_path, 'inputs', ts, name + '.nii.gz'))
+    _save(labels, os.path.join(tmp_path, 'inputs', 'T0', 'T1_label_Tumor.nii.gz'))
+    _save(labels, os.path.join(tmp_path, 'inputs', 'T1', 'a1_label_Tumor.nii.gz'))
+
+    patients = []
+    for output_name in ['outputs0', 'outputs1']:
+        context = _context(tmp_path, output_name)
+        with context.activate():
+            patients.append(PatientParameters(id="Patient", patient_filepath=context.config.input_folder,
+                                              context=context))
+    # Same uids for the same data, whatever the run
+    assert list(patients[0].radiological_volumes.keys()) == list(patients[1].radiological_volumes.keys())
+    assert list(patients[0].annotation_volumes.keys()) == list(patients[1].annotation_volumes.keys())
+
+    # Each annotation is attached to the volume of its timestamp with the exact same base filename
+    patient = patients[0]
+    assert len(patient.annotation_volumes) == 2
+    for annotation in patient.annotation_volumes.values():
+        volume = patient.radiological_volumes[annotation.radiological_volume_uid]
+        base_name = os.path.basename(annotation.raw_input_filepath).split('_label')[0]
+        assert os.path.basename(volume.raw_input_filepath) == base_name + '.nii.gz'
+        assert os.path.dirname(volume.raw_input_filepath) == os.path.dirname(annotation.raw_input_filepath)
@@ -0,0 +1,54 @@
+import json
+import os
+import threading
+import pytest
+from raidionicsrads.Utils.performance_metrics import PerformanceMonitor, bind_current_record, count_io
+
+
+class _Step:
+    step_description = "test step"
+
+    def get_task(self):
+        return "Segmentation"
+
+
+def test_performance_monitor_records(tmp_path):
+    monitor = PerformanceMonitor()
+    with monitor.measure("execute", "1", _Step()) as record:
+        count_io("nifti_loads")
+        count_io("nifti_saves")
+        count_io("nifti_saves")
+        sum(range(100000))
+    # Outside of a measured step, nothing is counted
+    count_io("nifti_loads")
+    assert record["status"] == "completed"
+    assert record["task"] == "Segmentation" and record["description"] == "test step"
+    assert record["nifti_loads"] == 1 and record["nifti_saves"] == 2
+    assert record["wall_time"] > 0. and record["cpu_time"] >= 0. and record["peak_rss"] >= 0
+
+    with pytest.raises(ValueError):
+        with monitor.measure("execute", "2", _Step()):
+            raise ValueError("step failure")
+    assert monitor.records["execute"]["2"]["status"] == "failed"
+
+    totals = monitor.compute_totals()
+    assert totals["nifti_loads"] == 1 and totals["nifti_saves"] == 2
+    metrics_fn = os.path.join(tmp_path, 'metrics.json')
+    monitor.dump(metrics_fn, patient_id="Patient")
+    with open(metrics_fn, 'r') as infile:
+        metrics = json.load(infile)
+    assert metrics["patient"] == "Patient" and list(metrics["execute"].keys()) == ["1", "2"]
+    assert metrics["totals"]["nifti_saves"] == 2
+
+
+def test_performance_monitor_worker_threads():
+    monitor = PerformanceMonitor()
+    with monitor.measure("execute", "1", _Step()) as record:
+        # Counted for the step only when bound to it
+        workers = [threading.Thread(target=bind_current_record(count_io), args=("nifti_loads",)),
+                   threading.Thread(target=count_io, args=("nifti_loads",))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    assert record["nifti_loads"] == 1
@@ -0,0 +1,54 @@
+import os
+from raidionicsrads.Pipelines.PipelineCheckpoint import PipelineCheckpoint
+
+
+class _Patient:
+    def __init__(self):
+        self.volumes = []
+
+
+def test_checkpoint_resume_after_abort(tmp_path):
+    checkpoint = PipelineCheckpoint(output_folder=str(tmp_path))
+    checkpoint.pipeline_json = {"1": {"task": "Segmentation"}, "2": {"task": "Registration"}, "3": {"task": "Apply"}}
+    patient = _Patient()
+    checkpoint.save(patient)
+    assert checkpoint.exists() and checkpoint.completed_steps == []
+
+    checkpoint.start("1")
+    patient.volumes.append("V1")
+    checkpoint.save(patient, "1")
+    assert checkpoint.completed_steps == ["1"]
+
+    # The partial changes of an interrupted step are never stored
+    checkpoint.start("2")
+    patient.volumes.append("partial")
+    checkpoint.abort("2")
+    checkpoint.save(patient, "3")
+
+    resumed = PipelineCheckpoint(output_folder=str(tmp_path))
+    restored = resumed.load()
+    assert restored.volumes == ["V1"]
+    assert resumed.pipeline_json == checkpoint.pipeline_json
+    assert resumed.is_completed("1") and not resumed.is_completed("2") and not resumed.is_completed("3")
+
+    resumed.clear()
+    assert not resumed.exists() and resumed.load() is None
+    assert not os.path.exists(resumed.checkpoint_folder)
+
+
+def test_checkpoint_parallel_steps(tmp_path):
+    checkpoint = PipelineCheckpoint(output_folder=str(tmp_path))
+    patient = _Patient()
+    checkpoint.start("1")
+    checkpoint.start("2")
+    patient.volumes.append("V1")
+    checkpoint.save(patient, "1")
+    # Not stored while another step is running
+    assert not checkpoint.exists() and checkpoint.completed_steps == []
+
+    patient.volumes.append("V2")
+    checkpoint.save(patient, "2")
+    assert checkpoint.completed_steps == ["1", "2"]
+    resumed = PipelineCheckpoint(output_folder=str(tmp_path))
+    assert resumed.load().volumes == ["V1", "V2"]
+    assert resumed.completed_steps == ["1", "2"]
@@ -0,0 +1,74 @@
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("nibabel")
+pytest.importorskip("pandas")
+pytest.importorskip("SimpleITK")
+pytest.importorskip("aenum")
+
+from raidionicsrads.Pipelines.PipelinePlanner import PipelinePlanner
+
+
+class _Config:
+    predictions_use_registered_data = False
+
+
+class _Context:
+    config = _Config()
+
+
+class _Patient:
+    """
+    Patient with a single T1-CE volume at the first timestamp, without any annotation or registration.
+    """
+    context = _Context()
+
+    def get_radiological_volume_uid(self, timestamp, sequence):
+        return "V1" if str(timestamp) == "0" and str(sequence) == "T1-CE" else "-1"
+
+    def get_all_annotations_uids_class_radiological_volume(self, volume_uid, annotation_class):
+        return []
+
+    def get_all_annotations_radiological_volume(self, volume_uid):
+        return []
+
+    def get_registration_by_json(self, fixed, moving):
+        return None
+
+
+def _entry(timestamp, sequence, labels=None):
+    return {"timestamp": timestamp, "sequence": sequence, "labels": labels}
+
+
+def test_planner_patient_data_and_planned_outputs():
+    planner = PipelinePlanner(patient_parameters=_Patient())
+    assert planner.has_volume(_entry(0, "T1-CE"))
+    assert not planner.has_volume(_entry(1, "T1-CE"))
+    assert planner.has_volume(_entry(-1, "MNI"))
+    assert not planner.has_annotation(_entry(0, "T1-CE"), "Tumor")
+
+    # Outputs declared by the previous steps are available to the following ones
+    planner.produce(('annotation', 0, 'T1-CE', 'Tumor'))
+    assert planner.has_annotation(_entry(0, "T1-CE"), "Tumor")
+    assert planner.get_annotation_labels(_entry(0, "T1-CE")) == ['Tumor']
+    assert not planner.has_registration(moving=_entry(0, "T1-CE"), fixed=_entry(-1, "MNI"))
+    planner.produce(('registration', 0, 'T1-CE', -1, 'MNI'))
+    assert planner.has_registration(moving=_entry(0, "T1-CE"), fixed=_entry(-1, "MNI"))
+    assert not planner.has_registered_volume(_entry(0, "T1-CE"), _entry(-1, "MNI"), "Tumor")
+    planner.produce(('registered', 0, 'T1-CE', 'Tumor', -1, 'MNI'))
+    assert planner.has_registered_volume(_entry(0, "T1-CE"), _entry(-1, "MNI"), "Tumor")
+
+
+def test_planner_assess_input():
+    planner = PipelinePlanner(patient_parameters=_Patient())
+    assert planner.assess_input(_entry(0, "T1-CE")) is None
+    assert planner.assess_input(_entry(1, "FLAIR")).startswith("No radiological volume")
+    assert planner.assess_input(_entry(0, "T1-CE", labels="Tumor")).startswith("No annotation")
+    planner.produce(('annotation', 0, 'T1-CE', 'Tumor'))
+    assert planner.assess_input(_entry(0, "T1-CE", labels="Tumor")) is None
+
+    entry = _entry(0, "T1-CE", labels="Tumor")
+    entry["space"] = _entry(-1, "MNI")
+    assert planner.assess_input(entry).startswith("No registered volume")
+    planner.produce(('registered', 0, 'T1-CE', 'Tumor', -1, 'MNI'))
+    assert planner.assess_input(entry) is None
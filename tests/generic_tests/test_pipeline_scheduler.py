@@ -0,0 +1,71 @@
+import threading
+from types import SimpleNamespace
+from raidionicsrads.Pipelines.PipelineScheduler import PipelineScheduler, get_step_footprint
+
+
+def _step(**step_json):
+    return SimpleNamespace(step_json=step_json)
+
+
+def _volume(timestamp, sequence):
+    return {"timestamp": timestamp, "sequence": sequence, "labels": None, "space": {"timestamp": timestamp,
+                                                                                   "sequence": sequence}}
+
+
+def _pipeline():
+    return {"1": _step(task="Classification"),
+            "2": _step(task="Registration", moving=_volume(0, "T1-CE"), fixed=_volume(-1, "MNI")),
+            "3": _step(task="Registration", moving=_volume(0, "FLAIR"), fixed=_volume(-1, "MNI")),
+            "4": _step(task="Segmentation", inputs={"0": _volume(0, "T1-CE")}),
+            "5": _step(task="Segmentation", inputs={"0": _volume(0, "FLAIR")}),
+            "6": _step(task="Features computation", timestamp=0)}
+
+
+def test_scheduler_dependencies():
+    scheduler = PipelineScheduler(steps=_pipeline(), max_workers=4)
+    assert scheduler.dependencies["1"] == set()
+    # Registrations of different sequences are independent, only waiting for the classification barrier
+    assert scheduler.dependencies["2"] == {"1"}
+    assert scheduler.dependencies["3"] == {"1"}
+    # A segmentation writes to the volume read by the registration of the same sequence only
+    assert scheduler.dependencies["4"] == {"1", "2"}
+    # Segmentations share their working folder
+    assert scheduler.dependencies["5"] == {"1", "3", "4"}
+    # The features are computed on all the annotations of the timestamp
+    assert scheduler.dependencies["6"] == {"1", "4", "5"}
+
+
+def test_scheduler_unknown_footprint_is_barrier():
+    assert get_step_footprint({"task": "Segmentation"}) == ({"*"}, {"*"})
+    assert get_step_footprint({"task": "Model selection"}) == ({"*"}, {"*"})
+
+
+def test_scheduler_runs_steps_after_dependencies():
+    scheduler = PipelineScheduler(steps=_pipeline(), max_workers=3)
+    lock = threading.Lock()
+    completed = set()
+    started = []
+
+    def run_step(s):
+        with lock:
+            assert scheduler.dependencies[s].issubset(completed)
+            started.append(s)
+        with lock:
+            completed.add(s)
+        return True
+
+    assert scheduler.run(run_step)
+    assert sorted(started) == ["1", "2", "3", "4", "5", "6"]
+
+
+def test_scheduler_interrupts_on_failure():
+    scheduler = PipelineScheduler(steps=_pipeline(), max_workers=2)
+    started = []
+
+    def run_step(s):
+        started.append(s)
+        return s != "2"
+
+    assert not scheduler.run(run_step)
+    # The steps depending on the failed one are never started
+    assert "4" not in started and "5" not in started and "6" not in started
@@ -0,0 +1,52 @@
+import os
+import time
+from raidionicsrads.Utils.result_cache import ResultCache
+
+
+def _write(filepath, content):
+    with open(filepath, 'wb') as outfile:
+        outfile.write(content)
+    return filepath
+
+
+def test_result_cache_hit_and_miss(tmp_path):
+    cache = ResultCache(cache_folder=os.path.join(tmp_path, 'cache'), max_size=1e9)
+    input_fn = _write(os.path.join(tmp_path, 'input.nii.gz'), b'input')
+    output_fn = _write(os.path.join(tmp_path, 'output.nii.gz'), b'output')
+    step = {"task": "Segmentation", "inputs": {"0": {"timestamp": 0, "sequence": "T1-CE"}}, "target": ["Tumor"]}
+    key = ResultCache.compute_key(step, [input_fn], runtime_parameters={"device": "cpu"})
+
+    assert cache.lookup(key) is None
+    assert cache.restore(key, os.path.join(tmp_path, 'restored')) is None
+    cache.store(key, files={'predictions/output.nii.gz': output_fn}, metadata={"labels": ["Tumor"]})
+
+    manifest = cache.restore(key, os.path.join(tmp_path, 'restored'))
+    assert manifest["metadata"] == {"labels": ["Tumor"]}
+    restored_fn = manifest["restored"]['predictions/output.nii.gz']
+    with open(restored_fn, 'rb') as infile:
+        assert infile.read() == b'output'
+
+    # Same content under another name is a hit, a new content or other parameters a miss
+    same_fn = _write(os.path.join(tmp_path, 'copy.nii.gz'), b'input')
+    assert ResultCache.compute_key(step, [same_fn], runtime_parameters={"device": "cpu"}) == key
+    assert ResultCache.compute_key(step, [same_fn], runtime_parameters={"device": "gpu"}) != key
+    _write(input_fn, b'changed')
+    assert ResultCache.compute_key(step, [input_fn], runtime_parameters={"device": "cpu"}) != key
+
+
+def test_result_cache_lru_eviction(tmp_path):
+    cache = ResultCache(cache_folder=os.path.join(tmp_path, 'cache'), max_size=2500)
+    keys = []
+    for i in range(3):
+        content_fn = _write(os.path.join(tmp_path, 'content{}.bin'.format(i)), bytes(1000))
+        keys.append(ResultCache.compute_key({"step": i}, [content_fn]))
+        cache.store(keys[-1], files={'content.bin': content_fn})
+        if i == 1:
+            # Using the first entry makes the second one the least recently used
+            time.sleep(0.05)
+            assert cache.lookup(keys[0]) is not None
+        time.sleep(0.05)
+
+    assert cache.lookup(keys[0]) is not None
+    assert cache.lookup(keys[1]) is None
+    assert cache.lookup(keys[2]) is not None
@@ -0,0 +1,61 @@
+import copy
+import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from raidionicsrads.Utils.configuration_parser import ResourcesConfiguration
+from raidionicsrads.Utils.run_context import RunContext
+from raidionicsrads.Utils.result_cache import ResultCache
+
+
+def _context(output_folder):
+    config = ResourcesConfiguration(standalone=True)
+    config.output_folder = output_folder
+    return RunContext(config=config)
+
+
+def test_context_activation():
+    first = _context('/tmp/first')
+    second = _context('/tmp/second')
+    with first.activate():
+        assert ResourcesConfiguration.getInstance() is first.config
+        with second.activate():
+            assert ResourcesConfiguration.getInstance().output_folder == '/tmp/second'
+        assert ResourcesConfiguration.getInstance().output_folder == '/tmp/first'
+        # Worker threads only see the context they are bound to
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            assert executor.submit(second.bind(lambda: ResourcesConfiguration.getInstance().output_folder)).result() \
+                   == '/tmp/second'
+    assert RunContext.resolve(first) is first
+
+
+def test_concurrent_contexts():
+    contexts = [_context('/tmp/patient{}'.format(i)) for i in range(4)]
+    barrier = threading.Barrier(len(contexts))
+
+    def run(context):
+        barrier.wait()
+        return ResourcesConfiguration.getInstance().output_folder
+
+    with ThreadPoolExecutor(max_workers=len(contexts)) as executor:
+        outputs = list(executor.map(lambda c: c.bind(run)(c), contexts))
+    assert outputs == [c.config.output_folder for c in contexts]
+
+
+def test_context_copy_and_pickle():
+    context = _context('/tmp/first')
+    assert copy.copy(context).config is context.config
+    reloaded = pickle.loads(pickle.dumps(context))
+    # A pickled context carries its own configuration, never the one active when reloading
+    with _context('/tmp/second').activate():
+        assert pickle.loads(pickle.dumps(context)).config.output_folder == '/tmp/first'
+    assert reloaded.config.output_folder == '/tmp/first'
+
+
+def test_result_cache_from_context(tmp_path):
+    context = _context(str(tmp_path))
+    assert ResultCache.from_configuration(config=context.config) is None
+    context.config.results_cache_folder = str(tmp_path)
+    context.config.results_cache_max_size = 1.
+    with _context('/tmp/other').activate():
+        cache = ResultCache.from_configuration(config=context.config)
+    assert cache is not None and cache.cache_folder == str(tmp_path)
@@ -0,0 +1,54 @@
+import gzip
+import os
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("nibabel")
+pytest.importorskip("pandas")
+
+from raidionicsrads.Utils.io import stage_file
+
+
+def _failing(*args, **kwargs):
+    raise OSError("Operation not permitted")
+
+
+def _source(tmp_path):
+    src = os.path.join(tmp_path, 'T1.nii.gz')
+    with open(src, 'wb') as outfile:
+        outfile.write(gzip.compress(b'volume content'))
+    return src
+
+
+def test_stage_file_hard_link(tmp_path):
+    src = _source(tmp_path)
+    dst = stage_file(src, os.path.join(tmp_path, 'input0.nii.gz'))
+    assert os.path.samefile(src, dst) and not os.path.islink(dst)
+    # An existing destination is replaced
+    assert stage_file(src, dst) == dst and os.path.samefile(src, dst)
+
+
+def test_stage_file_symlink_fallback(tmp_path, monkeypatch):
+    src = _source(tmp_path)
+    monkeypatch.setattr(os, 'link', _failing)
+    dst = stage_file(src, os.path.join(tmp_path, 'input0.nii.gz'))
+    assert os.path.islink(dst) and os.readlink(dst) == os.path.abspath(src)
+
+
+def test_stage_file_copy_fallback(tmp_path, monkeypatch):
+    src = _source(tmp_path)
+    monkeypatch.setattr(os, 'link', _failing)
+    monkeypatch.setattr(os, 'symlink', _failing)
+    dst = stage_file(src, os.path.join(tmp_path, 'input0.nii.gz'))
+    assert not os.path.islink(dst) and not os.path.samefile(src, dst)
+    with open(src, 'rb') as infile, open(dst, 'rb') as staged:
+        assert infile.read() == staged.read()
+
+
+def test_stage_file_compresses_intermediate_format(tmp_path):
+    src = os.path.join(tmp_path, 'T1.nii')
+    with open(src, 'wb') as outfile:
+        outfile.write(b'volume content')
+    dst = stage_file(src, os.path.join(tmp_path, 'input0.nii.gz'))
+    with gzip.open(dst, 'rb') as infile:
+        assert infile.read() == b'volume content'
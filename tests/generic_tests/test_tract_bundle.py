@@ -0,0 +1,35 @@
+import os
+import pytest
+
+np = pytest.importorskip("numpy")
+nib = pytest.importorskip("nibabel")
+pytest.importorskip("pandas")
+
+from raidionicsrads.Utils.atlas_store import TractBundle, pack_tract_bundle
+
+
+def test_tract_bundle_threshold_equivalence(tmp_path):
+    rng = np.random.default_rng(0)
+    affine = np.diag([1., 1., 1., 1.])
+    edges = np.array([0., 1., 0.5, np.nextafter(np.float32(0.5), np.float32(0.)),
+                      np.nextafter(np.float32(0.5), np.float32(1.)), 0.49, 0.51, 127.5 / 255, 128.5 / 255],
+                     dtype=np.float32)
+    tracts = {}
+    for name in ['AF_left', 'CST_right', 'IFOF_left']:
+        probabilities = rng.random((8, 9, 10), dtype=np.float32)
+        probabilities.flat[:len(edges)] = edges
+        tracts[name] = os.path.join(tmp_path, name + '.nii.gz')
+        nib.save(nib.Nifti1Image(probabilities, affine=affine), tracts[name])
+
+    bundle_fn = pack_tract_bundle(tracts, os.path.join(tmp_path, 'bundle.nii'), os.path.join(tmp_path, 'bundle.json'))
+    packed = TractBundle.open(bundle_fn, os.path.join(tmp_path, 'bundle.json'))
+    singular = TractBundle(tracts=tracts)
+    assert packed.packed and not singular.packed
+    assert packed.names == list(tracts.keys())
+    for name in tracts.keys():
+        packed_mask, packed_spacing = packed.mask(name, 0.5)
+        singular_mask, singular_spacing = singular.mask(name, 0.5)
+        assert packed_mask.dtype == np.uint8 and singular_mask.dtype == np.uint8
+        # Exact at a cutoff of 0.5, including the probabilities right around it
+        assert np.array_equal(packed_mask, singular_mask)
+        assert np.allclose(packed_spacing, singular_spacing)
@@ -0,0 +1,60 @@
+import os
+import pytest
+
+np = pytest.importorskip("numpy")
+nib = pytest.importorskip("nibabel")
+
+from raidionicsrads.Utils.volume_cache import VolumeCache
+
+
+def _save(data, filepath):
+    nib.save(nib.Nifti1Image(data, affine=np.eye(4)), filepath)
+    return filepath
+
+
+def test_volume_cache_eviction(tmp_path):
+    rng = np.random.default_rng(0)
+    filepaths = [_save(rng.random((8, 8, 8)).astype(np.float32), os.path.join(tmp_path, name + '.nii.gz'))
+                 for name in ['a', 'b', 'c']]
+    # Room for two volumes of 2048 bytes
+    cache = VolumeCache(max_bytes=5000)
+    cache.load(filepaths[0])
+    cache.load(filepaths[1])
+    assert cache.misses == 2 and cache.size == 4096
+    cache.load(filepaths[0])
+    assert cache.hits == 1
+
+    # The least recently used volume is evicted first
+    cache.load(filepaths[2])
+    assert cache.size == 4096
+    cache.load(filepaths[0])
+    assert cache.hits == 2
+    cache.load(filepaths[1])
+    assert cache.misses == 4
+
+    # A file rewritten on disk is never served from a stale entry
+    data = rng.random((8, 8, 9)).astype(np.float32)
+    _save(data, filepaths[1])
+    assert np.array_equal(np.asanyarray(cache.load(filepaths[1]).dataobj), data)
+
+    cache.resize(max_bytes=0)
+    assert cache.size == 0
+    cache.load(filepaths[0])
+    assert cache.size == 0
+
+
+def test_volume_cache_copy_on_write(tmp_path):
+    data = np.arange(512, dtype=np.int16).reshape((8, 8, 8))
+    filepath = _save(data, os.path.join(tmp_path, 'labels.nii.gz'))
+    cache = VolumeCache(max_bytes=1e6)
+    first = np.asanyarray(cache.load(filepath).dataobj)
+    second = np.asanyarray(cache.load(filepath).dataobj)
+    assert cache.hits == 1
+    assert second.dtype == np.int16 and np.array_equal(second, data)
+
+    # In-place edits stay private to each caller
+    first[...] = 0
+    second[0, 0, 0] = -1
+    third = np.asanyarray(cache.load(filepath).dataobj)
+    assert np.array_equal(third, data)
+    assert second[0, 0, 0] == -1 and np.array_equal(second.flat[1:], data.flat[1:])